@@ -0,0 +1,194 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+"""Admission control by database
+
+A slow database must not block all the threads of the process: the number
+of requests in progress by database is limited by ``--admission-limit``.
+The next requests wait in a bounded queue (``--admission-queue``) during
+``--admission-timeout`` seconds, then the server answers ``503`` with
+``Retry-After``. The tween is the first one, before the transaction and the
+registry of the request.
+"""
+import time
+from threading import Condition, Lock
+from anyblok.config import Configuration
+from pyramid.httpexceptions import HTTPServiceUnavailable
+from pyramid.tweens import INGRESS
+from .metrics import Metric, add_metrics_collector
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+_CONTROL = {}
+
+
+class DatabaseAdmission:
+    """Requests in progress and in the queue of one database
+
+    :param limit: maximum number of requests in progress
+    :param queue_size: maximum number of requests waiting
+    :param timeout: maximum wait in the queue, in seconds
+    """
+
+    def __init__(self, limit, queue_size=0, timeout=0):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.shed = 0
+        self.condition = Condition(Lock())
+
+    def acquire(self):
+        """Return True if the request can be handled, else it is shed"""
+        with self.condition:
+            if self.active < self.limit:
+                return self.admit()
+
+            if self.waiting >= self.queue_size:
+                self.shed += 1
+                return False
+
+            self.waiting += 1
+            try:
+                stop = time.monotonic() + self.timeout
+                while self.active >= self.limit:
+                    remaining = stop - time.monotonic()
+                    if remaining <= 0:
+                        self.shed += 1
+                        return False
+
+                    self.condition.wait(remaining)
+
+                return self.admit()
+            finally:
+                self.waiting -= 1
+
+    def admit(self):
+        self.active += 1
+        self.admitted += 1
+        return True
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+
+class AdmissionControl:
+    """``DatabaseAdmission`` by db name, created at the first request
+
+    :param limit: maximum number of requests in progress by database
+    :param queue_size: maximum number of requests waiting by database
+    :param timeout: maximum wait in the queue, in seconds
+    :param retry_after: value of the ``Retry-After`` header of the 503
+    :param exclude: prefixes of the paths which are not limited
+    """
+
+    def __init__(self, limit, queue_size=0, timeout=0, retry_after=5,
+                 exclude=None):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.exclude = tuple(exclude or ())
+        self.databases = {}
+        self.lock = Lock()
+
+    def get(self, db_name):
+        admission = self.databases.get(db_name)
+        if admission is None:
+            with self.lock:
+                admission = self.databases.get(db_name)
+                if admission is None:
+                    admission = DatabaseAdmission(
+                        self.limit, queue_size=self.queue_size,
+                        timeout=self.timeout)
+                    self.databases[db_name] = admission
+
+        return admission
+
+    def is_excluded(self, request):
+        return bool(self.exclude) and request.path.startswith(self.exclude)
+
+    def collect(self):
+        """Metrics collector"""
+        databases = sorted(self.databases.items())
+        yield Metric('anyblok_pyramid_admission_active',
+                     'Requests in progress', 'gauge',
+                     [({'db_name': db}, x.active) for db, x in databases])
+        yield Metric('anyblok_pyramid_admission_queue',
+                     'Requests waiting in the queue', 'gauge',
+                     [({'db_name': db}, x.waiting) for db, x in databases])
+        yield Metric('anyblok_pyramid_admission_admitted_total',
+                     'Requests admitted', 'counter',
+                     [({'db_name': db}, x.admitted) for db, x in databases])
+        yield Metric('anyblok_pyramid_admission_shed_total',
+                     'Requests answered by 503', 'counter',
+                     [({'db_name': db}, x.shed) for db, x in databases])
+
+
+def admission_tween_factory(handler, registry):
+    control = registry.anyblok_admission
+
+    def admission_tween(request):
+        if control.is_excluded(request):
+            return handler(request)
+
+        db_name = Configuration.get('get_db_name')(request)
+        admission = control.get(db_name)
+        if not admission.acquire():
+            logger.warning('The database %r is saturated, %s %s is shed',
+                           db_name, request.method, request.path)
+            return HTTPServiceUnavailable(
+                headers={'Retry-After': str(control.retry_after)})
+
+        try:
+            return handler(request)
+        finally:
+            admission.release()
+
+    return admission_tween
+
+
+def get_admission_control():
+    """Return the ``AdmissionControl`` of the process, created at the
+    first call, None if ``--admission-limit`` is not defined
+    """
+    limit = Configuration.get('admission_limit')
+    if not limit:
+        return None
+
+    control = _CONTROL.get('control')
+    if control is None:
+        control = _CONTROL.setdefault('control', AdmissionControl(
+            limit, queue_size=Configuration.get('admission_queue', 0),
+            timeout=Configuration.get('admission_timeout', 0),
+            retry_after=Configuration.get('admission_retry_after', 5),
+            exclude=Configuration.get('admission_exclude')))
+        add_metrics_collector(control.collect)
+
+    return control
+
+
+def admission(config):
+    """Pyramid includeme, add the admission control if
+    ``--admission-limit`` is defined
+
+    :param config: Pyramid configurator instance
+    """
+    control = get_admission_control()
+    if control is None:
+        return
+
+    config.registry.anyblok_admission = control
+    # under the resolution of the tenant, if any
+    config.add_tween('anyblok_pyramid.admission.admission_tween_factory',
+                     under=('anyblok_pyramid.tenant.tenant_tween_factory',
+                            INGRESS))
@@ -0,0 +1,345 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+"""Tenant-affine workers of gunicorn
+
+With ``--tenant-affinity-port``, the databases of ``--databases`` are
+shared between the slots of the workers by consistent hashing, each worker
+preloads only the databases of its slot::
+
+    gunicorn_anyblok_pyramid --databases db1 db2 db3 db4 -w 4 \\
+        --get-db-name-plugin anyblok_pyramid.tenant:get_db_name \\
+        --tenant-affinity-port 9100
+
+The worker of the slot ``n`` also serves the port ``9100 + n`` on the
+loopback. A request received by a worker for a database of another slot is
+forwarded to this port, so the registry of a database is only loaded by
+the workers of its slot. The workers of the same slot share the port
+(``SO_REUSEPORT``), during a rolling reload the new worker of a slot serves
+it with the old one.
+
+The forwarded requests carry a token given by the arbiter and the database
+resolved by the worker which received them, they are never forwarded
+again. When the worker of the slot does not answer, the request
+is served by the worker which received it.
+"""
+import hmac
+import os
+import socket
+from binascii import hexlify
+from bisect import bisect
+from collections import Counter
+from hashlib import md5
+from http.client import HTTPConnection
+from shutil import copyfileobj
+from tempfile import SpooledTemporaryFile
+from threading import Lock, Thread
+from anyblok.config import Configuration
+from pyramid.httpexceptions import HTTPBadGateway, HTTPForbidden
+from pyramid.request import Request
+from .common import get_database_names
+from .metrics import (Metric, add_metrics_collector,
+                      remove_metrics_collector)
+from .server import AnyBlokWSGIRequestHandler, ThreadPoolWSGIServer
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+SLOT_ENV = 'ANYBLOK_PYRAMID_AFFINITY_SLOT'
+TOKEN_ENV = 'ANYBLOK_PYRAMID_AFFINITY_TOKEN'
+TOKEN_HEADER = 'X-AnyBlok-Affinity-Token'
+REMOTE_ADDR_HEADER = 'X-AnyBlok-Remote-Addr'
+SCHEME_HEADER = 'X-AnyBlok-Url-Scheme'
+SCRIPT_NAME_HEADER = 'X-AnyBlok-Script-Name'
+DB_NAME_HEADER = 'X-AnyBlok-Db-Name'
+HOP_BY_HOP = ('connection', 'keep-alive', 'proxy-authenticate',
+              'proxy-authorization', 'te', 'trailers', 'transfer-encoding',
+              'upgrade')
+CHUNK_SIZE = 65536
+SPOOL_SIZE = 1024 * 1024
+
+
+def environ_key(header):
+    return 'HTTP_' + header.upper().replace('-', '_')
+
+
+AFFINITY_KEYS = tuple(environ_key(x) for x in (
+    TOKEN_HEADER, REMOTE_ADDR_HEADER, SCHEME_HEADER, SCRIPT_NAME_HEADER,
+    DB_NAME_HEADER))
+
+
+class HashRing:
+    """Consistent hashing of the names on the slots, adding a slot moves
+    only the names given to it
+
+    :param slots: list of the slots
+    :param replicas: points of each slot on the ring
+    """
+
+    def __init__(self, slots, replicas=64):
+        points = sorted((self.hash('%s-%d' % (slot, index)), slot)
+                        for slot in slots for index in range(replicas))
+        self.keys = [x[0] for x in points]
+        self.slots = [x[1] for x in points]
+
+    @staticmethod
+    def hash(value):
+        return int(md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+    def get_slot(self, name):
+        """Return the slot of the name"""
+        index = bisect(self.keys, self.hash(name)) % len(self.keys)
+        return self.slots[index]
+
+
+def assign_slot(arbiter, worker):
+    """Give the least used slot to the worker, called by the arbiter before
+    the fork, the slot and the token are given to the worker by the
+    environment
+    """
+    if not arbiter.cfg.tenant_affinity_port:
+        return
+
+    if TOKEN_ENV not in os.environ:
+        os.environ[TOKEN_ENV] = hexlify(os.urandom(16)).decode('ascii')
+
+    used = Counter(getattr(x, 'anyblok_slot', None)
+                   for x in arbiter.WORKERS.values())
+    worker.anyblok_slot = min(range(arbiter.cfg.workers),
+                              key=lambda slot: (used[slot], slot))
+    os.environ[SLOT_ENV] = str(worker.anyblok_slot)
+
+
+class AffinityServer(ThreadPoolWSGIServer):
+    """Server of the forwarded requests, the workers of a slot share its
+    port
+    """
+
+    def server_bind(self):
+        if hasattr(socket, 'SO_REUSEPORT'):
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        super(AffinityServer, self).server_bind()
+
+
+class ForwardedResponse:
+    """Body of the response of the worker of the slot, the connection is
+    closed at the end
+    """
+
+    def __init__(self, connection, response):
+        self.connection = connection
+        self.response = response
+
+    def __iter__(self):
+        while True:
+            data = self.response.read(CHUNK_SIZE)
+            if not data:
+                break
+
+            yield data
+
+    def close(self):
+        self.response.close()
+        self.connection.close()
+
+
+class TenantAffinity:
+    """Route the requests to the worker of the slot of their database
+
+    :param slot: slot of this worker
+    :param slots: number of slots
+    :param port: port of the slot 0, the slot n serves ``port + n``
+    :param token: secret of the forwarded requests
+    :param host: host of the ports of the slots
+    :param timeout: seconds to wait the worker of the slot
+    :param threads: threads of the server of the forwarded requests, they
+        are added to the threads of the worker
+    """
+
+    def __init__(self, slot, slots, port, token, host='127.0.0.1',
+                 timeout=None, threads=1):
+        self.slot = slot
+        self.ring = HashRing(range(slots))
+        self.port = port
+        self.token = token
+        self.host = host
+        self.timeout = timeout
+        self.threads = max(threads, 1)
+        self.app = None
+        self.server = None
+        self.counters = Counter()
+        self.lock = Lock()
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def get_database_names(self):
+        """Return the databases of the slot of this worker"""
+        return [x for x in get_database_names()
+                if self.ring.get_slot(x) == self.slot]
+
+    def start(self, app):
+        """Serve the forwarded requests on the port of the slot, return the
+        WSGI application which routes the requests
+        """
+        self.app = app
+        self.server = AffinityServer(
+            (self.host, self.port + self.slot), AnyBlokWSGIRequestHandler,
+            threads=self.threads)
+        self.server.set_app(self.serve_forwarded)
+        Thread(target=self.server.serve_forever, name='anyblok-affinity',
+               daemon=True).start()
+        add_metrics_collector(self.collect)
+        logger.info("Slot %d of the tenant affinity on the port %d",
+                    self.slot, self.port + self.slot)
+        return self.route
+
+    def stop(self):
+        if self.server is not None:
+            remove_metrics_collector(self.collect)
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def route(self, environ, start_response):
+        """WSGI application, forward the request if its database is given
+        to another slot
+        """
+        request = Request(environ)
+        db_name = Configuration.get('get_db_name')(request)
+        if not db_name:
+            return self.serve(environ, start_response)
+
+        slot = self.ring.get_slot(db_name)
+        if slot == self.slot:
+            return self.serve(environ, start_response)
+
+        return self.forward(slot, request, start_response, db_name)
+
+    def serve(self, environ, start_response):
+        self.count('local')
+        return self.app(environ, start_response)
+
+    def serve_forwarded(self, environ, start_response):
+        """WSGI application of the port of the slot"""
+        token = environ.get(environ_key(TOKEN_HEADER), '')
+        if not hmac.compare_digest(token.encode('latin-1'),
+                                   self.token.encode('latin-1')):
+            self.count('forbidden')
+            return HTTPForbidden()(environ, start_response)
+
+        environ['REMOTE_ADDR'] = environ.get(
+            environ_key(REMOTE_ADDR_HEADER), environ.get('REMOTE_ADDR'))
+        environ['wsgi.url_scheme'] = environ.get(
+            environ_key(SCHEME_HEADER), 'http')
+        script_name = environ.get(environ_key(SCRIPT_NAME_HEADER), '')
+        if environ['PATH_INFO'].startswith(script_name):
+            environ['SCRIPT_NAME'] = script_name
+            environ['PATH_INFO'] = environ['PATH_INFO'][len(script_name):]
+
+        if environ_key(DB_NAME_HEADER) in environ:
+            # resolved by the worker which received the request
+            environ['anyblok.db_name'] = environ[environ_key(DB_NAME_HEADER)]
+
+        for key in AFFINITY_KEYS:
+            environ.pop(key, None)
+
+        self.count('served')
+        return self.app(environ, start_response)
+
+    def get_headers(self, request, db_name):
+        headers = {}
+        for name, value in request.headers.items():
+            if name.lower() in HOP_BY_HOP:
+                continue
+
+            if environ_key(name) not in AFFINITY_KEYS:
+                headers[name] = value
+
+        headers[TOKEN_HEADER] = self.token
+        headers[REMOTE_ADDR_HEADER] = request.remote_addr or ''
+        headers[SCHEME_HEADER] = request.scheme
+        headers[SCRIPT_NAME_HEADER] = request.script_name
+        headers[DB_NAME_HEADER] = db_name
+        return headers
+
+    def send(self, connection, request, db_name):
+        """Send the request to the worker of the slot. A body without length
+        (chunked encoding) is spooled to get it, the server of the slot
+        needs it
+        """
+        headers = self.get_headers(request, db_name)
+        body = request.body_file if request.is_body_readable else None
+        if body is not None and request.content_length is None:
+            with SpooledTemporaryFile(SPOOL_SIZE) as spool:
+                copyfileobj(body, spool, CHUNK_SIZE)
+                headers['Content-Length'] = str(spool.tell())
+                spool.seek(0)
+                return self.send_body(connection, request, headers, spool)
+
+        return self.send_body(connection, request, headers, body)
+
+    def send_body(self, connection, request, headers, body):
+        """Send the request line, the headers and the body by chunks"""
+        names = set(x.lower() for x in headers)
+        connection.putrequest(
+            request.method, request.path_qs, skip_host='host' in names,
+            skip_accept_encoding='accept-encoding' in names)
+        for name, value in headers.items():
+            connection.putheader(name, value)
+
+        connection.endheaders()
+        while body is not None:
+            data = body.read(CHUNK_SIZE)
+            if not data:
+                break
+
+            connection.send(data)
+
+    def forward(self, slot, request, start_response, db_name):
+        """Send the request to the worker of the slot"""
+        connection = HTTPConnection(self.host, self.port + slot,
+                                    timeout=self.timeout)
+        try:
+            connection.connect()
+        except OSError:
+            logger.warning("The slot %d does not answer, the request is "
+                           "served by the slot %d", slot, self.slot)
+            connection.close()
+            self.count('fallback')
+            return self.serve(request.environ, start_response)
+
+        try:
+            self.send(connection, request, db_name)
+            response = connection.getresponse()
+        except (OSError, ValueError):
+            logger.exception("Error while forwarding the request to the "
+                             "slot %d", slot)
+            connection.close()
+            self.count('error')
+            return HTTPBadGateway()(request.environ, start_response)
+
+        self.count('forwarded')
+        start_response(
+            '%d %s' % (response.status, response.reason),
+            [(name, value) for name, value in response.getheaders()
+             if name.lower() not in HOP_BY_HOP])
+        return ForwardedResponse(connection, response)
+
+    def collect(self):
+        """Metrics collector"""
+        with self.lock:
+            counters = sorted(self.counters.items())
+
+        yield Metric('anyblok_pyramid_affinity_slot',
+                     'Slot of the tenant affinity of the worker', 'gauge',
+                     [({}, self.slot)])
+        yield Metric('anyblok_pyramid_affinity_requests_total',
+                     'Requests by route of the tenant affinity', 'counter',
+                     [({'route': name}, value) for name, value in counters])
@@ -17,9 +17,129 @@ from transaction._transaction import Status as ZopeStatus
 from zope.interface import implementer
 from transaction.interfaces import IDataManagerSavepoint
 from anyblok.environment import EnvironmentManager
+from sqlalchemy import event
 from sqlalchemy.engine.base import Engine
+from sqlalchemy.orm import Session
 from sqlalchemy.orm.exc import ConcurrentModificationError
 from sqlalchemy.exc import DBAPIError
+from itertools import chain
+from .timeout import apply_statement_timeout
+from .replica import check_writable
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+MODELS_INFO = 'anyblok_pyramid.changed_models'
+SQL_MODELS_INFO = 'anyblok_pyramid.sql_changed_models'
+CALLBACKS_INFO = 'anyblok_pyramid.after_commit_callbacks'
+_COMMIT_LISTENERS = []
+_BEFORE_COMMIT_LISTENERS = []
+
+
+def add_commit_listener(listener):
+    """Call ``listener(registry, models)`` after each commit, ``models`` is
+    the set of the registry names of the models changed by the transaction
+
+    :param listener: callable
+    """
+    if listener not in _COMMIT_LISTENERS:
+        _COMMIT_LISTENERS.append(listener)
+
+
+def remove_commit_listener(listener):
+    if listener in _COMMIT_LISTENERS:
+        _COMMIT_LISTENERS.remove(listener)
+
+
+def fire_commit_listeners(registry, models):
+    for listener in _COMMIT_LISTENERS:
+        try:
+            listener(registry, models)
+        except Exception:
+            logger.exception('Error in the commit listener %r', listener)
+
+
+def add_before_commit_listener(listener):
+    """Call ``listener(registry, models)`` before the commit of each
+    transaction which changed models, in the transaction. An error aborts
+    the transaction
+
+    :param listener: callable
+    """
+    if listener not in _BEFORE_COMMIT_LISTENERS:
+        _BEFORE_COMMIT_LISTENERS.append(listener)
+
+
+def remove_before_commit_listener(listener):
+    if listener in _BEFORE_COMMIT_LISTENERS:
+        _BEFORE_COMMIT_LISTENERS.remove(listener)
+
+
+def add_after_commit_callback(session, callback,
+                              transaction_manager=zope_transaction.manager):
+    """Call ``callback()`` once the transaction of the session is
+    committed, the callback is dropped if the transaction is aborted
+
+    :param callback: callable without argument
+    """
+    mark_changed(session, transaction_manager=transaction_manager)
+    session.info.setdefault(CALLBACKS_INFO, []).append(callback)
+
+
+def fire_after_commit_callbacks(callbacks):
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception:
+            logger.exception('Error in the after commit callback %r',
+                             callback)
+
+
+def add_changed_models(session, *models):
+    """Declare the models changed by the transaction of the session, for
+    the changes which are not flushed by the ORM (raw sql)
+
+    :param models: registry names of the models, ``Model.System.Blok``
+    """
+    session.info.setdefault(MODELS_INFO, set()).update(models)
+    session.info.setdefault(SQL_MODELS_INFO, set()).update(models)
+
+
+def add_flushed_models(session, *models):
+    """Declare the models flushed by the ORM in the transaction of the
+    session"""
+    session.info.setdefault(MODELS_INFO, set()).update(models)
+
+
+def get_sql_changed_models(session):
+    """Return the registry names of the models changed by SQL in the
+    transaction of the session (``add_changed_models``), flushed by the ORM
+    or not
+    """
+    return set(session.info.get(SQL_MODELS_INFO, ()))
+
+
+def get_changed_models(session):
+    """Return the registry names of the models changed by the transaction
+    of the session, flushed or not
+    """
+    models = set(session.info.get(MODELS_INFO, ()))
+    models.update(get_registry_names(
+        chain(session.new, session.dirty, session.deleted)))
+    return models
+
+
+def get_registry_names(entities):
+    names = set()
+    for entity in entities:
+        if not isinstance(entity, type):
+            entity = type(entity)
+
+        name = getattr(entity, '__registry_name__', None)
+        if name:
+            names.add(name)
+
+    return names
 
 
 class AnyBlokSessionDataManager:
@@ -37,6 +157,9 @@ class AnyBlokSessionDataManager:
     def _finish(self, final_state):
         assert self.transaction is not None
         del _SESSION_STATE[id(self.registry.session)]
+        self.registry.session.info.pop(MODELS_INFO, None)
+        self.registry.session.info.pop(SQL_MODELS_INFO, None)
+        self.registry.session.info.pop(CALLBACKS_INFO, None)
         registry = self.registry
         self.transaction = self.registry = None
         self.state = final_state
@@ -52,7 +175,12 @@ class AnyBlokSessionDataManager:
             self._finish('aborted')
 
     def tpc_begin(self, trans):
-        self.registry.session.flush()
+        session = self.registry.session
+        session.flush()
+        models = session.info.get(MODELS_INFO)
+        if models and _SESSION_STATE[id(session)] is STATUS_CHANGED:
+            for listener in _BEFORE_COMMIT_LISTENERS:
+                listener(self.registry, set(models))
 
     def commit(self, trans):
         status = _SESSION_STATE[id(self.registry.session)]
@@ -61,10 +189,18 @@ class AnyBlokSessionDataManager:
                 self.registry.session.expire_all()
             self._finish('no work')
 
+    def commit_and_notify(self):
+        registry = self.registry
+        models = registry.session.info.get(MODELS_INFO, set())
+        callbacks = registry.session.info.get(CALLBACKS_INFO, [])
+        registry.commit()
+        self._finish('committed')
+        fire_commit_listeners(registry, models)
+        fire_after_commit_callbacks(callbacks)
+
     def tpc_vote(self, trans):
         if self.transaction is not None:
-            self.registry.commit()
-            self._finish('committed')
+            self.commit_and_notify()
 
     def tpc_finish(self, trans):
         pass
@@ -109,8 +245,7 @@ class AnyBlokTwoPhaseSessionDataManager(AnyBlokSessionDataManager):
 
     def tpc_finish(self, trans):
         if self.transaction is not None:
-            self.registry.commit()
-            self._finish('committed')
+            self.commit_and_notify()
 
     def tpc_abort(self, trans):
         if self.transaction is not None:
@@ -159,21 +294,47 @@ class AnyBlokZopeTransactionExtension(ZopeTransactionExtension):
     def after_begin(self, session, transaction, connection):
         join_transaction(session, self.initial_state, self.transaction_manager,
                          self.keep_session)
+        apply_statement_timeout(connection)
 
     def after_attach(self, session, instance):
         join_transaction(session, self.initial_state, self.transaction_manager,
                          self.keep_session)
 
+    def before_flush(self, session, flush_context, instances):
+        check_writable(session)
+
     def after_flush(self, session, flush_context):
         mark_changed(session, self.transaction_manager, self.keep_session)
+        add_flushed_models(session, *get_registry_names(
+            chain(session.new, session.dirty, session.deleted)))
 
     def after_bulk_update(self, session, query, query_context, result):
         mark_changed(session, self.transaction_manager, self.keep_session)
+        add_changed_models(session, *get_registry_names(
+            x['entity'] for x in query.column_descriptions))
 
     def after_bulk_delete(self, session, query, query_context, result):
         mark_changed(session, self.transaction_manager, self.keep_session)
+        add_changed_models(session, *get_registry_names(
+            x['entity'] for x in query.column_descriptions))
 
     def before_commit(self, session):
         assert (session.transaction.nested or  # noqa
                 self.transaction_manager.get().status == ZopeStatus.COMMITTING,
                 "Transaction must be committed using the transaction manager")
+
+
+def forget_session_info(session, transaction):
+    """At the end of the main transaction (commit, rollback or close, with
+    or without the transaction manager), forget its changed models and its
+    after commit callbacks
+    """
+    if transaction.parent is None:
+        session.info.pop(MODELS_INFO, None)
+        session.info.pop(SQL_MODELS_INFO, None)
+        session.info.pop(CALLBACKS_INFO, None)
+
+
+if not event.contains(Session, 'after_transaction_end',
+                      forget_session_info):
+    event.listen(Session, 'after_transaction_end', forget_session_info)
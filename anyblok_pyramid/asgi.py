@@ -0,0 +1,337 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+"""ASGI entry point of the AnyBlok / Pyramid application
+
+The synchronous views are called in a bounded pool of threads. The whole
+WSGI call (the ``pyramid_tm`` transaction, the iteration and the close of
+the response) is done on the same thread, the body of the request and of
+the response are streamed through the event loop::
+
+    uvicorn anyblok_pyramid.asgi:app
+
+The configuration is loaded as for ``anyblok_pyramid.wsgi``. The threads of
+the pool are given to the pools of connections (``set_concurrency``) before
+the registries are loaded.
+"""
+import asyncio
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from anyblok.blok import BlokManager
+from anyblok.config import Configuration
+from .common import load_configuration_files, preload_databases
+from .pool import get_concurrency, set_concurrency
+from .reload import get_wsgi_app as get_reloadable_wsgi_app
+from .server import end_of_request
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+def get_max_workers():
+    """Return the number of threads of the pool
+
+    ``--asgi-max-workers`` if it is defined, else the threads of
+    ``get_concurrency`` (``--wsgi-threads``)
+    """
+    max_workers = Configuration.get('asgi_max_workers')
+    if max_workers:
+        return int(max_workers)
+
+    processes, threads = get_concurrency()
+    return threads
+
+
+def get_wsgi_app(max_workers=None):
+    """Load the configuration and the registries, return the WSGI
+    application and the number of threads
+
+    The pools of connections are sized for the threads by ``get_pool_options``
+    (a connection by thread), so the concurrency is set before the
+    registries are loaded
+    """
+    load_configuration_files()
+    max_workers = max_workers or get_max_workers()
+    processes, threads = get_concurrency()
+    set_concurrency(processes, max_workers)
+    BlokManager.load()
+    preload_databases()
+    return get_reloadable_wsgi_app(), max_workers
+
+
+def build_environ(scope, body):
+    """Return the WSGI environ of the http scope
+
+    :param scope: ASGI scope
+    :param body: file like object of the body of the request
+    """
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+
+    wsgi_environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.encode('utf-8').decode('latin-1'),
+        'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    server = scope.get('server') or ('localhost', 80)
+    wsgi_environ['SERVER_NAME'] = server[0]
+    wsgi_environ['SERVER_PORT'] = str(server[1])
+    client = scope.get('client')
+    if client:
+        wsgi_environ['REMOTE_ADDR'] = client[0]
+        wsgi_environ['REMOTE_PORT'] = str(client[1])
+
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+
+        if name in wsgi_environ:
+            # the cookies are separated by ';' (RFC 6265)
+            separator = '; ' if name == 'HTTP_COOKIE' else ','
+            value = wsgi_environ[name] + separator + value
+
+        wsgi_environ[name] = value
+
+    return wsgi_environ
+
+
+class ASGIInput:
+    """``wsgi.input`` which receives the body from the event loop, chunk
+    by chunk, when the application reads it
+    """
+
+    def __init__(self, call, receive):
+        self.call = call
+        self.receive = receive
+        self.buffer = bytearray()
+        self.more_body = True
+
+    def receive_chunk(self):
+        message = self.call(self.receive())
+        if message['type'] == 'http.request':
+            self.buffer.extend(message.get('body', b''))
+            self.more_body = message.get('more_body', False)
+        else:
+            # http.disconnect
+            self.more_body = False
+
+    def pop(self, size):
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            while self.more_body:
+                self.receive_chunk()
+
+            size = len(self.buffer)
+
+        while self.more_body and len(self.buffer) < size:
+            self.receive_chunk()
+
+        return self.pop(size)
+
+    def readline(self, size=-1):
+        while self.more_body and b'\n' not in self.buffer:
+            if size is not None and 0 <= size <= len(self.buffer):
+                break
+
+            self.receive_chunk()
+
+        end = self.buffer.find(b'\n') + 1 or len(self.buffer)
+        if size is not None and 0 <= size < end:
+            end = size
+
+        return self.pop(end)
+
+    def readlines(self, hint=-1):
+        return list(iter(self.readline, b''))
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+
+class ASGIResponse:
+    """Send the WSGI response to the event loop
+
+    The last chunk is kept until the next one, to send it with
+    ``more_body=False``: a response of one chunk is one message
+    """
+
+    def __init__(self, call, send):
+        self.call = call
+        self.send = send
+        self.status = None
+        self.headers = None
+        self.started = False
+        self.pending = None
+
+    def start_response(self, status, headers, exc_info=None):
+        if exc_info and self.started:
+            raise exc_info[1].with_traceback(exc_info[2])
+
+        self.status = int(status.split(' ', 1)[0])
+        self.headers = [(name.lower().encode('latin-1'),
+                         value.encode('latin-1'))
+                        for name, value in headers]
+        return self.write
+
+    def send_start(self):
+        self.started = True
+        self.call(self.send({'type': 'http.response.start',
+                             'status': self.status,
+                             'headers': self.headers}))
+
+    def write(self, data):
+        if not data:
+            return
+
+        if not self.started:
+            self.send_start()
+
+        if self.pending is not None:
+            self.call(self.send({'type': 'http.response.body',
+                                 'body': self.pending, 'more_body': True}))
+
+        self.pending = bytes(data)
+
+    def finish(self):
+        if not self.started:
+            self.send_start()
+
+        self.call(self.send({'type': 'http.response.body',
+                             'body': self.pending or b'',
+                             'more_body': False}))
+
+
+class ASGIApplication:
+    """ASGI application which calls a WSGI application in a bounded pool
+    of threads
+
+    :param wsgi_app: WSGI application, by default the application of
+        ``anyblok_pyramid.wsgi`` loaded on the first call
+    :param max_workers: number of threads, by default ``get_max_workers``
+    :param websocket_app: ASGI application called for the websocket
+        scopes, else the websockets are closed
+    """
+
+    def __init__(self, wsgi_app=None, max_workers=None, websocket_app=None):
+        self.wsgi_app = wsgi_app
+        self.max_workers = max_workers
+        self.websocket_app = websocket_app
+        self.executor = None
+        self.semaphore = None
+        self.lock = Lock()
+
+    def load(self):
+        """Load the WSGI application and the pool of threads"""
+        with self.lock:
+            if self.wsgi_app is None:
+                self.wsgi_app, self.max_workers = get_wsgi_app(
+                    self.max_workers)
+
+            if self.executor is None:
+                self.max_workers = self.max_workers or get_max_workers()
+                self.executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            await self.http(scope, receive, send)
+        elif scope['type'] == 'websocket':
+            await self.websocket(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self.lifespan(scope, receive, send)
+
+    async def http(self, scope, receive, send):
+        loop = asyncio.get_event_loop()
+        if self.executor is None:
+            await loop.run_in_executor(None, self.load)
+
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_workers)
+
+        # the requests wait in the event loop, not in the queue of the pool
+        async with self.semaphore:
+            await loop.run_in_executor(self.executor, self.run_wsgi, loop,
+                                       scope, receive, send)
+
+    def run_wsgi(self, loop, scope, receive, send):
+        """Call the WSGI application, in a thread of the pool"""
+
+        def call(coroutine):
+            return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+        response = ASGIResponse(call, send)
+        wsgi_environ = build_environ(scope, ASGIInput(call, receive))
+        try:
+            result = self.wsgi_app(wsgi_environ, response.start_response)
+            try:
+                for data in result:
+                    response.write(data)
+
+                response.finish()
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except Exception:
+            logger.exception('Error on %s %s', scope['method'], scope['path'])
+            if response.started:
+                raise
+
+            response.start_response('500 Internal Server Error',
+                                    [('Content-Type', 'text/plain'),
+                                     ('Content-Length', '0')])
+            response.finish()
+        finally:
+            end_of_request()
+
+    async def websocket(self, scope, receive, send):
+        if self.websocket_app is not None:
+            await self.websocket_app(scope, receive, send)
+            return
+
+        await receive()
+        await send({'type': 'websocket.close', 'code': 1000})
+
+    async def lifespan(self, scope, receive, send):
+        loop = asyncio.get_event_loop()
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await loop.run_in_executor(None, self.load)
+                except Exception as e:
+                    logger.exception('Error during the startup')
+                    await send({'type': 'lifespan.startup.failed',
+                                'message': str(e)})
+                    return
+
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.executor is not None:
+                    await loop.run_in_executor(None, self.executor.shutdown)
+
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+app = ASGIApplication()
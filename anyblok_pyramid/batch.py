@@ -0,0 +1,204 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+"""Batch of requests in one transaction
+
+With ``--pyramid-batch-path /batch`` the client posts a list of requests::
+
+    {"requests": [
+        {"method": "POST", "path": "/partner", "json": {"name": "x"}},
+        {"method": "GET", "path": "/partner?name=x",
+         "headers": {"Accept": "application/json"}}
+     ],
+     "atomic": false}
+
+The requests are called by the router of Pyramid, without the tweens, in the
+transaction of the batch: one registry and one commit. Each request has a
+savepoint of the session, a request which fails (status >= 400 or exception)
+is rolled back alone. With ``atomic`` the first failure stops the batch, the
+whole transaction is aborted and the batch gets the status of the failed
+request.
+
+Only the headers of ``INHERITED_HEADERS`` and of ``--pyramid-batch-headers``
+are given by the batch to its requests, they use the database of the batch.
+
+A request of the batch can not call the batch or the memory debug view, it
+gets a 400. The requests of the batch have ``BATCH_KEY`` in their environ:
+they see the writes of the batch which are not committed, so the response
+cache, the coalescing and the ETag are not used for them.
+"""
+import json
+import transaction as zope_transaction
+from anyblok.config import Configuration
+from pyramid.httpexceptions import (HTTPBadRequest, HTTPException,
+                                    HTTPInternalServerError, HTTPNotFound)
+from pyramid.request import Request
+from .anyblok import join_transaction
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+INHERITED_HEADERS = ('Accept', 'Accept-Language', 'Authorization', 'Cookie',
+                     'User-Agent')
+FAILED_DEPENDENCY = 424
+BATCH_KEY = 'anyblok.batch'
+
+
+def in_batch(request):
+    """Return True if the request is called by a batch"""
+    return bool(request.environ.get(BATCH_KEY))
+
+
+def get_forbidden_paths():
+    """Return the paths which can not be called by a batch"""
+    paths = {Configuration.get('pyramid_batch_path')}
+    if Configuration.get('memory_debug'):
+        paths.add(Configuration.get('memory_debug_path') or '/_debug/memory')
+
+    return paths
+
+
+def get_inherited_headers(request):
+    """Return the headers of the batch given to its requests"""
+    names = INHERITED_HEADERS + tuple(
+        Configuration.get('pyramid_batch_headers') or ())
+    return {name: request.headers[name] for name in names
+            if name in request.headers}
+
+
+def get_batch_items(request, max_size):
+    try:
+        data = request.json_body
+    except ValueError:
+        raise HTTPBadRequest('The body of the batch must be json')
+
+    items = data.get('requests') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not all(
+            isinstance(item, dict) and item.get('path') for item in items):
+        raise HTTPBadRequest('The batch needs a list of requests with path')
+
+    if len(items) > max_size:
+        raise HTTPBadRequest('More than %d requests in the batch' % max_size)
+
+    return items, bool(data.get('atomic'))
+
+
+def make_subrequest(request, item):
+    """Return the ``Request`` of an item of the batch"""
+    headers = get_inherited_headers(request)
+    headers.update(item.get('headers') or {})
+    kwargs = {}
+    if 'json' in item:
+        kwargs['POST'] = json.dumps(item['json'])
+        kwargs['content_type'] = 'application/json'
+    elif 'body' in item:
+        kwargs['POST'] = item['body']
+        kwargs['content_type'] = headers.get('Content-Type', 'text/plain')
+
+    subrequest = Request.blank(item['path'], base_url=request.application_url,
+                               headers=headers, **kwargs)
+    subrequest.method = item.get('method', 'GET').upper()
+    db_name = request.environ.get('anyblok.db_name')
+    if db_name is not None:
+        subrequest.environ['anyblok.db_name'] = db_name
+
+    subrequest.environ[BATCH_KEY] = True
+    return subrequest
+
+
+def call_subrequest(request, subrequest):
+    try:
+        return request.invoke_subrequest(subrequest)
+    except HTTPException as response:
+        return response
+    except Exception:
+        logger.exception('Error in the batch on %s %s', subrequest.method,
+                         subrequest.path_qs)
+        return HTTPInternalServerError()
+
+
+def format_response(subrequest, response):
+    if isinstance(response, HTTPException):
+        # the body of the exception is rendered when it is called
+        response.prepare(subrequest.environ)
+
+    body = response.text if response.charset else response.body.decode(
+        'latin-1')
+    if response.content_type == 'application/json' and body:
+        body = json.loads(body)
+
+    return {'status': response.status_int,
+            'headers': dict(response.headers),
+            'body': body}
+
+
+def call_item(request, session, subrequest):
+    """Call the request of the batch in a savepoint of the session"""
+    if subrequest.path_info.rstrip('/') in get_forbidden_paths():
+        return HTTPBadRequest(
+            '%s can not be called in a batch' % subrequest.path_info)
+
+    savepoint = session.begin_nested()
+    response = call_subrequest(request, subrequest)
+    if response.status_int < 400:
+        savepoint.commit()
+    else:
+        savepoint.rollback()
+
+    return response
+
+
+def run_batch(request, session, items, atomic):
+    responses = []
+    for item in items:
+        subrequest = make_subrequest(request, item)
+        response = call_item(request, session, subrequest)
+        responses.append(format_response(subrequest, response))
+        if response.status_int >= 400 and atomic:
+            responses.extend({'status': FAILED_DEPENDENCY}
+                             for x in items[len(responses):])
+            return responses, response.status_int
+
+    return responses, None
+
+
+def batch_view(request):
+    if in_batch(request):
+        raise HTTPBadRequest('A batch can not call a batch')
+
+    items, atomic = get_batch_items(
+        request, Configuration.get('pyramid_batch_max_size') or 50)
+    registry = request.anyblok.registry
+    if registry is None:
+        raise HTTPNotFound('No database for the batch')
+
+    manager = getattr(request, 'tm', zope_transaction.manager)
+    session = registry.session
+    join_transaction(session, transaction_manager=manager)
+    savepoint = session.begin_nested() if atomic else None
+    responses, failed = run_batch(request, session, items, atomic)
+    if savepoint is not None:
+        if failed is None:
+            savepoint.commit()
+        else:
+            savepoint.rollback()
+            manager.doom()
+            request.response.status_int = failed
+
+    return {'responses': responses}
+
+
+def batch(config):
+    """Pyramid includeme, add the batch view on ``--pyramid-batch-path``
+
+    :param config: Pyramid configurator instance
+    """
+    path = Configuration.get('pyramid_batch_path')
+    if path:
+        config.add_route('anyblok_batch', path, request_method='POST')
+        config.add_view(batch_view, route_name='anyblok_batch',
+                        renderer='json')
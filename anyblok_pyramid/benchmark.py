@@ -0,0 +1,377 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+"""Benchmarks of the request hot path
+
+Each benchmark is a function decorated by ``benchmark``, it receives the
+``BenchmarkContext`` and returns the callable to time, so the preparation is
+not measured::
+
+    from anyblok_pyramid.benchmark import benchmark
+
+    @benchmark('my_case', number=100)
+    def my_case(context):
+        registry = context.registry
+
+        def run():
+            registry.System.Blok.query().count()
+
+        return run
+
+The results are a dict ``{name: {min, max, mean, median, number, repeat}}``,
+the times are in seconds by call.
+"""
+import json
+import platform
+import sys
+import time
+import transaction
+from collections import OrderedDict
+from datetime import datetime, date
+from decimal import Decimal
+from uuid import UUID, uuid1
+from statistics import mean, median
+from pyramid.renderers import JSON
+from pyramid.testing import DummyRequest
+from anyblok.blok import BlokManager
+from anyblok.config import Configuration
+from .release import version
+from .common import get_registry_for
+from .anyblok import mark_changed
+from .bulk import bulk_insert, bulk_update, bulk_delete
+from .pyramid_config import (Configurator, AnyBlokRequest,
+                             InstalledBlokPredicate,
+                             NeedAnyBlokRegistryPredicate)
+from .adapter import (datetime_adapter, date_adapter, uuid_adapter,
+                      bytes_adapter, decimal_adapter)
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+benchmarks = OrderedDict()
+
+
+def benchmark(name, number=100, default=True):
+    """Decorator to declare a benchmark
+
+    :param name: name of the benchmark, used as key in the results
+    :param number: number of calls by repeat
+    :param default: if False the benchmark is only run when it is named
+    """
+    def wrapper(function):
+        benchmarks[name] = (function, number, default)
+        return function
+
+    return wrapper
+
+
+class BenchmarkContext:
+    """Share the expensive objects between the benchmarks"""
+
+    def __init__(self, db_name=None):
+        self.db_name = db_name or Configuration.get('db_name')
+        self._registry = None
+        self._app = None
+
+    @property
+    def registry(self):
+        if self._registry is None:
+            self._registry = get_registry_for(self.db_name)
+
+        return self._registry
+
+    @property
+    def app(self):
+        if self._app is None:
+            self._app = make_app()
+
+        return self._app
+
+    def request(self, path='/'):
+        request = DummyRequest(path=path)
+        request.anyblok = AnyBlokRequest(request)
+        return request
+
+
+def make_app():
+    config = Configurator()
+    config.include_from_entry_point()
+    config.load_config_bloks()
+    return config.make_wsgi_app()
+
+
+def time_function(function, number, repeat):
+    """Return the time by call of each repeat
+
+    :param function: callable to time
+    :param number: number of calls by repeat
+    :param repeat: number of repeat
+    :rtype: list of float
+    """
+    times = []
+    for x in range(repeat):
+        start = time.perf_counter()
+        for y in range(number):
+            function()
+
+        times.append((time.perf_counter() - start) / number)
+
+    return times
+
+
+def run_benchmarks(context, names=None, repeat=5, number=None):
+    """Run the benchmarks and return the results
+
+    :param context: ``BenchmarkContext`` instance
+    :param names: list of the benchmarks to run, by default all the
+                  benchmarks declared with ``default``
+    :param repeat: number of repeat by benchmark
+    :param number: force the number of calls by repeat
+    :rtype: dict
+    """
+    results = OrderedDict()
+    for name, (function, default_number, default) in benchmarks.items():
+        selected = name in names if names else default
+        if not selected:
+            continue
+
+        logger.info('Run benchmark %r', name)
+        try:
+            prepared = function(context)
+            nb = number or default_number
+            times = time_function(prepared, nb, repeat)
+        finally:
+            transaction.abort()
+
+        results[name] = {
+            'min': min(times),
+            'max': max(times),
+            'mean': mean(times),
+            'median': median(times),
+            'number': nb,
+            'repeat': repeat,
+        }
+
+    return results
+
+
+def dump_results(results, output):
+    """Save the results in a json file with information about the platform
+
+    :param results: dict of the results
+    :param output: path of the json file
+    """
+    data = {
+        'version': version,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': datetime.now().isoformat(),
+        'db_driver_name': Configuration.get('db_driver_name'),
+        'benchmarks': results,
+    }
+    with open(output, 'w') as fp:
+        json.dump(data, fp, indent=2)
+
+
+def load_results(path):
+    """Load the benchmarks saved by ``dump_results``
+
+    :param path: path of the json file
+    :rtype: dict
+    """
+    with open(path, 'r') as fp:
+        return json.load(fp)['benchmarks']
+
+
+def compare_results(results, baseline, tolerance=0.1, key='median'):
+    """Return the benchmarks slower than the baseline
+
+    :param results: dict of the current results
+    :param baseline: dict of the reference results
+    :param tolerance: accepted slowdown, 0.1 means 10%
+    :param key: statistic used to compare
+    :rtype: list of (name, baseline time, current time, ratio)
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        reference = baseline[name][key]
+        current = result[key]
+        if reference and current > reference * (1 + tolerance):
+            regressions.append((name, reference, current,
+                                current / reference))
+
+    return regressions
+
+
+def format_results(results, baseline=None):
+    lines = []
+    for name, result in results.items():
+        line = '%-30s %12.3f us (min %12.3f us)' % (
+            name, result['median'] * 1e6, result['min'] * 1e6)
+        if baseline and name in baseline and baseline[name]['median']:
+            line += '  x%.2f' % (result['median'] / baseline[name]['median'])
+
+        lines.append(line)
+
+    return '\n'.join(lines)
+
+
+@benchmark('app_construction', number=1)
+def bench_app_construction(context):
+    return make_app
+
+
+@benchmark('registry_resolution')
+def bench_registry_resolution(context):
+    context.registry
+
+    def run():
+        context.request().anyblok.registry
+
+    return run
+
+
+@benchmark('predicate_installed_blok')
+def bench_predicate_installed_blok(context):
+    predicate = InstalledBlokPredicate('anyblok-core', None)
+    context.registry
+
+    def run():
+        predicate(None, context.request())
+
+    return run
+
+
+@benchmark('predicate_need_anyblok_registry')
+def bench_predicate_need_anyblok_registry(context):
+    predicate = NeedAnyBlokRegistryPredicate(True, None)
+    context.registry
+
+    def run():
+        predicate(None, context.request())
+
+    return run
+
+
+@benchmark('transaction_join_readonly')
+def bench_transaction_join_readonly(context):
+    registry = context.registry
+
+    def run():
+        registry.System.Blok.query().count()
+        transaction.commit()
+
+    return run
+
+
+@benchmark('transaction_join_commit')
+def bench_transaction_join_commit(context):
+    registry = context.registry
+
+    def run():
+        registry.System.Blok.query().count()
+        mark_changed(registry.session)
+        transaction.commit()
+
+    return run
+
+
+@benchmark('bulk_100k', number=1, default=False)
+def bench_bulk_100k(context):
+    registry = context.registry
+    Cache = registry.System.Cache
+    records = [{'registry_name': 'Model.Benchmark', 'method': 'method%d' % x}
+               for x in range(100000)]
+
+    def run():
+        results = bulk_insert(Cache, records)
+        bulk_update(Cache, [dict(result['pk'], method='updated')
+                            for result in results])
+        bulk_delete(Cache, [result['pk'] for result in results])
+        transaction.abort()
+
+    return run
+
+
+@benchmark('json_adapters', number=1000)
+def bench_json_adapters(context):
+    renderer = JSON()
+    renderer.add_adapter(datetime, datetime_adapter)
+    renderer.add_adapter(date, date_adapter)
+    renderer.add_adapter(UUID, uuid_adapter)
+    renderer.add_adapter(bytes, bytes_adapter)
+    renderer.add_adapter(Decimal, decimal_adapter)
+    render = renderer(None)
+    value = [
+        {
+            'datetime': datetime(2017, 10, 1, 1, 1, 1),
+            'date': date(2017, 10, 1),
+            'uuid': uuid1(),
+            'bytes': b'x' * 100,
+            'decimal': Decimal('100.12'),
+        }
+    ] * 10
+
+    def run():
+        render(value, {})
+
+    return run
+
+
+@benchmark('webtest_hello')
+def bench_webtest_hello(context):
+    from webtest import TestApp
+    registry = context.registry
+    if 'test-pyramid-blok1' not in BlokManager.list():
+        raise Exception("The test bloks are not loaded")
+
+    if not registry.System.Blok.is_installed('test-pyramid-blok1'):
+        registry.System.Blok.update_list()
+        registry.upgrade(install=('test-pyramid-blok1',))
+        registry.commit()
+
+    webserver = TestApp(context.app)
+
+    def run():
+        webserver.get('/hello/JS/', status=200)
+
+    return run
+
+
+def main(context):
+    """Run the benchmarks in function of the ``Configuration``
+
+    :param context: ``BenchmarkContext`` instance
+    :rtype: int, exit code, 1 if at least one regression is found
+    """
+    results = run_benchmarks(context,
+                             names=Configuration.get('benchmark_names'),
+                             repeat=Configuration.get('benchmark_repeat') or 5,
+                             number=Configuration.get('benchmark_number'))
+    output = Configuration.get('benchmark_output')
+    if output:
+        dump_results(results, output)
+
+    baseline = None
+    compare = Configuration.get('benchmark_compare')
+    if compare:
+        baseline = load_results(compare)
+
+    sys.stdout.write(format_results(results, baseline) + '\n')
+    if baseline is None:
+        return 0
+
+    tolerance = Configuration.get('benchmark_tolerance')
+    regressions = compare_results(results, baseline, tolerance=tolerance)
+    for name, reference, current, ratio in regressions:
+        logger.error("Regression on %r: %.3f us => %.3f us (x%.2f)",
+                     name, reference * 1e6, current * 1e6, ratio)
+
+    return 1 if regressions else 0
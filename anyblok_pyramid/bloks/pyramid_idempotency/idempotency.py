@@ -0,0 +1,34 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok import Declarations
+from anyblok.column import DateTime, Integer, Json, LargeBinary, String
+
+
+register = Declarations.register
+Model = Declarations.Model
+
+
+@register(Model)
+class Pyramid:
+    pass
+
+
+@register(Model.Pyramid)
+class Idempotency:
+    """Response of the first request with an ``Idempotency-Key``, the
+    scope is the hash of the user or of the credentials of the request
+    """
+
+    scope = String(size=64, primary_key=True)
+    key = String(size=255, primary_key=True)
+    fingerprint = String(size=64, nullable=False)
+    status = Integer()
+    headers = Json()
+    body = LargeBinary()
+    create_date = DateTime(nullable=False)
+    expire_date = DateTime(nullable=False, index=True)
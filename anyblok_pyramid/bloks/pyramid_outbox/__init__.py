@@ -0,0 +1,24 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok.blok import Blok
+from anyblok_pyramid.release import version
+
+
+class PyramidOutboxBlok(Blok):
+    """Tables of the outbox of ``anyblok_pyramid.outbox``"""
+
+    version = version
+
+    @classmethod
+    def import_declaration_module(cls):
+        from . import outbox  # noqa
+
+    @classmethod
+    def reload_declaration_module(cls, reload):
+        from . import outbox
+        reload(outbox)
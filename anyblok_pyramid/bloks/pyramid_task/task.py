@@ -0,0 +1,37 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from datetime import datetime, timezone
+from anyblok import Declarations
+from anyblok.column import DateTime, Integer, Json, String, Text
+
+
+register = Declarations.register
+Model = Declarations.Model
+
+
+def now():
+    return datetime.now(timezone.utc)
+
+
+@register(Model)
+class Pyramid:
+    pass
+
+
+@register(Model.Pyramid)
+class Task:
+    """Durable task, called by the ``anyblok_pyramid_tasks`` script"""
+
+    id = Integer(primary_key=True)
+    func = String(size=256, nullable=False)
+    params = Json(default={})
+    state = String(size=16, default='pending', nullable=False, index=True)
+    attempts = Integer(default=0, nullable=False)
+    next_try = DateTime(default=now, nullable=False, index=True)
+    error = Text()
+    create_date = DateTime(default=now, nullable=False)
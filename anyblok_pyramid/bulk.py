@@ -0,0 +1,394 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+"""Bulk insert, update and delete of the records of a model
+
+The records are dicts of columns. They are written by batch with set based
+statements on the connection of the session, then the session is marked
+changed once. With PostgreSQL and one primary key, the updates and the
+deletes of a batch are one statement with arrays (``unnest``, ``= ANY``),
+else ``executemany`` and ``IN`` are used::
+
+    from anyblok_pyramid.bulk import bulk_insert, bulk_update, bulk_delete
+
+    results = bulk_insert(registry.Partner, [{'name': 'a'}, {'name': 'b'}])
+    # [{'status': 'created', 'pk': {'id': 1}}, ...]
+    bulk_update(registry.Partner, [{'id': 1, 'name': 'c'}])
+    bulk_delete(registry.Partner, [{'id': 2}])
+
+Each record gets its result, an invalid record gets ``error`` and is not
+written. Each batch is written in a savepoint, when the database refuses it
+(constraint, type, ...) the savepoint is rolled back and the records of the
+batch are written again one by one, each in its savepoint: only the records
+refused by the database get ``error``. The statements do not call the ORM:
+the instances of the model in the session are expired, the events of the
+model are not called.
+
+``add_bulk_views`` adds the REST views of a model::
+
+    add_bulk_views(config, 'partners', '/partners', 'Model.Partner',
+                   permission='write')
+
+``POST`` inserts, ``PATCH`` updates and ``DELETE`` deletes the json list of
+records of the body.
+"""
+from functools import partial
+from sqlalchemy import and_, any_, bindparam, func, select, tuple_
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.exc import StatementError
+from pyramid.httpexceptions import HTTPBadRequest, HTTPNotFound
+from .anyblok import mark_changed, add_changed_models
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+BATCH_SIZE = 1000
+
+
+def get_primary_keys(model):
+    return list(model.__table__.primary_key.columns)
+
+
+def check_record(table, record, required=()):
+    """Return the error of the record, None if it is valid"""
+    if not isinstance(record, dict):
+        return 'The record must be a dict'
+
+    unknown = set(record).difference(table.c.keys())
+    if unknown:
+        return 'Unknown columns: %s' % ', '.join(sorted(unknown))
+
+    missing = [name for name in required if record.get(name) is None]
+    if missing:
+        return 'Missing primary key: %s' % ', '.join(missing)
+
+    return None
+
+
+def split_records(model, records, required=()):
+    """Return the results with the errors and the valid records by index"""
+    table = model.__table__
+    results = [None] * len(records)
+    valid = []
+    for index, record in enumerate(records):
+        error = check_record(table, record, required=required)
+        if error:
+            results[index] = {'status': 'error', 'error': error}
+        else:
+            valid.append((index, record))
+
+    return results, valid
+
+
+def iter_batches(records, batch_size):
+    """Cut the records in batches of the same keys, a statement needs the
+    same columns, the order of the records is kept
+    """
+    keys, batch = None, []
+    for index, record in records:
+        record_keys = tuple(sorted(record))
+        if batch and (record_keys != keys or len(batch) >= batch_size):
+            yield keys, batch
+            batch = []
+
+        keys = record_keys
+        batch.append((index, record))
+
+    if batch:
+        yield keys, batch
+
+
+def get_pk(record, primary_keys):
+    return tuple(record[column.name] for column in primary_keys)
+
+
+def use_arrays(connection, primary_keys):
+    """With PostgreSQL and one primary key, the values of a batch are given
+    by arrays: one parameter by column instead of one by value
+    """
+    return connection.dialect.name == 'postgresql' and len(primary_keys) == 1
+
+
+def array_param(name, column):
+    return bindparam(name, type_=ARRAY(column.type))
+
+
+def where_pks(primary_keys, pks):
+    if len(primary_keys) == 1:
+        return primary_keys[0].in_([pk[0] for pk in pks])
+
+    return tuple_(*primary_keys).in_(pks)
+
+
+def select_existing(connection, model, pks):
+    """Return the primary keys which are in the table"""
+    primary_keys = get_primary_keys(model)
+    query = model.__table__.select().with_only_columns(primary_keys)
+    return set(tuple(row) for row in connection.execute(
+        query.where(where_pks(primary_keys, pks))))
+
+
+def get_session(model):
+    session = model.registry.session
+    session.flush()
+    return session
+
+
+def get_error(error):
+    """Return the first line of the error of the database"""
+    return str(error.orig or error).strip().split('\n')[0]
+
+
+def write_batch(session, batch, write):
+    """Call ``write(connection, batch)`` in a savepoint and return its
+    results by index, when the database refuses the batch, each record is
+    written in its own savepoint
+    """
+    try:
+        with session.begin_nested():
+            # the savepoint is emitted when the connection is asked
+            return write(session.connection(), batch)
+    except StatementError as error:
+        if len(batch) == 1:
+            logger.info('Record refused by the database: %s', error)
+            return [(batch[0][0], {'status': 'error',
+                                   'error': get_error(error)})]
+
+    results = []
+    for item in batch:
+        results.extend(write_batch(session, [item], write))
+
+    return results
+
+
+def set_changed(model, session):
+    """Mark the session changed once, and expire the instances of the model
+    """
+    mark_changed(session)
+    add_changed_models(session, model.__registry_name__)
+    for instance in list(session.identity_map.values()):
+        if isinstance(instance, model):
+            session.expire(instance)
+
+
+def insert_values(connection, model, values):
+    """Insert the values, return their primary keys"""
+    table = model.__table__
+    primary_keys = get_primary_keys(model)
+    if connection.dialect.name == 'postgresql':
+        rows = connection.execute(
+            table.insert().values(values).returning(*primary_keys))
+        return [dict(row) for row in rows]
+
+    if all(record.get(column.name) is not None
+           for record in values for column in primary_keys):
+        connection.execute(table.insert(), values)
+        return [{column.name: record[column.name] for column in primary_keys}
+                for record in values]
+
+    # the database gives the primary keys, one statement by record
+    names = [column.name for column in primary_keys]
+    return [dict(zip(names, connection.execute(
+        table.insert(), record).inserted_primary_key)) for record in values]
+
+
+def insert_batch(model, connection, batch):
+    pks = insert_values(connection, model,
+                        [record for index, record in batch])
+    return [(index, {'status': 'created', 'pk': pk})
+            for (index, record), pk in zip(batch, pks)]
+
+
+def bulk_insert(model, records, batch_size=BATCH_SIZE):
+    """Insert the records, return the results with the primary keys
+
+    The primary keys are returned by ``RETURNING`` with PostgreSQL, else
+    the records without their primary keys are inserted one by one to get
+    them
+    """
+    results, valid = split_records(model, records)
+    if not valid:
+        return results
+
+    session = get_session(model)
+    write = partial(insert_batch, model)
+    for keys, batch in iter_batches(valid, batch_size):
+        for index, result in write_batch(session, batch, write):
+            results[index] = result
+
+    set_changed(model, session)
+    return results
+
+
+def update_with_arrays(connection, model, names, records):
+    """``UPDATE ... FROM unnest(...) RETURNING``, return the updated keys"""
+    table = model.__table__
+    pk = get_primary_keys(model)[0]
+    columns = [pk.name] + names
+    values = select([func.unnest(array_param('a_' + name, table.c[name])
+                                 ).label(name)
+                     for name in columns]).alias('bulk_values')
+    statement = table.update().where(pk == values.c[pk.name]).values(
+        {name: values.c[name] for name in names}).returning(pk)
+    params = {'a_' + name: [record[name] for record in records]
+              for name in columns}
+    return set(tuple(row) for row in connection.execute(statement, params))
+
+
+def update_with_executemany(connection, model, names, records):
+    primary_keys = get_primary_keys(model)
+    existing = select_existing(
+        connection, model, [get_pk(record, primary_keys)
+                            for record in records])
+    params = []
+    for record in records:
+        if get_pk(record, primary_keys) in existing:
+            param = {'pk_' + column.name: record[column.name]
+                     for column in primary_keys}
+            param.update({'v_' + name: record[name] for name in names})
+            params.append(param)
+
+    if params:
+        where = and_(*[column == bindparam('pk_' + column.name)
+                       for column in primary_keys])
+        statement = model.__table__.update().where(where).values(
+            {name: bindparam('v_' + name) for name in names})
+        connection.execute(statement, params)
+
+    return existing
+
+
+def update_batch(model, connection, batch):
+    """Update the records of the batch, they have the same columns"""
+    primary_keys = get_primary_keys(model)
+    pk_names = [column.name for column in primary_keys]
+    names = sorted(name for name in batch[0][1] if name not in pk_names)
+    records = [record for index, record in batch]
+    if not names:
+        updated = select_existing(
+            connection, model, [get_pk(record, primary_keys)
+                                for record in records])
+    elif use_arrays(connection, primary_keys):
+        updated = update_with_arrays(connection, model, names, records)
+    else:
+        updated = update_with_executemany(connection, model, names, records)
+
+    return [(index, {'status': ('updated'
+                                if get_pk(record, primary_keys) in updated
+                                else 'not found')})
+            for index, record in batch]
+
+
+def bulk_update(model, records, batch_size=BATCH_SIZE):
+    """Update the records by primary key"""
+    primary_keys = get_primary_keys(model)
+    results, valid = split_records(
+        model, records, required=[column.name for column in primary_keys])
+    if not valid:
+        return results
+
+    session = get_session(model)
+    write = partial(update_batch, model)
+    for keys, batch in iter_batches(valid, batch_size):
+        for index, result in write_batch(session, batch, write):
+            results[index] = result
+
+    set_changed(model, session)
+    return results
+
+
+def delete_pks(connection, model, pks):
+    """Delete the primary keys, return the deleted ones"""
+    primary_keys = get_primary_keys(model)
+    table = model.__table__
+    if use_arrays(connection, primary_keys):
+        statement = table.delete().where(
+            primary_keys[0] == any_(array_param('pks', primary_keys[0]))
+        ).returning(primary_keys[0])
+        return set(tuple(row) for row in connection.execute(
+            statement, {'pks': [pk[0] for pk in pks]}))
+
+    existing = select_existing(connection, model, pks)
+    if existing:
+        connection.execute(table.delete().where(
+            where_pks(primary_keys, list(existing))))
+
+    return existing
+
+
+def delete_batch(model, connection, batch):
+    primary_keys = get_primary_keys(model)
+    pks = [get_pk(record, primary_keys) for index, record in batch]
+    deleted = delete_pks(connection, model, pks)
+    return [(index, {'status': 'deleted' if pk in deleted else 'not found'})
+            for (index, record), pk in zip(batch, pks)]
+
+
+def bulk_delete(model, records, batch_size=BATCH_SIZE):
+    """Delete the records by primary key, the other columns are ignored"""
+    primary_keys = get_primary_keys(model)
+    results, valid = split_records(
+        model, records, required=[column.name for column in primary_keys])
+    if not valid:
+        return results
+
+    session = get_session(model)
+    write = partial(delete_batch, model)
+    for start in range(0, len(valid), batch_size):
+        batch = valid[start:start + batch_size]
+        for index, result in write_batch(session, batch, write):
+            results[index] = result
+
+    set_changed(model, session)
+    return results
+
+
+BULK_METHODS = {
+    'POST': bulk_insert,
+    'PATCH': bulk_update,
+    'DELETE': bulk_delete,
+}
+
+
+def bulk_view_factory(model_name):
+    """Return the view which calls the bulk method of the request method"""
+
+    def bulk_view(request):
+        registry = request.anyblok.registry
+        if registry is None or model_name not in registry.loaded_namespaces:
+            raise HTTPNotFound()
+
+        try:
+            records = request.json_body
+        except ValueError:
+            raise HTTPBadRequest('The body must be a json list')
+
+        if not isinstance(records, list):
+            raise HTTPBadRequest('The body must be a json list')
+
+        method = BULK_METHODS[request.method]
+        return {'results': method(registry.get(model_name), records)}
+
+    return bulk_view
+
+
+def add_bulk_views(config, route_name, pattern, model_name, permission=None,
+                   **view_kwargs):
+    """Add the bulk REST views of the model
+
+    :param config: Pyramid configurator instance
+    :param route_name: name of the route
+    :param pattern: pattern of the route
+    :param model_name: registry name of the model, ``Model.Partner``
+    :param permission: permission of the views
+    :param view_kwargs: other arguments of ``config.add_view``
+    """
+    view_kwargs.setdefault('request_method', tuple(BULK_METHODS))
+    view_kwargs.setdefault('renderer', 'json')
+    config.add_route(route_name, pattern)
+    config.add_view(bulk_view_factory(model_name), route_name=route_name,
+                    permission=permission, **view_kwargs)
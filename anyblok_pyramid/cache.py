@@ -0,0 +1,357 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+"""Cache of the responses, invalidated by the commits
+
+A view declares the models it reads::
+
+    @view_config(route_name='products', renderer='json',
+                 anyblok_cache_models=['Model.Product'],
+                 anyblok_cache_ttl=600)
+    def products(request):
+        ...
+
+The key of the response is the db name, the route, the path, the
+parameters, the ``Authorization`` and ``Cookie`` headers and the
+generations of the models. A commit which changes one of
+the models increments its generation (see ``anyblok_pyramid.generation``),
+the next request does not find the old response.
+"""
+import json
+import os
+import time
+from collections import OrderedDict
+from hashlib import sha1
+from threading import Lock
+from anyblok.config import Configuration
+from pyramid.response import Response
+from . import AnyBlokPyramidException
+from .batch import in_batch
+from .generation import add_generations, check_shared
+from .replica import use_primary
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+DEFAULT_VARY = ('Authorization', 'Cookie')
+
+
+class CachedResponse:
+
+    def __init__(self, status, headerlist, body, expire):
+        self.status = status
+        self.headerlist = headerlist
+        self.body = body
+        self.expire = expire
+
+    @classmethod
+    def from_response(cls, response, ttl):
+        headerlist = [(name, value) for name, value in response.headerlist
+                      if name.lower() != 'set-cookie']
+        return cls(response.status, headerlist, response.body,
+                   time.time() + ttl)
+
+    def to_response(self):
+        return Response(status=self.status, headerlist=list(self.headerlist),
+                        body=self.body)
+
+    def dump(self, fp):
+        """Write the entry in the binary file, a json line followed by the
+        body, the files shared by the processes are never unpickled
+        """
+        fp.write(json.dumps({
+            'status': self.status, 'headerlist': self.headerlist,
+            'expire': self.expire}).encode('utf-8') + b'\n')
+        fp.write(self.body)
+
+    @classmethod
+    def load(cls, fp):
+        """Read the entry written by ``dump``
+
+        :exception: ValueError if the file is not an entry
+        """
+        try:
+            meta = json.loads(fp.readline().decode('utf-8'))
+            headerlist = [(str(name), str(value))
+                          for name, value in meta['headerlist']]
+            return cls(str(meta['status']), headerlist, fp.read(),
+                       float(meta['expire']))
+        except (KeyError, TypeError, UnicodeDecodeError) as error:
+            raise ValueError(error)
+
+    @property
+    def size(self):
+        return len(self.body)
+
+
+class MemoryCacheBackend:
+    """LRU cache of the process, bounded by the size of the bodies
+
+    :param max_size: bytes
+    """
+
+    def __init__(self, max_size=64 * 1024 * 1024):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            if entry.expire < time.time():
+                self.pop(key)
+                return None
+
+            self.entries.move_to_end(key)
+            return entry
+
+    def pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def set(self, key, entry):
+        if entry.size > self.max_size:
+            return
+
+        with self.lock:
+            self.pop(key)
+            self.entries[key] = entry
+            self.size += entry.size
+            while self.size > self.max_size:
+                self.pop(next(iter(self.entries)))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+class FileCacheBackend:
+    """Cache shared by the processes of the host, one file by entry
+
+    The oldest files are removed when the directory is bigger than
+    ``max_size``, it is checked every ``check_every`` writes
+
+    :param directory: directory of the cache
+    :param max_size: bytes
+    """
+
+    check_every = 100
+
+    def __init__(self, directory, max_size=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.writes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as fp:
+                entry = CachedResponse.load(fp)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if entry.expire < time.time():
+            return None
+
+        return entry
+
+    def set(self, key, entry):
+        if entry.size > self.max_size:
+            return
+
+        path = self.path(key)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as fp:
+            entry.dump(fp)
+
+        os.replace(tmp, path)
+        self.writes += 1
+        if not self.writes % self.check_every:
+            self.shrink()
+
+    def files(self):
+        files = []
+        for name in os.listdir(self.directory):
+            if len(name) != 40 or '.' in name:
+                # temporary files or generations
+                continue
+
+            path = self.path(name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+
+            files.append((stat.st_mtime, stat.st_size, path))
+
+        return files
+
+    def shrink(self):
+        files = sorted(self.files())
+        size = sum(x[1] for x in files)
+        for mtime, file_size, path in files:
+            if size <= self.max_size:
+                break
+
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+            size -= file_size
+
+    def clear(self):
+        for mtime, size, path in self.files():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class ResponseCache:
+    """Store the responses of the views in the backend, with the
+    generations of the models in the key
+
+    :param backend: ``MemoryCacheBackend`` or ``FileCacheBackend``
+    :param generations: ``MemoryGenerations`` or ``FileGenerations``
+    :param ttl: default time to live of the responses, in seconds
+    """
+
+    def __init__(self, backend, generations, ttl=300):
+        self.backend = backend
+        self.generations = generations
+        self.ttl = ttl
+
+    def key(self, request, db_name, models, vary=()):
+        parts = [db_name, str(self.generations.epoch)]
+        route = request.matched_route
+        parts.append(route.name if route is not None else '')
+        parts.append(request.path)
+        parts.extend('%s=%s' % x for x in sorted(request.GET.items()))
+        parts.extend(request.headers.get(header, '') for header in vary)
+        parts.extend('%s:%d' % (model, generation) for model, generation in
+                     zip(models, self.generations.get_many(db_name, models)))
+        return sha1('\x00'.join(parts).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def set(self, key, response, ttl=None):
+        self.backend.set(key, CachedResponse.from_response(
+            response, self.ttl if ttl is None else ttl))
+
+    def invalidate(self, registry, models):
+        self.generations.invalidate(registry, models)
+
+    def clear(self):
+        self.generations.bump_all()
+        self.backend.clear()
+
+
+def is_cacheable(response):
+    if response.status_int != 200 or 'Set-Cookie' in response.headers:
+        return False
+
+    if not isinstance(response.app_iter, (list, tuple)):
+        # streamed response
+        return False
+
+    cache_control = response.cache_control
+    return not (cache_control.no_store or cache_control.private)
+
+
+def cached_view(view, info):
+    """View deriver, add the options ``anyblok_cache_models`` (models read
+    by the view), ``anyblok_cache_ttl`` and ``anyblok_cache_vary`` (headers
+    of the request in the key with the credentials of ``DEFAULT_VARY``)
+    """
+    models = info.options.get('anyblok_cache_models')
+    if models is None:
+        return view
+
+    cache = getattr(info.registry, 'anyblok_response_cache', None)
+    if cache is not None:
+        check_shared(cache.generations, 'anyblok_cache_models')
+
+    models = sorted(models)
+    ttl = info.options.get('anyblok_cache_ttl')
+    vary = DEFAULT_VARY + tuple(info.options.get('anyblok_cache_vary') or ())
+
+    def wrapper(context, request):
+        cache = getattr(request.registry, 'anyblok_response_cache', None)
+        if in_batch(request):
+            cache = None
+
+        if cache is None or request.method not in ('GET', 'HEAD'):
+            return view(context, request)
+
+        db_name = Configuration.get('get_db_name')(request)
+        key = cache.key(request, db_name, models, vary=vary)
+        entry = cache.get(key)
+        if entry is not None:
+            response = entry.to_response()
+            response.headers['X-AnyBlok-Cache'] = 'hit'
+            return response
+
+        # a late replica would be kept under the generation of the primary
+        primary = use_primary(request)
+        response = view(context, request)
+        if primary and is_cacheable(response):
+            cache.set(key, response, ttl=ttl)
+
+        return response
+
+    return wrapper
+
+
+cached_view.options = ('anyblok_cache_models', 'anyblok_cache_ttl',
+                       'anyblok_cache_vary')
+
+
+def get_response_cache(generations):
+    """Return the ``ResponseCache`` defined by the configuration, None if
+    the backend is ``none``
+
+    :param generations: generations of the models
+    """
+    backend = Configuration.get('pyramid_cache_backend', 'memory')
+    if backend == 'none':
+        return None
+
+    max_size = int(Configuration.get('pyramid_cache_size', 64)) * 1024 * 1024
+    if backend == 'file':
+        directory = Configuration.get('pyramid_cache_dir')
+        if not directory:
+            raise AnyBlokPyramidException(
+                "The file cache needs --pyramid-cache-dir")
+
+        backend = FileCacheBackend(directory, max_size=max_size)
+    else:
+        backend = MemoryCacheBackend(max_size=max_size)
+
+    return ResponseCache(backend, generations,
+                         ttl=int(Configuration.get('pyramid_cache_ttl', 300)))
+
+
+def response_cache(config):
+    """Pyramid includeme, add the view deriver and the cache of the
+    responses
+
+    :param config: Pyramid configurator instance
+    """
+    config.add_view_deriver(cached_view)
+    config.registry.anyblok_response_cache = get_response_cache(
+        add_generations(config))
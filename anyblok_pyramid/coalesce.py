@@ -0,0 +1,333 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+"""Coalescing of the identical concurrent GET requests
+
+With the option ``anyblok_coalesce=True`` (or ``--pyramid-coalesce`` for
+all the views), the identical ``GET`` requests received at the same time
+by a process call the view once: the first request calls it, the others
+wait for its response and get a copy::
+
+    @view_config(route_name='dashboard', renderer='json',
+                 anyblok_coalesce=True)
+    def dashboard(request):
+        ...
+
+The key is the db name, the route, the path, the parameters and the
+``Authorization`` and ``Cookie`` headers (``anyblok_coalesce_vary`` adds
+headers to the key). A request waits at most
+``--pyramid-coalesce-timeout`` seconds, then it calls the view itself. Only
+the responses ``2xx`` and ``3xx`` are shared, the streamed responses and the
+responses with a cookie are not.
+
+With ``--pyramid-coalesce-dir`` the processes of the host are coalesced too:
+the first request locks the lock file of its key and writes its response
+next to it, then removes the lock file. The requests of the other
+processes wait for the lock then read the response, the files are a json
+line followed by the body.
+"""
+import os
+import time
+from collections import Counter
+from hashlib import sha1
+from threading import Event, Lock
+from anyblok.config import Configuration
+from .batch import in_batch
+from .cache import CachedResponse
+from .metrics import Metric, add_metrics_collector
+from logging import getLogger
+logger = getLogger(__name__)
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+
+DEFAULT_VARY = ('Authorization', 'Cookie')
+COALESCED_METHODS = ('GET', 'HEAD')
+LOCK_POLL = 0.01
+_FLIGHT = {}
+
+
+def get_entry(response):
+    """Return the ``CachedResponse`` of the response, None if it can not be
+    shared
+    """
+    if not 200 <= response.status_int < 400:
+        # error, the next request calls the view again
+        return None
+
+    if 'Set-Cookie' in response.headers:
+        return None
+
+    if not isinstance(response.app_iter, (list, tuple)):
+        # streamed response
+        return None
+
+    return CachedResponse.from_response(response, 0)
+
+
+class Flight:
+    """Call in progress, the waiters get its entry"""
+
+    def __init__(self):
+        self.event = Event()
+        self.entry = None
+
+
+class SingleFlight:
+    """Call the function once for the concurrent calls with the same key
+
+    The responses written for the other processes, and the lock files left
+    by a dead process, are removed when they are older than the timeout, it
+    is checked every ``check_every`` writes
+
+    :param timeout: maximum wait of the response of the leader, in seconds
+    :param directory: directory of the locks between the processes
+    """
+
+    check_every = 100
+
+    def __init__(self, timeout=5, directory=None):
+        self.timeout = timeout
+        self.directory = directory
+        self.flights = {}
+        self.lock = Lock()
+        self.counters = Counter()
+        self.writes = 0
+        if directory:
+            if fcntl is None:
+                raise OSError('The coalescing between the processes needs '
+                              'fcntl')
+
+            os.makedirs(directory, exist_ok=True)
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def call(self, key, func):
+        """Return the response of ``func()``, or a copy of the response of
+        the concurrent call with the same key
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+
+        if not leader:
+            return self.wait(flight, func)
+
+        try:
+            response, flight.entry = self.lead(key, func)
+            return response
+        finally:
+            with self.lock:
+                del self.flights[key]
+
+            flight.event.set()
+
+    def wait(self, flight, func):
+        if not flight.event.wait(self.timeout):
+            self.count('timeout')
+            return func()
+
+        if flight.entry is None:
+            # error or response which is not shared
+            self.count('unshared')
+            return func()
+
+        self.count('coalesced')
+        return flight.entry.to_response()
+
+    def lead(self, key, func):
+        if self.directory:
+            return self.lead_between_processes(key, func)
+
+        self.count('called')
+        response = func()
+        return response, get_entry(response)
+
+    def lock_file(self, fd, stop):
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except (IOError, OSError):
+                if time.time() >= stop:
+                    return False
+
+                time.sleep(LOCK_POLL)
+
+    def read_entry(self, path, start):
+        """Return the entry written after start by another process"""
+        try:
+            if os.stat(path).st_mtime < start:
+                return None
+
+            with open(path, 'rb') as fp:
+                return CachedResponse.load(fp)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def write_entry(self, path, entry):
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as fp:
+            entry.dump(fp)
+
+        os.replace(tmp, path)
+        self.writes += 1
+        if not self.writes % self.check_every:
+            self.prune()
+
+    def prune(self):
+        """Remove the responses which no request waits for and the lock
+        files of the dead processes
+        """
+        stop = time.time() - self.timeout
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if os.stat(path).st_mtime < stop:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    @staticmethod
+    def is_current(fd, lock_path):
+        """Return True if the locked file is still the lock file of the
+        key, its leader removes it
+        """
+        try:
+            return os.fstat(fd.fileno()).st_ino == os.stat(lock_path).st_ino
+        except OSError:
+            return False
+
+    def call_locked(self, fd, key, func, start):
+        """Return the response written by the leader of another process, or
+        call the function, None if the lock file was removed by its leader
+        """
+        path = os.path.join(self.directory, key)
+        lock_path = path + '.lock'
+        entry = self.read_entry(path, start)
+        if entry is not None:
+            self.count('coalesced_process')
+            return entry.to_response(), entry
+
+        if not self.is_current(fd, lock_path):
+            return None
+
+        self.count('called')
+        try:
+            response = func()
+            entry = get_entry(response)
+            if entry is not None:
+                self.write_entry(path, entry)
+        finally:
+            try:
+                os.remove(lock_path)
+            except OSError:
+                pass
+
+        return response, entry
+
+    def lead_between_processes(self, key, func):
+        lock_path = os.path.join(self.directory, key + '.lock')
+        start = time.time()
+        while True:
+            with open(lock_path, 'a') as fd:
+                if not self.lock_file(fd, start + self.timeout):
+                    self.count('timeout')
+                    response = func()
+                    return response, get_entry(response)
+
+                try:
+                    result = self.call_locked(fd, key, func, start)
+                finally:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+
+            if result is not None:
+                return result
+
+    def collect(self):
+        """Metrics collector"""
+        with self.lock:
+            counters = sorted(self.counters.items())
+            waiting = len(self.flights)
+
+        yield Metric('anyblok_pyramid_coalesce_in_progress',
+                     'Keys called by a leader', 'gauge', [({}, waiting)])
+        yield Metric('anyblok_pyramid_coalesce_total',
+                     'Coalesced requests by result', 'counter',
+                     [({'result': name}, value) for name, value in counters])
+
+
+def get_key(request, vary):
+    """Return the key of the request"""
+    parts = [Configuration.get('get_db_name')(request) or '']
+    route = request.matched_route
+    parts.append(route.name if route is not None else '')
+    parts.append(request.method)
+    parts.append(request.path)
+    parts.extend('%s=%s' % x for x in sorted(request.GET.items()))
+    parts.extend(request.headers.get(header, '') for header in vary)
+    return sha1('\x00'.join(parts).encode('utf-8')).hexdigest()
+
+
+def coalesce_view(view, info):
+    """View deriver, add the options ``anyblok_coalesce`` and
+    ``anyblok_coalesce_vary`` (headers of the request in the key)
+    """
+    settings = info.settings or {}
+    enabled = info.options.get('anyblok_coalesce',
+                               settings.get('anyblok.coalesce'))
+    if not enabled:
+        return view
+
+    vary = info.options.get('anyblok_coalesce_vary') or ()
+    vary = DEFAULT_VARY + tuple(vary)
+
+    def wrapper(context, request):
+        flight = getattr(request.registry, 'anyblok_single_flight', None)
+        if in_batch(request):
+            flight = None
+
+        if flight is None or request.method not in COALESCED_METHODS:
+            return view(context, request)
+
+        return flight.call(get_key(request, vary),
+                           lambda: view(context, request))
+
+    return wrapper
+
+
+coalesce_view.options = ('anyblok_coalesce', 'anyblok_coalesce_vary')
+
+
+def get_single_flight():
+    """Return the ``SingleFlight`` of the process, created at the first
+    call
+    """
+    flight = _FLIGHT.get('flight')
+    if flight is None:
+        flight = _FLIGHT.setdefault('flight', SingleFlight(
+            timeout=Configuration.get('pyramid_coalesce_timeout') or 5,
+            directory=Configuration.get('pyramid_coalesce_dir')))
+        add_metrics_collector(flight.collect)
+
+    return flight
+
+
+def coalesce(config):
+    """Pyramid includeme, add the view deriver of the coalescing
+
+    :param config: Pyramid configurator instance
+    """
+    config.registry.anyblok_single_flight = get_single_flight()
+    config.add_view_deriver(coalesce_view)
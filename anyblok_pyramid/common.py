@@ -5,29 +5,90 @@
 # This Source Code Form is subject to the terms of the Mozilla Public License,
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok import load_init_function_from_entry_points
 from anyblok.config import Configuration
+from appdirs import AppDirs
+from os import environ, path
 from .anyblok import AnyBlokZopeTransactionExtension
+from .replica import get_replica_router, bind_session
 from anyblok.registry import RegistryManager
+from anyblok.environment import EnvironmentManager
 from logging import getLogger
 
 logger = getLogger(__name__)
 
 
-def get_registry_for(dbname):
+def get_registry_for(dbname, readonly=False):
+    """Return the registry of dbname, with ``--pyramid-replica-url`` the
+    session is bound to the replica if readonly, else to the primary
+    """
     settings = {
         'sa.session.extension': AnyBlokZopeTransactionExtension,
     }
-    return RegistryManager.get(dbname, **settings)
+    registry = RegistryManager.get(dbname, **settings)
+    router = get_replica_router()
+    if router is not None:
+        bind_session(registry, readonly=readonly, router=router)
 
+    return registry
 
-def preload_databases():
-    dbnames = Configuration.get('db_names') or []
-    dbname = Configuration.get('db_name')
+
+def new_registry_for(dbname):
+    """Build a new registry for dbname, without migration, the registry in
+    use is not replaced
+    """
+    settings = {
+        'sa.session.extension': AnyBlokZopeTransactionExtension,
+    }
+    EnvironmentManager.set('db_name', dbname)
     Registry = Configuration.get('Registry')
-    if dbname not in dbnames:
+    registry = Registry(dbname, loadwithoutmigration=True, **settings)
+    registry.commit()
+    registry.session.close()
+    return registry
+
+
+def load_configuration_files():
+    """Load the configuration of the WSGI and ASGI entry points: the init
+    functions, the configuration files of the site, of the user and of
+    ``ANYBLOK_CONFIGFILE``, then the logging
+    """
+    load_init_function_from_entry_points()
+    # load default files
+    ad = AppDirs('AnyBlok')
+    # load the global configuration file
+    Configuration.parse_configfile(
+        path.join(ad.site_config_dir, 'conf.cfg'), ())
+    # load the user configuration file
+    Configuration.parse_configfile(
+        path.join(ad.user_config_dir, 'conf.cfg'), ())
+    # load config file in environment variable
+    configfile = environ.get('ANYBLOK_CONFIGFILE')
+    if configfile:
+        Configuration.parse_configfile(configfile, ())
+
+    if 'logging_level' in Configuration.configuration:
+        Configuration.initialize_logging()
+
+
+def get_database_names():
+    """Return the databases of ``--databases`` and ``--db-name``"""
+    dbnames = list(Configuration.get('db_names') or [])
+    dbname = Configuration.get('db_name')
+    if dbname and dbname not in dbnames:
         dbnames.append(dbname)
 
-    # preload all db names
+    return dbnames
+
+
+def preload_databases(dbnames=None):
+    """Load the registries of dbnames, by default of ``--databases`` and
+    ``--db-name``
+    """
+    if dbnames is None:
+        dbnames = get_database_names()
+
+    Registry = Configuration.get('Registry')
     dbnames = [x for x in dbnames if x]
     logger.info("Preload the databases : %s", ', '.join(dbnames))
     for dbname in dbnames:
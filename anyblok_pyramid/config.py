@@ -21,6 +21,38 @@ Configuration.applications.update({
         'description': "GUNICORN for test your AnyBlok / Pyramid app",
         'configuration_groups': ['gunicorn', 'database'],
     },
+    'pyramid-benchmark': {
+        'prog': 'AnyBlok / Pyramid benchmarks, version %r' % version,
+        'description': "Benchmark the request hot path of AnyBlok / Pyramid",
+        'configuration_groups': ['config', 'database'],
+    },
+    'pyramid-replay': {
+        'prog': 'AnyBlok / Pyramid replay, version %r' % version,
+        'description': "Replay an access log or a synthetic distribution "
+                       "of requests on the local AnyBlok / Pyramid app",
+        'configuration_groups': ['config', 'database'],
+    },
+    'pyramid-static': {
+        'prog': 'AnyBlok / Pyramid static files, version %r' % version,
+        'description': "Build the fingerprinted and compressed static "
+                       "files of the bloks",
+        'configuration_groups': ['config'],
+    },
+    'pyramid-rolling-reload': {
+        'prog': 'AnyBlok / Pyramid rolling reload, version %r' % version,
+        'description': "Replace the gunicorn workers one by one",
+        'configuration_groups': ['config'],
+    },
+    'pyramid-tasks': {
+        'prog': 'AnyBlok / Pyramid tasks, version %r' % version,
+        'description': "Call the durable tasks saved by the requests",
+        'configuration_groups': ['config', 'database'],
+    },
+    'pyramid-outbox': {
+        'prog': 'AnyBlok / Pyramid outbox, version %r' % version,
+        'description': "Give the events of the outbox to the consumers",
+        'configuration_groups': ['config', 'database'],
+    },
 })
 
 
@@ -42,6 +74,35 @@ def define_wsgi_option(group):
     group.add_argument(
         '--wsgi-port', type=int,
         default=os.environ.get('ANYBLOK_PYRAMID_WSGI_PORT', 5000))
+    group.add_argument(
+        '--wsgi-threads', type=int,
+        default=os.environ.get('ANYBLOK_PYRAMID_WSGI_THREADS', 0),
+        help="Number of threads to handle the requests, 0 to handle one "
+             "request at a time")
+    group.add_argument(
+        '--wsgi-processes', type=int,
+        default=os.environ.get('ANYBLOK_PYRAMID_WSGI_PROCESSES', 1),
+        help="Number of processes which serve the same socket")
+    group.add_argument(
+        '--wsgi-keepalive', type=int,
+        default=os.environ.get('ANYBLOK_PYRAMID_WSGI_KEEPALIVE', 5),
+        help="Seconds to wait the next request on a keep alive "
+             "connection (only with threads), 0 to disable the keep alive")
+    group.add_argument(
+        '--wsgi-queue-size', type=int,
+        default=os.environ.get('ANYBLOK_PYRAMID_WSGI_QUEUE_SIZE'),
+        help="Connections accepted which wait for a thread, the number of "
+             "threads by default (only with threads)")
+    group.add_argument(
+        '--wsgi-timeout', type=int,
+        default=os.environ.get('ANYBLOK_PYRAMID_WSGI_TIMEOUT', 30),
+        help="Seconds to wait the first request of a connection (only with "
+             "threads), 0 to wait forever")
+    group.add_argument(
+        '--asgi-max-workers', type=int,
+        default=os.environ.get('ANYBLOK_PYRAMID_ASGI_MAX_WORKERS'),
+        help="Threads of the ASGI application which call the views, "
+             "--wsgi-threads by default")
 
 
 @Configuration.add('pyramid-debug', label="Pyramid")
@@ -93,6 +154,393 @@ def define_wsgi_debug_option(group):
                             "locale name when a locale negotiator is not "
                             "registered.",
                        default='')
+    group.add_argument('--pyramid-memory-debug', dest='memory_debug',
+                       help="Trace the memory allocations and add a view "
+                            "which returns the allocations since the "
+                            "previous call, grouped by blok",
+                       action='store_true')
+    group.add_argument('--pyramid-memory-debug-path',
+                       dest='memory_debug_path', default='/_debug/memory',
+                       help="Path of the memory debug view")
+    group.add_argument('--pyramid-memory-debug-frames',
+                       dest='memory_debug_frames', type=int, default=1,
+                       help="Number of frames stored by tracemalloc for "
+                            "each allocation")
+
+
+@Configuration.add('pyramid-cache', label="Pyramid response cache")
+def define_cache_option(group):
+    group.add_argument('--pyramid-cache-backend',
+                       dest='pyramid_cache_backend', default='memory',
+                       choices=['memory', 'file', 'none'],
+                       help="Backend of the cache of the responses, file "
+                            "is shared by the processes of the host")
+    group.add_argument('--pyramid-cache-size', dest='pyramid_cache_size',
+                       type=int, default=64,
+                       help="Maximum size of the cache in Mo")
+    group.add_argument('--pyramid-cache-ttl', dest='pyramid_cache_ttl',
+                       type=int, default=300,
+                       help="Default time to live of a response, in seconds")
+    group.add_argument('--pyramid-cache-dir', dest='pyramid_cache_dir',
+                       help="Directory of the file backend")
+    group.add_argument('--pyramid-cache-generations',
+                       dest='pyramid_cache_generations',
+                       help="File of the generations of the models, shared "
+                            "by the processes of the host. By default in "
+                            "the directory of the file backend, else in "
+                            "memory")
+    group.add_argument('--pyramid-reference-models',
+                       dest='pyramid_reference_models', nargs="+",
+                       help="Reference models kept in the cache of the "
+                            "process, Model.System.Blok")
+    group.add_argument('--pyramid-reference-max-rows',
+                       dest='pyramid_reference_max_rows', type=int,
+                       default=10000,
+                       help="Maximum number of rows of the reference "
+                            "models in the cache")
+
+
+@Configuration.add('pyramid-reload', label="Reload of the registries")
+def define_reload_option(group):
+    group.add_argument('--pyramid-registry-reload',
+                       dest='pyramid_registry_reload', action='store_true',
+                       help="Reload the registries when the bloks are "
+                            "installed or updated by another process")
+    group.add_argument('--pyramid-registry-check-interval',
+                       dest='pyramid_registry_check_interval', type=int,
+                       default=10,
+                       help="Interval in seconds between two reads of the "
+                            "bloks in the database, 0 to only watch the "
+                            "generations")
+    group.add_argument('--pyramid-registry-release-delay',
+                       dest='pyramid_registry_release_delay', type=int,
+                       default=60,
+                       help="Delay in seconds before closing the connections "
+                            "of a replaced registry")
+
+
+@Configuration.add('benchmark', label="Benchmark")
+def define_benchmark_option(group):
+    group.add_argument('--benchmark-names', dest='benchmark_names',
+                       nargs="+",
+                       help="Benchmarks to run, by default all but the "
+                            "opt-in ones (bulk_100k)")
+    group.add_argument('--benchmark-repeat', dest='benchmark_repeat',
+                       type=int, default=5,
+                       help="Number of repeat for each benchmark")
+    group.add_argument('--benchmark-number', dest='benchmark_number',
+                       type=int,
+                       help="Force the number of calls by repeat")
+    group.add_argument('--benchmark-output', dest='benchmark_output',
+                       help="Save the results in this json file")
+    group.add_argument('--benchmark-compare', dest='benchmark_compare',
+                       help="Json file of the reference results, the exit "
+                            "code is 1 if a regression is found")
+    group.add_argument('--benchmark-tolerance', dest='benchmark_tolerance',
+                       type=float, default=0.1,
+                       help="Accepted slowdown before a regression, 0.1 "
+                            "means 10%%")
+
+
+@Configuration.add('replay', label="Replay")
+def define_replay_option(group):
+    group.add_argument('--replay-access-log', dest='replay_access_log',
+                       help="Access log (common or combined format) to "
+                            "replay")
+    group.add_argument('--replay-methods', dest='replay_methods', nargs="+",
+                       help="Methods of the access log which are replayed, "
+                            "GET and HEAD by default, the log has not the "
+                            "body of the requests")
+    group.add_argument('--replay-routes', dest='replay_routes', nargs="+",
+                       help="Synthetic distribution used without access "
+                            "log, 'METHOD PATH:WEIGHT', {id} is replaced "
+                            "by a random number")
+    group.add_argument('--replay-requests', dest='replay_requests',
+                       type=int, default=1000,
+                       help="Number of requests of the synthetic "
+                            "distribution")
+    group.add_argument('--replay-seed', dest='replay_seed', type=int,
+                       help="Seed of the random generator")
+    group.add_argument('--replay-concurrency', dest='replay_concurrency',
+                       type=int, default=1,
+                       help="Number of concurrent clients")
+    group.add_argument('--replay-tenants', dest='replay_tenants', nargs="+",
+                       help="db names, 'DB_NAME:WEIGHT', distributed on "
+                            "the requests")
+    group.add_argument('--replay-tenant-header', dest='replay_tenant_header',
+                       help="Header which gives the db name of the request")
+    group.add_argument('--replay-tenant-host', dest='replay_tenant_host',
+                       help="Host header of the request, {db_name} is "
+                            "replaced by the db name")
+    group.add_argument('--replay-url', dest='replay_url',
+                       help="Url of a server on the loopback, by default "
+                            "the requests are played in this process")
+    group.add_argument('--replay-gunicorn-args', dest='replay_gunicorn_args',
+                       help="Start a local gunicorn_anyblok_pyramid with "
+                            "these arguments and play the requests on it")
+    group.add_argument('--replay-output', dest='replay_output',
+                       help="Save the report in this json file")
+
+
+@Configuration.add('admission', label="Admission control")
+def define_admission_option(group):
+    group.add_argument('--admission-limit', dest='admission_limit', type=int,
+                       default=0,
+                       help="Maximum number of requests in progress by "
+                            "database, 0 for no limit")
+    group.add_argument('--admission-queue', dest='admission_queue', type=int,
+                       default=0,
+                       help="Maximum number of requests waiting by database")
+    group.add_argument('--admission-timeout', dest='admission_timeout',
+                       type=float, default=5,
+                       help="Maximum wait in the queue, in seconds")
+    group.add_argument('--admission-retry-after',
+                       dest='admission_retry_after', type=int, default=5,
+                       help="Retry-After header of the 503 responses")
+    group.add_argument('--admission-exclude', dest='admission_exclude',
+                       nargs="+",
+                       help="Prefixes of the paths which are not limited")
+
+
+@Configuration.add('pyramid-timeout', label="Timeouts of the requests")
+def define_timeout_option(group):
+    group.add_argument('--pyramid-statement-timeout',
+                       dest='pyramid_statement_timeout', type=int,
+                       help="Default statement timeout of the views in ms, "
+                            "PostgreSQL only")
+    group.add_argument('--pyramid-request-deadline',
+                       dest='pyramid_request_deadline', type=float,
+                       help="Default deadline of the views in seconds")
+
+
+@Configuration.add('pyramid-replica', label="Replica of the databases")
+def define_replica_option(group):
+    group.add_argument('--pyramid-replica-url', dest='pyramid_replica_url',
+                       help="SQLAlchemy url of the replica used by the read "
+                            "only requests, the database of the request is "
+                            "used if the url has no database")
+    group.add_argument('--pyramid-replica-max-lag',
+                       dest='pyramid_replica_max_lag', type=float, default=5,
+                       help="Maximum replication lag in seconds, the primary "
+                            "is used over it")
+    group.add_argument('--pyramid-replica-lag-interval',
+                       dest='pyramid_replica_lag_interval', type=float,
+                       default=1,
+                       help="Seconds between two checks of the lag")
+    group.add_argument('--pyramid-replica-sticky',
+                       dest='pyramid_replica_sticky', type=float, default=5,
+                       help="Seconds during which the client of a request "
+                            "which writes reads the primary, 0 to disable")
+
+
+@Configuration.add('pyramid-pool', label="Pool of connections")
+def define_pool_option(group):
+    group.add_argument('--pyramid-pool-size', dest='pyramid_pool_size',
+                       type=int,
+                       help="Size of the pool by database, by default the "
+                            "number of threads of the worker")
+    group.add_argument('--pyramid-pool-max-overflow',
+                       dest='pyramid_pool_max_overflow', type=int,
+                       help="Connections over the size of the pool, by "
+                            "default the number of threads of the worker")
+    group.add_argument('--pyramid-pool-timeout', dest='pyramid_pool_timeout',
+                       type=float, default=30,
+                       help="Seconds to wait a connection of the pool")
+    group.add_argument('--pyramid-pool-recycle', dest='pyramid_pool_recycle',
+                       type=int, default=-1,
+                       help="Seconds before the connections are recycled")
+    group.add_argument('--pyramid-pool-pre-ping',
+                       dest='pyramid_pool_pre_ping', action='store_true',
+                       help="Test the connections when they are got")
+    group.add_argument('--pyramid-pool-max-connections',
+                       dest='pyramid_pool_max_connections', type=int,
+                       help="Maximum connections of the server, for all the "
+                            "processes and all the databases")
+    group.add_argument('--pyramid-pool-databases',
+                       dest='pyramid_pool_databases',
+                       help="Json file with the pool options by database")
+
+
+@Configuration.add('pyramid-batch', label="Batch of requests")
+def define_batch_option(group):
+    group.add_argument('--pyramid-batch-path', dest='pyramid_batch_path',
+                       help="Path of the batch of requests, no batch if "
+                            "empty")
+    group.add_argument('--pyramid-batch-max-size',
+                       dest='pyramid_batch_max_size', type=int, default=50,
+                       help="Maximum number of requests in a batch")
+    group.add_argument('--pyramid-batch-headers',
+                       dest='pyramid_batch_headers', nargs="+",
+                       help="Headers of the batch given to its requests, "
+                            "with Accept, Accept-Language, Authorization, "
+                            "Cookie and User-Agent")
+
+
+@Configuration.add('pyramid-task', label="Tasks after commit")
+def define_task_option(group):
+    group.add_argument('--pyramid-task-threads', dest='pyramid_task_threads',
+                       type=int, default=2,
+                       help="Threads of the worker which call the tasks")
+    group.add_argument('--pyramid-task-queue-size',
+                       dest='pyramid_task_queue_size', type=int, default=1000,
+                       help="Maximum number of tasks waiting, the request "
+                            "calls the task over it")
+    group.add_argument('--pyramid-task-retries', dest='pyramid_task_retries',
+                       type=int, default=3,
+                       help="Calls of a failed task after the first one")
+    group.add_argument('--pyramid-task-retry-delay',
+                       dest='pyramid_task_retry_delay', type=float, default=1,
+                       help="Seconds before the first retry, doubled by "
+                            "retry")
+    group.add_argument('--pyramid-task-drain-timeout',
+                       dest='pyramid_task_drain_timeout', type=float,
+                       default=10,
+                       help="Seconds given to the tasks of the queue at the "
+                            "exit of the worker, keep it lower than the "
+                            "graceful timeout of the server")
+    group.add_argument('--pyramid-task-batch-size',
+                       dest='pyramid_task_batch_size', type=int, default=100,
+                       help="Durable tasks processed by transaction")
+    group.add_argument('--pyramid-task-poll-interval',
+                       dest='pyramid_task_poll_interval', type=float,
+                       default=1,
+                       help="Seconds to wait when there is no durable task")
+
+
+@Configuration.add('pyramid-outbox', label="Outbox of the changes")
+def define_outbox_option(group):
+    group.add_argument('--pyramid-outbox-models',
+                       dest='pyramid_outbox_models', nargs="+",
+                       help="Models recorded in the outbox, all by default")
+    group.add_argument('--pyramid-outbox-consumers',
+                       dest='pyramid_outbox_consumers', nargs="+",
+                       help="Dotted names of the consumers of the outbox, "
+                            "package.module:function")
+    group.add_argument('--pyramid-outbox-batch-size',
+                       dest='pyramid_outbox_batch_size', type=int,
+                       default=500,
+                       help="Events given to the consumers by call")
+    group.add_argument('--pyramid-outbox-poll-interval',
+                       dest='pyramid_outbox_poll_interval', type=float,
+                       default=1,
+                       help="Seconds to wait when there is no event")
+    group.add_argument('--pyramid-outbox-max-attempts',
+                       dest='pyramid_outbox_max_attempts', type=int,
+                       default=5,
+                       help="Failed calls of the consumers after which an "
+                            "event is kept in the state failed")
+
+
+@Configuration.add('pyramid-idempotency', label="Idempotency keys")
+def define_idempotency_option(group):
+    group.add_argument('--pyramid-idempotency', dest='pyramid_idempotency',
+                       action='store_true',
+                       help="Save the responses of the idempotency keys for "
+                            "all the views, else only for the views with "
+                            "anyblok_idempotency=True")
+    group.add_argument('--pyramid-idempotency-ttl',
+                       dest='pyramid_idempotency_ttl', type=int,
+                       default=86400,
+                       help="Seconds before an idempotency key expires")
+    group.add_argument('--pyramid-idempotency-purge-interval',
+                       dest='pyramid_idempotency_purge_interval', type=int,
+                       default=300,
+                       help="Seconds between two deletions of the expired "
+                            "keys by process, 0 to never delete them")
+    group.add_argument('--pyramid-idempotency-purge-size',
+                       dest='pyramid_idempotency_purge_size', type=int,
+                       default=1000,
+                       help="Expired keys deleted by batch")
+
+
+@Configuration.add('pyramid-coalesce', label="Coalescing of the requests")
+def define_coalesce_option(group):
+    group.add_argument('--pyramid-coalesce', dest='pyramid_coalesce',
+                       action='store_true',
+                       help="Coalesce the identical GET requests of all the "
+                            "views, else only of the views with "
+                            "anyblok_coalesce=True")
+    group.add_argument('--pyramid-coalesce-timeout',
+                       dest='pyramid_coalesce_timeout', type=float,
+                       default=5,
+                       help="Maximum wait of the response of the first "
+                            "request, in seconds")
+    group.add_argument('--pyramid-coalesce-dir', dest='pyramid_coalesce_dir',
+                       help="Directory of the locks, to coalesce the "
+                            "requests of all the processes of the host")
+
+
+@Configuration.add('pyramid-tenant', label="Tenants")
+def define_tenant_option(group):
+    group.add_argument('--pyramid-tenant-mapping',
+                       dest='pyramid_tenant_mapping',
+                       help="JSON file of the databases by kind and value "
+                            "of the tenant")
+    group.add_argument('--pyramid-tenant-url', dest='pyramid_tenant_url',
+                       help="SQLAlchemy url of the database of the table of "
+                            "the tenants")
+    group.add_argument('--pyramid-tenant-query',
+                       dest='pyramid_tenant_query',
+                       default='SELECT kind, value, db_name FROM tenant',
+                       help="Query of the rows (kind, value, db_name) of "
+                            "the tenants")
+    group.add_argument('--pyramid-tenant-ttl', dest='pyramid_tenant_ttl',
+                       type=float, default=60,
+                       help="Seconds between two loads of the mapping, 0 to "
+                            "load it once")
+    group.add_argument('--pyramid-tenant-kinds', dest='pyramid_tenant_kinds',
+                       nargs="+",
+                       choices=['header', 'host', 'subdomain', 'prefix'],
+                       default=['host', 'subdomain', 'prefix'],
+                       help="Kinds of value of the request tried in this "
+                            "order, add header to trust the header of the "
+                            "tenant")
+    group.add_argument('--pyramid-tenant-header',
+                       dest='pyramid_tenant_header', default='X-Tenant',
+                       help="Header of the tenant")
+    group.add_argument('--pyramid-tenant-domain',
+                       dest='pyramid_tenant_domain',
+                       help="Domain of the subdomains of the tenants, "
+                            "example.com")
+    group.add_argument('--pyramid-tenant-exclude',
+                       dest='pyramid_tenant_exclude', nargs="+",
+                       help="Prefixes of the paths served without tenant, "
+                            "the others get 404 for an unknown tenant")
+
+
+@Configuration.add('pyramid-metrics', label="Metrics")
+def define_metrics_option(group):
+    group.add_argument('--pyramid-metrics-path', dest='pyramid_metrics_path',
+                       help="Path of the metrics in the text format of "
+                            "Prometheus, /metrics")
+
+
+@Configuration.add('rolling-reload', label="Rolling reload")
+def define_rolling_reload_option(group):
+    group.add_argument('--rolling-pidfile', dest='rolling_pidfile',
+                       help="Pid file of the gunicorn arbiter started with "
+                            "--rolling-reload")
+    group.add_argument('--rolling-wait', dest='rolling_wait', type=int,
+                       default=300,
+                       help="Seconds to wait the end of the reload")
+
+
+@Configuration.add('static', label="Static files")
+def define_static_option(group):
+    group.add_argument('--static-build-dir', dest='static_build_dir',
+                       default=os.environ.get(
+                           'ANYBLOK_PYRAMID_STATIC_BUILD_DIR'),
+                       help="Directory of the built static files, if it is "
+                            "defined the built files are served instead of "
+                            "the static paths of the bloks")
+    group.add_argument('--static-stat-cache-ttl',
+                       dest='static_stat_cache_ttl', type=float, default=2,
+                       help="Seconds during which the stat of a static "
+                            "file is kept, 0 to disable the cache")
+    group.add_argument('--static-cache-max-age',
+                       dest='static_cache_max_age', type=int, default=3600,
+                       help="Seconds of cache by the clients of the static "
+                            "files of the bloks which are not built")
 
 
 @Configuration.add('gunicorn')
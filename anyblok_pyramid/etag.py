@@ -0,0 +1,94 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+"""ETag of the views computed from the generations of the models
+
+A view declares the models it reads::
+
+    @view_config(route_name='products', renderer='json',
+                 anyblok_etag_models=['Model.Product'])
+    def products(request):
+        ...
+
+The ETag is known before the view is called: if the client sends it in
+``If-None-Match``, the answer is ``304 Not Modified`` without calling the
+view, nor opening a transaction.
+"""
+from hashlib import sha1
+from anyblok.config import Configuration
+from pyramid.httpexceptions import HTTPNotModified
+from .batch import in_batch
+from .generation import add_generations, check_shared
+from .replica import use_primary
+
+
+def compute_etag(generations, db_name, models, request, vary=()):
+    """Return the ETag of the models for this request
+
+    :param generations: generations of the models
+    :param db_name: name of the database
+    :param models: sorted registry names of the models
+    :param request: Pyramid request
+    :param vary: headers of the request which change the response
+    """
+    parts = [db_name, str(generations.epoch)]
+    parts.extend(str(x) for x in generations.get_many(db_name, models))
+    parts.extend(request.headers.get(header, '') for header in vary)
+    return sha1('\x00'.join(parts).encode('utf-8')).hexdigest()[:20]
+
+
+def etag_view(view, info):
+    """View deriver, add the options ``anyblok_etag_models`` (models read
+    by the view) and ``anyblok_etag_vary`` (headers of the request which
+    change the response)
+    """
+    models = info.options.get('anyblok_etag_models')
+    if models is None:
+        return view
+
+    generations = getattr(info.registry, 'anyblok_generations', None)
+    if generations is not None:
+        check_shared(generations, 'anyblok_etag_models')
+
+    models = sorted(models)
+    vary = tuple(info.options.get('anyblok_etag_vary') or ())
+
+    def wrapper(context, request):
+        generations = getattr(request.registry, 'anyblok_generations', None)
+        if in_batch(request):
+            generations = None
+
+        if generations is None or request.method not in ('GET', 'HEAD'):
+            return view(context, request)
+
+        db_name = Configuration.get('get_db_name')(request)
+        etag = compute_etag(generations, db_name, models, request, vary=vary)
+        if etag in request.if_none_match:
+            return HTTPNotModified(headers={'ETag': '"%s"' % etag})
+
+        primary = use_primary(request)
+        response = view(context, request)
+        if primary and response.status_int == 200 and response.etag is None:
+            response.etag = etag
+            if vary:
+                response.vary = tuple(response.vary or ()) + vary
+
+        return response
+
+    return wrapper
+
+
+etag_view.options = ('anyblok_etag_models', 'anyblok_etag_vary')
+
+
+def etag(config):
+    """Pyramid includeme, add the view deriver of the ETags
+
+    :param config: Pyramid configurator instance
+    """
+    add_generations(config)
+    config.add_view_deriver(etag_view)
@@ -0,0 +1,237 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+"""Generation counters of the models
+
+A counter by database and model is incremented after each commit which
+changed the model. A value computed from a model (a cached response, an
+ETag) keeps the generations of the models it depends on, it is valid while
+they are unchanged.
+
+The epoch is changed by ``bump_all``, it invalidates all the values. The
+first epoch is given to the forked processes by the environment, so the
+workers of a server compute the same values.
+"""
+import fcntl
+import mmap
+import os
+import struct
+from random import getrandbits
+from threading import Lock
+from zlib import crc32
+from anyblok.config import Configuration
+from . import AnyBlokPyramidException
+from .anyblok import add_commit_listener, remove_commit_listener
+from .pool import get_concurrency
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+EPOCH_ENV = 'ANYBLOK_PYRAMID_EPOCH'
+_GENERATIONS = {}
+_LOCK = Lock()
+
+
+def get_epoch():
+    """Return the first epoch, chosen by the first call and given to the
+    processes forked after it by the environment
+    """
+    if not os.environ.get(EPOCH_ENV):
+        os.environ[EPOCH_ENV] = str(getrandbits(32) or 1)
+
+    return int(os.environ[EPOCH_ENV])
+
+
+class MemoryGenerations:
+    """Generations of the process"""
+
+    def __init__(self):
+        self.counters = {}
+        self.lock = Lock()
+        self.epoch = get_epoch()
+
+    def get(self, db_name, model):
+        return self.counters.get((db_name, model), 0)
+
+    def get_many(self, db_name, models):
+        return tuple(self.get(db_name, model) for model in models)
+
+    def bump(self, db_name, models):
+        with self.lock:
+            for model in models:
+                key = (db_name, model)
+                self.counters[key] = self.counters.get(key, 0) + 1
+
+    def bump_all(self):
+        with self.lock:
+            self.epoch += 1
+
+    def invalidate(self, registry, models):
+        """Commit listener, increment the generations of the models"""
+        if models:
+            self.bump(registry.db_name, models)
+
+
+class FileGenerations(MemoryGenerations):
+    """Generations shared by the processes of the host, in a file mapped in
+    memory
+
+    Each (db name, model) is hashed on a slot of the file: two models on
+    the same slot are invalidated together, never forgotten. The first slot
+    is the epoch.
+
+    :param path: path of the file, created if needed
+    :param slots: number of slots
+    """
+
+    SLOT = struct.Struct('Q')
+
+    def __init__(self, path, slots=4096):
+        self.path = path
+        self.slots = slots
+        size = self.SLOT.size * (slots + 1)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self.lock = Lock()
+        with self.locked():
+            if os.fstat(self.fd).st_size < size:
+                os.ftruncate(self.fd, size)
+
+            self.mmap = mmap.mmap(self.fd, size)
+            if not self.read(0):
+                self.write(0, get_epoch())
+
+    def locked(self):
+        return FileLock(self.fd, self.lock)
+
+    def read(self, slot):
+        return self.SLOT.unpack_from(self.mmap, slot * self.SLOT.size)[0]
+
+    def write(self, slot, value):
+        self.SLOT.pack_into(self.mmap, slot * self.SLOT.size, value)
+
+    def slot(self, db_name, model):
+        key = ('%s:%s' % (db_name, model)).encode('utf-8')
+        return crc32(key) % self.slots + 1
+
+    @property
+    def epoch(self):
+        return self.read(0)
+
+    def get(self, db_name, model):
+        return self.read(self.slot(db_name, model))
+
+    def bump(self, db_name, models):
+        slots = set(self.slot(db_name, model) for model in models)
+        with self.locked():
+            for slot in slots:
+                self.write(slot, self.read(slot) + 1)
+
+    def bump_all(self):
+        with self.locked():
+            self.write(0, self.read(0) + 1)
+
+    def close(self):
+        self.mmap.close()
+        os.close(self.fd)
+
+
+class FileLock:
+    """Lock between the threads and between the processes"""
+
+    def __init__(self, fd, lock):
+        self.fd = fd
+        self.lock = lock
+
+    def __enter__(self):
+        self.lock.acquire()
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *args):
+        fcntl.lockf(self.fd, fcntl.LOCK_UN)
+        self.lock.release()
+
+
+def get_generations():
+    """Return the generations defined by the configuration, in the file
+    ``--pyramid-cache-generations``, by default in the directory of the
+    cache with the file cache or several processes, else in memory
+
+    The generations in memory are not seen by the other processes, with
+    several processes they are refused by ``check_shared`` when a view or
+    a reference model uses them
+    """
+    processes = get_concurrency()[0]
+    path = Configuration.get('pyramid_cache_generations')
+    directory = Configuration.get('pyramid_cache_dir')
+    shared = processes > 1 or Configuration.get(
+        'pyramid_cache_backend') == 'file'
+    if not path and directory and shared:
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, 'generations')
+
+    if path:
+        return FileGenerations(path)
+
+    if processes > 1:
+        logger.warning("The generations in memory are not shared by the %d "
+                       "processes, the cache, the ETags and the reference "
+                       "models need --pyramid-cache-generations", processes)
+
+    return MemoryGenerations()
+
+
+def check_shared(generations, option):
+    """Refuse the generations in memory with several processes, a process
+    would not see the commits of the others
+
+    :param generations: generations used by the option
+    :param option: option of the view or of the configuration
+    :exception: AnyBlokPyramidException
+    """
+    processes = get_concurrency()[0]
+    if processes > 1 and not isinstance(generations, FileGenerations):
+        raise AnyBlokPyramidException(
+            "%s with %d processes needs --pyramid-cache-generations or "
+            "--pyramid-cache-dir" % (option, processes))
+
+
+def get_process_generations():
+    """Return the generations of the process, created the first time with
+    the commit listener which increments them
+    """
+    with _LOCK:
+        generations = _GENERATIONS.get('generations')
+        if generations is None:
+            generations = get_generations()
+            add_commit_listener(generations.invalidate)
+            _GENERATIONS['generations'] = generations
+
+    return generations
+
+
+def add_generations(config):
+    """Return the generations of the process (``get_process_generations``),
+    given to the Pyramid registry (``registry.anyblok_generations``)
+
+    :param config: Pyramid configurator instance
+    """
+    generations = get_process_generations()
+    config.registry.anyblok_generations = generations
+    return generations
+
+
+def reset_generations():
+    """Remove the commit listener and forget the generations, the next
+    call of ``add_generations`` creates new ones
+    """
+    with _LOCK:
+        generations = _GENERATIONS.pop('generations', None)
+
+    if generations is not None:
+        remove_commit_listener(generations.invalidate)
+        if isinstance(generations, FileGenerations):
+            generations.close()
@@ -7,16 +7,30 @@
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
 from gunicorn.config import (Config as GunicornConfig,
-                             Setting, validate_callable, validate_post_request)
+                             Setting, validate_callable, validate_post_request,
+                             validate_pos_int, validate_bool,
+                             validate_string, validate_list_string)
 from gunicorn.app.base import Application
-from gunicorn import __version__
+from gunicorn.arbiter import Arbiter
+from gunicorn import __version__, debug, util
 from anyblok.config import Configuration, getParser
 from anyblok.blok import BlokManager
-from .pyramid_config import Configurator
+from .reload import get_wsgi_app
 import argparse
+import os
 import six
+import sys
+from shutil import rmtree
+from tempfile import mkdtemp
 from anyblok import load_init_function_from_entry_points
+from .affinity import SLOT_ENV, TOKEN_ENV, TenantAffinity, assign_slot
 from .common import preload_databases
+from .config import get_db_name
+from .generation import get_epoch
+from .memory import check_worker_memory
+from .pool import set_concurrency
+from .rolling import (READY_DIR_ENV, RollingReload, probe_application,
+                      get_worker_state, clean_ready_files, write_status)
 from logging import getLogger
 logger = getLogger(__name__)
 
@@ -88,6 +102,8 @@ class WSGIApplication(Application):
 
     def init(self, parser, opts, args):
         Configuration.parse_options(opts, ('gunicorn',))
+        # in the arbiter, the workers get the same epoch
+        get_epoch()
 
         # get the configuration save in AnyBlok configuration in
         # gunicorn configuration
@@ -97,13 +113,164 @@ class WSGIApplication(Application):
                 if value:
                     self.cfg.settings[name].set(value)
 
+    def get_tenant_affinity(self):
+        """Return the ``TenantAffinity`` of the worker, None if the option
+        ``--tenant-affinity-port`` is not used
+        """
+        if not self.cfg.tenant_affinity_port or SLOT_ENV not in os.environ:
+            if self.cfg.tenant_affinity_port:
+                logger.warning("The worker has no slot (preloaded "
+                               "application or pre_fork without assign_slot)"
+                               ", the tenant affinity is disabled")
+
+            return None
+
+        if Configuration.get('get_db_name') is get_db_name:
+            logger.warning("The default get_db_name gives the same database "
+                           "to all the requests, the tenant affinity is "
+                           "disabled")
+            return None
+
+        return TenantAffinity(
+            int(os.environ[SLOT_ENV]), self.cfg.workers,
+            self.cfg.tenant_affinity_port, os.environ[TOKEN_ENV],
+            timeout=self.cfg.timeout or None, threads=self.cfg.threads)
+
     def load(self):
+        affinity = self.get_tenant_affinity()
+        threads = self.cfg.threads
+        if affinity is not None:
+            # the forwarded requests are served by the threads of the
+            # affinity with the registries of the worker
+            threads += affinity.threads
+
+        set_concurrency(self.cfg.workers, threads)
         BlokManager.load()
-        preload_databases()
-        config = Configurator()
-        config.include_from_entry_point()
-        config.load_config_bloks()
-        return config.make_wsgi_app()
+        if affinity is None:
+            preload_databases()
+            return get_wsgi_app()
+
+        preload_databases(affinity.get_database_names())
+        return affinity.start(get_wsgi_app())
+
+    def wsgi(self):
+        app = super(WSGIApplication, self).wsgi()
+        # only in the workers, the arbiter gives the directory
+        probe_application(app, self.cfg.rolling_probe_path,
+                          host=self.cfg.rolling_probe_host,
+                          headers=self.cfg.rolling_probe_headers)
+        return app
+
+    def run(self):
+        """Run the ``RollingArbiter`` with ``--rolling-reload``, the
+        process is prepared as by ``Application.run``
+        """
+        if not self.cfg.rolling_reload or self.cfg.check_config:
+            return super(WSGIApplication, self).run()
+
+        if self.cfg.spew:
+            debug.spew()
+
+        if self.cfg.daemon:
+            util.daemonize(self.cfg.enable_stdio_inheritance)
+
+        if self.cfg.pythonpath:
+            for path in self.cfg.pythonpath.split(","):
+                path = os.path.abspath(path)
+                if path not in sys.path:
+                    sys.path.insert(0, path)
+
+        try:
+            RollingArbiter(self).run()
+        except RuntimeError as e:
+            print("\nError: %s\n" % e, file=sys.stderr)
+            sys.stderr.flush()
+            sys.exit(1)
+
+
+class RollingArbiter(Arbiter):
+    """Arbiter which replaces the workers one by one on SIGHUP, see
+    ``anyblok_pyramid.rolling``
+    """
+
+    rolling = None
+    ready_dir = None
+    reloading_config = False
+
+    def start(self):
+        self.ready_dir = mkdtemp(prefix='anyblok-pyramid-')
+        os.environ[READY_DIR_ENV] = self.ready_dir
+        super(RollingArbiter, self).start()
+
+    @property
+    def status_file(self):
+        if self.cfg.pidfile:
+            return self.cfg.pidfile + '.reload'
+
+        return None
+
+    def get_worker_state(self, pid):
+        return get_worker_state(self.ready_dir, pid)
+
+    def spawn_worker(self):
+        if self.reloading_config:
+            # the new workers are started one by one by the rolling reload
+            return None
+
+        return super(RollingArbiter, self).spawn_worker()
+
+    def handle_hup(self):
+        if self.rolling is not None:
+            self.log.warning("A rolling reload is already in progress")
+            return
+
+        # gunicorn reloads the configuration, the logs and the pid file
+        self.reloading_config = True
+        try:
+            super(RollingArbiter, self).handle_hup()
+        finally:
+            self.reloading_config = False
+
+        if not self.cfg.rolling_reload:
+            # disabled by the new configuration
+            for _ in range(self.cfg.workers):
+                self.spawn_worker()
+
+            self.manage_workers()
+            return
+
+        self.log.info("Rolling reload of %d workers", len(self.WORKERS))
+        if self.cfg.preload_app:
+            self.log.warning("The application is preloaded, the new workers "
+                             "are forked with the old application")
+
+        clean_ready_files(self.ready_dir, [str(x) for x in self.WORKERS])
+        workers = sorted(self.WORKERS.items(), key=lambda w: w[1].age)
+        self.rolling = RollingReload([pid for pid, worker in workers],
+                                     timeout=self.cfg.rolling_timeout)
+        write_status(self.status_file, 'running')
+        self.manage_workers()
+
+    def manage_workers(self):
+        if self.reloading_config:
+            return
+
+        if self.rolling is None:
+            return super(RollingArbiter, self).manage_workers()
+
+        status = self.rolling.step(self)
+        if status is not None:
+            self.rolling = None
+            self.log.info("Rolling reload: %s", status)
+            write_status(self.status_file, status)
+            super(RollingArbiter, self).manage_workers()
+
+    def halt(self, reason=None, exit_status=0):
+        if self.ready_dir:
+            rmtree(self.ready_dir, ignore_errors=True)
+
+        super(RollingArbiter, self).halt(reason=reason,
+                                         exit_status=exit_status)
 
 
 class PreRequest(Setting):
@@ -133,6 +300,7 @@ class PostRequest(Setting):
     def post_request(worker, req, environ, resp):
         logger.info("POST-REQUEST => %s %s | %r" % (
             req.method, req.path, resp.status))
+        check_worker_memory(worker)
 
     default = staticmethod(post_request)
     desc = """\
@@ -140,4 +308,145 @@ class PostRequest(Setting):
 
         The callable needs to accept two instance variables for the Worker and
         the Request.
+
+        The default callable recycles the worker if its memory is greater
+        than ``max_worker_memory``, call
+        ``anyblok_pyramid.memory.check_worker_memory`` if you overwrite it.
+    """
+
+
+class PreFork(Setting):
+    name = "pre_fork"
+    section = "Server Hooks"
+    validator = validate_callable(2)
+    type = six.callable
+
+    def pre_fork(server, worker):
+        assign_slot(server, worker)
+
+    default = staticmethod(pre_fork)
+    desc = """\
+        Called just before a worker is forked.
+
+        The callable needs to accept two instance variables for the Arbiter
+        and new Worker.
+
+        The default callable gives its slot to the worker with
+        ``tenant_affinity_port``, call ``anyblok_pyramid.affinity.assign_slot``
+        if you overwrite it.
+    """
+
+
+class MaxWorkerMemory(Setting):
+    name = "max_worker_memory"
+    section = "Worker Processes"
+    cli = ["--max-worker-memory"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = int
+    default = 0
+    desc = """\
+        The maximum resident memory (in Mo) of a worker before restarting.
+
+        The resident memory is checked after each request by the
+        ``post_request`` hook, when it is greater than this value the worker
+        finishes the current request and is gracefully replaced by a new one.
+
+        If this is set to zero (the default) the memory is not checked.
+    """
+
+
+class RollingReloadSetting(Setting):
+    name = "rolling_reload"
+    section = "Server Mechanics"
+    cli = ["--rolling-reload"]
+    validator = validate_bool
+    action = "store_true"
+    default = False
+    desc = """\
+        Replace the workers one by one on SIGHUP.
+
+        A new worker is started and probed before the oldest one is
+        stopped, see ``anyblok_pyramid_reload``.
+    """
+
+
+class RollingProbePath(Setting):
+    name = "rolling_probe_path"
+    section = "Server Mechanics"
+    cli = ["--rolling-probe-path"]
+    meta = "STRING"
+    validator = validate_string
+    default = "/"
+    desc = """\
+        Path called by a new worker of a rolling reload before it is used.
+
+        A status lower than 500 is healthy.
+    """
+
+
+class RollingProbeHost(Setting):
+    name = "rolling_probe_host"
+    section = "Server Mechanics"
+    cli = ["--rolling-probe-host"]
+    meta = "STRING"
+    validator = validate_string
+    default = None
+    desc = """\
+        Host of the request of the probe of a rolling reload.
+
+        With the tenants resolved by the host, give the host of a tenant.
+    """
+
+
+class RollingProbeHeaders(Setting):
+    name = "rolling_probe_headers"
+    action = "append"
+    section = "Server Mechanics"
+    cli = ["--rolling-probe-header"]
+    meta = "HEADER"
+    validator = validate_list_string
+    default = []
+    desc = """\
+        Header of the request of the probe of a rolling reload
+        (``Name: value``), can be given several times.
+
+        With the tenants resolved by a header, give the header of a tenant.
+    """
+
+
+class RollingTimeout(Setting):
+    name = "rolling_timeout"
+    section = "Server Mechanics"
+    cli = ["--rolling-timeout"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = int
+    default = 120
+    desc = """\
+        Seconds given to a new worker of a rolling reload to be ready.
+
+        After this delay the reload is stopped and the old workers are kept.
+    """
+
+
+class TenantAffinityPort(Setting):
+    name = "tenant_affinity_port"
+    section = "Worker Processes"
+    cli = ["--tenant-affinity-port"]
+    meta = "INT"
+    validator = validate_pos_int
+    type = int
+    default = 0
+    desc = """\
+        First port of the tenant-affine workers on the loopback.
+
+        The databases of ``--databases`` are shared between the workers by
+        consistent hashing, each worker preloads only its databases and
+        serves the port ``tenant_affinity_port + slot``. The requests for
+        the databases of another worker are forwarded to its port, see
+        ``anyblok_pyramid.affinity``.
+
+        If this is set to zero (the default) all the workers preload all
+        the databases.
     """
@@ -0,0 +1,276 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+"""Idempotency keys of the unsafe requests
+
+A client which retries a ``POST`` sends the same ``Idempotency-Key``
+header. With the blok ``pyramid-idempotency`` installed, the views with the
+option ``anyblok_idempotency=True`` (or all the views with
+``--pyramid-idempotency``) save their response for the key, in the
+transaction of the request::
+
+    @view_config(route_name='order', request_method='POST',
+                 renderer='json', anyblok_idempotency=True)
+    def create_order(request):
+        ...
+
+The keys are scoped by the authenticated user of the request, or by its
+``Authorization`` and ``Cookie`` headers without authentication policy: two
+clients with the same key do not share their responses.
+
+A request with a known key gets the saved response, with the header
+``Idempotent-Replayed: true``, the view is not called. A concurrent request
+with the same key waits for the commit of the first one (PostgreSQL). If
+the first request is aborted, nothing is saved and the next one calls the
+view. The same key with another method, path or body is answered by
+``422``. A streamed response (``app_iter`` which is not a list) is not
+saved, the key is released.
+
+The keys expire after ``--pyramid-idempotency-ttl`` seconds, the expired
+keys are deleted by batch, at most once by
+``--pyramid-idempotency-purge-interval`` seconds and by process.
+"""
+import hashlib
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from threading import Lock
+from anyblok.config import Configuration
+from pyramid.httpexceptions import (HTTPBadRequest, HTTPConflict,
+                                    HTTPUnprocessableEntity)
+from pyramid.response import Response
+from sqlalchemy import and_, select, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from .anyblok import mark_changed
+from .metrics import Metric, add_metrics_collector
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+IDEMPOTENCY = 'Model.Pyramid.Idempotency'
+UNSAFE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+KEY_SIZE = 255
+_COUNTERS = Counter()
+_PURGE = {'last': 0}
+_LOCK = Lock()
+
+
+def count(name):
+    with _LOCK:
+        _COUNTERS[name] += 1
+
+
+def collect_idempotency():
+    """Metrics collector"""
+    yield Metric('anyblok_pyramid_idempotency_total',
+                 'Requests with an idempotency key', 'counter',
+                 [({'result': result}, value)
+                  for result, value in sorted(_COUNTERS.items())])
+
+
+def get_scope(request):
+    """Return the hash of the authenticated user of the request, or of its
+    credentials
+    """
+    userid = request.authenticated_userid
+    if userid is not None:
+        values = ['user', str(userid)]
+    else:
+        values = ['credentials'] + [request.headers.get(name, '')
+                                    for name in ('Authorization', 'Cookie')]
+
+    return hashlib.sha256('\0'.join(values).encode('utf-8')).hexdigest()
+
+
+def is_streamed(response):
+    return not isinstance(response.app_iter, (list, tuple))
+
+
+def get_fingerprint(request):
+    """Return the hash of the method, the path and the body"""
+    digest = hashlib.sha256()
+    for value in (request.method.encode('utf-8'),
+                  request.path_qs.encode('utf-8'), request.body):
+        digest.update(value)
+        digest.update(b'\0')
+
+    return digest.hexdigest()
+
+
+class IdempotencyStore:
+    """Responses of the keys, in the table of the registry
+
+    :param registry: AnyBlok registry of the request
+    :param ttl: seconds before a key expires
+    """
+
+    def __init__(self, registry, ttl=86400):
+        self.registry = registry
+        self.ttl = ttl
+        self.table = registry.get(IDEMPOTENCY).__table__
+
+    @property
+    def connection(self):
+        return self.registry.session.connection()
+
+    def where(self, scope, key):
+        return and_(self.table.c.scope == scope, self.table.c.key == key)
+
+    def acquire(self, scope, key, fingerprint):
+        """Reserve the key of the scope for the request, return None if the
+        view must be called, else the row saved by the first request
+        """
+        now = datetime.now(timezone.utc)
+        values = dict(scope=scope, key=key, fingerprint=fingerprint,
+                      create_date=now,
+                      expire_date=now + timedelta(seconds=self.ttl))
+        mark_changed(self.registry.session)
+        if self.connection.dialect.name == 'postgresql':
+            # wait for the transaction which has the same key
+            result = self.connection.execute(
+                pg_insert(self.table).values(**values).on_conflict_do_nothing(
+                    index_elements=['scope', 'key']))
+            if result.rowcount:
+                return None
+
+        row = self.connection.execute(
+            select([self.table]).where(self.where(scope, key))).first()
+        if row is None:
+            self.connection.execute(self.table.insert().values(**values))
+            return None
+
+        if row.expire_date <= now:
+            self.connection.execute(self.table.update().where(
+                self.where(scope, key)).values(
+                    status=None, headers=None, body=None, **values))
+            return None
+
+        return row
+
+    def save(self, scope, key, response):
+        """Save the response of the view for the key of the scope"""
+        headers = [[name, value] for name, value in response.headerlist
+                   if name.lower() != 'set-cookie']
+        self.connection.execute(self.table.update().where(
+            self.where(scope, key)).values(
+                status=response.status_int, headers=headers,
+                body=response.body))
+
+    def release(self, scope, key):
+        """Forget the key of the scope, the next request calls the view"""
+        self.connection.execute(self.table.delete().where(
+            self.where(scope, key)))
+
+    def purge(self, size=1000):
+        """Delete a batch of the expired keys
+
+        :rtype: number of keys deleted
+        """
+        expired = select([self.table.c.scope, self.table.c.key]).where(
+            self.table.c.expire_date <= datetime.now(timezone.utc)
+        ).limit(size)
+        if self.connection.dialect.name == 'postgresql':
+            expired = expired.with_for_update(skip_locked=True)
+
+        result = self.connection.execute(self.table.delete().where(
+            tuple_(self.table.c.scope, self.table.c.key).in_(expired)))
+        return result.rowcount
+
+
+def get_saved_response(row):
+    response = Response(status=row.status, body=row.body,
+                        headerlist=[tuple(x) for x in row.headers])
+    response.headers[REPLAYED_HEADER] = 'true'
+    return response
+
+
+def purge_if_needed(store):
+    interval = Configuration.get('pyramid_idempotency_purge_interval', 300)
+    now = time.monotonic()
+    with _LOCK:
+        if not interval or now - _PURGE['last'] < interval:
+            return
+
+        _PURGE['last'] = now
+
+    deleted = store.purge(
+        size=Configuration.get('pyramid_idempotency_purge_size') or 1000)
+    logger.debug('%d expired idempotency keys deleted', deleted)
+
+
+def call_with_key(view, context, request, key):
+    if len(key) > KEY_SIZE:
+        raise HTTPBadRequest('The %s is longer than %d' % (HEADER, KEY_SIZE))
+
+    store = IdempotencyStore(
+        request.anyblok.registry,
+        ttl=Configuration.get('pyramid_idempotency_ttl') or 86400)
+    scope = get_scope(request)
+    fingerprint = get_fingerprint(request)
+    row = store.acquire(scope, key, fingerprint)
+    if row is None:
+        response = view(context, request)
+        if is_streamed(response):
+            # the body would be read in memory, and not sent
+            logger.warning('The streamed response of %s is not saved for '
+                           'the %s', request.path, HEADER)
+            store.release(scope, key)
+            count('streamed')
+        else:
+            store.save(scope, key, response)
+            count('saved')
+
+        purge_if_needed(store)
+        return response
+
+    if row.fingerprint != fingerprint:
+        count('mismatch')
+        raise HTTPUnprocessableEntity(
+            'The %s is used by another request' % HEADER)
+
+    if row.status is None:
+        count('conflict')
+        raise HTTPConflict('The request of the %s is in progress' % HEADER)
+
+    count('replayed')
+    return get_saved_response(row)
+
+
+def idempotency_view(view, info):
+    """View deriver, add the option ``anyblok_idempotency``"""
+    settings = info.settings or {}
+    enabled = info.options.get('anyblok_idempotency',
+                               settings.get('anyblok.idempotency'))
+    if not enabled:
+        return view
+
+    def wrapper(context, request):
+        key = request.headers.get(HEADER)
+        if not key or request.method not in UNSAFE_METHODS:
+            return view(context, request)
+
+        registry = request.anyblok.registry
+        if registry is None or IDEMPOTENCY not in registry.loaded_namespaces:
+            return view(context, request)
+
+        return call_with_key(view, context, request, key)
+
+    return wrapper
+
+
+idempotency_view.options = ('anyblok_idempotency',)
+
+
+def idempotency(config):
+    """Pyramid includeme, add the view deriver of the idempotency keys
+
+    :param config: Pyramid configurator instance
+    """
+    config.add_view_deriver(idempotency_view)
+    add_metrics_collector(collect_idempotency)
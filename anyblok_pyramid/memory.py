@@ -0,0 +1,230 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+import os
+import resource
+from threading import Lock
+from anyblok.blok import BlokManager
+from anyblok.config import Configuration
+from pyramid.httpexceptions import HTTPBadRequest
+from logging import getLogger
+logger = getLogger(__name__)
+
+try:
+    import tracemalloc
+except ImportError:  # pragma: no cover
+    # python 3.3
+    tracemalloc = None
+
+
+def get_rss():
+    """Return the resident set size of the current process in bytes
+
+    Read ``/proc/self/statm`` when it is available, else fall back on the
+    peak resident set size given by ``getrusage``
+
+    :rtype: int
+    """
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            pages = int(statm.read().split()[1])
+
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        # ru_maxrss is given in kilobytes on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def check_worker_memory(worker):
+    """Ask to the gunicorn worker to stop gracefully if its memory is
+    greater than the ``max_worker_memory`` setting (in megabytes)
+
+    The worker finishes the current request and the arbiter spawns a new
+    one, exactly as ``max_requests`` does
+
+    :param worker: gunicorn worker instance
+    :rtype: bool, True if the worker will be recycled
+    """
+    limit = worker.cfg.max_worker_memory
+    if not limit or not worker.alive:
+        return False
+
+    rss = get_rss()
+    if rss > limit * 1024 * 1024:
+        logger.warning(
+            "Worker %r uses %.1f Mo (limit %d Mo), recycle it after the "
+            "current request", worker.pid, rss / 1024 / 1024, limit)
+        worker.alive = False
+        return True
+
+    return False
+
+
+def get_blok_from_filename(filename, blok_paths=None):
+    """Return the name of the blok which owns the filename
+
+    :param filename: path of a python file
+    :param blok_paths: list of (blok name, blok path), by default all the
+        loaded bloks
+    :rtype: str, the blok name or ``None``
+    """
+    if blok_paths is None:
+        blok_paths = [(blok, BlokManager.getPath(blok))
+                      for blok in BlokManager.ordered_bloks]
+
+    for blok, path in blok_paths:
+        if filename.startswith(os.path.join(path, '')):
+            return blok
+
+    return None
+
+
+def get_blok_from_traceback(traceback, blok_paths=None):
+    """Return the name of the blok of the most recent frame which is in a
+    blok
+
+    :param traceback: ``tracemalloc.Traceback``
+    :param blok_paths: list of (blok name, blok path)
+    :rtype: str, the blok name or ``None``
+    """
+    for frame in traceback:
+        blok = get_blok_from_filename(frame.filename, blok_paths)
+        if blok is not None:
+            return blok
+
+    return None
+
+
+def group_statistics_by_blok(statistics):
+    """Aggregate the tracemalloc ``StatisticDiff`` by blok
+
+    The statistics which are not in a blok are grouped in ``other``
+
+    With more than one frame by trace (``--pyramid-memory-debug-frames``)
+    the allocation is given to the most recent frame in a blok, so the
+    memory allocated by a library for a blok is counted in the blok
+
+    :param statistics: list of ``tracemalloc.StatisticDiff``
+    :rtype: dict {blok name: {size, size_diff, count, count_diff}}
+    """
+    blok_paths = [(blok, BlokManager.getPath(blok))
+                  for blok in BlokManager.ordered_bloks]
+    res = {}
+    for stat in statistics:
+        blok = get_blok_from_traceback(stat.traceback, blok_paths) or 'other'
+        entry = res.setdefault(blok, dict(size=0, size_diff=0, count=0,
+                                          count_diff=0))
+        entry['size'] += stat.size
+        entry['size_diff'] += stat.size_diff
+        entry['count'] += stat.count
+        entry['count_diff'] += stat.count_diff
+
+    return res
+
+
+class MemorySnapshots:
+    """Keep the last tracemalloc snapshot to diff it with the next one"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.previous = None
+
+    def take(self, key_type='filename'):
+        """Take a new snapshot and compare it with the previous one
+
+        :param key_type: ``filename``, or ``traceback`` to keep all the
+            frames of the traces
+        :rtype: list of ``tracemalloc.StatisticDiff`` by key_type
+        """
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+        with self.lock:
+            previous = self.previous
+            self.previous = snapshot
+
+        if previous is None:
+            return [tracemalloc.StatisticDiff(stat.traceback, stat.size,
+                                              stat.size, stat.count,
+                                              stat.count)
+                    for stat in snapshot.statistics(key_type)]
+
+        return snapshot.compare_to(previous, key_type)
+
+    def reset(self):
+        with self.lock:
+            self.previous = None
+
+
+snapshots = MemorySnapshots()
+
+
+def memory_debug_view(request):
+    """Return the memory allocated since the previous call, grouped by blok
+
+    ::
+
+        GET /_debug/memory?limit=10
+
+    the ``reset`` parameter forgets the previous snapshot
+    """
+    if request.params.get('reset'):
+        snapshots.reset()
+
+    try:
+        limit = int(request.params.get('limit', 20))
+    except ValueError:
+        limit = -1
+
+    if limit < 0:
+        raise HTTPBadRequest('The limit must be a positive integer')
+
+    frames = tracemalloc.get_traceback_limit()
+    statistics = snapshots.take(
+        key_type='traceback' if frames > 1 else 'filename')
+    statistics.sort(key=lambda stat: abs(stat.size_diff), reverse=True)
+    return {
+        'rss': get_rss(),
+        'pid': os.getpid(),
+        'traced': tracemalloc.get_traced_memory()[0],
+        'bloks': group_statistics_by_blok(statistics),
+        'files': [
+            {
+                'filename': stat.traceback[0].filename,
+                'traceback': ['%s:%d' % (frame.filename, frame.lineno)
+                              for frame in stat.traceback],
+                'size': stat.size,
+                'size_diff': stat.size_diff,
+                'count': stat.count,
+                'count_diff': stat.count_diff,
+            }
+            for stat in statistics[:limit]
+        ],
+    }
+
+
+def memory_debug(config):
+    """Pyramid includeme, add the tracemalloc debug view if the option
+    ``--pyramid-memory-debug`` is set
+
+    :param config: Pyramid configurator instance
+    """
+    if not Configuration.get('memory_debug'):
+        return
+
+    if tracemalloc is None:
+        logger.error('The memory debug view needs tracemalloc (python 3.4)')
+        return
+
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(Configuration.get('memory_debug_frames') or 1)
+
+    path = Configuration.get('memory_debug_path') or '/_debug/memory'
+    config.add_route('anyblok_memory_debug', path)
+    config.add_view(memory_debug_view, route_name='anyblok_memory_debug',
+                    renderer='json')
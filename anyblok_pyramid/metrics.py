@@ -0,0 +1,89 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+"""Metrics of the process in the text format of Prometheus
+
+A collector returns the metrics when they are read::
+
+    def collector():
+        yield Metric('anyblok_pyramid_queue', 'Requests in the queue',
+                     'gauge', [({'db_name': 'db'}, 3)])
+
+    add_metrics_collector(collector)
+
+The includeme ``metrics`` adds the view on ``--pyramid-metrics-path``.
+"""
+from collections import namedtuple
+from anyblok.config import Configuration
+from pyramid.response import Response
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+Metric = namedtuple('Metric', 'name help type samples')
+_COLLECTORS = []
+
+
+def add_metrics_collector(collector):
+    """Add a callable which returns ``Metric`` entries"""
+    if collector not in _COLLECTORS:
+        _COLLECTORS.append(collector)
+
+
+def remove_metrics_collector(collector):
+    if collector in _COLLECTORS:
+        _COLLECTORS.remove(collector)
+
+
+def collect_metrics():
+    metrics = []
+    for collector in _COLLECTORS:
+        try:
+            metrics.extend(collector())
+        except Exception:
+            logger.exception('Error in the metrics collector %r', collector)
+
+    return metrics
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+
+    return '{%s}' % ','.join(
+        '%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for key, value in sorted(labels.items()))
+
+
+def format_metrics(metrics):
+    """Return the metrics in the text format of Prometheus"""
+    lines = []
+    for metric in metrics:
+        lines.append('# HELP %s %s' % (metric.name, metric.help))
+        lines.append('# TYPE %s %s' % (metric.name, metric.type))
+        for labels, value in metric.samples:
+            lines.append('%s%s %s' % (metric.name, format_labels(labels),
+                                      value))
+
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view(request):
+    return Response(format_metrics(collect_metrics()),
+                    content_type='text/plain', charset='utf-8')
+
+
+def metrics(config):
+    """Pyramid includeme, add the view of the metrics on
+    ``--pyramid-metrics-path``
+
+    :param config: Pyramid configurator instance
+    """
+    path = Configuration.get('pyramid_metrics_path')
+    if path:
+        config.add_route('anyblok_metrics', path)
+        config.add_view(metrics_view, route_name='anyblok_metrics')
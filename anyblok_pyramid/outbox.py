@@ -0,0 +1,334 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+"""Outbox of the changes of the records
+
+When the blok ``pyramid-outbox`` is installed, the records changed by a
+transaction are inserted in the outbox before the commit, by the same
+transaction: an event exists if and only if the change is committed, and
+the request does not call the consumers.
+
+Each event gives the model, the operation (``insert``, ``update`` or
+``delete``) and the primary key of a record flushed by the ORM. A model
+changed by SQL statements (bulk writes, ``add_changed_models``) gets one
+event without operation nor primary key, even if the ORM flushed records
+of the model in the same transaction.
+
+The console script ``anyblok_pyramid_outbox`` gives the events by batch to
+the consumers of ``--pyramid-outbox-consumers``::
+
+    def consumer(events):
+        for event in events:
+            publish(event['model'], event['operation'], event['pk'])
+
+The events of a batch are claimed with ``FOR UPDATE SKIP LOCKED``, given to
+all the consumers, then deleted by the same transaction. If a consumer
+fails, the transaction is aborted and the events of the batch are given
+again to all the consumers, one by one: the events are given at least once.
+An event whose consumers failed ``--pyramid-outbox-max-attempts`` times is
+kept in the state ``failed`` with the error, and is not given anymore.
+Several dispatchers can work on the same database, each one claims other
+events.
+"""
+import time
+from datetime import datetime, timezone
+from itertools import takewhile
+import transaction as zope_transaction
+from anyblok.config import Configuration
+from pyramid.path import DottedNameResolver
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from .anyblok import (add_before_commit_listener, get_registry_names,
+                      get_sql_changed_models)
+from .common import get_registry_for
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+OUTBOX = 'Model.Pyramid.Outbox'
+EVENTS_INFO = 'anyblok_pyramid.outbox.events'
+JSON_TYPES = (int, float, str, bool, type(None))
+
+
+def has_outbox(registry):
+    return OUTBOX in registry.loaded_namespaces
+
+
+def is_recorded(model):
+    allowed = Configuration.get('pyramid_outbox_models')
+    return not model.startswith(OUTBOX) and (not allowed or model in allowed)
+
+
+def get_outbox_models(models):
+    """Return the models recorded, restricted by
+    ``--pyramid-outbox-models``, the models of the outbox are excluded
+    """
+    return sorted(model for model in models if is_recorded(model))
+
+
+def get_primary_key(instance):
+    """Return the primary key of the instance, the values which are not
+    json types are given as strings
+    """
+    return {name: value if isinstance(value, JSON_TYPES) else str(value)
+            for name, value in instance.to_primary_keys().items()}
+
+
+def get_flushed_records(session):
+    """Return ``(model, operation, instance)`` of the flushed instances"""
+    for operation, instances in (('insert', session.new),
+                                 ('update', session.dirty),
+                                 ('delete', session.deleted)):
+        for instance in instances:
+            if operation == 'update' and not session.is_modified(instance):
+                continue
+
+            for model in get_registry_names([instance]):
+                yield model, operation, instance
+
+
+def record_flushed_records(session, flush_context):
+    """After flush, keep the primary keys of the flushed records with the
+    transaction of the session which flushed them
+    """
+    registry = getattr(session._query_cls, 'registry', None)
+    if registry is None or not has_outbox(registry):
+        return
+
+    events = session.info.setdefault(EVENTS_INFO, [])
+    for model, operation, instance in get_flushed_records(session):
+        if is_recorded(model):
+            events.append((session.transaction, model, operation,
+                           get_primary_key(instance)))
+
+
+def is_in(transaction, parent):
+    while transaction is not None:
+        if transaction is parent:
+            return True
+
+        transaction = transaction.parent
+
+    return False
+
+
+def forget_rolled_back_records(session, previous_transaction):
+    """After rollback, forget the records flushed by the transaction rolled
+    back (savepoint or not)
+    """
+    events = session.info.get(EVENTS_INFO)
+    if events:
+        events[:] = [x for x in events
+                     if not is_in(x[0], previous_transaction)]
+
+
+def forget_records(session, transaction):
+    """At the end of the main transaction, forget its records"""
+    if transaction.parent is None:
+        session.info.pop(EVENTS_INFO, None)
+
+
+SESSION_LISTENERS = (
+    ('after_flush', record_flushed_records),
+    ('after_soft_rollback', forget_rolled_back_records),
+    ('after_transaction_end', forget_records),
+)
+
+
+def get_events(session, models):
+    """Return ``(model, operation, pk)`` of the flushed records, once by
+    record and operation, and of the models changed by SQL
+    """
+    events = []
+    known = set()
+    for transaction, model, operation, pk in session.info.pop(
+            EVENTS_INFO, []):
+        key = (model, operation, tuple(sorted(pk.items())))
+        if key not in known:
+            known.add(key)
+            events.append((model, operation, pk))
+
+    sql_models = get_sql_changed_models(session) & set(models)
+    events.extend((model, None, None)
+                  for model in get_outbox_models(sql_models))
+    return events
+
+
+def record_changed_models(registry, models):
+    """Before commit listener, insert the events of the flushed records and
+    of the models changed by SQL in the outbox
+    """
+    if not has_outbox(registry):
+        return
+
+    now = datetime.now(timezone.utc)
+    values = [{'model': model, 'operation': operation, 'pk': pk,
+               'create_date': now}
+              for model, operation, pk in get_events(registry.session,
+                                                     models)]
+    if values:
+        session = registry.session
+        session.connection().execute(
+            registry.Pyramid.Outbox.__table__.insert(), values)
+
+
+class OutboxDispatcher:
+    """Give the events of the outbox of a registry to the consumers
+
+    :param registry: AnyBlok registry
+    :param consumers: dict of the consumers by name, callables which take
+        the list of the events
+    :param batch_size: maximum number of events by call
+    """
+
+    def __init__(self, registry, consumers, batch_size=500, max_attempts=5):
+        self.registry = registry
+        self.consumers = consumers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.claimed = []
+        self.more = False
+
+    def claim_events(self):
+        """Return the next pending events, locked until the end of the
+        transaction, the events locked by another dispatcher are skipped.
+        An event which already failed is given alone
+        """
+        table = self.registry.Pyramid.Outbox.__table__
+        query = table.select().where(table.c.state == 'pending').order_by(
+            table.c.id).limit(self.batch_size).with_for_update(
+                skip_locked=True)
+        rows = [dict(row) for row in
+                self.registry.session.connection().execute(query)]
+        if rows and rows[0]['attempts']:
+            events = rows[:1]
+        else:
+            events = list(takewhile(lambda x: not x['attempts'], rows))
+
+        self.more = len(events) < len(rows)
+        self.claimed = [x['id'] for x in events]
+        return events
+
+    def dispatch(self):
+        """Give the next batch to the consumers and delete it, the caller
+        commits
+
+        :rtype: number of events given
+        """
+        events = self.claim_events()
+        if not events:
+            return 0
+
+        for name, consumer in sorted(self.consumers.items()):
+            logger.debug('Give %d events to %r', len(events), name)
+            consumer(events)
+
+        table = self.registry.Pyramid.Outbox.__table__
+        self.registry.session.connection().execute(table.delete().where(
+            table.c.id.in_([x['id'] for x in events])))
+        return len(events)
+
+    def record_failure(self, error):
+        """Count a failed call of the consumers for the events claimed, in
+        a new transaction, the events are ``failed`` after ``max_attempts``
+        """
+        if not self.claimed:
+            return
+
+        table = self.registry.Pyramid.Outbox.__table__
+        claimed = table.c.id.in_(self.claimed)
+        with zope_transaction.manager:
+            connection = self.registry.session.connection()
+            connection.execute(table.update().where(claimed).values(
+                attempts=table.c.attempts + 1, error=repr(error)))
+            failed = connection.execute(table.update().where(claimed).where(
+                table.c.attempts >= self.max_attempts).values(
+                    state='failed'))
+            if failed.rowcount:
+                logger.error('%d events of the outbox failed %d times, they '
+                             'are not given anymore', failed.rowcount,
+                             self.max_attempts)
+
+        self.claimed = []
+
+
+def get_consumers(names):
+    """Return the consumers by name, from the dotted names"""
+    resolver = DottedNameResolver()
+    return {name: resolver.resolve(name) for name in names}
+
+
+def dispatch_outbox(registry, consumers, batch_size=500, max_attempts=5):
+    """Give the events of the registry to the consumers, a transaction by
+    batch
+
+    :param consumers: dict of the consumers by name
+    :param max_attempts: failed calls before the event is ``failed``
+    :rtype: number of events given
+    """
+    dispatcher = OutboxDispatcher(registry, consumers, batch_size=batch_size,
+                                  max_attempts=max_attempts)
+    dispatched = 0
+    while True:
+        try:
+            with zope_transaction.manager:
+                count = dispatcher.dispatch()
+        except Exception as error:
+            logger.exception('Error while giving the events of the outbox')
+            try:
+                dispatcher.record_failure(error)
+            except Exception:
+                logger.exception('Error while counting the failure')
+
+            break
+
+        dispatched += count
+        if count < batch_size and not dispatcher.more:
+            break
+
+    return dispatched
+
+
+def work_on_outbox(db_names, consumers, batch_size=500, poll_interval=1,
+                   once=False, max_attempts=5):
+    """Dispatch the outbox of the databases until interrupted, wait
+    ``poll_interval`` seconds when there is no event
+
+    :param once: dispatch the events ready then return
+    :param max_attempts: failed calls before the event is ``failed``
+    """
+    while True:
+        dispatched = 0
+        for db_name in list(db_names):
+            registry = get_registry_for(db_name)
+            if not has_outbox(registry):
+                logger.warning('The blok pyramid-outbox is not installed on '
+                               '%r', db_name)
+                db_names.remove(db_name)
+                continue
+
+            dispatched += dispatch_outbox(registry, consumers,
+                                          batch_size=batch_size,
+                                          max_attempts=max_attempts)
+
+        if once or not db_names:
+            return
+
+        if not dispatched:
+            time.sleep(poll_interval)
+
+
+def outbox(config):
+    """Pyramid includeme, record the changed records in the outbox of the
+    databases where the blok ``pyramid-outbox`` is installed
+
+    :param config: Pyramid configurator instance
+    """
+    add_before_commit_listener(record_changed_models)
+    for name, listener in SESSION_LISTENERS:
+        if not event.contains(Session, name, listener):
+            event.listen(Session, name, listener)
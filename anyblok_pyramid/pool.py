@@ -0,0 +1,227 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+"""Pool of connections by database
+
+The registry class ``anyblok_pyramid.pool:Registry``
+(``--registry-cls anyblok_pyramid.pool:Registry``) creates the engines with
+the options ``--pyramid-pool-*``. By default the size of the pool is the
+number of threads of the worker plus the threads which use the database out
+of the requests (tasks, watcher of the reload, check of the replication
+lag), and the overflow is the number of threads of the worker, for the
+streamed files read after the request. With
+``--pyramid-pool-max-connections`` the pool of each database is bounded by::
+
+    max connections / (processes * databases)
+
+The databases are the ones of ``--databases`` and the ones of the mapping
+of the tenants when ``anyblok_pyramid.tenant:get_db_name`` resolves them.
+
+``--pyramid-pool-databases`` is a json file with the options of some
+databases, they are not bounded::
+
+    {"big_tenant": {"pool_size": 10, "max_overflow": 5}}
+
+The statistics of the pools (size, checked out, overflow, wait) are given by
+the metrics.
+"""
+import json
+import time
+from threading import Lock
+from anyblok.config import Configuration
+from anyblok.registry import Registry as BaseRegistry, RegistryManager
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import QueuePool
+from .metrics import Metric, add_metrics_collector
+from .tenant import get_db_name as get_tenant_db_name, get_tenant_resolver
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle',
+                'pool_pre_ping')
+_CONCURRENCY = {}
+_DATABASES = {}
+
+
+class TimedQueuePool(QueuePool):
+    """``QueuePool`` which measures the time to get a connection"""
+
+    def __init__(self, *args, **kwargs):
+        super(TimedQueuePool, self).__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time = 0
+        self.stats_lock = Lock()
+
+    def _do_get(self):
+        start = time.monotonic()
+        timeout = False
+        try:
+            return super(TimedQueuePool, self)._do_get()
+        except TimeoutError:
+            timeout = True
+            raise
+        finally:
+            with self.stats_lock:
+                self.checkouts += 1
+                self.timeouts += timeout
+                self.wait_time += time.monotonic() - start
+
+
+def set_concurrency(processes, threads):
+    """Called by the server which knows its workers and threads"""
+    _CONCURRENCY.update(processes=processes, threads=threads)
+
+
+def get_concurrency():
+    """Return the number of processes and the number of threads by process
+    which handle the requests
+    """
+    processes = _CONCURRENCY.get('processes')
+    threads = _CONCURRENCY.get('threads')
+    if not processes:
+        processes = Configuration.get('wsgi_processes') or 1
+        threads = Configuration.get('wsgi_threads') or 1
+
+    return processes, threads
+
+
+def get_background_connections():
+    """Return the connections which the threads of the process can take
+    out of the requests: the threads of the tasks, the watcher of the
+    reload and the check of the replication lag
+    """
+    connections = Configuration.get('pyramid_task_threads') or 2
+    if Configuration.get('pyramid_registry_reload') and Configuration.get(
+            'pyramid_registry_check_interval', 10):
+        connections += 1
+
+    if Configuration.get('pyramid_replica_url'):
+        connections += 1
+
+    return connections
+
+
+def get_database_count():
+    """Return the number of databases which share the connections, the
+    databases of ``--databases`` and of the tenants
+    """
+    db_names = set(Configuration.get('db_names') or [])
+    if Configuration.get('get_db_name') is get_tenant_db_name:
+        db_names.update(get_tenant_resolver().get_database_names())
+
+    return len(db_names) or 1
+
+
+def get_database_pool_options(db_name):
+    """Return the options of db_name from ``--pyramid-pool-databases``"""
+    path = Configuration.get('pyramid_pool_databases')
+    if not path:
+        return {}
+
+    if path not in _DATABASES:
+        with open(path) as fp:
+            _DATABASES[path] = json.load(fp)
+
+    options = _DATABASES[path].get(db_name, {})
+    return {key: value for key, value in options.items()
+            if key in POOL_OPTIONS}
+
+
+def get_max_connections_by_database():
+    """Return the connections allowed to each pool, None if there is no
+    ``--pyramid-pool-max-connections``
+    """
+    max_connections = Configuration.get('pyramid_pool_max_connections')
+    if not max_connections:
+        return None
+
+    processes, threads = get_concurrency()
+    databases = get_database_count()
+    connections = max_connections // (processes * databases)
+    if connections < 1:
+        logger.warning('%d connections for %d processes and %d databases, '
+                       'one connection is kept by pool', max_connections,
+                       processes, databases)
+        connections = 1
+
+    return connections
+
+
+def get_pool_options(db_name):
+    """Return the options of the engine of db_name"""
+    processes, threads = get_concurrency()
+    pool_size = Configuration.get('pyramid_pool_size') or (
+        threads + get_background_connections())
+    max_overflow = Configuration.get('pyramid_pool_max_overflow')
+    if max_overflow is None:
+        max_overflow = threads
+
+    connections = get_max_connections_by_database()
+    if connections is not None:
+        pool_size = min(pool_size, connections)
+        max_overflow = min(max_overflow, connections - pool_size)
+
+    options = dict(
+        poolclass=TimedQueuePool,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=Configuration.get('pyramid_pool_timeout') or 30,
+        pool_recycle=Configuration.get('pyramid_pool_recycle') or -1,
+        pool_pre_ping=bool(Configuration.get('pyramid_pool_pre_ping')),
+    )
+    options.update(get_database_pool_options(db_name))
+    return options
+
+
+class Registry(BaseRegistry):
+    """Registry whose engine uses ``get_pool_options``"""
+
+    def init_engine_options(self):
+        options = super(Registry, self).init_engine_options()
+        options.update(get_pool_options(self.db_name))
+        logger.info('Pool of %r: size=%d overflow=%d', self.db_name,
+                    options['pool_size'], options['max_overflow'])
+        return options
+
+
+def collect_pools():
+    """Metrics collector, the wait only with ``TimedQueuePool``"""
+    pools = sorted((db_name, registry.engine.pool)
+                   for db_name, registry in RegistryManager.registries.items()
+                   if isinstance(registry.engine.pool, QueuePool))
+    timed = [(db_name, pool) for db_name, pool in pools
+             if isinstance(pool, TimedQueuePool)]
+    yield Metric('anyblok_pyramid_pool_size', 'Size of the pool', 'gauge',
+                 [({'db_name': db}, pool.size()) for db, pool in pools])
+    yield Metric('anyblok_pyramid_pool_checked_out',
+                 'Connections in use', 'gauge',
+                 [({'db_name': db}, pool.checkedout()) for db, pool in pools])
+    yield Metric('anyblok_pyramid_pool_overflow',
+                 'Connections over the size of the pool', 'gauge',
+                 [({'db_name': db}, max(pool.overflow(), 0))
+                  for db, pool in pools])
+    yield Metric('anyblok_pyramid_pool_checkouts_total',
+                 'Connections got from the pool', 'counter',
+                 [({'db_name': db}, pool.checkouts) for db, pool in timed])
+    yield Metric('anyblok_pyramid_pool_wait_seconds_total',
+                 'Time to get the connections, the connect included',
+                 'counter',
+                 [({'db_name': db}, round(pool.wait_time, 6))
+                  for db, pool in timed])
+    yield Metric('anyblok_pyramid_pool_timeouts_total',
+                 'Connections not got before the timeout', 'counter',
+                 [({'db_name': db}, pool.timeouts) for db, pool in timed])
+
+
+def pool(config):
+    """Pyramid includeme, add the metrics of the pools
+
+    :param config: Pyramid configurator instance
+    """
+    add_metrics_collector(collect_pools)
@@ -5,12 +5,15 @@
 # This Source Code Form is subject to the terms of the Mozilla Public License,
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
-from os.path import join
+from os.path import isdir
 from pyramid.config import Configurator as PConfigurator
 from anyblok.blok import BlokManager
 from anyblok.config import Configuration
 from pkg_resources import iter_entry_points
 from .common import get_registry_for
+from .replica import (is_readonly_request, get_replica_router, bind_session,
+                      set_sticky_cookie)
+from .static import get_static_paths, add_static_file_view
 from logging import getLogger
 logger = getLogger(__name__)
 
@@ -24,6 +27,7 @@ class AnyBlokRequest:
     """
     def __init__(self, request):
         self.request = request
+        self._registry = None
 
     @property
     def registry(self):
@@ -37,11 +41,21 @@ class AnyBlokRequest:
             The db_name must be defined
 
         """
-        dbname = Configuration.get('get_db_name')(self.request)
-        if Configuration.get('Registry').db_exists(db_name=dbname):
-            return get_registry_for(dbname)
-        else:
-            return None
+        if self._registry is None:
+            # kept for the request, the registry can be replaced by a reload
+            dbname = Configuration.get('get_db_name')(self.request)
+            if Configuration.get('Registry').db_exists(db_name=dbname):
+                self._registry = get_registry_for(
+                    dbname, readonly=is_readonly_request(self.request))
+                if get_replica_router() is not None:
+                    self.request.add_response_callback(set_sticky_cookie)
+                    self.request.add_finished_callback(self.bind_primary)
+
+        return self._registry
+
+    def bind_primary(self, request):
+        """The session of the thread goes back to the primary"""
+        bind_session(self._registry)
 
 
 class NeedAnyBlokRegistryPredicate:
@@ -207,6 +221,12 @@ def pyramid_settings(settings):
         'pyramid.reload_all': Configuration.get('pyramid.reload_all'),
         'pyramid.default_locale_name': Configuration.get(
             'pyramid.default_locale_name'),
+        'anyblok.statement_timeout': Configuration.get(
+            'pyramid_statement_timeout'),
+        'anyblok.request_deadline': Configuration.get(
+            'pyramid_request_deadline'),
+        'anyblok.idempotency': Configuration.get('pyramid_idempotency'),
+        'anyblok.coalesce': Configuration.get('pyramid_coalesce'),
     })
 
 
@@ -225,15 +245,15 @@ def static_paths(config):
     :param config: Pyramid configurator instance
     """
 
-    for blok, cls in BlokManager.bloks.items():
-        if hasattr(cls, 'static_paths'):
-            paths = cls.static_paths
-            if isinstance(paths, str):
-                paths = [paths]
-        else:
-            paths = ['static']
+    if Configuration.get('static_build_dir'):
+        # the built files are served by the static_assets includeme
+        return
 
-        blok_path = BlokManager.getPath(blok)
+    for blok, prefix, directory in get_static_paths():
+        if not isdir(directory):
+            logger.debug('No static directory %r for %r', directory, blok)
+            continue
 
-        for p in paths:
-            config.add_static_view(join(blok, p), join(blok_path, p))
+        add_static_file_view(
+            config, prefix, directory,
+            cache_max_age=Configuration.get('static_cache_max_age', 3600))
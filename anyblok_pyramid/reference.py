@@ -0,0 +1,159 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+"""Cache of the small reference models, shared by the requests
+
+The reference models are declared with ``--pyramid-reference-models``, their
+rows are read once and kept while the generation of the model is unchanged::
+
+    blok = request.anyblok_reference('Model.System.Blok').get('anyblok-core')
+    if blok['state'] == 'installed':
+        ...
+
+The rows are read only mappings of the columns, not instances of the
+models: they are shared by the threads and the sessions.
+"""
+from collections import OrderedDict
+from threading import Lock
+from types import MappingProxyType
+from anyblok.config import Configuration
+from sqlalchemy import select
+from . import AnyBlokPyramidException
+from .anyblok import get_changed_models
+from .generation import add_generations, check_shared
+
+
+class ReferenceTable:
+    """Rows of a reference model read at a generation
+
+    :param generation: (epoch, generation of the model)
+    :param primary_keys: names of the primary key columns
+    :param rows: mappings of the columns
+    """
+
+    def __init__(self, generation, primary_keys, rows):
+        self.generation = generation
+        self.rows = tuple(MappingProxyType(dict(row)) for row in rows)
+        self.index = {tuple(row[pk] for pk in primary_keys): row
+                      for row in self.rows}
+
+    def get(self, *primary_keys):
+        """Return the row of the primary key, None if it does not exist"""
+        return self.index.get(primary_keys)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+
+class ReferenceCache:
+    """Read through cache of the reference models, by database
+
+    The generation of the model is read before the query: a commit done
+    during the query gives a table with an old generation, read again by
+    the next request.
+
+    :param generations: generations of the models
+    :param models: registry names of the reference models
+    :param max_rows: maximum number of rows of all the tables, the least
+        recently used tables are removed
+    """
+
+    def __init__(self, generations, models, max_rows=10000):
+        self.generations = generations
+        self.models = frozenset(models or ())
+        self.max_rows = max_rows
+        self.rows = 0
+        self.tables = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, registry, model):
+        """Return the ``ReferenceTable`` of the model
+
+        :param registry: AnyBlok registry, its session is used to read the
+            rows
+        :param model: registry name of the model, ``Model.System.Blok``
+        :exception: AnyBlokPyramidException if the model is not declared
+        """
+        if model not in self.models:
+            raise AnyBlokPyramidException(
+                "%r is not a reference model" % model)
+
+        key = (registry.db_name, model)
+        generation = (self.generations.epoch,
+                      self.generations.get(registry.db_name, model))
+        if model in get_changed_models(registry.session):
+            # the changes of the transaction are not committed, they are
+            # read from the database and not seen by the other requests
+            registry.session.flush()
+            return self.load(registry, model, generation)
+
+        with self.lock:
+            table = self.tables.get(key)
+            if table is not None and table.generation == generation:
+                self.tables.move_to_end(key)
+                return table
+
+        table = self.load(registry, model, generation)
+        if not registry.session.info.get('anyblok_replica'):
+            # the rows of a late replica are older than the generation
+            self.store(key, table)
+
+        return table
+
+    def load(self, registry, model, generation):
+        sql_table = registry.get(model).__table__
+        primary_keys = [column.name for column in sql_table.primary_key]
+        rows = registry.session.execute(select([sql_table])).fetchall()
+        return ReferenceTable(generation, primary_keys, rows)
+
+    def pop(self, key):
+        table = self.tables.pop(key, None)
+        if table is not None:
+            self.rows -= len(table)
+
+    def store(self, key, table):
+        if len(table) > self.max_rows:
+            return
+
+        with self.lock:
+            self.pop(key)
+            self.tables[key] = table
+            self.rows += len(table)
+            while self.rows > self.max_rows:
+                self.pop(next(iter(self.tables)))
+
+    def clear(self):
+        with self.lock:
+            self.tables.clear()
+            self.rows = 0
+
+
+def anyblok_reference(request, model):
+    """Request method, return the ``ReferenceTable`` of the model for the
+    registry of the request
+    """
+    return request.registry.anyblok_reference_cache.get(
+        request.anyblok.registry, model)
+
+
+def reference_cache(config):
+    """Pyramid includeme, add ``request.anyblok_reference``
+
+    :param config: Pyramid configurator instance
+    """
+    generations = add_generations(config)
+    models = Configuration.get('pyramid_reference_models')
+    if models:
+        check_shared(generations, '--pyramid-reference-models')
+
+    config.registry.anyblok_reference_cache = ReferenceCache(
+        generations, models,
+        max_rows=Configuration.get('pyramid_reference_max_rows', 10000))
+    config.add_request_method(anyblok_reference, 'anyblok_reference')
@@ -0,0 +1,353 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+"""Reload of the registries when the bloks are installed or updated by
+another process
+
+Each database has a generation of its registry, incremented after a commit
+which changed ``Model.System.Blok``, and shared by the processes with the
+generations of the models (``--pyramid-cache-generations``). A thread of
+each process also reads the state of the bloks in the database every
+``--pyramid-registry-check-interval`` seconds, for the changes done by the
+scripts (``anyblok_updatedb``).
+
+The check at the beginning of the request only reads the generations. When
+one has changed, the new registry and the new WSGI application are built in
+a thread, without migration, then they replace the old ones. The requests
+in progress, and the new ones during the build, keep the old registry and
+the old application: a request ends when its response is closed. The
+connections of the old registry are closed at the end of its requests, at
+most ``--pyramid-registry-release-delay`` seconds after the replacement.
+
+The includemes are run again by the new application, the objects they
+register globally (generations, commit listeners, metrics collectors) are
+created once by process.
+"""
+import os
+import time
+from threading import Condition, Lock, Thread
+from anyblok.config import Configuration
+from anyblok.registry import RegistryManager
+from sqlalchemy import select
+from .anyblok import add_commit_listener
+from .common import new_registry_for
+from .generation import get_process_generations
+from .pyramid_config import Configurator
+from .static import BLOCK_SIZE
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+REGISTRY = '__registry__'
+
+
+def get_blok_states(registry):
+    """Return the state and the version of the bloks, read out of the
+    transaction of the request
+    """
+    columns = registry.System.Blok.__table__.c
+    query = select([columns.name, columns.state, columns.installed_version])
+    with registry.engine.connect() as connection:
+        return sorted(tuple(row) for row in connection.execute(query))
+
+
+class RegistryWatcher:
+    """Detect the databases whose registry must be reloaded
+
+    :param generations: generations shared by the processes
+    :param check_interval: seconds between two reads of the bloks, 0 to
+        not read them
+    """
+
+    def __init__(self, generations, check_interval=10):
+        self.generations = generations
+        self.check_interval = check_interval
+        self.blok_states = {}
+        self.local_changes = {}
+        self.loaded = {}
+        self.pid = None
+
+    def generation(self, db_name):
+        return (self.generations.get(db_name, REGISTRY),
+                self.local_changes.get(db_name, 0))
+
+    def changed(self):
+        """Return the databases to reload with their generation, called
+        at the beginning of each request
+        """
+        changed = {}
+        for db_name in list(RegistryManager.registries):
+            generation = self.generation(db_name)
+            if self.loaded.setdefault(db_name, generation) != generation:
+                changed[db_name] = generation
+
+        return changed
+
+    def set_loaded(self, db_name, generation):
+        self.loaded[db_name] = generation
+
+    def invalidate(self, registry, models):
+        """Commit listener, increment the generation of the registry when
+        the bloks changed
+        """
+        if 'Model.System.Blok' in models:
+            self.generations.bump(registry.db_name, [REGISTRY])
+
+    def check_databases(self):
+        """Compare the bloks of the databases with the last read"""
+        for db_name, registry in list(RegistryManager.registries.items()):
+            states = get_blok_states(registry)
+            if self.blok_states.setdefault(db_name, states) != states:
+                logger.info('The bloks of %r changed', db_name)
+                self.blok_states[db_name] = states
+                self.local_changes[db_name] = self.local_changes.get(
+                    db_name, 0) + 1
+
+    def start(self):
+        """Start the thread which reads the bloks, once by process"""
+        if not self.check_interval or self.pid == os.getpid():
+            return
+
+        self.pid = os.getpid()
+        Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while True:
+            time.sleep(self.check_interval)
+            try:
+                self.check_databases()
+            except Exception:
+                logger.exception('Error while reading the bloks')
+
+
+def release_registry(registry):
+    """Close the connections of a replaced registry"""
+    logger.info('Release the old registry of %r', registry.db_name)
+    registry.engine.dispose()
+
+
+class RequestCounter:
+    """Requests in progress on an application, a request is counted until
+    its response is closed
+    """
+
+    def __init__(self):
+        self.condition = Condition()
+        self.requests = 0
+
+    def acquire(self):
+        with self.condition:
+            self.requests += 1
+
+    def release(self):
+        with self.condition:
+            self.requests -= 1
+            self.condition.notify_all()
+
+    def wait(self, timeout=None):
+        """Wait for the end of the requests, return False after the
+        timeout"""
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.condition:
+            while self.requests:
+                remaining = deadline - time.time() if deadline else None
+                if remaining is not None and remaining <= 0:
+                    return False
+
+                self.condition.wait(remaining)
+
+        return True
+
+
+class ReleasingFile:
+    """File given to ``wsgi.file_wrapper`` which releases the request when
+    it is closed, the server still uses its ``fileno``
+    """
+
+    def __init__(self, filelike, release):
+        self.filelike = filelike
+        self.release = release
+
+    def __getattr__(self, name):
+        return getattr(self.filelike, name)
+
+    def close(self):
+        try:
+            if hasattr(self.filelike, 'close'):
+                self.filelike.close()
+        finally:
+            self.release()
+
+
+class ReleasingIterator:
+    """Response of the application which releases the request when it is
+    closed by the server
+    """
+
+    def __init__(self, app_iter, release):
+        self.app_iter = app_iter
+        self.release = release
+
+    def __iter__(self):
+        return iter(self.app_iter)
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            self.release()
+
+
+def release_on_close(environ, app_iter, release):
+    """Return the response of the application, ``release`` is called once
+    when the server closes it
+    """
+    released = []
+
+    def release_once():
+        if not released:
+            released.append(True)
+            release()
+
+    file_wrapper = environ.get('wsgi.file_wrapper')
+    if isinstance(file_wrapper, type) and isinstance(app_iter, file_wrapper):
+        if hasattr(app_iter, 'filelike'):
+            # keep the file wrapper, the server sends the file without copy
+            filelike = ReleasingFile(app_iter.filelike, release_once)
+            return file_wrapper(filelike,
+                                getattr(app_iter, 'blksize', BLOCK_SIZE))
+
+    return ReleasingIterator(app_iter, release_once)
+
+
+class ReloadableApplication:
+    """WSGI application rebuilt when the registries are reloaded
+
+    :param make_app: callable which returns the WSGI application
+    :param watcher: ``RegistryWatcher``
+    :param release_delay: seconds before releasing a replaced registry
+    """
+
+    def __init__(self, make_app, watcher, release_delay=60):
+        self.make_app = make_app
+        self.watcher = watcher
+        self.release_delay = release_delay
+        # the application and its requests, replaced together
+        self.current = (make_app(), RequestCounter())
+        self.lock = Lock()
+        self.thread = None
+
+    @property
+    def app(self):
+        return self.current[0]
+
+    def __call__(self, environ, start_response):
+        self.watcher.start()
+        changed = self.watcher.changed()
+        if changed:
+            self.reload(changed)
+
+        app, requests = self.current
+        requests.acquire()
+        try:
+            app_iter = app(environ, start_response)
+        except BaseException:
+            requests.release()
+            raise
+
+        return release_on_close(environ, app_iter, requests.release)
+
+    def reload(self, changed):
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+
+            self.thread = Thread(target=self.run_reload, args=(changed,),
+                                 daemon=True)
+            self.thread.start()
+
+    def build_registry(self, db_name):
+        return new_registry_for(db_name)
+
+    def release_registry(self, registry):
+        release_registry(registry)
+
+    def build(self, changed):
+        """Return the new registries and the new application, the old ones
+        are still used by the requests
+        """
+        registries = {}
+        for db_name in changed:
+            try:
+                registries[db_name] = self.build_registry(db_name)
+            except Exception:
+                logger.exception('Error while reloading %r', db_name)
+
+        try:
+            return registries, self.make_app()
+        except Exception:
+            logger.exception('Error while rebuilding the application')
+            for registry in registries.values():
+                self.release_registry(registry)
+
+            return None, None
+
+    def release(self, requests, registries):
+        """Release the old registries at the end of their requests"""
+        if not requests.wait(self.release_delay):
+            logger.warning('Requests still use the old registries after %ss',
+                           self.release_delay)
+
+        for registry in registries:
+            self.release_registry(registry)
+
+    def run_reload(self, changed):
+        registries, app = self.build(changed)
+        if app is None:
+            return
+
+        old_registries = []
+        for db_name, registry in registries.items():
+            old = RegistryManager.registries.get(db_name)
+            RegistryManager.registries[db_name] = registry
+            if old is not None and old is not registry:
+                old_registries.append(old)
+
+            self.watcher.set_loaded(db_name, changed[db_name])
+            logger.info('The registry of %r is reloaded', db_name)
+
+        requests = self.current[1]
+        self.current = (app, RequestCounter())
+        thread = Thread(target=self.release,
+                        args=(requests, old_registries), daemon=True)
+        thread.start()
+
+
+def make_wsgi_app():
+    """Return the WSGI application of the bloks"""
+    config = Configurator()
+    config.include_from_entry_point()
+    config.load_config_bloks()
+    return config.make_wsgi_app()
+
+
+def get_wsgi_app():
+    """Return the WSGI application, reloaded when the bloks change if
+    ``--pyramid-registry-reload`` is set
+    """
+    if not Configuration.get('pyramid_registry_reload'):
+        return make_wsgi_app()
+
+    watcher = RegistryWatcher(
+        get_process_generations(),
+        check_interval=Configuration.get(
+            'pyramid_registry_check_interval', 10))
+    add_commit_listener(watcher.invalidate)
+    return ReloadableApplication(
+        make_wsgi_app, watcher,
+        release_delay=Configuration.get('pyramid_registry_release_delay', 60))
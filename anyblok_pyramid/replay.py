@@ -0,0 +1,439 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+"""Replay an access log or a synthetic distribution of requests
+
+The requests are played on the WSGI application in the same process, or on
+a server listening on the loopback (for example a local
+``gunicorn_anyblok_pyramid``), never on a remote host.
+
+The access log has no body, only its ``GET`` and ``HEAD`` requests are
+played unless other methods are given (``--replay-methods``).
+"""
+import json
+import re
+import socket
+import subprocess
+import sys
+import time
+from math import ceil
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection
+from random import Random
+from threading import local, Lock
+from urllib.parse import urlsplit
+from webob import Request
+from . import AnyBlokPyramidException
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+LOG_PATTERN = re.compile(
+    r'^(?P<remote>\S+) \S+ \S+ \[(?P<date>[^\]]+)\] '
+    r'"(?P<method>[A-Z]+) (?P<path>\S+)(?: [^"]*)?" (?P<status>\d{3}) ')
+NUMBER_PATTERN = re.compile(r'(?<=/)\d+(?=/|$)')
+LOOPBACK_HOSTS = ('localhost', '127.0.0.1', '::1')
+REPLAYED_METHODS = ('GET', 'HEAD')
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'TRACE', 'PUT', 'DELETE')
+
+
+class ReplayRequest:
+
+    def __init__(self, method, path, db_name=None):
+        self.method = method
+        self.path = path
+        self.db_name = db_name
+
+    @property
+    def route(self):
+        """Group the paths which differ only by numeric segments"""
+        path = self.path.split('?')[0]
+        return '%s %s' % (self.method, NUMBER_PATTERN.sub('{id}', path))
+
+
+def parse_access_log(lines, methods=REPLAYED_METHODS):
+    """Return the requests of an access log, in the common or combined
+    log format
+
+    :param lines: iterable of lines
+    :param methods: methods replayed, the log has not the body of the
+        requests, ``GET`` and ``HEAD`` by default
+    :rtype: list of ``ReplayRequest``
+    """
+    requests = []
+    skipped = 0
+    for line in lines:
+        match = LOG_PATTERN.match(line)
+        if match is None:
+            logger.debug('Ignore the line %r', line)
+            continue
+
+        if match.group('method') not in methods:
+            skipped += 1
+            continue
+
+        requests.append(ReplayRequest(match.group('method'),
+                                      match.group('path')))
+
+    if skipped:
+        logger.info('%d requests of the access log are not replayed, their '
+                    'method is not in %s', skipped, ', '.join(methods))
+
+    return requests
+
+
+def parse_routes(routes):
+    """Parse the routes of the synthetic distribution
+
+    Each route is ``METHOD PATH:WEIGHT``, the ``{id}`` in the path is
+    replaced by a random number::
+
+        parse_routes(['GET /hello/{id}/:10', 'POST /foo:1'])
+
+    :rtype: list of (method, path, weight)
+    """
+    res = []
+    for route in routes:
+        route, _, weight = route.rpartition(':')
+        if not route or not weight.isdigit():
+            route, weight = route + _ + weight, '1'
+
+        method, _, path = route.strip().partition(' ')
+        if not path:
+            method, path = 'GET', method
+
+        res.append((method.upper(), path, int(weight)))
+
+    return res
+
+
+def synthetic_requests(routes, count, seed=None, max_id=1000):
+    """Return ``count`` requests picked in the weighted routes
+
+    :param routes: list of (method, path, weight), see ``parse_routes``
+    :param count: number of requests
+    :param seed: seed of the random generator, to replay the same sequence
+    :param max_id: maximum value of the ``{id}`` in the path
+    :rtype: list of ``ReplayRequest``
+    """
+    random = Random(seed)
+    weights = [weight for method, path, weight in routes]
+    requests = []
+    for x in range(count):
+        method, path, weight = weighted_choice(random, routes, weights)
+        path = path.replace('{id}', str(random.randint(1, max_id)))
+        requests.append(ReplayRequest(method, path))
+
+    return requests
+
+
+def weighted_choice(random, values, weights):
+    total = sum(weights)
+    point = random.uniform(0, total)
+    for value, weight in zip(values, weights):
+        point -= weight
+        if point <= 0:
+            return value
+
+    return values[-1]
+
+
+def assign_tenants(requests, tenants, seed=None):
+    """Assign a db name to each request
+
+    :param requests: list of ``ReplayRequest``
+    :param tenants: list of ``db_name`` or ``db_name:weight``
+    :param seed: seed of the random generator
+    """
+    random = Random(seed)
+    names, weights = [], []
+    for tenant in tenants:
+        name, _, weight = tenant.partition(':')
+        names.append(name)
+        weights.append(int(weight or 1))
+
+    for request in requests:
+        request.db_name = weighted_choice(random, names, weights)
+
+
+class WSGITarget:
+    """Play the requests on the WSGI application in this process"""
+
+    def __init__(self, app, tenant_header=None, tenant_host=None):
+        self.app = app
+        self.tenant_header = tenant_header
+        self.tenant_host = tenant_host
+
+    def headers(self, request):
+        headers = {}
+        if request.db_name:
+            if self.tenant_header:
+                headers[self.tenant_header] = request.db_name
+            if self.tenant_host:
+                headers['Host'] = self.tenant_host.format(
+                    db_name=request.db_name)
+
+        return headers
+
+    def __call__(self, request):
+        req = Request.blank(request.path, method=request.method,
+                            headers=self.headers(request))
+        return req.get_response(self.app).status_code
+
+    def close(self):
+        pass
+
+
+class HTTPTarget(WSGITarget):
+    """Play the requests on a server listening on the loopback"""
+
+    def __init__(self, url, tenant_header=None, tenant_host=None,
+                 timeout=60):
+        url = urlsplit(url)
+        if url.scheme != 'http':
+            raise AnyBlokPyramidException("Only http is allowed")
+
+        loopback = url.hostname in LOOPBACK_HOSTS
+        if not loopback and not url.hostname.startswith('127.'):
+            raise AnyBlokPyramidException(
+                "Only the loopback is allowed, not %r" % url.hostname)
+
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.prefix = url.path.rstrip('/')
+        self.timeout = timeout
+        self.tenant_header = tenant_header
+        self.tenant_host = tenant_host
+        self.local = local()
+        self.connections = []
+        self.lock = Lock()
+
+    def get_connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = HTTPConnection(self.host, self.port,
+                                        timeout=self.timeout)
+            self.local.connection = connection
+            with self.lock:
+                self.connections.append(connection)
+
+        return connection
+
+    def send(self, connection, request):
+        connection.request(request.method, self.prefix + request.path,
+                           headers=self.headers(request))
+        response = connection.getresponse()
+        response.read()
+        return response
+
+    def __call__(self, request):
+        connection = self.get_connection()
+        # the socket of the previous request
+        reused = connection.sock is not None
+        try:
+            response = self.send(connection, request)
+        except (socket.error, IOError):
+            connection.close()
+            if not reused or request.method not in IDEMPOTENT_METHODS:
+                raise
+
+            # the server can close the keep alive connection, retry once
+            response = self.send(connection, request)
+
+        if response.getheader('Connection', '').lower() == 'close':
+            connection.close()
+
+        return response.status
+
+    def close(self):
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+
+            self.connections = []
+
+
+def percentile(values, percent):
+    """Return the percentile of the values, with the nearest rank method
+
+    :param values: sorted list of values
+    :param percent: float between 0 and 100
+    """
+    if not values:
+        return None
+
+    rank = max(int(ceil(percent / 100. * len(values))), 1)
+    return values[min(rank, len(values)) - 1]
+
+
+class ReplayReport:
+    """Collect the latency of each request by route"""
+
+    percents = (50, 90, 95, 99)
+
+    def __init__(self):
+        self.lock = Lock()
+        self.latencies = OrderedDict()
+        self.errors = {}
+        self.duration = 0
+
+    def add(self, route, latency, error=False):
+        with self.lock:
+            self.latencies.setdefault(route, []).append(latency)
+            if error:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+    def route_stats(self, latencies, errors):
+        latencies = sorted(latencies)
+        stats = {
+            'count': len(latencies),
+            'errors': errors,
+            'throughput': (len(latencies) / self.duration
+                           if self.duration else 0),
+            'max': latencies[-1],
+        }
+        for percent in self.percents:
+            stats['p%d' % percent] = percentile(latencies, percent)
+
+        return stats
+
+    def to_dict(self):
+        routes = OrderedDict()
+        all_latencies = []
+        for route, latencies in self.latencies.items():
+            routes[route] = self.route_stats(latencies,
+                                             self.errors.get(route, 0))
+            all_latencies.extend(latencies)
+
+        return {
+            'duration': self.duration,
+            'total': (self.route_stats(all_latencies,
+                                       sum(self.errors.values()))
+                      if all_latencies else {}),
+            'routes': routes,
+        }
+
+    def format(self):
+        data = self.to_dict()
+        lines = ['%-40s %7s %7s %9s %9s %9s %9s %9s' % (
+            'route', 'count', 'errors', 'req/s', 'p50 ms', 'p90 ms',
+            'p99 ms', 'max ms')]
+        routes = list(data['routes'].items())
+        if data['total']:
+            routes.append(('TOTAL', data['total']))
+
+        for route, stats in routes:
+            lines.append('%-40s %7d %7d %9.1f %9.2f %9.2f %9.2f %9.2f' % (
+                route[:40], stats['count'], stats['errors'],
+                stats['throughput'], stats['p50'] * 1000,
+                stats['p90'] * 1000, stats['p99'] * 1000,
+                stats['max'] * 1000))
+
+        return '\n'.join(lines)
+
+
+def run_replay(target, requests, concurrency=1):
+    """Play the requests on the target with ``concurrency`` threads
+
+    :param target: ``WSGITarget`` or ``HTTPTarget`` instance
+    :param requests: list of ``ReplayRequest``
+    :param concurrency: number of concurrent clients
+    :rtype: ``ReplayReport``
+    """
+    report = ReplayReport()
+
+    def play(request):
+        start = time.perf_counter()
+        try:
+            status = target(request)
+            error = status >= 500
+        except Exception:
+            logger.exception('Error on %s %s', request.method, request.path)
+            error = True
+
+        report.add(request.route, time.perf_counter() - start, error=error)
+
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(play, requests))
+    finally:
+        target.close()
+
+    report.duration = time.perf_counter() - start
+    return report
+
+
+def wait_for_port(host, port, timeout=60):
+    """Wait until the server accepts the connections"""
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return True
+        except (socket.error, IOError):
+            time.sleep(0.2)
+
+    return False
+
+
+def get_free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_gunicorn(args, port):
+    """Start a local ``gunicorn_anyblok_pyramid`` bound on the loopback
+
+    :param args: list of arguments given to gunicorn_anyblok_pyramid
+    :param port: port to bind
+    :rtype: the ``subprocess.Popen`` instance
+    """
+    command = [sys.executable, '-c',
+               'from anyblok_pyramid.scripts import gunicorn_wsgi; '
+               'gunicorn_wsgi()',
+               '--bind', '127.0.0.1:%d' % port] + list(args)
+    process = subprocess.Popen(command)
+    if not wait_for_port('127.0.0.1', port):
+        process.terminate()
+        raise AnyBlokPyramidException("gunicorn did not start")
+
+    return process
+
+
+def get_requests(configuration):
+    """Build the requests to replay in function of the configuration
+
+    :param configuration: the ``Configuration`` class
+    :rtype: list of ``ReplayRequest``
+    """
+    seed = configuration.get('replay_seed')
+    access_log = configuration.get('replay_access_log')
+    if access_log:
+        methods = [x.upper() for x in
+                   configuration.get('replay_methods') or REPLAYED_METHODS]
+        with open(access_log, 'r') as fp:
+            requests = parse_access_log(fp, methods=methods)
+    else:
+        routes = parse_routes(configuration.get('replay_routes') or ['/'])
+        requests = synthetic_requests(
+            routes, configuration.get('replay_requests') or 1000, seed=seed)
+
+    tenants = configuration.get('replay_tenants')
+    if tenants:
+        assign_tenants(requests, tenants, seed=seed)
+
+    return requests
+
+
+def dump_report(report, output):
+    with open(output, 'w') as fp:
+        json.dump(report.to_dict(), fp, indent=2)
@@ -0,0 +1,310 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+"""Routing of the read only requests to a replica
+
+With ``--pyramid-replica-url`` the session of a read only request (``GET``,
+``HEAD``, ``OPTIONS`` or a view with ``anyblok_readonly=True``) is bound to
+an engine of the replica, with its own pool. The other requests, and the
+scripts, use the primary.
+
+The primary is used if the replication lag is greater than
+``--pyramid-replica-max-lag`` seconds, if the replica is not reachable, or
+if the session has already written. The target is chosen once by request,
+before its first query, it never changes during the transaction. The
+transactions on the replica are read only: a flush raises
+``ReadOnlyRequest``, ``Query.update``, ``Query.delete`` and the raw writes
+are refused by PostgreSQL. A view which writes on a safe method must have
+``anyblok_readonly=False``.
+
+The client of a request which writes gets the cookie ``anyblok_primary``,
+its read only requests use the primary during ``--pyramid-replica-sticky``
+seconds: it reads its own writes. The views whose response is kept under
+the generations of the models (``anyblok_cache_models``,
+``anyblok_etag_models``) use the primary too, the rows of a late replica
+would be kept under the generation of the commit.
+"""
+import math
+import time
+from collections import Counter
+from threading import Lock
+from anyblok.config import Configuration
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+from zope.sqlalchemy.datamanager import _SESSION_STATE, STATUS_CHANGED
+from . import AnyBlokPyramidException
+from .metrics import Metric, add_metrics_collector
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+STICKY_COOKIE = 'anyblok_primary'
+LAG_QUERY = ("SELECT CASE WHEN pg_is_in_recovery() "
+             "THEN extract(epoch FROM now() - pg_last_xact_replay_timestamp()) "
+             "ELSE 0 END")
+
+
+class ReadOnlyRequest(AnyBlokPyramidException):
+    """Flush in a session bound on the replica"""
+
+
+def set_readonly(dbapi_connection, connection_record):
+    """Engine event ``connect``, the transactions of the replica are read
+    only
+    """
+    dbapi_connection.set_session(readonly=True)
+
+
+class ReplicaRouter:
+    """Engines of the replica by database, and their lag
+
+    :param url: url of the replica, the database of the request is used if
+        the url has no database
+    :param max_lag: maximum replication lag in seconds
+    :param lag_interval: seconds between two checks of the lag
+    """
+
+    def __init__(self, url, max_lag=5, lag_interval=1):
+        self.url = make_url(url)
+        self.max_lag = max_lag
+        self.lag_interval = lag_interval
+        self.engines = {}
+        self.lags = {}
+        self.routed = Counter()
+        self.lock = Lock()
+
+    def get_url(self, db_name):
+        url = make_url(str(self.url))
+        if not url.database:
+            url.database = db_name
+
+        return url
+
+    def get_engine(self, registry):
+        engine = self.engines.get(registry.db_name)
+        if engine is None:
+            with self.lock:
+                engine = self.engines.get(registry.db_name)
+                if engine is None:
+                    engine = create_engine(
+                        self.get_url(registry.db_name),
+                        **registry.init_engine_options())
+                    if engine.dialect.name == 'postgresql':
+                        event.listen(engine, 'connect', set_readonly)
+
+                    self.engines[registry.db_name] = engine
+
+        return engine
+
+    def get_lag(self, engine):
+        """Return the replication lag in seconds"""
+        if engine.dialect.name != 'postgresql':
+            return 0
+
+        with engine.connect() as connection:
+            return connection.execute(LAG_QUERY).scalar() or 0
+
+    def is_usable(self, db_name, engine):
+        """Return True if the lag of the replica is lower than max_lag, the
+        lag is checked once by lag_interval
+        """
+        lag, checked = self.lags.get(db_name, (None, None))
+        now = time.monotonic()
+        if checked is None or now - checked >= self.lag_interval:
+            try:
+                lag = self.get_lag(engine)
+            except Exception:
+                logger.exception('The replica of %r is not reachable',
+                                 db_name)
+                lag = None
+
+            self.lags[db_name] = (lag, now)
+
+        return lag is not None and lag <= self.max_lag
+
+    def count(self, db_name, target):
+        with self.lock:
+            self.routed[(db_name, target)] += 1
+
+    def collect(self):
+        """Metrics collector"""
+        yield Metric('anyblok_pyramid_replica_sessions_total',
+                     'Sessions of the read only requests by target',
+                     'counter',
+                     [({'db_name': db_name, 'target': target}, value)
+                      for (db_name, target), value in sorted(
+                          self.routed.items())])
+        yield Metric('anyblok_pyramid_replica_lag_seconds',
+                     'Last replication lag read', 'gauge',
+                     [({'db_name': db_name}, lag)
+                      for db_name, (lag, _) in sorted(self.lags.items())
+                      if lag is not None])
+
+    def dispose(self):
+        for engine in self.engines.values():
+            engine.dispose()
+
+        self.engines.clear()
+        self.lags.clear()
+
+
+_ROUTER = []
+
+
+def get_replica_router():
+    """Return the ``ReplicaRouter`` of ``--pyramid-replica-url``, None if
+    there is no replica
+    """
+    url = Configuration.get('pyramid_replica_url')
+    if not url:
+        return None
+
+    if not _ROUTER or _ROUTER[0] != url:
+        router = ReplicaRouter(
+            url, max_lag=Configuration.get('pyramid_replica_max_lag', 5),
+            lag_interval=Configuration.get('pyramid_replica_lag_interval', 1))
+        add_metrics_collector(router.collect)
+        _ROUTER[:] = [url, router]
+
+    return _ROUTER[1]
+
+
+def is_write_request(request):
+    """The option ``anyblok_readonly`` of the view wins over the method"""
+    readonly = request.__dict__.get('anyblok_readonly')
+    if readonly is None:
+        readonly = request.method in SAFE_METHODS
+
+    return not readonly
+
+
+def is_sticky(request):
+    """Return True if the client wrote during the last
+    ``--pyramid-replica-sticky`` seconds
+    """
+    try:
+        return float(request.cookies.get(STICKY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def is_readonly_request(request):
+    """Return True if the request can read the replica: a read only request
+    which does not need the primary (``use_primary``) and whose client did
+    not write recently
+    """
+    if request.__dict__.get('anyblok_primary'):
+        return False
+
+    return not is_write_request(request) and not is_sticky(request)
+
+
+def set_sticky_cookie(request, response):
+    """Response callback, the client of a request which writes reads the
+    primary during ``--pyramid-replica-sticky`` seconds
+    """
+    sticky = Configuration.get('pyramid_replica_sticky', 5)
+    if sticky and is_write_request(request) and response.status_int < 400:
+        response.set_cookie(STICKY_COOKIE, '%.3f' % (time.time() + sticky),
+                            max_age=math.ceil(sticky), httponly=True)
+
+
+def use_primary(request):
+    """The request reads the primary, called by the views whose response is
+    kept under the generations of the models
+
+    :rtype: bool, False if the session of the request is already bound on
+        the replica
+    """
+    request.anyblok_primary = True
+    anyblok = request.__dict__.get('anyblok')
+    registry = getattr(anyblok, '_registry', None)
+    if registry is None or get_replica_router() is None:
+        return True
+
+    return bind_session(registry) == 'primary'
+
+
+def has_written(session):
+    return _SESSION_STATE.get(id(session)) == STATUS_CHANGED
+
+
+def bind_session(registry, readonly=False, router=None):
+    """Bind the session of the registry on the replica if readonly and if
+    the replica is usable, else on the primary
+
+    The bind is not changed while the transaction of the session has a
+    connection, the target of a request is chosen before its first query
+
+    :rtype: str, ``replica`` or ``primary``
+    """
+    if router is None:
+        router = get_replica_router()
+
+    session = registry.session
+    current = 'replica' if session.info.get('anyblok_replica') else 'primary'
+    transaction = session.transaction
+    if transaction is not None and transaction._connections:
+        return current
+
+    target = 'primary'
+    if readonly and router is not None and not has_written(session):
+        engine = router.get_engine(registry)
+        if router.is_usable(registry.db_name, engine):
+            target = 'replica'
+            session.bind = engine
+        else:
+            logger.debug('The replica of %r is late, use the primary',
+                         registry.db_name)
+
+        router.count(registry.db_name, target)
+
+    if target == 'primary':
+        session.bind = registry.bind
+
+    session.info['anyblok_replica'] = target == 'replica'
+    return target
+
+
+def check_writable(session):
+    """Called before the flush, a session on the replica does not write
+
+    :exception: ReadOnlyRequest
+    """
+    if session.info.get('anyblok_replica'):
+        raise ReadOnlyRequest(
+            "The request is read only, its session is bound on the replica. "
+            "Add anyblok_readonly=False on the view which writes")
+
+
+def replica_view(view, info):
+    """View deriver, add the option ``anyblok_readonly``"""
+    readonly = info.options.get('anyblok_readonly')
+    if readonly is None:
+        return view
+
+    def wrapper(context, request):
+        request.anyblok_readonly = readonly
+        registry = request.anyblok._registry
+        if registry is not None:
+            bind_session(registry, readonly=is_readonly_request(request))
+
+        return view(context, request)
+
+    return wrapper
+
+
+replica_view.options = ('anyblok_readonly',)
+
+
+def replica(config):
+    """Pyramid includeme, add the view option ``anyblok_readonly``
+
+    :param config: Pyramid configurator instance
+    """
+    config.add_view_deriver(replica_view)
@@ -0,0 +1,203 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+"""Rolling reload of the gunicorn workers
+
+On ``SIGHUP`` (sent by ``anyblok_pyramid_reload``) the arbiter starts one
+worker more than ``workers``. The new worker loads the bloks, the registry
+and the WSGI application, calls the probe path, then writes a ready file.
+Once it is ready, the oldest worker is stopped gracefully and the next one
+is started, until all the workers are replaced. The failure of a new worker
+(probe in error, exit, timeout) stops the reload, the old workers are kept.
+
+The new workers are forked from the arbiter: the libraries and the
+configuration are already loaded, only the bloks and the registry are read.
+"""
+import os
+import signal
+import time
+from webob import Request
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+READY_DIR_ENV = 'ANYBLOK_PYRAMID_READY_DIR'
+
+
+def parse_headers(headers):
+    """Return the dict of the headers ``Name: value``"""
+    result = {}
+    for header in headers or ():
+        name, sep, value = header.partition(':')
+        if not sep:
+            raise ValueError("The header %r is not 'Name: value'" % header)
+
+        result[name.strip()] = value.strip()
+
+    return result
+
+
+def probe_application(app, path='/', host=None, headers=None):
+    """Call the application in the new worker and write its ready file, in
+    the directory given by the arbiter
+
+    :param app: WSGI application of the worker
+    :param path: path of the probe, a status lower than 500 is healthy
+    :param host: host of the request, to resolve the tenant
+    :param headers: list of the headers ``Name: value`` of the request
+    :rtype: bool, True if the application is healthy
+    """
+    directory = os.environ.get(READY_DIR_ENV)
+    if not directory:
+        return None
+
+    try:
+        request = Request.blank(path, headers=parse_headers(headers))
+        if host:
+            request.host = host
+
+        ready = request.get_response(app).status_int < 500
+    except Exception:
+        logger.exception('Error in the probe %r', path)
+        ready = False
+
+    name = str(os.getpid())
+    if not ready:
+        name += '.failed'
+
+    with open(os.path.join(directory, name), 'w'):
+        pass
+
+    return ready
+
+
+def get_worker_state(directory, pid):
+    """Return ``ready``, ``failed`` or None if the probe is not done"""
+    if os.path.exists(os.path.join(directory, '%d.failed' % pid)):
+        return 'failed'
+
+    if os.path.exists(os.path.join(directory, str(pid))):
+        return 'ready'
+
+    return None
+
+
+def clean_ready_files(directory, pids):
+    """Remove the ready files of the workers which are not in pids"""
+    for name in os.listdir(directory):
+        if name.split('.')[0] not in pids:
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+
+def write_status(path, status):
+    if not path:
+        return
+
+    with open(path, 'w') as fp:
+        fp.write(status)
+
+
+class RollingReload:
+    """Replace the workers one by one, the next is started when the last
+    started is ready
+
+    The arbiter must have the ``WORKERS`` dict, ``spawn_worker()``,
+    ``kill_worker(pid, sig)`` and ``get_worker_state(pid)``
+
+    :param old: pids of the workers to replace, the oldest first
+    :param timeout: seconds given to a new worker to be ready
+    """
+
+    def __init__(self, old, timeout=120):
+        self.old = list(old)
+        self.new = []
+        self.timeout = timeout
+        self.pending = None
+        self.started = None
+
+    def start_next(self, arbiter):
+        self.pending = arbiter.spawn_worker()
+        self.started = time.time()
+
+    def check_pending(self, arbiter):
+        """Return the state of the worker which is loading"""
+        if self.pending not in arbiter.WORKERS:
+            return 'failed'
+
+        state = arbiter.get_worker_state(self.pending)
+        if state is None and time.time() - self.started > self.timeout:
+            return 'timeout'
+
+        return state
+
+    def step(self, arbiter):
+        """Called by the main loop of the arbiter
+
+        :rtype: None while the reload is in progress, else ``done`` or the
+            reason of the failure
+        """
+        self.old = [pid for pid in self.old if pid in arbiter.WORKERS]
+        if self.pending is None:
+            if not self.old:
+                return 'done'
+
+            self.start_next(arbiter)
+            return None
+
+        state = self.check_pending(arbiter)
+        if state is None:
+            return None
+
+        if state != 'ready':
+            if self.pending in arbiter.WORKERS:
+                arbiter.kill_worker(self.pending, signal.SIGTERM)
+
+            return 'failed: the worker %d is %s' % (self.pending, state)
+
+        self.new.append(self.pending)
+        self.pending = None
+        if self.old:
+            arbiter.kill_worker(self.old.pop(0), signal.SIGTERM)
+
+        if not self.old:
+            return 'done'
+
+        self.start_next(arbiter)
+        return None
+
+
+def send_reload(pidfile, timeout=300, interval=1):
+    """Send ``SIGHUP`` to the arbiter of the pid file, and wait the end of
+    the rolling reload
+
+    :param pidfile: pid file of gunicorn
+    :param timeout: seconds to wait
+    :rtype: str, ``done`` or the reason of the failure
+    """
+    with open(pidfile) as fp:
+        pid = int(fp.read().strip())
+
+    status_file = pidfile + '.reload'
+    if os.path.exists(status_file):
+        os.remove(status_file)
+
+    os.kill(pid, signal.SIGHUP)
+    stop = time.time() + timeout
+    status = None
+    while time.time() < stop:
+        time.sleep(interval)
+        if os.path.exists(status_file):
+            with open(status_file) as fp:
+                status = fp.read().strip()
+
+            if status not in ('', 'running'):
+                return status
+
+    return 'timeout (%s)' % (status or 'not started')
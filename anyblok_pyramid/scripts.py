@@ -6,14 +6,17 @@
 # This Source Code Form is subject to the terms of the Mozilla Public License,
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
-from wsgiref.simple_server import make_server
 from anyblok.blok import BlokManager
 from anyblok.scripts import format_configuration
 from anyblok.config import Configuration
 from .pyramid_config import Configurator
 import sys
+import shlex
 from anyblok import load_init_function_from_entry_points
-from .common import preload_databases
+from .common import preload_databases, get_database_names
+from .generation import get_epoch
+from .reload import get_wsgi_app
+from .server import make_anyblok_server, serve, PreForkServer
 from logging import getLogger
 logger = getLogger(__name__)
 
@@ -25,24 +28,37 @@ def anyblok_wsgi(application, configuration_groups, **kwargs):
     :param \**kwargs: ArgumentParser named arguments
     """
     format_configuration(configuration_groups, 'preload', 'pyramid-debug',
-                         'wsgi')
+                         'pyramid-cache', 'pyramid-reload', 'admission',
+                         'pyramid-timeout', 'pyramid-replica',
+                         'pyramid-pool', 'pyramid-batch', 'pyramid-task',
+                         'pyramid-outbox', 'pyramid-idempotency',
+                         'pyramid-coalesce', 'pyramid-tenant',
+                         'pyramid-metrics', 'static', 'wsgi')
     load_init_function_from_entry_points()
     Configuration.load(application,
                        configuration_groups=configuration_groups, **kwargs)
     BlokManager.load()
-    config = Configurator()
-    config.include_from_entry_point()
-    config.load_config_bloks()
+    get_epoch()
+    app = get_wsgi_app()
 
     wsgi_host = Configuration.get('wsgi_host')
     wsgi_port = int(Configuration.get('wsgi_port'))
+    threads = int(Configuration.get('wsgi_threads') or 0)
+    processes = int(Configuration.get('wsgi_processes') or 1)
 
-    app = config.make_wsgi_app()
-    server = make_server(wsgi_host, wsgi_port, app)
-    preload_databases()
+    server = make_anyblok_server(
+        wsgi_host, wsgi_port, app, threads=threads,
+        keepalive=int(Configuration.get('wsgi_keepalive') or 0),
+        queue_size=Configuration.get('wsgi_queue_size'),
+        timeout=int(Configuration.get('wsgi_timeout') or 0))
 
-    logger.info("Serve forever on %r:%r" % (wsgi_host, wsgi_port))
-    server.serve_forever()
+    logger.info("Serve forever on %r:%r (threads=%d, processes=%d)" % (
+        wsgi_host, wsgi_port, threads, processes))
+    if processes > 1:
+        PreForkServer(server, processes,
+                      before_serve=preload_databases).serve_forever()
+    else:
+        serve(server, before_serve=preload_databases)
 
 
 def wsgi():
@@ -56,7 +72,13 @@ def gunicorn_anyblok_wsgi(application, configuration_groups, **kwargs):
         logger.error("No gunicorn installed")
         sys.exit(1)
 
-    format_configuration(configuration_groups, 'preload', 'pyramid-debug')
+    format_configuration(configuration_groups, 'preload', 'pyramid-debug',
+                         'pyramid-cache', 'pyramid-reload', 'admission',
+                         'pyramid-timeout', 'pyramid-replica',
+                         'pyramid-pool', 'pyramid-batch', 'pyramid-task',
+                         'pyramid-outbox', 'pyramid-idempotency',
+                         'pyramid-coalesce', 'pyramid-tenant',
+                         'pyramid-metrics', 'static')
     from .gunicorn import WSGIApplication
     WSGIApplication(application,
                     configuration_groups=configuration_groups).run()
@@ -64,3 +86,198 @@ def gunicorn_anyblok_wsgi(application, configuration_groups, **kwargs):
 
 def gunicorn_wsgi():
     gunicorn_anyblok_wsgi('gunicorn', ['logging'])
+
+
+def anyblok_benchmark(application, configuration_groups, **kwargs):
+    """
+    :param application: name of the application
+    :param configuration_groups: list configuration groupe to load
+    :param \**kwargs: ArgumentParser named arguments
+    """
+    from .benchmark import BenchmarkContext, main
+    format_configuration(configuration_groups, 'benchmark')
+    load_init_function_from_entry_points()
+    Configuration.load(application,
+                       configuration_groups=configuration_groups, **kwargs)
+    BlokManager.load(entry_points=('bloks', 'test_bloks'))
+    sys.exit(main(BenchmarkContext()))
+
+
+def benchmark():
+    anyblok_benchmark('pyramid-benchmark', ['logging', 'database'])
+
+
+def anyblok_replay(application, configuration_groups, **kwargs):
+    """
+    :param application: name of the application
+    :param configuration_groups: list configuration groupe to load
+    :param \**kwargs: ArgumentParser named arguments
+    """
+    from . import replay
+    format_configuration(configuration_groups, 'replay')
+    load_init_function_from_entry_points()
+    Configuration.load(application,
+                       configuration_groups=configuration_groups, **kwargs)
+    requests = replay.get_requests(Configuration)
+    options = dict(
+        tenant_header=Configuration.get('replay_tenant_header'),
+        tenant_host=Configuration.get('replay_tenant_host'))
+    process = None
+    url = Configuration.get('replay_url')
+    gunicorn_args = Configuration.get('replay_gunicorn_args')
+    if gunicorn_args is not None:
+        port = replay.get_free_port()
+        process = replay.start_gunicorn(shlex.split(gunicorn_args), port)
+        url = 'http://127.0.0.1:%d' % port
+
+    try:
+        if url:
+            target = replay.HTTPTarget(url, **options)
+        else:
+            BlokManager.load()
+            preload_databases()
+            config = Configurator()
+            config.include_from_entry_point()
+            config.load_config_bloks()
+            target = replay.WSGITarget(config.make_wsgi_app(), **options)
+
+        report = replay.run_replay(
+            target, requests,
+            concurrency=Configuration.get('replay_concurrency') or 1)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    output = Configuration.get('replay_output')
+    if output:
+        replay.dump_report(report, output)
+
+    sys.stdout.write(report.format() + '\n')
+
+
+def replay():
+    anyblok_replay('pyramid-replay', ['logging'])
+
+
+def anyblok_static(application, configuration_groups, **kwargs):
+    """
+    :param application: name of the application
+    :param configuration_groups: list configuration groupe to load
+    :param \**kwargs: ArgumentParser named arguments
+    """
+    from .static import build_static
+    format_configuration(configuration_groups, 'static')
+    load_init_function_from_entry_points()
+    Configuration.load(application,
+                       configuration_groups=configuration_groups, **kwargs)
+    build_dir = Configuration.get('static_build_dir')
+    if not build_dir:
+        logger.error("No build directory, use --static-build-dir")
+        sys.exit(1)
+
+    BlokManager.load()
+    manifest = build_static(build_dir)
+    sys.stdout.write('%d static files built in %s\n' % (
+        len(manifest['files']), build_dir))
+
+
+def static():
+    anyblok_static('pyramid-static', ['logging'])
+
+
+def anyblok_rolling_reload(application, configuration_groups, **kwargs):
+    """
+    :param application: name of the application
+    :param configuration_groups: list configuration groupe to load
+    :param \**kwargs: ArgumentParser named arguments
+    """
+    from .rolling import send_reload
+    format_configuration(configuration_groups, 'rolling-reload')
+    load_init_function_from_entry_points()
+    Configuration.load(application,
+                       configuration_groups=configuration_groups, **kwargs)
+    pidfile = Configuration.get('rolling_pidfile')
+    if not pidfile:
+        logger.error("No pid file, use --rolling-pidfile")
+        sys.exit(1)
+
+    status = send_reload(pidfile, timeout=Configuration.get('rolling_wait'))
+    sys.stdout.write('Rolling reload: %s\n' % status)
+    if status != 'done':
+        sys.exit(1)
+
+
+def rolling_reload():
+    anyblok_rolling_reload('pyramid-rolling-reload', ['logging'])
+
+
+def anyblok_tasks(application, configuration_groups, **kwargs):
+    """
+    :param application: name of the application
+    :param configuration_groups: list configuration groupe to load
+    :param \**kwargs: ArgumentParser named arguments
+    """
+    from .tasks import work_on_durable_tasks
+    format_configuration(configuration_groups, 'pyramid-task')
+    load_init_function_from_entry_points()
+    Configuration.load(application,
+                       configuration_groups=configuration_groups, **kwargs)
+    BlokManager.load()
+    db_names = get_database_names()
+    if not db_names:
+        logger.error("No database, use --db-name or --databases")
+        sys.exit(1)
+
+    logger.info("Process the durable tasks of %s", ', '.join(db_names))
+    try:
+        work_on_durable_tasks(
+            db_names,
+            batch_size=Configuration.get('pyramid_task_batch_size') or 100,
+            retries=Configuration.get('pyramid_task_retries', 3),
+            retry_delay=Configuration.get('pyramid_task_retry_delay', 1),
+            poll_interval=Configuration.get('pyramid_task_poll_interval', 1))
+    except KeyboardInterrupt:
+        logger.info("Stop the durable tasks")
+
+
+def tasks():
+    anyblok_tasks('pyramid-tasks', ['logging', 'database'])
+
+
+def anyblok_outbox(application, configuration_groups, **kwargs):
+    """
+    :param application: name of the application
+    :param configuration_groups: list configuration groupe to load
+    :param \**kwargs: ArgumentParser named arguments
+    """
+    from .outbox import get_consumers, work_on_outbox
+    format_configuration(configuration_groups, 'pyramid-outbox')
+    load_init_function_from_entry_points()
+    Configuration.load(application,
+                       configuration_groups=configuration_groups, **kwargs)
+    consumers = Configuration.get('pyramid_outbox_consumers')
+    if not consumers:
+        logger.error("No consumer, use --pyramid-outbox-consumers")
+        sys.exit(1)
+
+    BlokManager.load()
+    db_names = get_database_names()
+    if not db_names:
+        logger.error("No database, use --db-name or --databases")
+        sys.exit(1)
+
+    logger.info("Dispatch the outbox of %s", ', '.join(db_names))
+    try:
+        work_on_outbox(
+            db_names, get_consumers(consumers),
+            batch_size=Configuration.get('pyramid_outbox_batch_size') or 500,
+            poll_interval=Configuration.get('pyramid_outbox_poll_interval',
+                                            1),
+            max_attempts=Configuration.get('pyramid_outbox_max_attempts', 5))
+    except KeyboardInterrupt:
+        logger.info("Stop the dispatch of the outbox")
+
+
+def outbox():
+    anyblok_outbox('pyramid-outbox', ['logging', 'database'])
@@ -0,0 +1,426 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+"""WSGI server of the ``anyblok_pyramid`` console script
+
+Without thread, the server is the ``wsgiref`` server which handles one
+request at a time. With threads, the requests are handled by a pool of
+threads, with keep alive. With processes, the socket is bound then the
+server is forked, each process serves the same socket.
+
+The connections waiting for a thread are bounded, over the bound the
+server stops accepting and the connections wait in the backlog of the
+socket. A connection which sends nothing is closed after ``timeout``
+seconds, and the idle keep alive connections are closed when other
+connections wait for a thread.
+"""
+import os
+import select
+import signal
+import socket
+import time
+import transaction as zope_transaction
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock, Thread
+from wsgiref.simple_server import (make_server, WSGIServer,
+                                   WSGIRequestHandler, ServerHandler)
+from anyblok.environment import EnvironmentManager
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+def end_of_request():
+    """Clean the state let by the request on the current thread
+
+    The threads of the pool are reused, the transaction of the thread is
+    aborted if the request did not finish it, and the hooks of the AnyBlok
+    environment are reseted
+    """
+    zope_transaction.abort()
+    EnvironmentManager.set('_precommit_hook', [])
+    EnvironmentManager.set('_postcommit_hook', [])
+
+
+class InputWrapper:
+    """Count the bytes read by the application from ``wsgi.input``, the
+    unread body must be drained before the next request of the connection
+    """
+
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def _limit(self, size):
+        if size is None or size < 0 or size > self.remaining:
+            return self.remaining
+
+        return size
+
+    def read(self, size=-1):
+        data = self.rfile.read(self._limit(size))
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        data = self.rfile.readline(self._limit(size))
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint=-1):
+        return list(iter(self.readline, b''))
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def drain(self, limit):
+        """Read the unread body
+
+        :param limit: maximum size to read
+        :rtype: bool, False if the body is too big to be drained
+        """
+        if self.remaining > limit:
+            return False
+
+        while self.remaining:
+            if not self.read(65536):
+                return False
+
+        return True
+
+
+class AnyBlokServerHandler(ServerHandler):
+    """Announce the end of the connection to the client and keep the
+    headers of the response, ``close`` forgets them
+    """
+
+    response_headers = None
+
+    def cleanup_headers(self):
+        super(AnyBlokServerHandler, self).cleanup_headers()
+        request_handler = self.request_handler
+        if 'Content-Length' not in self.headers:
+            request_handler.close_connection = True
+        elif self.headers.get('Connection', '').lower() == 'close':
+            request_handler.close_connection = True
+
+        closed = request_handler.close_connection
+        if closed and 'Connection' not in self.headers:
+            self.headers['Connection'] = 'close'
+
+    def close(self):
+        self.response_headers = self.headers
+        super(AnyBlokServerHandler, self).close()
+
+
+class AnyBlokWSGIRequestHandler(WSGIRequestHandler):
+    """Request handler with keep alive, the connection is kept open while
+    the client asks for it and the length of the response is known
+    """
+
+    protocol_version = 'HTTP/1.1'
+    max_drain = 1024 * 1024
+    poll_interval = 0.1
+
+    def setup(self):
+        super(AnyBlokWSGIRequestHandler, self).setup()
+        self.nb_requests = 0
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            self.handle_one_request()
+
+    def wait_next_request(self):
+        """Wait the next request of the keep alive connection, return False
+        if it does not come before the keep alive timeout or if another
+        connection waits for the thread
+        """
+        self.connection.settimeout(0)
+        try:
+            if self.rfile.peek(1):
+                # pipelined request
+                return True
+        finally:
+            self.connection.settimeout(None)
+
+        stop = time.monotonic() + self.server.keepalive
+        while not self.server.is_saturated():
+            remaining = stop - time.monotonic()
+            if remaining <= 0:
+                return False
+
+            readable = select.select([self.connection], [], [],
+                                     min(remaining, self.poll_interval))[0]
+            if readable:
+                return True
+
+        return False
+
+    def read_requestline(self):
+        """Read the request line, return False if the connection must be
+        closed
+        """
+        if self.nb_requests:
+            if not self.wait_next_request():
+                return False
+
+            self.connection.settimeout(self.server.keepalive)
+        else:
+            self.connection.settimeout(self.server.request_timeout)
+
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except socket.timeout:
+            return False
+        finally:
+            self.connection.settimeout(None)
+
+        self.nb_requests += 1
+        return bool(self.raw_requestline)
+
+    def handle_one_request(self):
+        if not self.read_requestline():
+            self.close_connection = True
+            return
+
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            self.close_connection = True
+            return
+
+        if not self.parse_request():
+            return
+
+        if not self.server.keepalive or self.headers.get('Transfer-Encoding'):
+            self.close_connection = True
+
+        length = int(self.headers.get('Content-Length') or 0)
+        rfile = InputWrapper(self.rfile, length)
+        handler = AnyBlokServerHandler(
+            rfile, self.wfile, self.get_stderr(), self.get_environ(),
+            multithread=self.server.multithread,
+            multiprocess=self.server.multiprocess)
+        if self.request_version == 'HTTP/1.1':
+            handler.http_version = '1.1'
+
+        handler.request_handler = self
+        try:
+            handler.run(self.server.get_app())
+        finally:
+            end_of_request()
+
+        if handler.response_headers is None:
+            self.close_connection = True
+
+        if not self.close_connection and not rfile.drain(self.max_drain):
+            self.close_connection = True
+
+        self.wfile.flush()
+
+
+class ThreadPoolWSGIServer(WSGIServer):
+    """WSGI server which handles the requests in a pool of threads
+
+    :param threads: number of threads of the pool
+    :param keepalive: seconds to wait the next request of the connection,
+        0 to disable the keep alive
+    :param queue_size: connections accepted which wait for a thread, the
+        next ones wait in the backlog of the socket
+    :param timeout: seconds to wait the first request of a connection
+    """
+
+    multithread = True
+    multiprocess = False
+
+    def __init__(self, server_address, RequestHandlerClass, threads=8,
+                 keepalive=5, queue_size=None, timeout=30,
+                 bind_and_activate=True):
+        self.keepalive = keepalive
+        self.request_timeout = timeout or None
+        self.threads = threads
+        if queue_size is None:
+            queue_size = threads
+
+        self.connections = BoundedSemaphore(threads + queue_size)
+        self.active = 0
+        self.lock = Lock()
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        super(ThreadPoolWSGIServer, self).__init__(
+            server_address, RequestHandlerClass,
+            bind_and_activate=bind_and_activate)
+
+    def is_saturated(self):
+        """Return True if accepted connections wait for a thread"""
+        return self.active > self.threads
+
+    def process_request(self, request, client_address):
+        # blocks the accept loop while the queue is full
+        self.connections.acquire()
+        with self.lock:
+            self.active += 1
+
+        self.executor.submit(self.process_request_thread, request,
+                             client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self.lock:
+                self.active -= 1
+
+            self.connections.release()
+
+    def server_close(self):
+        """Close the socket and wait the end of the requests in progress"""
+        super(ThreadPoolWSGIServer, self).server_close()
+        self.executor.shutdown(wait=True)
+
+
+def make_anyblok_server(host, port, app, threads=0, keepalive=5,
+                        queue_size=None, timeout=30):
+    """Return the WSGI server
+
+    :param host: host to bind
+    :param port: port to bind
+    :param app: WSGI application
+    :param threads: number of threads, 0 for the ``wsgiref`` server
+    :param keepalive: keep alive timeout in seconds for the threaded server
+    :param queue_size: connections waiting for a thread, by default the
+        number of threads
+    :param timeout: seconds to wait the first request of a connection
+    """
+    if not threads:
+        return make_server(host, port, app)
+
+    server = ThreadPoolWSGIServer((host, port), AnyBlokWSGIRequestHandler,
+                                  threads=threads, keepalive=keepalive,
+                                  queue_size=queue_size, timeout=timeout)
+    server.set_app(app)
+    return server
+
+
+def shutdown_on_signal(server, *signums):
+    """Stop the server gracefully when one of the signals is received"""
+
+    def handler(signum, frame):
+        logger.info("Signal %r received, stop the server", signum)
+        # shutdown waits the end of serve_forever, call it in another thread
+        Thread(target=server.shutdown).start()
+
+    for signum in signums:
+        signal.signal(signum, handler)
+
+
+def serve(server, before_serve=None):
+    """Serve until SIGTERM or SIGINT, then wait the requests in progress
+
+    :param server: WSGI server
+    :param before_serve: callable called before serving
+    """
+    shutdown_on_signal(server, signal.SIGTERM, signal.SIGINT)
+    if before_serve:
+        before_serve()
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+class PreForkServer:
+    """Fork the server, each process serves the socket bound by the
+    parent. The dead processes are replaced, SIGTERM and SIGINT are sent
+    to the children which finish their requests in progress. A process
+    which dies less than ``min_uptime`` seconds after its start is replaced
+    after a delay, doubled at each quick death up to ``max_backoff``
+
+    :param server: WSGI server, already bound
+    :param processes: number of processes
+    :param before_serve: callable called in each child, after the fork
+    """
+
+    min_uptime = 1
+    max_backoff = 30
+
+    def __init__(self, server, processes, before_serve=None):
+        self.server = server
+        self.server.multiprocess = True
+        self.processes = processes
+        self.before_serve = before_serve
+        self.children = {}
+        self.stopping = False
+        self.backoff = 0
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.monotonic()
+            return
+
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        status = 0
+        try:
+            serve(self.server, before_serve=self.before_serve)
+        except Exception:
+            logger.exception("Error in the process %r", os.getpid())
+            status = 1
+        finally:
+            os._exit(status)
+
+    def stop(self, signum, frame):
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def wait_backoff(self, started):
+        """Wait before the replacement of a process started at started"""
+        if time.monotonic() - started >= self.min_uptime:
+            self.backoff = 0
+            return
+
+        self.backoff = min(max(self.backoff * 2, 0.1), self.max_backoff)
+        logger.warning("The process died at its start, wait %.1f seconds",
+                       self.backoff)
+        stop = time.monotonic() + self.backoff
+        while not self.stopping and time.monotonic() < stop:
+            time.sleep(0.05)
+
+    def serve_forever(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for x in range(self.processes):
+            self.spawn()
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+
+            started = self.children.pop(pid, None)
+            if started is None:
+                continue
+
+            if not self.stopping:
+                logger.warning("The process %r is dead, spawn a new one", pid)
+                self.wait_backoff(started)
+
+            if not self.stopping:
+                self.spawn()
+
+        self.server.socket.close()
@@ -0,0 +1,475 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+"""Fingerprinted and precompressed static files
+
+The build step copies the files of the ``static_paths`` of each blok with
+the hash of the content in the name, writes the gzip (and brotli if the
+``brotli`` package is installed) variants and a ``manifest.json``::
+
+    anyblok_pyramid_static --static-build-dir /var/www/static
+
+When ``static_build_dir`` is defined, the ``static_paths`` includeme serves
+the built directory: the compressed variant is chosen by
+``Accept-Encoding`` and the fingerprinted files are cached forever by the
+clients. The templates get the url with ``request.static_asset_url``.
+"""
+import gzip
+import json
+import mimetypes
+import os
+import shutil
+from hashlib import sha1
+from stat import S_ISREG
+from threading import Lock
+from time import monotonic
+from os.path import join, isdir, splitext, dirname, relpath
+from anyblok.blok import BlokManager
+from anyblok.config import Configuration
+from pyramid.config.views import StaticURLInfo
+from pyramid.httpexceptions import HTTPNotFound
+from pyramid.interfaces import IStaticURLInfo
+from pyramid.response import Response, FileIter
+from pyramid.security import NO_PERMISSION_REQUIRED
+from logging import getLogger
+logger = getLogger(__name__)
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+MANIFEST = 'manifest.json'
+IMMUTABLE = 'public, max-age=31536000, immutable'
+UNCOMPRESSIBLE = ('.png', '.jpg', '.jpeg', '.gif', '.webp', '.ico', '.gz',
+                  '.br', '.zip', '.woff', '.woff2', '.mp3', '.mp4', '.ogg',
+                  '.webm', '.pdf')
+COMPRESS_MIN_SIZE = 256
+BLOCK_SIZE = 256 * 1024
+
+
+def get_static_paths():
+    """Return the static paths of the bloks
+
+    The blok defines them with the attribute ``static_paths``, by default
+    ``static``
+
+    :rtype: list of (blok name, url prefix, directory)
+    """
+    res = []
+    for blok, cls in BlokManager.bloks.items():
+        paths = getattr(cls, 'static_paths', ['static'])
+        if isinstance(paths, str):
+            paths = [paths]
+
+        blok_path = BlokManager.getPath(blok)
+        for p in paths:
+            res.append((blok, join(blok, p), join(blok_path, p)))
+
+    return res
+
+
+def fingerprint(name, digest):
+    """Return the name with the hash: ``app.js`` => ``app.<hash>.js``"""
+    root, ext = splitext(name)
+    return '%s.%s%s' % (root, digest, ext)
+
+
+def is_compressible(path):
+    if path.lower().endswith(UNCOMPRESSIBLE):
+        return False
+
+    return os.path.getsize(path) >= COMPRESS_MIN_SIZE
+
+
+def compress(path, encoding):
+    """Write the compressed variant of the file, return the encoding if the
+    variant is smaller than the file
+    """
+    with open(path, 'rb') as fp:
+        data = fp.read()
+
+    if encoding == 'gzip':
+        extension = '.gz'
+        compressed = gzip.compress(data, compresslevel=9)
+    else:
+        extension = '.br'
+        compressed = brotli.compress(data)
+
+    if len(compressed) >= len(data):
+        return None
+
+    with open(path + extension, 'wb') as fp:
+        fp.write(compressed)
+
+    return encoding
+
+
+def build_static(output, static_paths=None):
+    """Build the fingerprinted and compressed files in the output directory
+
+    :param output: build directory, removed before the build
+    :param static_paths: list of (blok, prefix, directory), by default
+        ``get_static_paths()``
+    :rtype: dict, the manifest
+    """
+    if static_paths is None:
+        static_paths = get_static_paths()
+
+    if isdir(output):
+        shutil.rmtree(output)
+
+    encodings = ['gzip'] if brotli is None else ['br', 'gzip']
+    files = {}
+    for blok, prefix, directory in static_paths:
+        if not isdir(directory):
+            continue
+
+        for root, dirs, filenames in os.walk(directory):
+            for filename in sorted(filenames):
+                path = join(root, filename)
+                name = join(prefix, relpath(path, directory))
+                with open(path, 'rb') as fp:
+                    digest = sha1(fp.read()).hexdigest()[:12]
+
+                hashed = fingerprint(name, digest)
+                target = join(output, hashed)
+                os.makedirs(dirname(target), exist_ok=True)
+                shutil.copyfile(path, target)
+                entry = {'path': hashed, 'encodings': []}
+                if is_compressible(path):
+                    entry['encodings'] = [
+                        encoding for encoding in encodings
+                        if compress(target, encoding)]
+
+                files[name] = entry
+
+    manifest = {'version': 1, 'files': files}
+    os.makedirs(output, exist_ok=True)
+    with open(join(output, MANIFEST), 'w') as fp:
+        json.dump(manifest, fp, indent=2, sort_keys=True)
+
+    logger.info('%d static files built in %r', len(files), output)
+    return manifest
+
+
+def load_manifest(build_dir):
+    with open(join(build_dir, MANIFEST), 'r') as fp:
+        return json.load(fp)
+
+
+class StatCache:
+    """Keep the ``os.stat`` of the files during ``ttl`` seconds
+
+    :param ttl: seconds, 0 to disable the cache
+    :param max_entries: the cache is cleared beyond this size
+    """
+
+    def __init__(self, ttl=2, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = {}
+        self.lock = Lock()
+
+    def stat(self, path):
+        """Return the stat of the regular file, None if it does not exist"""
+        now = monotonic()
+        entry = self.entries.get(path)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+
+        try:
+            stat = os.stat(path)
+            if not S_ISREG(stat.st_mode):
+                stat = None
+        except OSError:
+            stat = None
+
+        if self.ttl:
+            with self.lock:
+                if len(self.entries) >= self.max_entries:
+                    self.entries.clear()
+
+                self.entries[path] = (now + self.ttl, stat)
+
+        return stat
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+stat_cache = StatCache()
+
+
+class FileRange:
+    """File limited to ``length`` bytes from the current position
+
+    The servers which use ``sendfile`` (gunicorn) send the file from its
+    current position with the Content-Length of the response, the others
+    call ``read``
+    """
+
+    def __init__(self, fp, length):
+        self.fp = fp
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+
+        data = self.fp.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.fp.fileno()
+
+    def close(self):
+        self.fp.close()
+
+
+class AnyBlokFileResponse(Response):
+    """Response of a file, given to ``wsgi.file_wrapper`` when the server
+    has one (zero copy with the ``sendfile`` of gunicorn), with the
+    conditional (ETag, Last-Modified) and the range requests
+
+    :param path: path of the file
+    :param request: Pyramid request
+    :param stat: ``os.stat`` of the file, by default read by ``stat_cache``
+    :param content_type: by default guessed from the path
+    :param content_encoding: encoding of the file (gzip, br)
+    :param cache_max_age: seconds of cache by the client
+    """
+
+    def __init__(self, path, request=None, stat=None, content_type=None,
+                 content_encoding=None, cache_max_age=None):
+        if stat is None:
+            stat = os.stat(path)
+
+        if content_type is None:
+            content_type, _ = mimetypes.guess_type(path)
+
+        super(AnyBlokFileResponse, self).__init__(
+            conditional_response=True,
+            content_type=content_type or 'application/octet-stream',
+            content_encoding=content_encoding)
+        self.path = path
+        self.request = request
+        self.last_modified = stat.st_mtime
+        self.etag = '%x-%x' % (int(stat.st_mtime * 1000000), stat.st_size)
+        self.accept_ranges = 'bytes'
+        self.app_iter = self.file_iter(open(path, 'rb'))
+        self.content_length = stat.st_size
+        if cache_max_age is not None:
+            self.cache_expires = cache_max_age
+
+    def file_iter(self, fp):
+        environ = self.request.environ if self.request is not None else {}
+        if 'wsgi.file_wrapper' in environ:
+            return environ['wsgi.file_wrapper'](fp, BLOCK_SIZE)
+
+        return FileIter(fp, BLOCK_SIZE)
+
+    def app_iter_range(self, start, stop):
+        """Called by the conditional response for a range request, the
+        file is seeked, not read until the start
+        """
+        self.app_iter.close()
+        fp = open(self.path, 'rb')
+        fp.seek(start)
+        return self.file_iter(FileRange(fp, stop - start))
+
+
+def is_safe_subpath(subpath):
+    if not subpath:
+        return False
+
+    for part in subpath:
+        if part in ('', '.', '..') or '/' in part or os.sep in part:
+            return False
+
+        if '\x00' in part:
+            return False
+
+    return True
+
+
+class StaticFileView:
+    """Serve the files of a directory with ``AnyBlokFileResponse``
+
+    :param directory: absolute path of the directory
+    :param cache_max_age: seconds of cache by the client
+    """
+
+    def __init__(self, directory, cache_max_age=None):
+        self.directory = directory
+        self.cache_max_age = cache_max_age
+
+    def __call__(self, request):
+        if not is_safe_subpath(request.subpath):
+            raise HTTPNotFound(request.url)
+
+        path = join(self.directory, *request.subpath)
+        stat = stat_cache.stat(path)
+        if stat is None:
+            raise HTTPNotFound(request.url)
+
+        try:
+            return AnyBlokFileResponse(path, request=request, stat=stat,
+                                       cache_max_age=self.cache_max_age)
+        except (IOError, OSError):
+            raise HTTPNotFound(request.url)
+
+
+def add_static_file_view(config, name, directory, cache_max_age=3600):
+    """Same as ``config.add_static_view`` for a directory, with
+    ``StaticFileView``. ``request.static_url`` works with the files of the
+    directory
+
+    :param config: Pyramid configurator instance
+    :param name: url prefix
+    :param directory: absolute path of the directory
+    :param cache_max_age: seconds of cache by the client, one hour by
+        default as ``add_static_view``, None for no cache headers
+    """
+    name = name.rstrip('/') + '/'
+    route_name = '__%s' % name
+    config.add_route(route_name, '/%s*subpath' % name)
+    config.add_view(StaticFileView(directory, cache_max_age=cache_max_age),
+                    route_name=route_name,
+                    permission=NO_PERMISSION_REQUIRED)
+
+    info = config.registry.queryUtility(IStaticURLInfo)
+    if info is None:
+        info = StaticURLInfo()
+        config.registry.registerUtility(info, IStaticURLInfo)
+
+    spec = directory.rstrip(os.sep) + os.sep
+
+    def register():
+        info.registrations.append((None, spec, route_name))
+
+    config.action(None, callable=register)
+
+
+class StaticAssetView:
+    """Serve the built files of one static path
+
+    The fingerprinted name is cached forever, the original name is served
+    too but must be revalidated by the client
+
+    :param build_dir: build directory
+    :param prefix: url prefix of the static path
+    :param manifest: manifest of the build
+    """
+
+    EXTENSIONS = {'br': '.br', 'gzip': '.gz'}
+
+    def __init__(self, build_dir, prefix, manifest):
+        self.build_dir = build_dir
+        self.files = {}
+        for name, entry in manifest['files'].items():
+            if name.startswith(prefix + '/'):
+                self.files[name] = (entry, False)
+                self.files[entry['path']] = (entry, True)
+
+        self.prefix = prefix
+
+    def get_encoding(self, request, encodings):
+        if not request.headers.get('Accept-Encoding'):
+            return None
+
+        for encoding in encodings:
+            if encoding in request.accept_encoding:
+                return encoding
+
+        return None
+
+    def __call__(self, request):
+        name = '/'.join((self.prefix,) + request.matchdict['subpath'])
+        if name not in self.files:
+            raise HTTPNotFound()
+
+        entry, fingerprinted = self.files[name]
+        path = join(self.build_dir, entry['path'])
+        content_type, _ = mimetypes.guess_type(entry['path'])
+        encoding = self.get_encoding(request, entry['encodings'])
+        if encoding:
+            path += self.EXTENSIONS[encoding]
+
+        stat = stat_cache.stat(path)
+        if stat is None:
+            raise HTTPNotFound()
+
+        response = AnyBlokFileResponse(
+            path, request=request, stat=stat, content_type=content_type,
+            content_encoding=encoding)
+        if entry['encodings']:
+            response.vary = ('Accept-Encoding',)
+
+        if fingerprinted:
+            response.headers['Cache-Control'] = IMMUTABLE
+        else:
+            response.headers['Cache-Control'] = 'no-cache'
+
+        return response
+
+
+def static_asset_url(request, name, **kw):
+    """Return the url of the static file, the fingerprinted one if the
+    static files are built::
+
+        request.static_asset_url('my-blok/static/js/app.js')
+
+    :param name: ``blok/static path/file``
+    """
+    manifest = request.registry.settings.get('anyblok.static_manifest')
+    if manifest:
+        entry = manifest['files'].get(name)
+        if entry:
+            return request.route_url(
+                'anyblok_static', subpath=entry['path'].split('/'), **kw)
+
+    blok, _, path = name.partition('/')
+    return request.static_url(join(BlokManager.getPath(blok), path), **kw)
+
+
+def add_static_assets(config, build_dir, static_paths=None):
+    """Serve the built directory for each static path
+
+    :param config: Pyramid configurator instance
+    :param build_dir: build directory
+    :param static_paths: list of (blok, prefix, directory), by default
+        ``get_static_paths()``
+    """
+    if static_paths is None:
+        static_paths = get_static_paths()
+
+    manifest = load_manifest(build_dir)
+    config.registry.settings['anyblok.static_manifest'] = manifest
+    # only used to build the urls
+    config.add_route('anyblok_static', '/*subpath', static=True)
+    for blok, prefix, directory in static_paths:
+        view = StaticAssetView(build_dir, prefix, manifest)
+        route_name = 'anyblok_static_' + prefix.replace('/', '_')
+        config.add_route(route_name, '/%s/*subpath' % prefix)
+        config.add_view(view, route_name=route_name,
+                        permission=NO_PERMISSION_REQUIRED)
+
+
+def static_assets(config):
+    """Pyramid includeme, add ``request.static_asset_url``
+
+    :param config: Pyramid configurator instance
+    """
+    config.add_request_method(static_asset_url, 'static_asset_url')
+    stat_cache.ttl = Configuration.get('static_stat_cache_ttl', 2)
+    build_dir = Configuration.get('static_build_dir')
+    if build_dir:
+        add_static_assets(config, build_dir)
@@ -0,0 +1,360 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+"""Tasks called after the commit of the transaction
+
+The views register the slow work (mail, index, webhook) which is called
+once the transaction is committed, the response does not wait for it::
+
+    from anyblok_pyramid.tasks import add_task
+
+    def view(request):
+        partner = request.anyblok.registry.Partner.insert(name='x')
+        add_task(request.anyblok.registry, send_mail, partner.email)
+
+The task is dropped if the transaction is aborted. By default the tasks are
+called by a bounded pool of threads of the worker (``--pyramid-task-*``),
+a failed task is retried with an exponential delay. When the queue of the
+pool is full the task is called by the thread which commits. At the exit of
+the process (recycled or stopped worker) the tasks of the queue are called
+during ``--pyramid-task-drain-timeout`` seconds, the others are dropped and
+logged: these tasks are best effort, a killed process loses them.
+
+With ``durable=True`` the task is inserted in the table of the blok
+``pyramid-task`` by the transaction of the request, and called by the
+``anyblok_pyramid_tasks`` console script. The function must be importable
+and the arguments json serializable.
+"""
+import atexit
+import time
+from datetime import datetime, timedelta, timezone
+from queue import Empty, Full, Queue
+from threading import Lock, Thread
+import transaction as zope_transaction
+from anyblok.config import Configuration
+from pyramid.path import DottedNameResolver
+from .anyblok import add_after_commit_callback
+from .common import get_registry_for
+from .metrics import Metric, add_metrics_collector
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+_EXECUTOR = {}
+
+
+class Task:
+    """Function and arguments of a task, with the number of calls"""
+
+    def __init__(self, func, args=(), kwargs=None):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.attempts = 0
+
+    def __call__(self):
+        self.attempts += 1
+        return self.func(*self.args, **self.kwargs)
+
+    def __repr__(self):
+        return '<Task %r attempts=%d>' % (self.func, self.attempts)
+
+
+class TaskExecutor:
+    """Bounded pool of threads which calls the tasks
+
+    :param threads: number of threads
+    :param queue_size: maximum number of tasks waiting
+    :param retries: calls after the first failure
+    :param retry_delay: seconds before the first retry, doubled by retry
+    """
+
+    def __init__(self, threads=2, queue_size=1000, retries=3, retry_delay=1):
+        self.threads = threads
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.queue = Queue(queue_size)
+        self.workers = []
+        self.lock = Lock()
+        self.stats_lock = Lock()
+        self.submitted = self.succeeded = self.failed = 0
+        self.retried = self.inline = self.dropped = 0
+
+    def start(self):
+        with self.lock:
+            while len(self.workers) < self.threads:
+                worker = Thread(target=self.work, daemon=True,
+                                name='anyblok-task-%d' % len(self.workers))
+                worker.start()
+                self.workers.append(worker)
+
+    def count(self, name):
+        with self.stats_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def submit(self, task):
+        """Put the task in the queue, call it now if the queue is full"""
+        self.start()
+        self.count('submitted')
+        try:
+            self.queue.put_nowait(task)
+        except Full:
+            logger.warning('The queue of the tasks is full, %r is called by '
+                           'the thread of the request', task)
+            self.count('inline')
+            self.run(task)
+
+    def work(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+
+                self.run(task)
+            finally:
+                self.queue.task_done()
+
+    def run(self, task):
+        while True:
+            try:
+                task()
+                self.count('succeeded')
+                return
+            except Exception:
+                if task.attempts > self.retries:
+                    logger.exception('The task %r failed', task)
+                    self.count('failed')
+                    return
+
+                logger.warning('The task %r failed, retry', task,
+                               exc_info=True)
+                self.count('retried')
+                time.sleep(self.retry_delay * 2 ** (task.attempts - 1))
+
+    def join(self):
+        """Wait the end of the tasks of the queue"""
+        self.queue.join()
+
+    def stop(self, timeout=None):
+        """Call the tasks of the queue then stop the threads, the tasks
+        which are not called before the timeout are dropped
+
+        :param timeout: seconds to wait the threads, None for no limit
+        :rtype: list of the dropped tasks
+        """
+        with self.lock:
+            workers, self.workers = self.workers, []
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        def remaining():
+            if deadline is None:
+                return None
+
+            return max(deadline - time.monotonic(), 0)
+
+        try:
+            for worker in workers:
+                self.queue.put(None, timeout=remaining())
+        except Full:
+            pass
+
+        for worker in workers:
+            worker.join(remaining())
+
+        running = sum(worker.is_alive() for worker in workers)
+        if running:
+            logger.warning('%d tasks are still running after %r seconds',
+                           running, timeout)
+
+        return self.drop()
+
+    def drop(self):
+        """Remove the tasks of the queue, they are logged"""
+        dropped = []
+        while True:
+            try:
+                task = self.queue.get_nowait()
+            except Empty:
+                break
+
+            self.queue.task_done()
+            if task is not None:
+                logger.error('The task %r is dropped', task)
+                self.count('dropped')
+                dropped.append(task)
+
+        return dropped
+
+    def collect(self):
+        """Metrics collector"""
+        yield Metric('anyblok_pyramid_tasks_queue', 'Tasks waiting', 'gauge',
+                     [({}, self.queue.qsize())])
+        for name, value, help_ in (
+            ('submitted', self.submitted, 'Tasks submitted after commit'),
+            ('succeeded', self.succeeded, 'Tasks done'),
+            ('failed', self.failed, 'Tasks failed after the retries'),
+            ('retried', self.retried, 'Retries of the tasks'),
+            ('inline', self.inline,
+             'Tasks called by the request, the queue was full'),
+            ('dropped', self.dropped,
+             'Tasks of the queue dropped at the exit of the process'),
+        ):
+            yield Metric('anyblok_pyramid_tasks_%s_total' % name, help_,
+                         'counter', [({}, value)])
+
+
+def get_task_executor():
+    """Return the ``TaskExecutor`` of the process, configured by
+    ``--pyramid-task-*``
+    """
+    executor = _EXECUTOR.get('executor')
+    if executor is None:
+        executor = _EXECUTOR.setdefault('executor', TaskExecutor(
+            threads=Configuration.get('pyramid_task_threads') or 2,
+            queue_size=Configuration.get('pyramid_task_queue_size') or 1000,
+            retries=Configuration.get('pyramid_task_retries', 3),
+            retry_delay=Configuration.get('pyramid_task_retry_delay', 1)))
+
+    return executor
+
+
+def stop_task_executor():
+    """Called at the exit of the process, the tasks of the queue are called
+    during ``--pyramid-task-drain-timeout`` seconds
+    """
+    executor = _EXECUTOR.pop('executor', None)
+    if executor is not None:
+        executor.stop(
+            timeout=Configuration.get('pyramid_task_drain_timeout', 10))
+
+
+atexit.register(stop_task_executor)
+
+
+def get_function_path(func):
+    """Return the dotted name of the function, ``package.module:name``"""
+    module = getattr(func, '__module__', None)
+    name = getattr(func, '__qualname__', '')
+    if not module or not name or '<' in name:
+        raise ValueError('%r can not be imported' % func)
+
+    return '%s:%s' % (module, name)
+
+
+def add_task(registry, func, *args, durable=False, **kwargs):
+    """Call ``func(*args, **kwargs)`` after the commit of the transaction
+    of the registry
+
+    :param registry: AnyBlok registry of the request
+    :param func: callable, importable if durable
+    :param durable: if True the task is saved in the table of the blok
+        ``pyramid-task``, else it is called by the threads of the worker
+    """
+    if durable:
+        return registry.Pyramid.Task.insert(
+            func=get_function_path(func),
+            params={'args': list(args), 'kwargs': kwargs})
+
+    task = Task(func, args, kwargs)
+    add_after_commit_callback(
+        registry.session, lambda: get_task_executor().submit(task))
+
+
+def get_next_try(attempts, retry_delay):
+    return datetime.now(timezone.utc) + timedelta(
+        seconds=retry_delay * 2 ** (attempts - 1))
+
+
+def run_durable_task(registry, entry, retries, retry_delay):
+    """Call the task of the entry, the entry is deleted if it succeeds,
+    else the next try is planned, until ``retries``
+
+    :rtype: True if the task succeeded
+    """
+    savepoint = registry.session.begin_nested()
+    try:
+        func = DottedNameResolver().resolve(entry.func)
+        func(*entry.params.get('args', []), **entry.params.get('kwargs', {}))
+        savepoint.commit()
+        entry.delete()
+        return True
+    except Exception as error:
+        savepoint.rollback()
+        logger.exception('The durable task %r failed', entry.func)
+        entry.attempts += 1
+        entry.error = repr(error)
+        if entry.attempts > retries:
+            entry.state = 'failed'
+        else:
+            entry.next_try = get_next_try(entry.attempts, retry_delay)
+
+        return False
+
+
+def process_durable_tasks(registry, batch_size=100, retries=3, retry_delay=1):
+    """Call a batch of the durable tasks which are ready, the entries are
+    locked (``SKIP LOCKED`` with PostgreSQL) so several processes can work
+    on the same database. The caller commits
+
+    :rtype: number of entries processed
+    """
+    Task = registry.Pyramid.Task
+    query = Task.query().filter(
+        Task.state == 'pending',
+        Task.next_try <= datetime.now(timezone.utc))
+    query = query.order_by(Task.id).limit(batch_size)
+    if registry.engine.dialect.name == 'postgresql':
+        query = query.with_for_update(skip_locked=True)
+
+    entries = query.all()
+    for entry in entries:
+        run_durable_task(registry, entry, retries, retry_delay)
+
+    return len(entries)
+
+
+def work_on_durable_tasks(db_names, batch_size=100, retries=3, retry_delay=1,
+                          poll_interval=1, once=False):
+    """Process the durable tasks of the databases until interrupted, wait
+    ``poll_interval`` seconds when there is no task ready
+
+    :param once: process the tasks ready then return
+    """
+    registries = {}
+    while True:
+        processed = 0
+        for db_name in db_names:
+            if db_name not in registries:
+                registries[db_name] = get_registry_for(db_name)
+
+            registry = registries[db_name]
+            if 'Model.Pyramid.Task' not in registry.loaded_namespaces:
+                logger.warning('The blok pyramid-task is not installed on '
+                               '%r', db_name)
+                db_names = [x for x in db_names if x != db_name]
+                continue
+
+            with zope_transaction.manager:
+                processed += process_durable_tasks(
+                    registry, batch_size=batch_size, retries=retries,
+                    retry_delay=retry_delay)
+
+        if once or not db_names:
+            return
+
+        if not processed:
+            time.sleep(poll_interval)
+
+
+def tasks(config):
+    """Pyramid includeme, add the metrics of the tasks
+
+    :param config: Pyramid configurator instance
+    """
+    add_metrics_collector(get_task_executor().collect)
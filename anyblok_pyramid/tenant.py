@@ -0,0 +1,320 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+"""Resolution of the database of the request by tenant
+
+The plugin ``anyblok_pyramid.tenant:get_db_name`` gives the database of the
+request from the host, the subdomain, the first segment of the path or,
+when ``header`` is in ``--pyramid-tenant-kinds``, a header::
+
+    gunicorn_anyblok_pyramid \\
+        --get-db-name-plugin anyblok_pyramid.tenant:get_db_name \\
+        --pyramid-tenant-mapping tenants.json \\
+        --pyramid-tenant-domain example.com
+
+The mapping is a JSON file, by kind of value::
+
+    {
+        "header": {"acme": "acme_db"},
+        "host": {"shop.acme.com": "acme_db"},
+        "subdomain": {"acme": "acme_db"},
+        "prefix": {"acme": "acme_db"}
+    }
+
+or the rows ``(kind, value, db_name)`` of ``--pyramid-tenant-query`` in the
+database ``--pyramid-tenant-url``, both are merged. The mapping is loaded
+once by process, then reloaded every ``--pyramid-tenant-ttl`` seconds by a
+thread, the requests only read dicts.
+
+When the database is given by the first segment of the path, this segment
+is moved from ``PATH_INFO`` to ``SCRIPT_NAME``: the routes do not have it.
+A request of an unknown tenant gets ``404``, but the paths of
+``--pyramid-tenant-exclude``.
+"""
+import json
+import os
+import time
+from threading import Event, Lock, Thread
+from anyblok.config import Configuration
+from pyramid.httpexceptions import HTTPNotFound
+from pyramid.tweens import INGRESS
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import NullPool
+from .metrics import Metric, add_metrics_collector
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+KINDS = ('header', 'host', 'subdomain', 'prefix')
+DEFAULT_KINDS = ('host', 'subdomain', 'prefix')
+DB_NAME_KEY = 'anyblok.db_name'
+DEFAULT_QUERY = 'SELECT kind, value, db_name FROM tenant'
+_RESOLVER = {}
+_LOCK = Lock()
+
+
+def normalize(kind, value):
+    if kind in ('host', 'subdomain'):
+        return value.lower()
+
+    return value
+
+
+class TenantMapping:
+    """Compiled lookup of the database, one dict by kind
+
+    :param entries: iterable of ``(kind, value, db_name)``
+    """
+
+    def __init__(self, entries=()):
+        self.maps = {kind: {} for kind in KINDS}
+        for kind, value, db_name in entries:
+            if kind not in self.maps:
+                logger.warning('Unknown kind of tenant %r', kind)
+                continue
+
+            self.maps[kind][normalize(kind, value)] = db_name
+
+    def __len__(self):
+        return sum(len(x) for x in self.maps.values())
+
+    def get(self, kind, value):
+        return self.maps[kind].get(value)
+
+
+def load_file_entries(path):
+    """Return the entries of the JSON file"""
+    with open(path, 'r') as fp:
+        mapping = json.load(fp)
+
+    return [(kind, value, db_name)
+            for kind, values in mapping.items()
+            for value, db_name in values.items()]
+
+
+def load_table_entries(url, query=DEFAULT_QUERY):
+    """Return the rows of the query in the database of the url"""
+    engine = create_engine(url, poolclass=NullPool)
+    try:
+        with engine.connect() as connection:
+            return [tuple(row) for row in connection.execute(text(query))]
+    finally:
+        engine.dispose()
+
+
+def get_subdomain(host, domain):
+    """Return the label just before the domain, None if the host is not a
+    subdomain of it
+    """
+    if not host.endswith('.' + domain):
+        return None
+
+    return host[:-len(domain) - 1].rsplit('.', 1)[-1]
+
+
+class TenantResolver:
+    """Give the database of a request from the mapping of the loader
+
+    :param loader: callable which returns a ``TenantMapping``
+    :param ttl: seconds between two loads, 0 to never reload
+    :param kinds: kinds of value tried in this order, the header is only
+        used if it is given
+    :param header: header of the tenant
+    :param domain: domain of the subdomains
+    """
+
+    def __init__(self, loader, ttl=60, kinds=DEFAULT_KINDS, header=None,
+                 domain=None):
+        self.loader = loader
+        self.ttl = ttl
+        self.kinds = tuple(kinds)
+        self.header = header
+        self.domain = domain.lower() if domain else None
+        self.mapping = None
+        self.loaded = 0
+        self.errors = 0
+        self.pid = None
+        self.stopped = Event()
+        self.lock = Lock()
+
+    def refresh(self):
+        """Load the mapping, the previous one is kept if it fails"""
+        try:
+            mapping = self.loader()
+        except Exception:
+            self.errors += 1
+            logger.exception('Error while loading the mapping of the tenants')
+            if self.mapping is None:
+                self.mapping = TenantMapping()
+
+            return False
+
+        self.mapping = mapping
+        self.loaded = time.time()
+        return True
+
+    def run(self):
+        while not self.stopped.wait(self.ttl):
+            self.refresh()
+
+    def start(self):
+        """Load the mapping and start the thread of the refresh, once by
+        process
+        """
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+
+            self.refresh()
+            self.pid = os.getpid()
+            if self.ttl:
+                Thread(target=self.run, name='anyblok-tenant',
+                       daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def get_value(self, kind, request):
+        """Return the value of the kind in the request"""
+        if kind == 'header':
+            return request.headers.get(self.header) if self.header else None
+        elif kind == 'host':
+            return request.domain.lower()
+        elif kind == 'subdomain':
+            if not self.domain:
+                return None
+
+            return get_subdomain(request.domain.lower(), self.domain)
+
+        return request.path_info.split('/', 2)[1] or None
+
+    def find(self, request):
+        """Return the kind and the database of the request, ``(None, None)``
+        if it is unknown
+        """
+        if self.pid != os.getpid():
+            self.start()
+
+        mapping = self.mapping
+        for kind in self.kinds:
+            value = self.get_value(kind, request)
+            db_name = mapping.get(kind, value) if value else None
+            if db_name:
+                return kind, db_name
+
+        return None, None
+
+    def resolve(self, request):
+        """Return the database of the request, None if it is unknown"""
+        return self.find(request)[1]
+
+    def get_database_names(self):
+        """Return the databases of the mapping"""
+        if self.pid != os.getpid():
+            self.start()
+
+        return set(db_name for values in self.mapping.maps.values()
+                   for db_name in values.values())
+
+    def collect(self):
+        """Metrics collector"""
+        mapping = self.mapping or TenantMapping()
+        yield Metric('anyblok_pyramid_tenant_entries',
+                     'Values of the mapping of the tenants', 'gauge',
+                     [({'kind': kind}, len(mapping.maps[kind]))
+                      for kind in KINDS])
+        yield Metric('anyblok_pyramid_tenant_loaded_seconds',
+                     'Timestamp of the last load of the mapping', 'gauge',
+                     [({}, self.loaded)])
+        yield Metric('anyblok_pyramid_tenant_errors_total',
+                     'Failed loads of the mapping', 'counter',
+                     [({}, self.errors)])
+
+
+def load_configured_mapping():
+    """Return the mapping of the file and of the table of the
+    configuration
+    """
+    entries = []
+    path = Configuration.get('pyramid_tenant_mapping')
+    if path:
+        entries.extend(load_file_entries(path))
+
+    url = Configuration.get('pyramid_tenant_url')
+    if url:
+        entries.extend(load_table_entries(
+            url, Configuration.get('pyramid_tenant_query') or DEFAULT_QUERY))
+
+    return TenantMapping(entries)
+
+
+def get_tenant_resolver():
+    """Return the resolver of the configuration, created at the first
+    call
+    """
+    with _LOCK:
+        if 'resolver' not in _RESOLVER:
+            kinds = Configuration.get('pyramid_tenant_kinds') or DEFAULT_KINDS
+            _RESOLVER['resolver'] = TenantResolver(
+                load_configured_mapping,
+                ttl=Configuration.get('pyramid_tenant_ttl', 60), kinds=kinds,
+                header=Configuration.get('pyramid_tenant_header'),
+                domain=Configuration.get('pyramid_tenant_domain'))
+
+        return _RESOLVER['resolver']
+
+
+def reset_tenant_resolver():
+    """Stop and forget the resolver, the next call creates a new one"""
+    with _LOCK:
+        resolver = _RESOLVER.pop('resolver', None)
+
+    if resolver is not None:
+        resolver.stop()
+
+
+def get_db_name(request):
+    """Plugin of ``--get-db-name-plugin``, the database is resolved once
+    by request, None if the tenant is unknown. With the kind ``prefix`` the
+    segment of the tenant is moved to the script name
+    """
+    environ = request.environ
+    if DB_NAME_KEY not in environ:
+        kind, db_name = get_tenant_resolver().find(request)
+        if kind == 'prefix':
+            request.path_info_pop()
+
+        environ[DB_NAME_KEY] = db_name
+
+    return environ[DB_NAME_KEY]
+
+
+def tenant_tween_factory(handler, registry):
+    exclude = tuple(Configuration.get('pyramid_tenant_exclude') or ())
+
+    def tenant_tween(request):
+        if exclude and request.path.startswith(exclude):
+            return handler(request)
+
+        if get_db_name(request) is None:
+            return HTTPNotFound('Unknown tenant')
+
+        return handler(request)
+
+    return tenant_tween
+
+
+def tenant(config):
+    """Pyramid includeme, resolve the tenant before the routes, and add the
+    metrics of the mapping of the tenants
+
+    :param config: Pyramid configurator instance
+    """
+    if Configuration.get('get_db_name') is get_db_name:
+        config.add_tween('anyblok_pyramid.tenant.tenant_tween_factory',
+                         under=INGRESS)
+        add_metrics_collector(get_tenant_resolver().collect)
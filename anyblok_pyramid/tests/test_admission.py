@@ -0,0 +1,124 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok.tests.testcase import TestCase
+from anyblok.config import Configuration
+from anyblok_pyramid import admission as admission_module
+from anyblok_pyramid.admission import DatabaseAdmission, admission
+from anyblok_pyramid.metrics import _COLLECTORS, remove_metrics_collector
+from pyramid.config import Configurator
+from threading import Event, Thread
+from webtest import TestApp
+import time
+
+
+class TestDatabaseAdmission(TestCase):
+
+    def test_limit_without_queue(self):
+        db = DatabaseAdmission(2)
+        self.assertTrue(db.acquire())
+        self.assertTrue(db.acquire())
+        self.assertFalse(db.acquire())
+        self.assertEqual((db.active, db.admitted, db.shed), (2, 2, 1))
+        db.release()
+        self.assertTrue(db.acquire())
+
+    def test_queue_timeout(self):
+        db = DatabaseAdmission(1, queue_size=1, timeout=0.05)
+        db.acquire()
+        start = time.monotonic()
+        self.assertFalse(db.acquire())
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+        self.assertEqual(db.waiting, 0)
+        self.assertEqual(db.shed, 1)
+
+    def test_queue_admitted_after_release(self):
+        db = DatabaseAdmission(1, queue_size=1, timeout=5)
+        db.acquire()
+        results = []
+        thread = Thread(target=lambda: results.append(db.acquire()))
+        thread.start()
+        while not db.waiting:
+            time.sleep(0.001)
+
+        # the queue is full
+        self.assertFalse(db.acquire())
+        db.release()
+        thread.join()
+        self.assertEqual(results, [True])
+        self.assertEqual(db.active, 1)
+
+
+class TestAdmissionTween(TestCase):
+
+    def setUp(self):
+        super(TestAdmissionTween, self).setUp()
+        self.configuration = {
+            key: Configuration.get(key)
+            for key in ('get_db_name', 'admission_limit', 'admission_queue',
+                        'admission_timeout', 'admission_exclude')}
+        Configuration.update(
+            get_db_name=lambda request: request.params.get('db', 'db'),
+            admission_limit=1, admission_queue=0, admission_timeout=0,
+            admission_exclude=['/static'])
+        self.event = Event()
+        self.started = Event()
+        admission_module._CONTROL.clear()
+        config = Configurator()
+        config.include(admission)
+        self.control = config.registry.anyblok_admission
+        self.addCleanup(remove_metrics_collector, self.control.collect)
+        self.addCleanup(admission_module._CONTROL.clear)
+
+        def slow(request):
+            self.started.set()
+            self.event.wait(5)
+            return {}
+
+        config.add_route('slow', '/slow')
+        config.add_view(slow, route_name='slow', renderer='json')
+        config.add_route('fast', '/{path:.*}')
+        config.add_view(lambda request: {}, route_name='fast',
+                        renderer='json')
+        self.app = TestApp(config.make_wsgi_app())
+
+    def tearDown(self):
+        self.event.set()
+        Configuration.update(**self.configuration)
+        super(TestAdmissionTween, self).tearDown()
+
+    def test_shed(self):
+        thread = Thread(target=self.app.get, args=('/slow',))
+        thread.start()
+        self.started.wait(5)
+        response = self.app.get('/fast', status=503)
+        self.assertEqual(response.headers['Retry-After'], '5')
+        # the other databases are not limited
+        self.app.get('/fast?db=other')
+        # nor the excluded paths
+        self.app.get('/static/file.css')
+        self.event.set()
+        thread.join()
+        self.app.get('/fast')
+        self.assertEqual(self.control.get('db').shed, 1)
+        self.assertEqual(self.control.get('db').active, 0)
+
+    def test_metrics(self):
+        self.app.get('/fast')
+        metrics = {metric.name: metric.samples
+                   for metric in self.control.collect()}
+        self.assertEqual(
+            metrics['anyblok_pyramid_admission_admitted_total'],
+            [({'db_name': 'db'}, 1)])
+        self.assertEqual(metrics['anyblok_pyramid_admission_queue'],
+                         [({'db_name': 'db'}, 0)])
+
+    def test_one_control_by_process(self):
+        config = Configurator()
+        config.include(admission)
+        self.assertIs(config.registry.anyblok_admission, self.control)
+        self.assertEqual(_COLLECTORS.count(self.control.collect), 1)
@@ -0,0 +1,226 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok.tests.testcase import TestCase
+from anyblok.config import Configuration
+from anyblok_pyramid.affinity import (SLOT_ENV, TOKEN_ENV, TOKEN_HEADER,
+                                      HashRing, TenantAffinity, assign_slot)
+from pyramid.request import Request
+from io import BytesIO
+from os import environ
+import json
+import socket
+
+
+class MockConfig:
+
+    def __init__(self, workers, tenant_affinity_port=9100):
+        self.workers = workers
+        self.tenant_affinity_port = tenant_affinity_port
+
+
+class MockWorker:
+    pass
+
+
+class MockArbiter:
+
+    def __init__(self, workers):
+        self.cfg = MockConfig(workers)
+        self.WORKERS = {}
+
+    def fork(self):
+        worker = MockWorker()
+        assign_slot(self, worker)
+        self.WORKERS[id(worker)] = worker
+        return worker.anyblok_slot
+
+
+class TestHashRing(TestCase):
+
+    def test_stable(self):
+        names = ['db%d' % x for x in range(100)]
+        self.assertEqual([HashRing(range(4)).get_slot(x) for x in names],
+                         [HashRing(range(4)).get_slot(x) for x in names])
+
+    def test_distribution(self):
+        ring = HashRing(range(4))
+        slots = [ring.get_slot('db%d' % x) for x in range(1000)]
+        for slot in range(4):
+            self.assertGreater(slots.count(slot), 150)
+
+    def test_new_slot_moves_only_its_names(self):
+        ring, new_ring = HashRing(range(4)), HashRing(range(5))
+        for name in ('db%d' % x for x in range(1000)):
+            slot = new_ring.get_slot(name)
+            if slot != 4:
+                self.assertEqual(slot, ring.get_slot(name))
+
+
+class TestAssignSlot(TestCase):
+
+    def setUp(self):
+        super(TestAssignSlot, self).setUp()
+        for key in (SLOT_ENV, TOKEN_ENV):
+            if key in environ:
+                self.addCleanup(environ.__setitem__, key, environ[key])
+            else:
+                self.addCleanup(environ.pop, key, None)
+
+    def test_slots(self):
+        arbiter = MockArbiter(3)
+        self.assertEqual([arbiter.fork() for x in range(3)], [0, 1, 2])
+        self.assertEqual(environ[SLOT_ENV], '2')
+        self.assertTrue(environ[TOKEN_ENV])
+        # the dead worker is replaced by a worker of the same slot
+        del arbiter.WORKERS[next(
+            pid for pid, x in arbiter.WORKERS.items() if x.anyblok_slot == 1)]
+        self.assertEqual(arbiter.fork(), 1)
+        # rolling reload, a new worker before the end of the old one
+        self.assertEqual(arbiter.fork(), 0)
+
+    def test_without_port(self):
+        arbiter = MockArbiter(3)
+        arbiter.cfg.tenant_affinity_port = 0
+        worker = MockWorker()
+        assign_slot(arbiter, worker)
+        self.assertFalse(hasattr(worker, 'anyblok_slot'))
+
+
+def get_free_ports():
+    """Return a port followed by a free port"""
+    while True:
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+
+        try:
+            with socket.socket() as sock:
+                sock.bind(('127.0.0.1', port + 1))
+        except OSError:
+            continue
+
+        return port
+
+
+def make_app(slot):
+
+    def app(environ, start_response):
+        request = Request(environ)
+        body = json.dumps({
+            'slot': slot,
+            'path': request.path_qs,
+            'body': request.text,
+            'remote_addr': request.remote_addr,
+            'token': request.headers.get(TOKEN_HEADER),
+            'db_name': environ.get('anyblok.db_name'),
+        }).encode('utf-8')
+        start_response('200 OK', [('Content-Type', 'application/json'),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
+
+    return app
+
+
+class TestTenantAffinity(TestCase):
+
+    def setUp(self):
+        super(TestTenantAffinity, self).setUp()
+        self.addCleanup(Configuration.update,
+                        get_db_name=Configuration.get('get_db_name'))
+        Configuration.update(
+            get_db_name=lambda request: request.headers.get('X-Db'))
+        self.port = get_free_ports()
+        self.affinities = [TenantAffinity(x, 2, self.port, 'secret')
+                           for x in range(2)]
+        self.apps = [self.start(x) for x in self.affinities]
+        ring = self.affinities[0].ring
+        self.db_names = {}
+        for name in ('db%d' % x for x in range(20)):
+            self.db_names.setdefault(ring.get_slot(name), name)
+
+    def start(self, affinity):
+        self.addCleanup(affinity.stop)
+        return affinity.start(make_app(affinity.slot))
+
+    def call(self, slot, db_slot, **kwargs):
+        request = Request.blank('/path?a=1', headers={
+            'X-Db': self.db_names[db_slot]}, **kwargs)
+        return request.get_response(self.apps[slot])
+
+    def test_local(self):
+        response = self.call(0, 0)
+        self.assertEqual(response.json_body['slot'], 0)
+        self.assertEqual(self.affinities[0].counters['local'], 1)
+
+    def test_forwarded(self):
+        response = self.call(0, 1, method='POST', body=b'data',
+                             remote_addr='10.0.0.1')
+        self.assertEqual(response.json_body, {
+            'slot': 1, 'path': '/path?a=1', 'body': 'data',
+            'remote_addr': '10.0.0.1', 'token': None,
+            'db_name': self.db_names[1]})
+        self.assertEqual(self.affinities[0].counters['forwarded'], 1)
+        self.assertEqual(self.affinities[1].counters['served'], 1)
+
+    def test_forwarded_by_chunks(self):
+        request = Request.blank('/path', method='POST', headers={
+            'X-Db': self.db_names[1]})
+        body = BytesIO(b'x' * 200000)
+        request.body_file_raw = body
+        request.environ['wsgi.input_terminated'] = True
+        self.assertIsNone(request.content_length)
+        response = request.get_response(self.apps[0])
+        self.assertEqual(response.json_body['body'], 'x' * 200000)
+        self.assertEqual(response.json_body['slot'], 1)
+
+    def test_body_not_loaded(self):
+        reads = []
+        body = BytesIO(b'x' * 200000)
+        read = body.read
+
+        def read_chunk(size=-1):
+            reads.append(size)
+            return read(size)
+
+        body.read = read_chunk
+        request = Request.blank('/path', method='POST', headers={
+            'X-Db': self.db_names[1]})
+        request.body_file_raw = body
+        request.content_length = 200000
+        response = request.get_response(self.apps[0])
+        self.assertEqual(len(response.json_body['body']), 200000)
+        self.assertNotIn(-1, reads)
+        self.assertTrue(all(x and x <= 65536 for x in reads))
+
+    def test_threads_of_the_server(self):
+        affinity = TenantAffinity(0, 2, self.port, 'secret', threads=0)
+        self.assertEqual(affinity.threads, 1)
+        self.assertEqual(self.affinities[0].server.threads, 1)
+
+    def test_without_database(self):
+        response = Request.blank('/').get_response(self.apps[1])
+        self.assertEqual(response.json_body['slot'], 1)
+
+    def test_wrong_token(self):
+        request = Request.blank('/', headers={TOKEN_HEADER: 'wrong'})
+        response = request.get_response(self.affinities[1].serve_forwarded)
+        self.assertEqual(response.status_int, 403)
+
+    def test_fallback(self):
+        self.affinities[1].stop()
+        response = self.call(0, 1)
+        self.assertEqual(response.json_body['slot'], 0)
+        self.assertEqual(self.affinities[0].counters['fallback'], 1)
+
+    def test_database_names(self):
+        self.addCleanup(Configuration.update,
+                        db_names=Configuration.get('db_names'))
+        Configuration.update(db_names=list(self.db_names.values()))
+        db_names = self.affinities[1].get_database_names()
+        self.assertIn(self.db_names[1], db_names)
+        self.assertNotIn(self.db_names[0], db_names)
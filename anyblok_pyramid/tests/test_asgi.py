@@ -0,0 +1,223 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok.tests.testcase import TestCase
+from anyblok.config import Configuration
+from anyblok_pyramid import asgi, pool
+from anyblok_pyramid.asgi import (ASGIApplication, build_environ,
+                                  get_max_workers)
+from threading import current_thread, Lock
+import asyncio
+import time
+
+
+def scope(path='/', method='GET', headers=None):
+    return {'type': 'http', 'method': method, 'path': path,
+            'query_string': b'a=1', 'headers': headers or [],
+            'server': ('127.0.0.1', 8000), 'client': ('127.0.0.1', 4000)}
+
+
+def echo_app(environ, start_response):
+    body = environ['wsgi.input'].read()
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+                              ('Content-Length', str(len(body)))])
+    return [body]
+
+
+def error_app(environ, start_response):
+    raise Exception('error')
+
+
+class TestASGI(TestCase):
+
+    def setUp(self):
+        super(TestASGI, self).setUp()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        super(TestASGI, self).tearDown()
+
+    def call(self, app, scope, chunks=(b'',)):
+        messages = [{'type': 'http.request', 'body': chunk,
+                     'more_body': i < len(chunks) - 1}
+                    for i, chunk in enumerate(chunks)]
+        sent = []
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+
+        self.loop.run_until_complete(app(scope, receive, send))
+        return sent
+
+    def test_build_environ(self):
+        environ = build_environ(
+            scope(path='/app/hello', headers=[(b'content-length', b'3'),
+                                              (b'x-foo', b'a'),
+                                              (b'x-foo', b'b')]),
+            None)
+        self.assertEqual(environ['PATH_INFO'], '/app/hello')
+        self.assertEqual(environ['QUERY_STRING'], 'a=1')
+        self.assertEqual(environ['CONTENT_LENGTH'], '3')
+        self.assertEqual(environ['HTTP_X_FOO'], 'a,b')
+        self.assertEqual(environ['SERVER_PORT'], '8000')
+        self.assertEqual(environ['REMOTE_ADDR'], '127.0.0.1')
+
+    def test_build_environ_with_cookies(self):
+        environ = build_environ(
+            scope(headers=[(b'cookie', b'a=1'), (b'cookie', b'b=2')]), None)
+        self.assertEqual(environ['HTTP_COOKIE'], 'a=1; b=2')
+
+    def test_build_environ_with_root_path(self):
+        environ = build_environ(
+            dict(scope(path='/app/hello'), root_path='/app'), None)
+        self.assertEqual(environ['SCRIPT_NAME'], '/app')
+        self.assertEqual(environ['PATH_INFO'], '/hello')
+
+    def test_get_max_workers(self):
+        self.addCleanup(Configuration.update,
+                        asgi_max_workers=Configuration.get('asgi_max_workers'))
+        Configuration.update(asgi_max_workers=3)
+        self.assertEqual(get_max_workers(), 3)
+
+    def test_get_max_workers_from_the_concurrency(self):
+        self.addCleanup(Configuration.update,
+                        asgi_max_workers=Configuration.get('asgi_max_workers'))
+        self.addCleanup(pool._CONCURRENCY.clear)
+        Configuration.update(asgi_max_workers=None)
+        pool.set_concurrency(1, 6)
+        self.assertEqual(get_max_workers(), 6)
+
+    def replace(self, name, value):
+        self.addCleanup(setattr, asgi, name, getattr(asgi, name))
+        setattr(asgi, name, value)
+
+    def test_concurrency_set_before_the_registries(self):
+        self.addCleanup(pool._CONCURRENCY.clear)
+        seen = []
+        self.replace('load_configuration_files', lambda: None)
+        self.replace('BlokManager', type('BlokManager', (), {
+            'load': staticmethod(lambda: None)}))
+        self.replace('preload_databases',
+                     lambda: seen.append(pool.get_concurrency()))
+        self.replace('get_reloadable_wsgi_app', lambda: echo_app)
+        app = ASGIApplication()
+        app.load()
+        self.addCleanup(app.executor.shutdown)
+        self.assertIs(app.wsgi_app, echo_app)
+        self.assertEqual(seen[0][1], app.max_workers)
+        self.assertEqual(app.executor._max_workers, app.max_workers)
+
+    def test_streamed_request_body(self):
+        app = ASGIApplication(echo_app, max_workers=2)
+        sent = self.call(app, scope(method='POST'),
+                         chunks=[b'hello ', b'world'])
+        self.assertEqual(sent[0]['type'], 'http.response.start')
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertIn((b'content-length', b'11'), sent[0]['headers'])
+        self.assertEqual(sent[1:], [{'type': 'http.response.body',
+                                     'body': b'hello world',
+                                     'more_body': False}])
+
+    def test_streamed_response_body(self):
+        threads = []
+
+        class Result:
+
+            def __iter__(self):
+                threads.append(current_thread())
+                yield b'a'
+                yield b'b'
+
+            def close(self):
+                threads.append(current_thread())
+
+        def app(environ, start_response):
+            threads.append(current_thread())
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return Result()
+
+        sent = self.call(ASGIApplication(app, max_workers=2), scope())
+        self.assertEqual([(m.get('body'), m.get('more_body')) for m in sent],
+                         [(None, None), (b'a', True), (b'b', False)])
+        # the view, the iteration and the close are on the same thread
+        self.assertEqual(len(set(threads)), 1)
+        self.assertIsNot(threads[0], current_thread())
+
+    def test_bounded_pool(self):
+        lock = Lock()
+        state = {'running': 0, 'max': 0}
+
+        def app(environ, start_response):
+            with lock:
+                state['running'] += 1
+                state['max'] = max(state['max'], state['running'])
+
+            time.sleep(0.1)
+            with lock:
+                state['running'] -= 1
+
+            start_response('200 OK', [('Content-Length', '0')])
+            return []
+
+        asgi_app = ASGIApplication(app, max_workers=2)
+
+        async def request():
+            async def receive():
+                return {'type': 'http.request', 'body': b''}
+
+            async def send(message):
+                pass
+
+            await asgi_app(scope(), receive, send)
+
+        self.loop.run_until_complete(
+            asyncio.gather(*[request() for x in range(6)], loop=self.loop))
+        self.assertEqual(state['max'], 2)
+
+    def test_error_before_start_response(self):
+        sent = self.call(ASGIApplication(error_app, max_workers=1), scope())
+        self.assertEqual(sent[0]['status'], 500)
+        self.assertFalse(sent[1]['more_body'])
+
+    def test_websocket_closed(self):
+        sent = []
+
+        async def receive():
+            return {'type': 'websocket.connect'}
+
+        async def send(message):
+            sent.append(message)
+
+        app = ASGIApplication(echo_app, max_workers=1)
+        self.loop.run_until_complete(
+            app({'type': 'websocket', 'path': '/'}, receive, send))
+        self.assertEqual(sent, [{'type': 'websocket.close', 'code': 1000}])
+
+    def test_lifespan(self):
+        messages = [{'type': 'lifespan.startup'},
+                    {'type': 'lifespan.shutdown'}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message['type'])
+
+        app = ASGIApplication(echo_app, max_workers=1)
+        self.loop.run_until_complete(
+            app({'type': 'lifespan'}, receive, send))
+        self.assertEqual(sent, ['lifespan.startup.complete',
+                                'lifespan.shutdown.complete'])
+        self.assertIsNotNone(app.executor)
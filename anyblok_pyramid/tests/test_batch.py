@@ -0,0 +1,173 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from .testcase import PyramidDBTestCase
+from anyblok import Declarations
+from anyblok.column import Integer, String
+from anyblok.config import Configuration
+from anyblok_pyramid.batch import in_batch
+from pyramid.httpexceptions import HTTPConflict
+
+
+def add_model():
+
+    @Declarations.register(Declarations.Model)
+    class Test:
+        id = Integer(primary_key=True)
+        name = String()
+
+
+def create(request):
+    name = request.matchdict['name']
+    request.anyblok.registry.Test.insert(name=name)
+    return {'name': name}
+
+
+def create_and_fail(request):
+    request.anyblok.registry.Test.insert(name=request.matchdict['name'])
+    raise Exception('error in the view')
+
+
+def create_and_conflict(request):
+    request.anyblok.registry.Test.insert(name=request.matchdict['name'])
+    return HTTPConflict()
+
+
+def headers(request):
+    return dict(request.headers)
+
+
+def names(request):
+    return sorted(x.name for x in request.anyblok.registry.Test.query())
+
+
+def batched(request):
+    return in_batch(request)
+
+
+def add_route_and_views(config):
+    config.add_route('create', '/create/{name}')
+    config.add_view(create, route_name='create', renderer='json')
+    config.add_route('fail', '/fail/{name}')
+    config.add_view(create_and_fail, route_name='fail', renderer='json')
+    config.add_route('conflict', '/conflict/{name}')
+    config.add_view(create_and_conflict, route_name='conflict',
+                    renderer='json')
+    config.add_route('batched', '/batched')
+    config.add_view(batched, route_name='batched', renderer='json')
+    config.add_route('headers', '/headers')
+    config.add_view(headers, route_name='headers', renderer='json')
+    config.add_route('names', '/names')
+    config.add_view(names, route_name='names', renderer='json')
+
+
+class TestBatch(PyramidDBTestCase):
+
+    def setUp(self):
+        super(TestBatch, self).setUp()
+        if not Configuration.has('pyramid_batch_headers'):
+            Configuration.add_argument('pyramid_batch_headers', None,
+                                       type=list)
+
+        self.configuration = {
+            key: Configuration.get(key)
+            for key in ('pyramid_batch_path', 'pyramid_batch_max_size',
+                        'pyramid_batch_headers')}
+        Configuration.update(pyramid_batch_path='/batch',
+                             pyramid_batch_max_size=5)
+        self.includemes.append(add_route_and_views)
+        self.registry = self.init_registry(add_model)
+
+    def tearDown(self):
+        Configuration.update(**self.configuration)
+        super(TestBatch, self).tearDown()
+
+    def batch(self, *paths, **kwargs):
+        status = kwargs.pop('status', 200)
+        kwargs['requests'] = [{'method': 'POST', 'path': path}
+                              for path in paths]
+        return self.webserver.post_json('/batch', kwargs, status=status)
+
+    def get_names(self):
+        return sorted(x.name for x in self.registry.Test.query())
+
+    def test_batch(self):
+        response = self.batch('/create/a', '/fail/b', '/conflict/c',
+                              '/create/d', '/names')
+        responses = response.json_body['responses']
+        self.assertEqual([x['status'] for x in responses],
+                         [200, 500, 409, 200, 200])
+        self.assertEqual(responses[0]['body'], {'name': 'a'})
+        # the last request sees the writes of the batch
+        self.assertEqual(responses[4]['body'], ['a', 'd'])
+        self.assertEqual(self.get_names(), ['a', 'd'])
+        # the body of the exceptions is rendered
+        self.assertIn('409 Conflict', responses[2]['body'])
+        self.assertIn('500 Internal Server Error', responses[1]['body'])
+
+    def test_atomic(self):
+        response = self.batch('/create/a', '/fail/b', '/create/c',
+                              atomic=True, status=500)
+        self.assertEqual(
+            [x['status'] for x in response.json_body['responses']],
+            [200, 500, 424])
+        self.assertEqual(self.get_names(), [])
+
+    def test_headers_and_method(self):
+        response = self.webserver.post_json('/batch', {'requests': [
+            {'path': '/names', 'headers': {'Accept': 'application/json'}},
+            {'method': 'POST', 'path': '/create/a', 'json': {}}]})
+        responses = response.json_body['responses']
+        self.assertEqual(responses[0]['body'], [])
+        self.assertEqual(responses[1]['status'], 200)
+
+    def test_atomic_conflict(self):
+        response = self.batch('/create/a', '/conflict/b', atomic=True,
+                              status=409)
+        self.assertEqual(
+            [x['status'] for x in response.json_body['responses']],
+            [200, 409])
+        self.assertEqual(self.get_names(), [])
+
+    def test_inherited_headers(self):
+        Configuration.update(pyramid_batch_headers=['X-Tenant'])
+        response = self.webserver.post_json(
+            '/batch', {'requests': [{'path': '/headers'}]},
+            headers={'Authorization': 'Basic abc', 'X-Tenant': 'acme',
+                     'X-Other': 'other'})
+        headers = response.json_body['responses'][0]['body']
+        self.assertEqual(headers['Authorization'], 'Basic abc')
+        self.assertEqual(headers['X-Tenant'], 'acme')
+        self.assertNotIn('X-Other', headers)
+
+    def test_batch_in_batch(self):
+        response = self.batch('/create/a', '/batch', '/batch/')
+        self.assertEqual(
+            [x['status'] for x in response.json_body['responses']],
+            [200, 400, 400])
+        self.assertEqual(self.get_names(), ['a'])
+
+    def test_batch_in_batch_atomic(self):
+        response = self.batch('/create/a', '/batch', atomic=True,
+                              status=400)
+        self.assertEqual(
+            [x['status'] for x in response.json_body['responses']],
+            [200, 400])
+        self.assertEqual(self.get_names(), [])
+
+    def test_in_batch(self):
+        self.assertFalse(self.webserver.get('/batched').json)
+        response = self.webserver.post_json(
+            '/batch', {'requests': [{'path': '/batched'}]})
+        self.assertTrue(response.json_body['responses'][0]['body'])
+
+    def test_too_many_requests(self):
+        self.batch(*['/names'] * 6, status=400)
+
+    def test_bad_body(self):
+        self.webserver.post_json('/batch', {'requests': [{}]}, status=400)
+        self.webserver.post('/batch', 'not json', status=400)
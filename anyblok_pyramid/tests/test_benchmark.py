@@ -0,0 +1,95 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok.tests.testcase import TestCase, DBTestCase
+from anyblok_pyramid.benchmark import (benchmarks, benchmark,
+                                       BenchmarkContext, run_benchmarks,
+                                       compare_results, dump_results,
+                                       load_results, time_function)
+from tempfile import mkstemp
+from os import remove
+
+
+def result(median):
+    return {'min': median, 'max': median, 'mean': median, 'median': median,
+            'number': 1, 'repeat': 1}
+
+
+class TestBenchmark(TestCase):
+
+    def tearDown(self):
+        super(TestBenchmark, self).tearDown()
+        benchmarks.pop('test_case', None)
+
+    def test_time_function(self):
+        calls = []
+        times = time_function(lambda: calls.append(1), 10, 3)
+        self.assertEqual(len(times), 3)
+        self.assertEqual(len(calls), 30)
+
+    def test_declare_and_run_benchmark(self):
+        calls = []
+
+        @benchmark('test_case', number=2)
+        def test_case(context):
+            return lambda: calls.append(context)
+
+        context = BenchmarkContext(db_name='test')
+        results = run_benchmarks(context, names=['test_case'], repeat=3)
+        self.assertEqual(list(results.keys()), ['test_case'])
+        self.assertEqual(results['test_case']['number'], 2)
+        self.assertEqual(results['test_case']['repeat'], 3)
+        self.assertEqual(calls, [context] * 6)
+
+    def test_opt_in_benchmark(self):
+        declared = benchmarks.copy()
+        self.addCleanup(benchmarks.update, declared)
+        benchmarks.clear()
+
+        @benchmark('test_case', number=1, default=False)
+        def test_case(context):
+            return lambda: None
+
+        context = BenchmarkContext(db_name='test')
+        self.assertEqual(run_benchmarks(context, repeat=1), {})
+        self.assertIn('test_case', run_benchmarks(
+            context, names=['test_case'], repeat=1))
+
+    def test_run_json_adapters(self):
+        results = run_benchmarks(BenchmarkContext(db_name='test'),
+                                 names=['json_adapters'], repeat=1, number=1)
+        self.assertGreater(results['json_adapters']['min'], 0)
+
+    def test_compare_without_regression(self):
+        self.assertFalse(compare_results(
+            {'case': result(1.05)}, {'case': result(1.)}, tolerance=0.1))
+
+    def test_compare_with_regression(self):
+        regressions = compare_results(
+            {'case': result(1.5), 'new': result(1.)}, {'case': result(1.)},
+            tolerance=0.1)
+        self.assertEqual(regressions, [('case', 1., 1.5, 1.5)])
+
+    def test_dump_and_load_results(self):
+        fd, path = mkstemp(suffix='.json')
+        try:
+            dump_results({'case': result(1.)}, path)
+            self.assertEqual(load_results(path), {'case': result(1.)})
+        finally:
+            remove(path)
+
+
+class TestBenchmarkDB(DBTestCase):
+
+    def test_run_registry_benchmarks(self):
+        self.init_registry(None)
+        names = ['registry_resolution', 'predicate_installed_blok',
+                 'predicate_need_anyblok_registry',
+                 'transaction_join_readonly']
+        results = run_benchmarks(BenchmarkContext(), names=names, repeat=1,
+                                 number=2)
+        self.assertEqual(list(results.keys()), names)
@@ -0,0 +1,163 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok.tests.testcase import DBTestCase, TestCase
+from anyblok import Declarations
+from anyblok.column import Integer, String
+from anyblok_pyramid.anyblok import get_changed_models
+from anyblok_pyramid.bulk import (bulk_insert, bulk_update, bulk_delete,
+                                  add_bulk_views, insert_values)
+from .testcase import PyramidDBTestCase
+from sqlalchemy import Column, Integer as SAInteger, MetaData, Table
+from sqlalchemy import String as SAString, create_engine
+from zope.sqlalchemy.datamanager import _SESSION_STATE, STATUS_CHANGED
+import transaction
+
+
+def add_model():
+
+    @Declarations.register(Declarations.Model)
+    class Test:
+        id = Integer(primary_key=True)
+        name = String()
+        number = Integer(default=7)
+        code = String(unique=True)
+
+
+class TestBulk(DBTestCase):
+
+    def setUp(self):
+        super(TestBulk, self).setUp()
+        self.registry = self.init_registry(add_model)
+        self.addCleanup(transaction.abort)
+
+    def get_rows(self):
+        return [(x.name, x.number)
+                for x in self.registry.Test.query().order_by('id')]
+
+    def test_insert(self):
+        results = bulk_insert(self.registry.Test, [
+            {'name': 'a'}, {'name': 'b', 'number': 1}, {'unknown': 1},
+            'wrong', {'name': 'c'}], batch_size=1)
+        self.assertEqual([x['status'] for x in results],
+                         ['created', 'created', 'error', 'error', 'created'])
+        self.assertEqual(results[2]['error'], 'Unknown columns: unknown')
+        self.assertEqual(self.get_rows(), [('a', 7), ('b', 1), ('c', 7)])
+        ids = [x.id for x in self.registry.Test.query().order_by('id')]
+        self.assertEqual([results[x]['pk']['id'] for x in (0, 1, 4)], ids)
+
+    def test_session_changed_once(self):
+        session = self.registry.session
+        bulk_insert(self.registry.Test, [{'name': 'a'}])
+        self.assertEqual(_SESSION_STATE[id(session)], STATUS_CHANGED)
+        self.assertEqual(get_changed_models(session), {'Model.Test'})
+
+    def test_update(self):
+        Test = self.registry.Test
+        test = Test.insert(name='a')
+        results = bulk_update(Test, [
+            {'id': test.id, 'name': 'b'}, {'id': test.id + 1, 'name': 'c'},
+            {'name': 'd'}])
+        self.assertEqual([x['status'] for x in results],
+                         ['updated', 'not found', 'error'])
+        # the instance of the session is expired
+        self.assertEqual(test.name, 'b')
+
+    def test_delete(self):
+        Test = self.registry.Test
+        ids = [x['pk']['id'] for x in bulk_insert(
+            Test, [{'name': 'a'}, {'name': 'b'}])]
+        results = bulk_delete(Test, [{'id': ids[0]}, {'id': ids[1] + 1}])
+        self.assertEqual([x['status'] for x in results],
+                         ['deleted', 'not found'])
+        self.assertEqual(self.get_rows(), [('b', 7)])
+
+    def test_record_refused_by_the_database(self):
+        Test = self.registry.Test
+        results = bulk_insert(Test, [
+            {'name': 'a', 'code': 'x'}, {'name': 'b', 'code': 'x'},
+            {'name': 'c', 'code': 'y'}])
+        self.assertEqual([x['status'] for x in results],
+                         ['created', 'error', 'created'])
+        self.assertIn('duplicate key', results[1]['error'])
+        self.assertEqual(self.get_rows(), [('a', 7), ('c', 7)])
+        ids = [results[x]['pk']['id'] for x in (0, 2)]
+        results = bulk_update(Test, [{'id': ids[0], 'code': 'z'},
+                                     {'id': ids[1], 'code': 'z'}])
+        self.assertEqual([x['status'] for x in results],
+                         ['updated', 'error'])
+        self.assertEqual(
+            [x.code for x in Test.query().order_by('id')], ['z', 'y'])
+
+    def test_nothing_valid(self):
+        self.assertEqual(bulk_delete(self.registry.Test, [{}]), [
+            {'status': 'error', 'error': 'Missing primary key: id'}])
+
+
+class FakeModel:
+
+    __table__ = Table('test', MetaData(),
+                      Column('id', SAInteger, primary_key=True),
+                      Column('name', SAString))
+
+
+class TestInsertValues(TestCase):
+
+    def test_primary_keys_without_returning(self):
+        engine = create_engine('sqlite://')
+        self.addCleanup(engine.dispose)
+        FakeModel.__table__.create(engine)
+        with engine.connect() as connection:
+            self.assertEqual(
+                insert_values(connection, FakeModel,
+                              [{'name': 'a'}, {'name': 'b'}]),
+                [{'id': 1}, {'id': 2}])
+            self.assertEqual(
+                insert_values(connection, FakeModel,
+                              [{'id': 10, 'name': 'c'}]),
+                [{'id': 10}])
+
+
+class FakeConfig:
+
+    def __init__(self):
+        self.views = []
+
+    def add_route(self, name, pattern):
+        pass
+
+    def add_view(self, view, **kwargs):
+        self.views.append(kwargs)
+
+
+class TestBulkViews(PyramidDBTestCase):
+
+    def test_view_arguments(self):
+        config = FakeConfig()
+        add_bulk_views(config, 'tests', '/tests', 'Model.Test',
+                       permission='write', request_method='POST')
+        self.assertEqual(config.views, [{
+            'route_name': 'tests', 'permission': 'write',
+            'request_method': 'POST', 'renderer': 'json'}])
+
+    def test_views(self):
+        self.includemes.append(
+            lambda config: add_bulk_views(config, 'tests', '/tests',
+                                          'Model.Test'))
+        self.init_registry(add_model)
+        response = self.webserver.post_json(
+            '/tests', [{'name': 'a'}, {'name': 'b'}])
+        ids = [x['pk']['id'] for x in response.json_body['results']]
+        response = self.webserver.patch_json(
+            '/tests', [{'id': ids[0], 'name': 'c'}])
+        self.assertEqual(response.json_body['results'],
+                         [{'status': 'updated'}])
+        response = self.webserver.delete_json('/tests', [{'id': ids[1]}])
+        self.assertEqual(response.json_body['results'],
+                         [{'status': 'deleted'}])
+        self.assertEqual([x.name for x in self.registry.Test.query()], ['c'])
+        self.webserver.post_json('/tests', {'name': 'a'}, status=400)
@@ -0,0 +1,331 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok.tests.testcase import TestCase, DBTestCase
+from anyblok import Declarations
+from anyblok.column import Integer, String
+from anyblok.config import Configuration
+from anyblok_pyramid.anyblok import (AnyBlokZopeTransactionExtension,
+                                     add_changed_models, add_commit_listener,
+                                     get_changed_models,
+                                     remove_commit_listener)
+from anyblok_pyramid.cache import (MemoryCacheBackend, FileCacheBackend,
+                                   CachedResponse, ResponseCache,
+                                   cached_view, response_cache)
+from anyblok_pyramid import AnyBlokPyramidException, pool
+from anyblok_pyramid.generation import (EPOCH_ENV, MemoryGenerations,
+                                        FileGenerations, check_shared,
+                                        get_generations, reset_generations)
+from os import environ
+from pyramid.config import Configurator
+from pyramid.exceptions import ConfigurationExecutionError
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from webtest import TestApp
+import time
+import transaction
+
+
+def entry(body, ttl=60):
+    return CachedResponse('200 OK', [], body, time.time() + ttl)
+
+
+class FakeRegistry:
+    db_name = 'db'
+
+
+class TestBackend(TestCase):
+
+    def setUp(self):
+        super(TestBackend, self).setUp()
+        self.directory = mkdtemp()
+        self.addCleanup(rmtree, self.directory)
+
+    def test_memory_lru(self):
+        backend = MemoryCacheBackend(max_size=10)
+        backend.set('a', entry(b'1234'))
+        backend.set('b', entry(b'1234'))
+        self.assertEqual(backend.get('a').body, b'1234')
+        backend.set('c', entry(b'1234'))
+        # b is the least recently used
+        self.assertIsNone(backend.get('b'))
+        self.assertIsNotNone(backend.get('a'))
+        self.assertEqual(backend.size, 8)
+        backend.set('d', entry(b'12345678901'))
+        self.assertIsNone(backend.get('d'))
+
+    def test_memory_expire(self):
+        backend = MemoryCacheBackend()
+        backend.set('a', entry(b'1', ttl=-1))
+        self.assertIsNone(backend.get('a'))
+        self.assertEqual(backend.size, 0)
+
+    def test_file(self):
+        backend = FileCacheBackend(self.directory, max_size=10)
+        backend.set('a' * 40, entry(b'1234'))
+        self.assertEqual(backend.get('a' * 40).body, b'1234')
+        self.assertIsNone(backend.get('b' * 40))
+        backend.set('b' * 40, entry(b'1', ttl=-1))
+        self.assertIsNone(backend.get('b' * 40))
+        backend.clear()
+        self.assertIsNone(backend.get('a' * 40))
+
+    def test_file_format(self):
+        backend = FileCacheBackend(self.directory)
+        backend.set('a' * 40, CachedResponse(
+            '200 OK', [('Content-Type', 'text/plain')], b'line\nbody',
+            time.time() + 60))
+        entry_ = backend.get('a' * 40)
+        self.assertEqual((entry_.status, entry_.headerlist, entry_.body),
+                         ('200 OK', [('Content-Type', 'text/plain')],
+                          b'line\nbody'))
+        # the files are not unpickled
+        with open(backend.path('b' * 40), 'wb') as fp:
+            fp.write(b'\x80\x03cos\nsystem\n.')
+
+        self.assertIsNone(backend.get('b' * 40))
+
+    def test_file_shrink(self):
+        backend = FileCacheBackend(self.directory, max_size=500)
+        for x in '0123456789':
+            backend.set(x * 40, entry(b'x' * 100))
+
+        backend.shrink()
+        self.assertLessEqual(sum(x[1] for x in backend.files()), 500)
+
+    def test_memory_generations(self):
+        generations = MemoryGenerations()
+        self.assertEqual(generations.get_many('db', ['A', 'B']), (0, 0))
+        generations.bump('db', ['A'])
+        self.assertEqual(generations.get_many('db', ['A', 'B']), (1, 0))
+        self.assertEqual(generations.get('other', 'A'), 0)
+        epoch = generations.epoch
+        generations.bump_all()
+        self.assertNotEqual(generations.epoch, epoch)
+
+    def test_file_generations_are_shared(self):
+        path = join(self.directory, 'generations')
+        generations1 = FileGenerations(path, slots=16)
+        generations2 = FileGenerations(path, slots=16)
+        self.addCleanup(generations1.close)
+        self.addCleanup(generations2.close)
+        self.assertEqual(generations1.epoch, generations2.epoch)
+        generations1.bump('db', ['A'])
+        self.assertEqual(generations2.get('db', 'A'), 1)
+        generations2.bump_all()
+        self.assertEqual(generations1.epoch, generations2.epoch)
+
+    def test_epoch_of_the_environment(self):
+        self.addCleanup(environ.__setitem__, EPOCH_ENV,
+                        environ.get(EPOCH_ENV, ''))
+        environ[EPOCH_ENV] = '1234'
+        self.assertEqual(MemoryGenerations().epoch, 1234)
+        generations = FileGenerations(join(self.directory, 'generations'))
+        self.addCleanup(generations.close)
+        self.assertEqual(generations.epoch, 1234)
+
+
+class TestGetGenerations(TestCase):
+
+    OPTIONS = ('pyramid_cache_generations', 'pyramid_cache_dir',
+               'pyramid_cache_backend')
+
+    def setUp(self):
+        super(TestGetGenerations, self).setUp()
+        self.directory = mkdtemp()
+        self.addCleanup(rmtree, self.directory)
+        for key in self.OPTIONS:
+            if not Configuration.has(key):
+                Configuration.add_argument(key, None, type=str)
+
+        self.addCleanup(Configuration.update, **{
+            key: Configuration.get(key) for key in self.OPTIONS})
+        Configuration.update(**{key: None for key in self.OPTIONS})
+        self.addCleanup(pool._CONCURRENCY.clear)
+
+    def test_one_process(self):
+        pool.set_concurrency(1, 4)
+        self.assertIsInstance(get_generations(), MemoryGenerations)
+
+    def test_processes_in_the_directory(self):
+        pool.set_concurrency(4, 1)
+        Configuration.update(pyramid_cache_dir=self.directory)
+        generations = get_generations()
+        self.addCleanup(generations.close)
+        self.assertIsInstance(generations, FileGenerations)
+        self.assertEqual(generations.path, join(self.directory, 'generations'))
+
+    def test_processes_without_file(self):
+        pool.set_concurrency(4, 1)
+        generations = get_generations()
+        self.assertIsInstance(generations, MemoryGenerations)
+        with self.assertRaises(AnyBlokPyramidException):
+            check_shared(generations, 'anyblok_cache_models')
+
+    def test_processes_with_file(self):
+        pool.set_concurrency(4, 1)
+        Configuration.update(pyramid_cache_dir=self.directory)
+        generations = get_generations()
+        self.addCleanup(generations.close)
+        check_shared(generations, 'anyblok_cache_models')
+
+    def test_view_without_cache_starts(self):
+        pool.set_concurrency(4, 1)
+        config = Configurator()
+        response_cache(config)
+        self.addCleanup(reset_generations)
+        config.add_route('view', '/view')
+        config.add_view(lambda request: {}, route_name='view',
+                        renderer='json')
+        config.make_wsgi_app()
+
+    def test_view_with_cache_refused(self):
+        pool.set_concurrency(4, 1)
+        config = Configurator()
+        response_cache(config)
+        self.addCleanup(reset_generations)
+        config.add_route('view', '/view')
+        config.add_view(lambda request: {}, route_name='view',
+                        renderer='json', anyblok_cache_models=['Model.Test'])
+        with self.assertRaises(ConfigurationExecutionError):
+            config.make_wsgi_app()
+
+
+class TestCachedView(TestCase):
+
+    def setUp(self):
+        super(TestCachedView, self).setUp()
+        self.get_db_name = Configuration.get('get_db_name')
+        Configuration.update(get_db_name=lambda request: 'db')
+        self.calls = []
+        config = Configurator()
+        config.add_view_deriver(cached_view)
+        self.cache = ResponseCache(MemoryCacheBackend(), MemoryGenerations())
+        config.registry.anyblok_response_cache = self.cache
+
+        def view(request):
+            self.calls.append(request.path_qs)
+            return {'calls': len(self.calls)}
+
+        def cookie(request):
+            request.response.set_cookie('a', 'b')
+            return {}
+
+        config.add_route('view', '/view')
+        config.add_view(view, route_name='view', renderer='json',
+                        request_method=('GET', 'POST'),
+                        anyblok_cache_models=['Model.Test'])
+        config.add_route('cookie', '/cookie')
+        config.add_view(cookie, route_name='cookie', renderer='json',
+                        anyblok_cache_models=['Model.Test'])
+        self.app = TestApp(config.make_wsgi_app())
+
+    def tearDown(self):
+        Configuration.update(get_db_name=self.get_db_name)
+        super(TestCachedView, self).tearDown()
+
+    def test_hit(self):
+        self.assertEqual(self.app.get('/view').json, {'calls': 1})
+        response = self.app.get('/view')
+        self.assertEqual(response.json, {'calls': 1})
+        self.assertEqual(response.headers['X-AnyBlok-Cache'], 'hit')
+
+    def test_params_in_key(self):
+        self.app.get('/view?a=1')
+        self.assertEqual(self.app.get('/view?a=2').json, {'calls': 2})
+        self.assertEqual(self.app.get('/view?a=1').json, {'calls': 1})
+
+    def test_credentials_in_key(self):
+        self.app.get('/view', headers={'Authorization': 'Basic YTpi'})
+        self.assertEqual(self.app.get('/view').json, {'calls': 2})
+        self.assertEqual(self.app.get('/view', headers={
+            'Cookie': 'session=1'}).json, {'calls': 3})
+        self.assertEqual(self.app.get('/view', headers={
+            'Authorization': 'Basic YTpi'}).json, {'calls': 1})
+
+    def test_invalidate(self):
+        self.app.get('/view')
+        self.cache.invalidate(FakeRegistry, {'Model.Other'})
+        self.assertEqual(self.app.get('/view').json, {'calls': 1})
+        self.cache.invalidate(FakeRegistry, {'Model.Test'})
+        self.assertEqual(self.app.get('/view').json, {'calls': 2})
+
+    def test_clear(self):
+        self.app.get('/view')
+        self.cache.clear()
+        self.assertEqual(self.app.get('/view').json, {'calls': 2})
+
+    def test_post_not_cached(self):
+        self.app.post('/view')
+        self.assertEqual(self.app.post('/view').json, {'calls': 2})
+
+    def test_batch_not_cached(self):
+        environ = {'anyblok.batch': True}
+        self.app.get('/view')
+        self.assertEqual(self.app.get('/view', extra_environ=environ).json,
+                         {'calls': 2})
+        self.app.get('/view', extra_environ=environ)
+        self.assertEqual(self.app.get('/view').json, {'calls': 1})
+
+    def test_set_cookie_not_cached(self):
+        self.app.get('/cookie')
+        response = self.app.get('/cookie')
+        self.assertNotIn('X-AnyBlok-Cache', response.headers)
+
+
+def add_model():
+
+    @Declarations.register(Declarations.Model)
+    class Test:
+        id = Integer(primary_key=True)
+        name = String()
+
+
+class TestCommitListener(DBTestCase):
+
+    def test_changed_models(self):
+        registry = self.init_registry(add_model)
+        calls = []
+
+        def listener(registry, models):
+            calls.append(models)
+
+        add_commit_listener(listener)
+        self.addCleanup(remove_commit_listener, listener)
+        session = registry.session
+        session.add(registry.Test(name='test'))
+        AnyBlokZopeTransactionExtension().after_flush(session, None)
+        transaction.commit()
+        self.assertEqual(calls, [{'Model.Test'}])
+
+    def test_abort(self):
+        registry = self.init_registry(add_model)
+        calls = []
+
+        def listener(registry, models):
+            calls.append(models)
+
+        add_commit_listener(listener)
+        self.addCleanup(remove_commit_listener, listener)
+        session = registry.session
+        session.add(registry.Test(name='test'))
+        AnyBlokZopeTransactionExtension().after_flush(session, None)
+        transaction.abort()
+        transaction.commit()
+        self.assertEqual(calls, [])
+
+    def test_forgotten_at_the_end_of_the_transaction(self):
+        registry = self.init_registry(add_model)
+        session = registry.session
+        add_changed_models(session, 'Model.Test')
+        savepoint = session.begin_nested()
+        savepoint.rollback()
+        self.assertEqual(get_changed_models(session), {'Model.Test'})
+        # rolled back without the transaction manager
+        session.rollback()
+        self.assertEqual(get_changed_models(session), set())
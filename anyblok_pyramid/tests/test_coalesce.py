@@ -0,0 +1,228 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok.tests.testcase import TestCase
+from anyblok_pyramid.coalesce import SingleFlight, coalesce_view, get_key
+from pyramid.request import Request
+from pyramid.response import Response
+from .testcase import PyramidDBTestCase
+from tempfile import TemporaryDirectory
+from threading import Event, Thread
+import os
+import time
+
+
+class SlowView:
+
+    def __init__(self, headers=None, error=False, status=200):
+        self.calls = 0
+        self.status = status
+        self.started = Event()
+        self.release = Event()
+        self.headers = headers or {}
+        self.error = error
+
+    def __call__(self):
+        self.calls += 1
+        self.started.set()
+        self.release.wait(5)
+        if self.error and self.calls == 1:
+            raise Exception('error in the view')
+
+        return Response(body=b'calls=%d' % self.calls, headers=self.headers,
+                        status=self.status)
+
+
+def call_in_threads(flight, view, followers=2, flights=None):
+    """Call the view by a leader then by the followers, return the bodies"""
+    bodies = []
+
+    def call(flight):
+        try:
+            bodies.append(flight.call('key', view).body)
+        except Exception as error:
+            bodies.append(error)
+
+    threads = [Thread(target=call, args=(flight,))]
+    threads[0].start()
+    view.started.wait(5)
+    for index in range(followers):
+        other = flights[index] if flights else flight
+        threads.append(Thread(target=call, args=(other,)))
+        threads[-1].start()
+
+    time.sleep(0.1)
+    view.release.set()
+    for thread in threads:
+        thread.join(5)
+
+    return bodies
+
+
+class TestSingleFlight(TestCase):
+
+    def test_coalesced(self):
+        flight = SingleFlight(timeout=5)
+        view = SlowView()
+        self.assertEqual(call_in_threads(flight, view), [b'calls=1'] * 3)
+        self.assertEqual(view.calls, 1)
+        self.assertEqual(flight.counters['coalesced'], 2)
+        self.assertEqual(flight.flights, {})
+
+    def test_timeout(self):
+        flight = SingleFlight(timeout=0.01)
+        view = SlowView()
+        call_in_threads(flight, view, followers=1)
+        self.assertEqual(view.calls, 2)
+        self.assertEqual(flight.counters['timeout'], 1)
+
+    def test_not_shared(self):
+        flight = SingleFlight(timeout=5)
+        view = SlowView(headers={'Set-Cookie': 'session=1'})
+        call_in_threads(flight, view, followers=1)
+        self.assertEqual(view.calls, 2)
+        self.assertEqual(flight.counters['unshared'], 1)
+
+    def test_error_status_not_shared(self):
+        flight = SingleFlight(timeout=5)
+        view = SlowView(status=503)
+        call_in_threads(flight, view, followers=1)
+        self.assertEqual(view.calls, 2)
+        self.assertEqual(flight.counters['unshared'], 1)
+
+    def test_error_of_the_leader(self):
+        flight = SingleFlight(timeout=5)
+        view = SlowView(error=True)
+        bodies = call_in_threads(flight, view, followers=1)
+        # the follower calls the view
+        self.assertIn(b'calls=2', bodies)
+        self.assertEqual(
+            len([x for x in bodies if isinstance(x, Exception)]), 1)
+
+    def test_between_processes(self):
+        with TemporaryDirectory() as directory:
+            flights = [SingleFlight(timeout=5, directory=directory)
+                       for x in range(3)]
+            view = SlowView()
+            bodies = call_in_threads(flights[0], view, flights=flights[1:])
+            self.assertEqual(bodies, [b'calls=1'] * 3)
+            self.assertEqual(view.calls, 1)
+            self.assertEqual(flights[1].counters['coalesced_process'], 1)
+
+    def test_lock_files_removed(self):
+        with TemporaryDirectory() as directory:
+            flight = SingleFlight(timeout=5, directory=directory)
+            for index in range(10):
+                flight.call('key-%d' % index, Response)
+
+            self.assertEqual(sorted(os.listdir(directory)),
+                             ['key-%d' % x for x in range(10)])
+
+    def test_other_key_not_locked(self):
+        with TemporaryDirectory() as directory:
+            flights = [SingleFlight(timeout=5, directory=directory)
+                       for x in range(2)]
+            view = SlowView()
+            self.addCleanup(view.release.set)
+            thread = Thread(target=flights[0].call, args=('key', view))
+            thread.start()
+            self.addCleanup(thread.join, 5)
+            view.started.wait(5)
+            start = time.monotonic()
+            flights[1].call('other', Response)
+            self.assertLess(time.monotonic() - start, 1)
+
+    def test_entry_file_not_unpickled(self):
+        with TemporaryDirectory() as directory:
+            flight = SingleFlight(timeout=5, directory=directory)
+            path = os.path.join(directory, 'key')
+            with open(path, 'wb') as fp:
+                fp.write(b'\x80\x03cos\nsystem\n.')
+
+            self.assertIsNone(flight.read_entry(path, 0))
+
+
+class FakeRoute:
+    name = 'route'
+
+
+def make_request(path, **headers):
+    request = Request.blank(path, headers=headers)
+    request.matched_route = FakeRoute
+    return request
+
+
+class TestKey(TestCase):
+
+    def test_parameters_order(self):
+        self.assertEqual(get_key(make_request('/x?a=1&b=2'), ()),
+                         get_key(make_request('/x?b=2&a=1'), ()))
+
+    def test_vary(self):
+        vary = ('Authorization',)
+        self.assertNotEqual(
+            get_key(make_request('/x', Authorization='a'), vary),
+            get_key(make_request('/x', Authorization='b'), vary))
+        self.assertEqual(
+            get_key(make_request('/x', Accept='a'), vary),
+            get_key(make_request('/x', Accept='b'), vary))
+
+
+class FakeRegistry:
+    anyblok_single_flight = None
+
+
+class FakeViewInfo:
+    settings = {}
+
+    def __init__(self, **options):
+        self.options = options
+
+
+class FakeFlight:
+
+    def __init__(self):
+        self.keys = []
+
+    def call(self, key, func):
+        self.keys.append(key)
+        return func()
+
+
+class TestCoalesceViewOptions(TestCase):
+
+    def test_vary_keeps_the_credentials(self):
+        view = coalesce_view(lambda context, request: None, FakeViewInfo(
+            anyblok_coalesce=True, anyblok_coalesce_vary=['Accept-Language']))
+        flight = FakeRegistry.anyblok_single_flight = FakeFlight()
+        self.addCleanup(setattr, FakeRegistry, 'anyblok_single_flight', None)
+        for headers in ({'Authorization': 'a'}, {'Authorization': 'b'},
+                        {'Accept-Language': 'fr'}):
+            request = make_request('/x', **headers)
+            request.registry = FakeRegistry
+            view(None, request)
+
+        self.assertEqual(len(set(flight.keys)), 3)
+
+
+def dashboard(request):
+    return {'name': request.matchdict['name']}
+
+
+def add_route_and_views(config):
+    config.add_route('dashboard', '/dashboard/{name}')
+    config.add_view(dashboard, route_name='dashboard', renderer='json',
+                    anyblok_coalesce=True)
+
+
+class TestCoalesceView(PyramidDBTestCase):
+
+    def test_view(self):
+        self.includemes.append(add_route_and_views)
+        self.init_registry(None)
+        response = self.webserver.get('/dashboard/a')
+        self.assertEqual(response.json_body, {'name': 'a'})
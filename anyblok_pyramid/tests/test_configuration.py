@@ -9,7 +9,25 @@ from anyblok_pyramid.config import (define_preload_option,
                                     define_wsgi_option,
                                     define_wsgi_debug_option,
                                     add_configuration_file,
-                                    update_plugins)
+                                    update_plugins,
+                                    define_benchmark_option,
+                                    define_replay_option,
+                                    define_static_option,
+                                    define_cache_option,
+                                    define_reload_option,
+                                    define_rolling_reload_option,
+                                    define_admission_option,
+                                    define_metrics_option,
+                                    define_timeout_option,
+                                    define_replica_option,
+                                    define_pool_option,
+                                    define_batch_option,
+                                    define_task_option,
+                                    define_outbox_option,
+                                    define_idempotency_option,
+                                    define_coalesce_option,
+                                    define_tenant_option)
+from anyblok.config import Configuration
 from anyblok.tests.testcase import TestCase
 from anyblok.tests.test_config import MockArgumentParser
 
@@ -28,6 +46,23 @@ class TestArgsParseOption(TestCase):
             'define_wsgi_debug_option': define_wsgi_debug_option,
             'add_configuration_file': add_configuration_file,
             'update_plugins': update_plugins,
+            'define_benchmark_option': define_benchmark_option,
+            'define_replay_option': define_replay_option,
+            'define_static_option': define_static_option,
+            'define_cache_option': define_cache_option,
+            'define_reload_option': define_reload_option,
+            'define_rolling_reload_option': define_rolling_reload_option,
+            'define_admission_option': define_admission_option,
+            'define_metrics_option': define_metrics_option,
+            'define_timeout_option': define_timeout_option,
+            'define_replica_option': define_replica_option,
+            'define_pool_option': define_pool_option,
+            'define_batch_option': define_batch_option,
+            'define_task_option': define_task_option,
+            'define_outbox_option': define_outbox_option,
+            'define_idempotency_option': define_idempotency_option,
+            'define_coalesce_option': define_coalesce_option,
+            'define_tenant_option': define_tenant_option,
         }
 
     def test_define_preload_option(self):
@@ -44,3 +79,62 @@ class TestArgsParseOption(TestCase):
 
     def test_update_plugins(self):
         self.function['update_plugins'](self.parser)
+
+    def test_define_benchmark_option(self):
+        self.function['define_benchmark_option'](self.parser)
+
+    def test_define_replay_option(self):
+        self.function['define_replay_option'](self.parser)
+
+    def test_define_static_option(self):
+        self.function['define_static_option'](self.parser)
+
+    def test_define_cache_option(self):
+        self.function['define_cache_option'](self.parser)
+
+    def test_define_reload_option(self):
+        self.function['define_reload_option'](self.parser)
+
+    def test_define_rolling_reload_option(self):
+        self.function['define_rolling_reload_option'](self.parser)
+
+    def test_define_admission_option(self):
+        self.function['define_admission_option'](self.parser)
+
+    def test_define_metrics_option(self):
+        self.function['define_metrics_option'](self.parser)
+
+    def test_define_timeout_option(self):
+        self.function['define_timeout_option'](self.parser)
+
+    def test_define_replica_option(self):
+        self.function['define_replica_option'](self.parser)
+
+    def test_define_pool_option(self):
+        self.function['define_pool_option'](self.parser)
+
+    def test_define_batch_option(self):
+        self.function['define_batch_option'](self.parser)
+
+    def test_define_task_option(self):
+        self.function['define_task_option'](self.parser)
+
+    def test_define_outbox_option(self):
+        self.function['define_outbox_option'](self.parser)
+
+    def test_define_idempotency_option(self):
+        self.function['define_idempotency_option'](self.parser)
+
+    def test_define_coalesce_option(self):
+        self.function['define_coalesce_option'](self.parser)
+
+    def test_define_tenant_option(self):
+        self.function['define_tenant_option'](self.parser)
+
+    def test_applications(self):
+        for application in ('pyramid-benchmark', 'pyramid-replay',
+                            'pyramid-static', 'pyramid-rolling-reload',
+                            'pyramid-tasks', 'pyramid-outbox'):
+            self.assertIn(application, Configuration.applications)
+
+        self.assertNotIn('pyramid-reload', Configuration.applications)
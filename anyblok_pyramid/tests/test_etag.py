@@ -0,0 +1,82 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok.tests.testcase import TestCase
+from anyblok.config import Configuration
+from anyblok_pyramid.anyblok import _COMMIT_LISTENERS, fire_commit_listeners
+from anyblok_pyramid.etag import etag
+from anyblok_pyramid.generation import reset_generations
+from pyramid.config import Configurator
+from webtest import TestApp
+
+
+class FakeRegistry:
+    db_name = 'db'
+
+
+class TestETag(TestCase):
+
+    def setUp(self):
+        super(TestETag, self).setUp()
+        self.get_db_name = Configuration.get('get_db_name')
+        Configuration.update(get_db_name=lambda request: 'db')
+        self.calls = 0
+        config = Configurator()
+        config.include(etag)
+        self.generations = config.registry.anyblok_generations
+        self.addCleanup(reset_generations)
+
+        def view(request):
+            self.calls += 1
+            return {'calls': self.calls}
+
+        config.add_route('view', '/view')
+        config.add_view(view, route_name='view', renderer='json',
+                        request_method=('GET', 'POST'),
+                        anyblok_etag_models=['Model.Test'],
+                        anyblok_etag_vary=['Accept-Language'])
+        self.app = TestApp(config.make_wsgi_app())
+
+    def tearDown(self):
+        Configuration.update(get_db_name=self.get_db_name)
+        super(TestETag, self).tearDown()
+
+    def test_not_modified(self):
+        response = self.app.get('/view')
+        etag = response.headers['ETag']
+        self.assertIn('Accept-Language', response.headers['Vary'])
+        response = self.app.get('/view', headers={'If-None-Match': etag},
+                                status=304)
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(self.calls, 1)
+
+    def test_modified_after_commit(self):
+        etag = self.app.get('/view').headers['ETag']
+        fire_commit_listeners(FakeRegistry, {'Model.Other'})
+        self.app.get('/view', headers={'If-None-Match': etag}, status=304)
+        fire_commit_listeners(FakeRegistry, {'Model.Test'})
+        response = self.app.get('/view', headers={'If-None-Match': etag})
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual(self.calls, 2)
+
+    def test_vary(self):
+        etag = self.app.get('/view', headers={
+            'Accept-Language': 'fr'}).headers['ETag']
+        response = self.app.get('/view', headers={
+            'If-None-Match': etag, 'Accept-Language': 'en'})
+        self.assertEqual(response.status_int, 200)
+
+    def test_generations_added_once(self):
+        config = Configurator()
+        config.include(etag)
+        self.assertIs(config.registry.anyblok_generations, self.generations)
+        self.assertEqual(_COMMIT_LISTENERS.count(self.generations.invalidate),
+                         1)
+
+    def test_post(self):
+        response = self.app.post('/view')
+        self.assertNotIn('ETag', response.headers)
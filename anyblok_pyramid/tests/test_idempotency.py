@@ -0,0 +1,156 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok import Declarations
+from anyblok.column import Integer, String
+from anyblok_pyramid.anyblok import AnyBlokZopeTransactionExtension
+from anyblok_pyramid.idempotency import (IdempotencyStore, get_fingerprint,
+                                         get_scope)
+from pyramid.request import Request
+from pyramid.response import Response
+from datetime import datetime, timedelta, timezone
+from .testcase import PyramidDBTestCase
+
+
+def add_model():
+
+    @Declarations.register(Declarations.Model)
+    class Test:
+        id = Integer(primary_key=True)
+        name = String()
+
+
+def create(request):
+    registry = request.anyblok.registry
+    if request.params.get('fail'):
+        raise Exception('error in the view')
+
+    test = registry.Test.insert(name=request.json_body['name'])
+    return {'id': test.id}
+
+
+def stream(request):
+    request.anyblok.registry.Test.insert(name='stream')
+    return Response(app_iter=iter([b'a', b'b']))
+
+
+def add_route_and_views(config):
+    config.add_route('create', '/create')
+    config.add_view(create, route_name='create', renderer='json',
+                    anyblok_idempotency=True)
+    config.add_route('stream', '/stream')
+    config.add_view(stream, route_name='stream', anyblok_idempotency=True)
+    config.add_route('other', '/other')
+    config.add_view(create, route_name='other', renderer='json')
+
+
+class TestIdempotency(PyramidDBTestCase):
+
+    @classmethod
+    def additional_setting(cls):
+        return dict(unittest=True,
+                    **{'sa.session.extension': AnyBlokZopeTransactionExtension})
+
+    def setUp(self):
+        super(TestIdempotency, self).setUp()
+        self.includemes.append(add_route_and_views)
+        self.registry = self.init_registry_with_bloks(
+            ('pyramid-idempotency',), add_model)
+        self.webserver = self.init_web_server()
+
+    def post(self, path='/create', key='key-1', name='a', headers=None,
+             **kwargs):
+        headers = dict(headers or {})
+        if key:
+            headers['Idempotency-Key'] = key
+
+        return self.webserver.post_json(path, {'name': name},
+                                        headers=headers, **kwargs)
+
+    def count(self):
+        return self.registry.Test.query().count()
+
+    def test_replayed(self):
+        response = self.post()
+        self.assertNotIn('Idempotent-Replayed', response.headers)
+        replayed = self.post()
+        self.assertEqual(replayed.json_body, response.json_body)
+        self.assertEqual(replayed.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(replayed.content_type, 'application/json')
+        self.assertEqual(self.count(), 1)
+
+    def test_other_keys_and_no_key(self):
+        self.post(key='key-1')
+        self.post(key='key-2')
+        self.post(key=None)
+        self.post(key=None)
+        self.assertEqual(self.count(), 4)
+
+    def test_same_key_another_request(self):
+        self.post()
+        self.post(name='b', status=422)
+        self.assertEqual(self.count(), 1)
+
+    def test_in_progress(self):
+        request = Request.blank('/create', method='POST',
+                                body=b'{"name": "a"}')
+        store = IdempotencyStore(self.registry)
+        # the first request has not saved its response
+        self.assertIsNone(store.acquire(get_scope(request), 'key-1',
+                                        get_fingerprint(request)))
+        self.post(status=409)
+
+    def test_scoped_by_credentials(self):
+        response = self.post(headers={'Authorization': 'Basic alice'})
+        other = self.post(headers={'Authorization': 'Basic bob'})
+        self.assertNotIn('Idempotent-Replayed', other.headers)
+        self.assertNotEqual(other.json_body, response.json_body)
+        replayed = self.post(headers={'Authorization': 'Basic alice'})
+        self.assertEqual(replayed.json_body, response.json_body)
+        self.assertEqual(self.count(), 2)
+
+    def test_scope(self):
+        request = Request.blank('/', headers={'Cookie': 'a=1'})
+        self.assertNotEqual(get_scope(request),
+                            get_scope(Request.blank('/')))
+
+    def test_streamed_response_not_saved(self):
+        headers = {'Idempotency-Key': 'key-1'}
+        response = self.webserver.post('/stream', headers=headers)
+        self.assertEqual(response.body, b'ab')
+        response = self.webserver.post('/stream', headers=headers)
+        self.assertNotIn('Idempotent-Replayed', response.headers)
+        self.assertEqual(self.count(), 2)
+        self.assertEqual(self.registry.Pyramid.Idempotency.query().count(),
+                         0)
+
+    def test_view_without_option(self):
+        self.post('/other')
+        self.post('/other')
+        self.assertEqual(self.count(), 2)
+
+    def test_expired(self):
+        self.post()
+        Idempotency = self.registry.Pyramid.Idempotency
+        Idempotency.query().update(
+            {'expire_date': datetime.now(timezone.utc) - timedelta(1)})
+        response = self.post()
+        self.assertNotIn('Idempotent-Replayed', response.headers)
+        self.assertEqual(self.count(), 2)
+
+    def test_too_long_key(self):
+        self.post(key='x' * 256, status=400)
+
+    def test_purge(self):
+        self.post(key='key-1')
+        self.post(key='key-2')
+        Idempotency = self.registry.Pyramid.Idempotency
+        Idempotency.query().filter_by(key='key-1').update(
+            {'expire_date': datetime.now(timezone.utc) - timedelta(1)})
+        store = IdempotencyStore(self.registry)
+        self.assertEqual(store.purge(), 1)
+        self.assertEqual([x.key for x in Idempotency.query()], ['key-2'])
@@ -0,0 +1,111 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from .testcase import PyramidDBTestCase
+from anyblok.tests.testcase import TestCase, DBTestCase
+from anyblok.blok import BlokManager
+from anyblok_pyramid.memory import (get_rss, check_worker_memory,
+                                    get_blok_from_filename,
+                                    get_blok_from_traceback)
+from collections import namedtuple
+import tracemalloc
+
+
+class MockConfig:
+
+    def __init__(self, max_worker_memory):
+        self.max_worker_memory = max_worker_memory
+
+
+class MockWorker:
+
+    pid = 1
+
+    def __init__(self, max_worker_memory):
+        self.cfg = MockConfig(max_worker_memory)
+        self.alive = True
+
+
+class TestMemory(TestCase):
+
+    def test_get_rss(self):
+        self.assertGreater(get_rss(), 0)
+
+    def test_check_worker_memory_without_limit(self):
+        worker = MockWorker(0)
+        self.assertFalse(check_worker_memory(worker))
+        self.assertTrue(worker.alive)
+
+    def test_check_worker_memory_under_limit(self):
+        worker = MockWorker(1024 * 1024)
+        self.assertFalse(check_worker_memory(worker))
+        self.assertTrue(worker.alive)
+
+    def test_check_worker_memory_over_limit(self):
+        worker = MockWorker(1)
+        self.assertTrue(check_worker_memory(worker))
+        self.assertFalse(worker.alive)
+
+    def test_get_blok_from_filename(self):
+        blok_paths = [('blok1', '/path/blok1'), ('blok2', '/path/blok2')]
+        self.assertEqual(
+            get_blok_from_filename('/path/blok2/model.py', blok_paths),
+            'blok2')
+        self.assertIsNone(
+            get_blok_from_filename('/other/model.py', blok_paths))
+
+    def test_get_blok_from_filename_with_same_prefix(self):
+        blok_paths = [('blok1', '/path/blok1'), ('blok10', '/path/blok10')]
+        self.assertEqual(
+            get_blok_from_filename('/path/blok10/model.py', blok_paths),
+            'blok10')
+
+    def test_get_blok_from_traceback(self):
+        Frame = namedtuple('Frame', 'filename lineno')
+        blok_paths = [('blok1', '/path/blok1')]
+        traceback = [Frame('/lib/sqlalchemy/orm.py', 1),
+                     Frame('/path/blok1/model.py', 2)]
+        self.assertEqual(get_blok_from_traceback(traceback, blok_paths),
+                         'blok1')
+        self.assertIsNone(get_blok_from_traceback(traceback[:1], blok_paths))
+
+
+class TestMemoryDebugView(PyramidDBTestCase):
+
+    def setUp(self):
+        super(TestMemoryDebugView, self).setUp()
+        if not tracemalloc.is_tracing():
+            self.addCleanup(tracemalloc.stop)
+
+    def test_memory_debug_view_not_enabled(self):
+        webserver = self.init_web_server()
+        webserver.get('/_debug/memory', status=404)
+
+    def test_memory_debug_view(self):
+        with DBTestCase.Configuration(memory_debug=True):
+            webserver = self.init_web_server()
+            res = webserver.get('/_debug/memory', status=200)
+            self.assertIn('bloks', res.json_body)
+            self.assertGreater(res.json_body['rss'], 0)
+            res = webserver.get('/_debug/memory?limit=2', status=200)
+            self.assertLessEqual(len(res.json_body['files']), 2)
+            webserver.get('/_debug/memory?limit=x', status=400)
+            webserver.get('/_debug/memory?limit=-1', status=400)
+            for blok in res.json_body['bloks']:
+                self.assertIn(blok, BlokManager.list() + ['other'])
+
+    def test_memory_debug_view_with_frames(self):
+        if tracemalloc.is_tracing():
+            self.skipTest('tracemalloc is already started')
+
+        with DBTestCase.Configuration(memory_debug=True,
+                                      memory_debug_frames=5):
+            webserver = self.init_web_server()
+            res = webserver.get('/_debug/memory?limit=5', status=200)
+            self.assertEqual(tracemalloc.get_traceback_limit(), 5)
+            self.assertTrue(any(len(x['traceback']) > 1
+                                for x in res.json_body['files']))
@@ -0,0 +1,48 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok.tests.testcase import TestCase
+from anyblok.config import Configuration
+from anyblok_pyramid.metrics import (Metric, add_metrics_collector,
+                                     remove_metrics_collector,
+                                     format_metrics, metrics)
+from pyramid.config import Configurator
+from webtest import TestApp
+
+
+def collector():
+    yield Metric('test_requests', 'Requests', 'counter',
+                 [({'db_name': 'db', 'route': 'a"b'}, 2), ({}, 3)])
+
+
+def failed_collector():
+    raise Exception('error')
+
+
+class TestMetrics(TestCase):
+
+    def test_format(self):
+        self.assertEqual(format_metrics(collector()), '\n'.join([
+            '# HELP test_requests Requests',
+            '# TYPE test_requests counter',
+            'test_requests{db_name="db",route="a\\"b"} 2',
+            'test_requests 3',
+        ]) + '\n')
+
+    def test_view(self):
+        path = Configuration.get('pyramid_metrics_path')
+        Configuration.update(pyramid_metrics_path='/metrics')
+        self.addCleanup(Configuration.update, pyramid_metrics_path=path)
+        add_metrics_collector(collector)
+        add_metrics_collector(failed_collector)
+        self.addCleanup(remove_metrics_collector, collector)
+        self.addCleanup(remove_metrics_collector, failed_collector)
+        config = Configurator()
+        config.include(metrics)
+        response = TestApp(config.make_wsgi_app()).get('/metrics')
+        self.assertEqual(response.content_type, 'text/plain')
+        self.assertIn('test_requests 3', response.text)
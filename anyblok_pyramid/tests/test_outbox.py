@@ -0,0 +1,250 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok import Declarations
+from anyblok.column import Integer, String
+from anyblok.config import Configuration
+from anyblok_pyramid.anyblok import (AnyBlokZopeTransactionExtension,
+                                     add_changed_models, mark_changed,
+                                     remove_before_commit_listener)
+from anyblok_pyramid.outbox import (OutboxDispatcher, dispatch_outbox,
+                                    record_changed_models)
+from .testcase import PyramidDBTestCase
+from sqlalchemy import event
+import transaction
+
+
+def add_model():
+
+    @Declarations.register(Declarations.Model)
+    class Test:
+        id = Integer(primary_key=True)
+        name = String()
+
+    @Declarations.register(Declarations.Model)
+    class Other:
+        id = Integer(primary_key=True)
+
+
+def create(request):
+    registry = request.anyblok.registry
+    registry.Test.insert(name=request.matchdict['name'])
+    registry.Other.insert()
+    if request.params.get('fail'):
+        raise Exception('error in the view')
+
+    return {}
+
+
+def change(request):
+    registry = request.anyblok.registry
+    for test in registry.Test.query().all():
+        if test.name == request.matchdict['name']:
+            test.delete()
+        else:
+            test.name = request.matchdict['name']
+
+    return {}
+
+
+def rolled_back(request):
+    registry = request.anyblok.registry
+    registry.Test.insert(name='kept')
+    savepoint = registry.begin_nested()
+    registry.Test.insert(name='rolled back')
+    registry.flush()
+    savepoint.rollback()
+    return {}
+
+
+def sql(request):
+    registry = request.anyblok.registry
+    registry.execute("UPDATE test SET name = 'sql'")
+    mark_changed(registry.session)
+    add_changed_models(registry.session, 'Model.Test')
+    return {}
+
+
+def sql_and_change(request):
+    change(request)
+    sql(request)
+    request.anyblok.registry.flush()
+    return {}
+
+
+def read(request):
+    request.anyblok.registry.Test.query().all()
+    return {}
+
+
+def add_route_and_views(config):
+    for name, view in (('create', create), ('change', change),
+                       ('sql_and_change', sql_and_change)):
+        config.add_route(name, '/%s/{name}' % name)
+        config.add_view(view, route_name=name, renderer='json')
+
+    for name, view in (('rolled_back', rolled_back), ('sql', sql),
+                       ('read', read)):
+        config.add_route(name, '/' + name)
+        config.add_view(view, route_name=name, renderer='json')
+
+
+class TestOutbox(PyramidDBTestCase):
+
+    @classmethod
+    def additional_setting(cls):
+        return dict(unittest=True,
+                    **{'sa.session.extension': AnyBlokZopeTransactionExtension})
+
+    def setUp(self):
+        super(TestOutbox, self).setUp()
+        self.addCleanup(remove_before_commit_listener, record_changed_models)
+        if not Configuration.has('pyramid_outbox_models'):
+            Configuration.add_argument('pyramid_outbox_models', None,
+                                       type=list)
+
+        self.addCleanup(Configuration.update,
+                        pyramid_outbox_models=Configuration.get(
+                            'pyramid_outbox_models'))
+        self.includemes.append(add_route_and_views)
+        self.registry = self.init_registry_with_bloks(('pyramid-outbox',),
+                                                      add_model)
+        self.webserver = self.init_web_server()
+
+    def get_events(self):
+        Outbox = self.registry.Pyramid.Outbox
+        return sorted((x.model, x.operation, x.pk)
+                      for x in Outbox.query().order_by(Outbox.id))
+
+    def get_outbox(self):
+        Outbox = self.registry.Pyramid.Outbox
+        return Outbox.query().order_by(Outbox.id).all()
+
+    def get_test_id(self):
+        return self.registry.Test.query().one().id
+
+    def test_recorded_by_the_transaction(self):
+        self.webserver.get('/create/a')
+        other = self.registry.Other.query().one()
+        self.assertEqual(self.get_events(), [
+            ('Model.Other', 'insert', {'id': other.id}),
+            ('Model.Test', 'insert', {'id': self.get_test_id()})])
+
+    def test_update_and_delete(self):
+        self.webserver.get('/create/a')
+        test_id = self.get_test_id()
+        self.registry.Pyramid.Outbox.query().delete()
+        transaction.commit()
+        self.webserver.get('/change/b')
+        self.webserver.get('/change/b')
+        self.assertEqual(self.get_events(), [
+            ('Model.Test', 'delete', {'id': test_id}),
+            ('Model.Test', 'update', {'id': test_id})])
+
+    def test_rolled_back_savepoint(self):
+        self.webserver.get('/rolled_back')
+        self.assertEqual(self.get_events(), [
+            ('Model.Test', 'insert', {'id': self.get_test_id()})])
+
+    def test_changed_by_sql(self):
+        self.webserver.get('/sql')
+        self.assertEqual(self.get_events(), [('Model.Test', None, None)])
+
+    def test_restricted_models(self):
+        Configuration.update(pyramid_outbox_models=['Model.Test'])
+        self.webserver.get('/create/a')
+        self.assertEqual([x[0] for x in self.get_events()], ['Model.Test'])
+
+    def test_nothing_on_abort_or_read(self):
+        with self.assertRaises(Exception):
+            self.webserver.get('/create/b', params={'fail': 1})
+
+        self.webserver.get('/read')
+        self.assertEqual(self.get_events(), [])
+
+    def test_dispatch(self):
+        self.webserver.get('/create/a')
+        self.webserver.get('/create/b')
+        first, second = [], []
+        self.assertEqual(dispatch_outbox(
+            self.registry, {'first': first.append, 'second': second.append},
+            batch_size=3), 4)
+        self.assertEqual([len(batch) for batch in first], [3, 1])
+        self.assertEqual(first, second)
+        self.assertEqual(sorted(x['operation'] for x in first[0]),
+                         ['insert'] * 3)
+        # the events given to the consumers are deleted
+        self.assertEqual(self.get_events(), [])
+
+    def test_consumer_fails(self):
+        self.webserver.get('/create/a')
+        batches = []
+
+        def fail(events):
+            raise Exception('error in the consumer')
+
+        self.assertEqual(dispatch_outbox(
+            self.registry, {'a': batches.append, 'b': fail}), 0)
+        # the batch is kept and given again, one event by call
+        self.assertEqual(len(self.get_events()), 2)
+        self.assertEqual([x.attempts for x in self.get_outbox()], [1, 1])
+        self.assertEqual(dispatch_outbox(
+            self.registry, {'a': batches.append}), 2)
+        self.assertEqual([len(batch) for batch in batches], [2, 1, 1])
+
+    def test_failed_after_max_attempts(self):
+        self.webserver.get('/create/a')
+        self.webserver.get('/create/b')
+        calls = []
+        other_id = min(x.id for x in self.registry.Other.query())
+
+        def fail_on_other(events):
+            calls.append(len(events))
+            if any(x['model'] == 'Model.Other' and x['pk']['id'] == other_id
+                   for x in events):
+                raise Exception('error in the consumer')
+
+        for x in range(3):
+            dispatch_outbox(self.registry, {'a': fail_on_other},
+                            max_attempts=2)
+
+        # only the event which fails is failed, the others are given
+        self.assertEqual(calls, [4, 1, 1, 1, 1])
+        outbox = self.get_outbox()
+        self.assertEqual([(x.model, x.state, x.attempts) for x in outbox],
+                         [('Model.Other', 'failed', 2)])
+        self.assertIn('error in the consumer', outbox[0].error)
+        self.assertEqual(dispatch_outbox(self.registry, {'a': calls.append},
+                                         max_attempts=2), 0)
+
+    def test_sql_and_flushed_in_the_same_transaction(self):
+        self.webserver.get('/create/a')
+        self.registry.Pyramid.Outbox.query().delete()
+        transaction.commit()
+        self.webserver.get('/sql_and_change/b')
+        self.assertEqual(
+            sorted((x.model, x.operation or '', x.pk)
+                   for x in self.get_outbox()),
+            [('Model.Test', '', None),
+             ('Model.Test', 'update', {'id': self.get_test_id()})])
+
+    def test_skip_locked(self):
+        self.webserver.get('/create/a')
+        statements = []
+
+        def before_cursor_execute(connection, cursor, statement, *args):
+            statements.append(statement)
+
+        engine = self.registry.engine
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        self.addCleanup(event.remove, engine, 'before_cursor_execute',
+                        before_cursor_execute)
+        dispatcher = OutboxDispatcher(self.registry, {'test': list})
+        self.assertEqual(dispatcher.dispatch(), 2)
+        transaction.abort()
+        # the events locked by another dispatcher are skipped
+        self.assertTrue(statements[0].endswith('FOR UPDATE SKIP LOCKED'))
@@ -0,0 +1,152 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok.tests.testcase import TestCase
+from anyblok.config import Configuration, get_url
+from anyblok.registry import RegistryManager
+from anyblok_pyramid import pool
+from anyblok_pyramid.pool import (Registry, TimedQueuePool, get_pool_options,
+                                  set_concurrency, collect_pools)
+from anyblok_pyramid.tenant import get_db_name, reset_tenant_resolver
+from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError
+from tempfile import NamedTemporaryFile
+import json
+
+OPTIONS = {'pyramid_pool_size': int, 'pyramid_pool_max_overflow': int,
+           'pyramid_pool_max_connections': int, 'pyramid_pool_databases': str,
+           'db_names': list, 'pyramid_task_threads': int,
+           'pyramid_registry_reload': bool,
+           'pyramid_registry_check_interval': float,
+           'pyramid_replica_url': str, 'pyramid_tenant_mapping': str,
+           'pyramid_tenant_ttl': float}
+
+
+class FakeRegistry:
+
+    def __init__(self, engine):
+        self.engine = engine
+
+
+class TestPool(TestCase):
+
+    def setUp(self):
+        super(TestPool, self).setUp()
+        for key, type_ in OPTIONS.items():
+            if not Configuration.has(key):
+                Configuration.add_argument(key, None, type=type_)
+
+        configuration = {key: Configuration.get(key) for key in OPTIONS}
+        self.addCleanup(Configuration.update, **configuration)
+        self.addCleanup(pool._CONCURRENCY.clear)
+        self.addCleanup(pool._DATABASES.clear)
+        Configuration.update(**{key: None for key in OPTIONS})
+
+    def test_threads_of_the_worker(self):
+        set_concurrency(4, 8)
+        options = get_pool_options('db')
+        # 8 threads of the requests and 2 threads of the tasks
+        self.assertEqual((options['pool_size'], options['max_overflow']),
+                         (10, 8))
+        self.assertIs(options['poolclass'], TimedQueuePool)
+
+    def test_background_threads(self):
+        set_concurrency(4, 8)
+        Configuration.update(pyramid_task_threads=4,
+                             pyramid_registry_reload=True,
+                             pyramid_registry_check_interval=10,
+                             pyramid_replica_url='postgresql:///replica')
+        self.assertEqual(get_pool_options('db')['pool_size'], 14)
+
+    def test_configured(self):
+        Configuration.update(pyramid_pool_size=3, pyramid_pool_max_overflow=0)
+        options = get_pool_options('db')
+        self.assertEqual((options['pool_size'], options['max_overflow']),
+                         (3, 0))
+
+    def test_max_connections(self):
+        set_concurrency(4, 8)
+        Configuration.update(pyramid_pool_max_connections=100,
+                             db_names=['db1', 'db2', 'db3', 'db4', 'db5'])
+        # 100 / (4 * 5)
+        options = get_pool_options('db1')
+        self.assertEqual((options['pool_size'], options['max_overflow']),
+                         (5, 0))
+
+    def test_max_connections_with_tenants(self):
+        self.addCleanup(Configuration.update,
+                        get_db_name=Configuration.get('get_db_name'))
+        self.addCleanup(reset_tenant_resolver)
+        with NamedTemporaryFile('w', suffix='.json') as fp:
+            json.dump({'host': {'a.com': 'db1', 'b.com': 'db6'},
+                       'prefix': {'c': 'db7'}}, fp)
+            fp.flush()
+            set_concurrency(4, 8)
+            reset_tenant_resolver()
+            Configuration.update(pyramid_pool_max_connections=100,
+                                 pyramid_tenant_mapping=fp.name,
+                                 pyramid_tenant_ttl=0,
+                                 get_db_name=get_db_name,
+                                 db_names=['db1', 'db2', 'db3', 'db4', 'db5'])
+            # 100 / (4 * 7)
+            options = get_pool_options('db1')
+            self.assertEqual((options['pool_size'], options['max_overflow']),
+                             (3, 0))
+
+    def test_max_connections_too_low(self):
+        set_concurrency(4, 8)
+        Configuration.update(pyramid_pool_max_connections=2)
+        options = get_pool_options('db')
+        self.assertEqual((options['pool_size'], options['max_overflow']),
+                         (1, 0))
+
+    def test_options_by_database(self):
+        with NamedTemporaryFile('w', suffix='.json') as fp:
+            json.dump({'big': {'pool_size': 20, 'unknown': 1}}, fp)
+            fp.flush()
+            Configuration.update(pyramid_pool_databases=fp.name,
+                                 pyramid_pool_max_connections=10)
+            options = get_pool_options('big')
+            self.assertEqual(options['pool_size'], 20)
+            self.assertNotIn('unknown', options)
+            # 1 thread of the requests and 2 threads of the tasks
+            self.assertEqual(get_pool_options('small')['pool_size'], 3)
+
+    def test_registry_engine_options(self):
+        set_concurrency(1, 2)
+        registry = Registry.__new__(Registry)
+        registry.db_name = 'db'
+        registry.additional_setting = {}
+        options = registry.init_engine_options()
+        self.assertEqual(options['pool_size'], 4)
+        self.assertIn('isolation_level', options)
+
+    def test_timed_pool_and_metrics(self):
+        url = get_url(db_name=Configuration.get('db_name'))
+        engine = create_engine(url, poolclass=TimedQueuePool, pool_size=1,
+                               max_overflow=0, pool_timeout=0.1)
+        self.addCleanup(engine.dispose)
+        RegistryManager.registries['test_pool'] = FakeRegistry(engine)
+        self.addCleanup(RegistryManager.registries.pop, 'test_pool')
+        connection = engine.connect()
+        with self.assertRaises(TimeoutError):
+            engine.connect()
+
+        metrics = {
+            metric.name: dict((labels['db_name'], value)
+                              for labels, value in metric.samples)
+            for metric in collect_pools()}
+        connection.close()
+        self.assertEqual(
+            metrics['anyblok_pyramid_pool_checked_out']['test_pool'], 1)
+        self.assertEqual(
+            metrics['anyblok_pyramid_pool_checkouts_total']['test_pool'], 2)
+        self.assertEqual(
+            metrics['anyblok_pyramid_pool_timeouts_total']['test_pool'], 1)
+        self.assertGreaterEqual(
+            metrics['anyblok_pyramid_pool_wait_seconds_total']['test_pool'],
+            0.1)
@@ -0,0 +1,96 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok.tests.testcase import DBTestCase
+from anyblok import Declarations
+from anyblok.column import Integer, String
+from anyblok_pyramid import AnyBlokPyramidException
+from anyblok_pyramid.anyblok import MODELS_INFO, add_changed_models
+from anyblok_pyramid.generation import MemoryGenerations
+from anyblok_pyramid.reference import ReferenceCache
+
+
+def add_model():
+
+    @Declarations.register(Declarations.Model)
+    class Test:
+        id = Integer(primary_key=True)
+        name = String()
+
+
+class TestReferenceCache(DBTestCase):
+
+    def init_cache(self, max_rows=10000):
+        registry = self.init_registry(add_model)
+        for name in ('a', 'b', 'c'):
+            registry.Test.insert(name=name)
+
+        registry.flush()
+        cache = ReferenceCache(MemoryGenerations(),
+                               ['Model.Test', 'Model.System.Blok'],
+                               max_rows=max_rows)
+        return registry, cache
+
+    def test_get(self):
+        registry, cache = self.init_cache()
+        table = cache.get(registry, 'Model.Test')
+        self.assertEqual(len(table), 3)
+        test = registry.Test.query().filter_by(name='b').one()
+        self.assertEqual(table.get(test.id)['name'], 'b')
+        self.assertIsNone(table.get(0))
+        self.assertIs(cache.get(registry, 'Model.Test'), table)
+        with self.assertRaises(TypeError):
+            table.get(test.id)['name'] = 'x'
+
+    def test_invalidate(self):
+        registry, cache = self.init_cache()
+        table = cache.get(registry, 'Model.Test')
+        registry.Test.insert(name='d')
+        registry.flush()
+        # as after_flush of the transaction of Pyramid
+        add_changed_models(registry.session, 'Model.Test')
+        self.addCleanup(registry.session.info.pop, MODELS_INFO, None)
+        # the request which changed the model reads its own rows
+        fresh = cache.get(registry, 'Model.Test')
+        self.assertIsNot(fresh, table)
+        self.assertEqual(len(fresh), 4)
+        self.assertIs(cache.tables[(registry.db_name, 'Model.Test')], table)
+        cache.generations.invalidate(registry, {'Model.Test'})
+        self.assertEqual(len(cache.get(registry, 'Model.Test')), 4)
+
+    def test_uncommitted_changes_not_stored(self):
+        registry, cache = self.init_cache()
+        registry.Test.query().first().name = 'x'
+        table = cache.get(registry, 'Model.Test')
+        self.assertIn('x', [row['name'] for row in table])
+        self.assertNotIn((registry.db_name, 'Model.Test'), cache.tables)
+
+    def test_replica_not_stored(self):
+        registry, cache = self.init_cache()
+        registry.session.info['anyblok_replica'] = True
+        self.addCleanup(registry.session.info.pop, 'anyblok_replica')
+        self.assertEqual(len(cache.get(registry, 'Model.Test')), 3)
+        self.assertNotIn((registry.db_name, 'Model.Test'), cache.tables)
+
+    def test_max_rows(self):
+        registry, cache = self.init_cache(max_rows=4)
+        blok = registry.System.Blok.query().count()
+        self.assertGreater(blok, 4)
+        cache.get(registry, 'Model.Test')
+        self.assertEqual(cache.rows, 3)
+        cache.get(registry, 'Model.System.Blok')
+        self.assertEqual(cache.rows, 3)
+        cache.max_rows = 3
+        cache.get(registry, 'Model.Test')
+        cache.generations.bump_all()
+        cache.get(registry, 'Model.Test')
+        self.assertEqual(cache.rows, 3)
+
+    def test_not_declared(self):
+        registry, cache = self.init_cache()
+        with self.assertRaises(AnyBlokPyramidException):
+            cache.get(registry, 'Model.System.Model')
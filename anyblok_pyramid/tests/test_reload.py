@@ -0,0 +1,160 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok.tests.testcase import TestCase, DBTestCase
+from anyblok_pyramid.generation import MemoryGenerations
+from anyblok.registry import RegistryManager
+from anyblok_pyramid.reload import (RegistryWatcher, ReloadableApplication,
+                                    RequestCounter, release_on_close)
+from io import BytesIO
+from threading import Thread
+from webtest import TestApp
+
+
+def make_app(text):
+
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [text.encode('utf-8')]
+
+    return app
+
+
+class MockReloadableApplication(ReloadableApplication):
+
+    def __init__(self, *args, **kwargs):
+        self.reloaded = []
+        self.released = []
+        self.apps = iter(['first', 'second', 'third'])
+        super(MockReloadableApplication, self).__init__(
+            lambda: make_app(next(self.apps)), *args, **kwargs)
+
+    def build_registry(self, db_name):
+        self.reloaded.append(db_name)
+        # the same registry, nothing to release
+        return RegistryManager.registries[db_name]
+
+    def release_registry(self, registry):
+        self.released.append(registry)
+
+
+def environ():
+    return {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/'}
+
+
+def start_response(status, headers, exc_info=None):
+    pass
+
+
+class TestReload(DBTestCase):
+
+    def test_watcher_generation(self):
+        registry = self.init_registry(None)
+        watcher = RegistryWatcher(MemoryGenerations(), check_interval=0)
+        self.assertEqual(watcher.changed(), {})
+        watcher.invalidate(registry, {'Model.System.Model'})
+        self.assertEqual(watcher.changed(), {})
+        watcher.invalidate(registry, {'Model.System.Blok'})
+        changed = watcher.changed()
+        self.assertEqual(list(changed), [registry.db_name])
+        watcher.set_loaded(registry.db_name, changed[registry.db_name])
+        self.assertEqual(watcher.changed(), {})
+
+    def test_watcher_blok_states(self):
+        registry = self.init_registry(None)
+        watcher = RegistryWatcher(MemoryGenerations(), check_interval=0)
+        watcher.changed()
+        watcher.check_databases()
+        self.assertEqual(watcher.changed(), {})
+        self.assertIn(('anyblok-core', 'installed'), [
+            x[:2] for x in watcher.blok_states[registry.db_name]])
+        watcher.blok_states[registry.db_name] = []
+        watcher.check_databases()
+        self.assertEqual(list(watcher.changed()), [registry.db_name])
+
+    def test_reloadable_application(self):
+        registry = self.init_registry(None)
+        watcher = RegistryWatcher(MemoryGenerations(), check_interval=0)
+        app = MockReloadableApplication(watcher)
+        webapp = TestApp(app)
+        self.assertEqual(webapp.get('/').text, 'first')
+        watcher.invalidate(registry, {'Model.System.Blok'})
+        # the request which sees the change starts the reload
+        webapp.get('/')
+        app.thread.join()
+        self.assertEqual(app.reloaded, [registry.db_name])
+        self.assertEqual(webapp.get('/').text, 'second')
+        self.assertEqual(app.reloaded, [registry.db_name])
+
+    def test_request_keeps_the_old_application(self):
+        registry = self.init_registry(None)
+        watcher = RegistryWatcher(MemoryGenerations(), check_interval=0)
+        app = MockReloadableApplication(watcher)
+        app.release_delay = 5
+        old = app.current[1]
+        # the response is not closed yet
+        app_iter = app(environ(), start_response)
+        watcher.invalidate(registry, {'Model.System.Blok'})
+        # the request which starts the reload
+        app(environ(), start_response).close()
+        # the reload does not wait for the requests
+        app.thread.join(5)
+        self.assertFalse(app.thread.is_alive())
+        self.assertEqual(list(app(environ(), start_response)), [b'second'])
+        self.assertEqual(old.requests, 1)
+        self.assertEqual(list(app_iter), [b'first'])
+        app_iter.close()
+        self.assertTrue(old.wait(5))
+
+
+class TestRequestCounter(TestCase):
+
+    def test_wait(self):
+        requests = RequestCounter()
+        self.assertTrue(requests.wait(0))
+        requests.acquire()
+        self.assertFalse(requests.wait(0.05))
+        thread = Thread(target=requests.release, daemon=True)
+        thread.start()
+        self.assertTrue(requests.wait(5))
+        thread.join()
+
+    def test_released_on_close(self):
+        requests = RequestCounter()
+        requests.acquire()
+        app_iter = release_on_close({}, [b'data'], requests.release)
+        self.assertEqual(list(app_iter), [b'data'])
+        self.assertEqual(requests.requests, 1)
+        app_iter.close()
+        app_iter.close()
+        self.assertEqual(requests.requests, 0)
+
+    def test_file_wrapper_kept(self):
+
+        class FileWrapper:
+
+            def __init__(self, filelike, blksize=8192):
+                self.filelike = filelike
+                self.blksize = blksize
+
+            def __iter__(self):
+                return iter(lambda: self.filelike.read(self.blksize), b'')
+
+            def close(self):
+                self.filelike.close()
+
+        requests = RequestCounter()
+        requests.acquire()
+        fp = BytesIO(b'data')
+        app_iter = release_on_close({'wsgi.file_wrapper': FileWrapper},
+                                    FileWrapper(fp, 2), requests.release)
+        self.assertIsInstance(app_iter, FileWrapper)
+        self.assertEqual(app_iter.blksize, 2)
+        self.assertEqual(list(app_iter), [b'da', b'ta'])
+        app_iter.close()
+        self.assertTrue(fp.closed)
+        self.assertEqual(requests.requests, 0)
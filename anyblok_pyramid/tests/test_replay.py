@@ -0,0 +1,163 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok.tests.testcase import TestCase
+from anyblok_pyramid import AnyBlokPyramidException
+from anyblok_pyramid.replay import (parse_access_log, parse_routes,
+                                    synthetic_requests, assign_tenants,
+                                    percentile, run_replay, ReplayRequest,
+                                    WSGITarget, HTTPTarget)
+import socket
+
+
+LOG = [
+    '127.0.0.1 - - [18/Oct/2017:10:00:00 +0200] "GET /hello/1/ HTTP/1.1" '
+    '200 12',
+    '127.0.0.1 - frank [18/Oct/2017:10:00:01 +0200] "POST /foo?a=1 '
+    'HTTP/1.1" 201 0 "http://referer/" "Mozilla/5.0"',
+    'not a log line',
+]
+
+
+def app(environ, start_response):
+    status = '500 Error' if environ['PATH_INFO'] == '/error' else '200 OK'
+    start_response(status, [('Content-Type', 'text/plain')])
+    return [environ.get('HTTP_X_DB_NAME', '').encode('utf-8')]
+
+
+class FakeResponse:
+    status = 200
+
+    def read(self):
+        return b''
+
+    def getheader(self, name, default=None):
+        return default
+
+
+class FakeConnection:
+    """Keep alive connection, the first requests fail"""
+
+    def __init__(self, fail=0):
+        self.fail = fail
+        self.sent = []
+        self.sock = object()
+
+    def request(self, method, url, headers=None):
+        self.sent.append(method)
+        if self.fail:
+            self.fail -= 1
+            raise socket.error('connection reset')
+
+    def getresponse(self):
+        return FakeResponse()
+
+    def close(self):
+        self.sock = None
+
+
+class TestReplay(TestCase):
+
+    def test_parse_access_log(self):
+        requests = parse_access_log(LOG, methods=('GET', 'POST'))
+        self.assertEqual([(r.method, r.path) for r in requests],
+                         [('GET', '/hello/1/'), ('POST', '/foo?a=1')])
+
+    def test_parse_access_log_without_body(self):
+        # the body of the POST is not in the log
+        requests = parse_access_log(LOG)
+        self.assertEqual([(r.method, r.path) for r in requests],
+                         [('GET', '/hello/1/')])
+
+    def test_route(self):
+        self.assertEqual(ReplayRequest('GET', '/hello/12/?a=1').route,
+                         'GET /hello/{id}/')
+        self.assertEqual(ReplayRequest('GET', '/hello/12').route,
+                         'GET /hello/{id}')
+        self.assertEqual(ReplayRequest('GET', '/v2/hello').route,
+                         'GET /v2/hello')
+
+    def test_parse_routes(self):
+        self.assertEqual(
+            parse_routes(['GET /hello/{id}/:10', 'POST /foo', '/bar:2']),
+            [('GET', '/hello/{id}/', 10), ('POST', '/foo', 1),
+             ('GET', '/bar', 2)])
+
+    def test_synthetic_requests_with_seed(self):
+        routes = parse_routes(['GET /hello/{id}/:10', 'POST /foo:1'])
+        requests1 = synthetic_requests(routes, 50, seed=1)
+        requests2 = synthetic_requests(routes, 50, seed=1)
+        self.assertEqual(len(requests1), 50)
+        self.assertEqual([r.path for r in requests1],
+                         [r.path for r in requests2])
+        self.assertEqual(set(r.route for r in requests1),
+                         {'GET /hello/{id}/', 'POST /foo'})
+
+    def test_assign_tenants(self):
+        requests = synthetic_requests(parse_routes(['/']), 20, seed=1)
+        assign_tenants(requests, ['db1:3', 'db2'], seed=1)
+        self.assertEqual(set(r.db_name for r in requests), {'db1', 'db2'})
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertEqual(percentile([1], 90), 1)
+        self.assertIsNone(percentile([], 90))
+
+    def test_run_replay_on_wsgi_app(self):
+        requests = [ReplayRequest('GET', '/hello/%d/' % x, db_name='db1')
+                    for x in range(10)]
+        requests.append(ReplayRequest('GET', '/error'))
+        target = WSGITarget(app, tenant_header='X-DB-Name')
+        report = run_replay(target, requests, concurrency=4).to_dict()
+        self.assertEqual(report['total']['count'], 11)
+        self.assertEqual(report['total']['errors'], 1)
+        self.assertEqual(report['routes']['GET /hello/{id}/']['count'], 10)
+        self.assertEqual(report['routes']['GET /error']['errors'], 1)
+
+    def test_wsgi_target_tenant_header(self):
+        target = WSGITarget(app, tenant_header='X-DB-Name',
+                            tenant_host='{db_name}.localhost')
+        self.assertEqual(target.headers(ReplayRequest('GET', '/', 'db1')),
+                         {'X-DB-Name': 'db1', 'Host': 'db1.localhost'})
+
+    def test_http_target_retry_on_keep_alive(self):
+        target = HTTPTarget('http://127.0.0.1:8080')
+        connection = FakeConnection(fail=1)
+        target.local.connection = connection
+        self.assertEqual(target(ReplayRequest('GET', '/')), 200)
+        self.assertEqual(connection.sent, ['GET', 'GET'])
+
+    def test_http_target_no_retry_for_post(self):
+        target = HTTPTarget('http://127.0.0.1:8080')
+        connection = FakeConnection(fail=1)
+        target.local.connection = connection
+        with self.assertRaises(socket.error):
+            target(ReplayRequest('POST', '/'))
+
+        self.assertEqual(connection.sent, ['POST'])
+
+    def test_http_target_no_retry_on_new_connection(self):
+        target = HTTPTarget('http://127.0.0.1:8080')
+        connection = FakeConnection(fail=1)
+        connection.sock = None
+        target.local.connection = connection
+        with self.assertRaises(socket.error):
+            target(ReplayRequest('GET', '/'))
+
+        self.assertEqual(connection.sent, ['GET'])
+
+    def test_http_target_only_on_loopback(self):
+        HTTPTarget('http://127.0.0.1:8080')
+        HTTPTarget('http://localhost:8080')
+        with self.assertRaises(AnyBlokPyramidException):
+            HTTPTarget('http://example.com:8080')
+
+        with self.assertRaises(AnyBlokPyramidException):
+            HTTPTarget('https://127.0.0.1:8080')
@@ -0,0 +1,214 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok.tests.testcase import TestCase, DBTestCase
+from anyblok.config import Configuration, get_url
+from anyblok_pyramid import replica
+from anyblok_pyramid.metrics import remove_metrics_collector
+from anyblok_pyramid.replica import (ReplicaRouter, ReadOnlyRequest,
+                                     bind_session, check_writable,
+                                     get_replica_router, is_readonly_request,
+                                     set_sticky_cookie, use_primary,
+                                     STICKY_COOKIE,
+                                     replica_view)
+from pyramid.response import Response
+from pyramid.testing import DummyRequest
+from sqlalchemy.exc import DBAPIError
+from zope.sqlalchemy.datamanager import _SESSION_STATE, STATUS_CHANGED
+import time
+
+
+class FakeAnyBlok:
+    _registry = None
+
+
+class FakeViewInfo:
+
+    def __init__(self, **options):
+        self.options = options
+
+
+class TestReadOnlyRequest(TestCase):
+
+    def test_method(self):
+        self.assertTrue(is_readonly_request(DummyRequest()))
+        self.assertFalse(is_readonly_request(DummyRequest(post={})))
+
+    def test_view_option(self):
+        seen = []
+        view = replica_view(
+            lambda context, request: seen.append(is_readonly_request(request)),
+            FakeViewInfo(anyblok_readonly=True))
+        request = DummyRequest(post={})
+        request.anyblok = FakeAnyBlok()
+        view(None, request)
+        self.assertEqual(seen, [True])
+
+    def test_sticky(self):
+        request = DummyRequest(cookies={STICKY_COOKIE: str(time.time() + 5)})
+        self.assertFalse(is_readonly_request(request))
+        request = DummyRequest(cookies={STICKY_COOKIE: str(time.time() - 1)})
+        self.assertTrue(is_readonly_request(request))
+        request = DummyRequest(cookies={STICKY_COOKIE: 'wrong'})
+        self.assertTrue(is_readonly_request(request))
+
+    def test_set_sticky_cookie(self):
+        response = Response()
+        set_sticky_cookie(DummyRequest(post={}), response)
+        cookie = response.headers['Set-Cookie']
+        self.assertTrue(cookie.startswith(STICKY_COOKIE + '='))
+        self.assertIn('Max-Age=5', cookie)
+        response = Response()
+        set_sticky_cookie(DummyRequest(), response)
+        self.assertNotIn('Set-Cookie', response.headers)
+        response = Response(status=500)
+        set_sticky_cookie(DummyRequest(post={}), response)
+        self.assertNotIn('Set-Cookie', response.headers)
+
+    def test_use_primary(self):
+        request = DummyRequest()
+        self.assertTrue(use_primary(request))
+        self.assertFalse(is_readonly_request(request))
+
+    def test_without_option(self):
+        view = object()
+        self.assertIs(replica_view(view, FakeViewInfo()), view)
+
+    def test_router_of_the_configuration(self):
+        self.addCleanup(Configuration.update, pyramid_replica_url=(
+            Configuration.get('pyramid_replica_url')))
+        self.addCleanup(replica._ROUTER.clear)
+        Configuration.update(pyramid_replica_url='postgresql://replica/db')
+        router = get_replica_router()
+        self.addCleanup(remove_metrics_collector, router.collect)
+        self.assertIs(get_replica_router(), router)
+        Configuration.update(pyramid_replica_url='postgresql://other/db')
+        self.assertIsNot(get_replica_router(), router)
+        remove_metrics_collector(get_replica_router().collect)
+
+    def test_url_without_database(self):
+        router = ReplicaRouter('postgresql://replica:5432')
+        self.assertEqual(router.get_url('db').database, 'db')
+        router = ReplicaRouter('postgresql://replica:5432/other')
+        self.assertEqual(router.get_url('db').database, 'other')
+
+
+class TestBindSession(DBTestCase):
+
+    def setUp(self):
+        super(TestBindSession, self).setUp()
+        url = get_url(db_name=Configuration.get('db_name'))
+        url.query['application_name'] = 'replica'
+        self.router = ReplicaRouter(str(url), max_lag=5)
+        self.registry = self.init_registry(None)
+        # the transaction of the registry is begun by its load
+        self.registry.session.close()
+        self.addCleanup(self.router.dispose)
+
+    def tearDown(self):
+        self.registry.rollback()
+        bind_session(self.registry, router=self.router)
+        super(TestBindSession, self).tearDown()
+
+    def get_application_name(self):
+        return self.registry.session.execute(
+            "SELECT current_setting('application_name')").scalar()
+
+    def test_readonly(self):
+        self.assertEqual(
+            bind_session(self.registry, readonly=True, router=self.router),
+            'replica')
+        self.assertEqual(self.get_application_name(), 'replica')
+        self.assertEqual(self.router.lags, {
+            self.registry.db_name: (0, self.router.lags[
+                self.registry.db_name][1])})
+
+    def test_not_readonly(self):
+        self.assertEqual(bind_session(self.registry, router=self.router),
+                         'primary')
+        self.assertNotEqual(self.get_application_name(), 'replica')
+
+    def test_lag(self):
+        self.router.get_lag = lambda engine: 10
+        self.assertEqual(
+            bind_session(self.registry, readonly=True, router=self.router),
+            'primary')
+        metric = next(self.router.collect())
+        self.assertEqual(metric.samples, [
+            ({'db_name': self.registry.db_name, 'target': 'primary'}, 1)])
+
+    def test_replica_not_reachable(self):
+
+        def get_lag(engine):
+            raise Exception('down')
+
+        self.router.get_lag = get_lag
+        self.assertEqual(
+            bind_session(self.registry, readonly=True, router=self.router),
+            'primary')
+
+    def test_session_written(self):
+        session_id = id(self.registry.session)
+        _SESSION_STATE[session_id] = STATUS_CHANGED
+        self.addCleanup(_SESSION_STATE.pop, session_id)
+        self.assertEqual(
+            bind_session(self.registry, readonly=True, router=self.router),
+            'primary')
+
+    def test_bind_kept_in_transaction(self):
+        bind_session(self.registry, readonly=True, router=self.router)
+        self.get_application_name()
+        self.assertEqual(bind_session(self.registry, router=self.router),
+                         'replica')
+
+    def test_flush_refused(self):
+        bind_session(self.registry, readonly=True, router=self.router)
+        with self.assertRaises(ReadOnlyRequest):
+            check_writable(self.registry.session)
+
+        self.assertEqual(self.get_application_name(), 'replica')
+
+    def test_bulk_update_refused(self):
+        bind_session(self.registry, readonly=True, router=self.router)
+        query = self.registry.System.Blok.query().filter_by(name='none')
+        with self.assertRaises(DBAPIError):
+            query.update({'state': 'installed'}, synchronize_session=False)
+
+    def test_primary_writable(self):
+        bind_session(self.registry, router=self.router)
+        check_writable(self.registry.session)
+
+    def use_router(self):
+        self.addCleanup(Configuration.update, pyramid_replica_url=(
+            Configuration.get('pyramid_replica_url')))
+        self.addCleanup(replica._ROUTER.clear)
+        url = str(self.router.url)
+        Configuration.update(pyramid_replica_url=url)
+        replica._ROUTER[:] = [url, self.router]
+        request = DummyRequest()
+        request.anyblok = FakeAnyBlok()
+        request.anyblok._registry = self.registry
+        return request
+
+    def test_use_primary(self):
+        request = self.use_router()
+        bind_session(self.registry, readonly=True, router=self.router)
+        self.assertTrue(use_primary(request))
+        self.assertNotEqual(self.get_application_name(), 'replica')
+
+    def test_use_primary_too_late(self):
+        request = self.use_router()
+        bind_session(self.registry, readonly=True, router=self.router)
+        self.get_application_name()
+        self.assertFalse(use_primary(request))
+
+    def test_metrics_collector(self):
+        bind_session(self.registry, readonly=True, router=self.router)
+        samples = [metric.samples for metric in self.router.collect()]
+        self.assertEqual(samples[0], [
+            ({'db_name': self.registry.db_name, 'target': 'replica'}, 1)])
+        self.assertEqual(samples[1], [({'db_name': self.registry.db_name}, 0)])
@@ -0,0 +1,222 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok.tests.testcase import TestCase
+from anyblok_pyramid.rolling import (READY_DIR_ENV, RollingReload,
+                                     probe_application, get_worker_state,
+                                     clean_ready_files, parse_headers)
+from os import environ, getpid, listdir
+from shutil import rmtree
+from tempfile import mkdtemp
+from types import SimpleNamespace
+from unittest import skipIf
+import logging
+
+try:
+    from gunicorn.arbiter import Arbiter
+    from anyblok_pyramid.gunicorn import RollingArbiter
+except ImportError:  # pragma: no cover
+    RollingArbiter = None
+
+
+class MockArbiter:
+
+    def __init__(self, workers):
+        self.WORKERS = {pid: None for pid in workers}
+        self.states = {}
+        self.killed = []
+        self.next_pid = 100
+
+    def spawn_worker(self):
+        self.next_pid += 1
+        self.WORKERS[self.next_pid] = None
+        return self.next_pid
+
+    def kill_worker(self, pid, sig):
+        self.killed.append(pid)
+        self.WORKERS.pop(pid)
+
+    def get_worker_state(self, pid):
+        return self.states.get(pid)
+
+
+def make_app(status, expected=None):
+
+    def app(environ, start_response):
+        if expected and any(environ.get(key) != value
+                            for key, value in expected.items()):
+            status_ = '404 Not Found'
+        else:
+            status_ = status
+
+        start_response(status_, [('Content-Type', 'text/plain')])
+        return [b'']
+
+    return app
+
+
+class TestRollingReload(TestCase):
+
+    def test_rotation(self):
+        arbiter = MockArbiter([1, 2])
+        rolling = RollingReload([1, 2])
+        self.assertIsNone(rolling.step(arbiter))
+        self.assertEqual(sorted(arbiter.WORKERS), [1, 2, 101])
+        # not ready
+        self.assertIsNone(rolling.step(arbiter))
+        self.assertEqual(arbiter.killed, [])
+        arbiter.states[101] = 'ready'
+        self.assertIsNone(rolling.step(arbiter))
+        self.assertEqual(arbiter.killed, [1])
+        self.assertEqual(sorted(arbiter.WORKERS), [2, 101, 102])
+        arbiter.states[102] = 'ready'
+        self.assertEqual(rolling.step(arbiter), 'done')
+        self.assertEqual(sorted(arbiter.WORKERS), [101, 102])
+
+    def test_failed_probe(self):
+        arbiter = MockArbiter([1, 2])
+        rolling = RollingReload([1, 2])
+        rolling.step(arbiter)
+        arbiter.states[101] = 'failed'
+        self.assertIn('failed', rolling.step(arbiter))
+        self.assertEqual(sorted(arbiter.WORKERS), [1, 2])
+
+    def test_worker_exited(self):
+        arbiter = MockArbiter([1])
+        rolling = RollingReload([1])
+        rolling.step(arbiter)
+        del arbiter.WORKERS[101]
+        self.assertIn('failed', rolling.step(arbiter))
+        self.assertEqual(sorted(arbiter.WORKERS), [1])
+
+    def test_timeout(self):
+        arbiter = MockArbiter([1])
+        rolling = RollingReload([1], timeout=0)
+        rolling.step(arbiter)
+        rolling.started -= 1
+        self.assertIn('timeout', rolling.step(arbiter))
+        self.assertEqual(sorted(arbiter.WORKERS), [1])
+
+    def test_old_worker_exited(self):
+        arbiter = MockArbiter([1, 2])
+        rolling = RollingReload([1, 2])
+        rolling.step(arbiter)
+        del arbiter.WORKERS[1]
+        del arbiter.WORKERS[2]
+        arbiter.states[101] = 'ready'
+        self.assertEqual(rolling.step(arbiter), 'done')
+
+
+class TestProbe(TestCase):
+
+    def setUp(self):
+        super(TestProbe, self).setUp()
+        self.directory = mkdtemp()
+        self.addCleanup(rmtree, self.directory)
+        environ[READY_DIR_ENV] = self.directory
+        self.addCleanup(environ.pop, READY_DIR_ENV)
+
+    def test_ready(self):
+        self.assertTrue(probe_application(make_app('404 Not Found')))
+        self.assertEqual(get_worker_state(self.directory, getpid()), 'ready')
+
+    def test_failed(self):
+        self.assertFalse(probe_application(make_app('500 Error')))
+        self.assertEqual(get_worker_state(self.directory, getpid()),
+                         'failed')
+
+    def test_not_probed(self):
+        self.assertIsNone(get_worker_state(self.directory, getpid()))
+
+    def test_without_directory(self):
+        environ.pop(READY_DIR_ENV)
+        self.assertIsNone(probe_application(make_app('200 OK')))
+        environ[READY_DIR_ENV] = self.directory
+
+    def test_host_and_headers(self):
+        app = make_app('500 Error', expected={
+            'HTTP_HOST': 'acme.example.com', 'HTTP_X_TENANT': 'acme'})
+        self.assertFalse(probe_application(
+            app, host='acme.example.com', headers=['X-Tenant: acme']))
+        self.assertTrue(probe_application(app, host='other.example.com',
+                                          headers=['X-Tenant: acme']))
+
+    def test_parse_headers(self):
+        self.assertEqual(parse_headers(['X-Tenant: acme', 'A:b:c']),
+                         {'X-Tenant': 'acme', 'A': 'b:c'})
+        with self.assertRaises(ValueError):
+            parse_headers(['X-Tenant'])
+
+    def test_clean(self):
+        probe_application(make_app('200 OK'))
+        clean_ready_files(self.directory, [])
+        self.assertEqual(listdir(self.directory), [])
+
+
+if RollingArbiter is not None:
+
+    class FakeArbiter(Arbiter):
+        """Arbiter without process, below ``RollingArbiter``"""
+
+        def __init__(self, workers):
+            self.WORKERS = {pid: SimpleNamespace(age=pid) for pid in workers}
+            self.cfg = SimpleNamespace(
+                rolling_reload=True, workers=len(workers), preload_app=False,
+                rolling_timeout=120, pidfile=None)
+            self.log = logging.getLogger(__name__)
+            self.ready_dir = mkdtemp()
+            self.spawned = []
+            self.managed = 0
+            self.reloaded = False
+            self.master_name = 'Master'
+
+        def reload(self):
+            # as gunicorn, reload the configuration then start all the
+            # new workers
+            self.reloaded = True
+            for _ in range(self.cfg.workers):
+                self.spawn_worker()
+
+            self.manage_workers()
+
+        def spawn_worker(self):
+            pid = 100 + len(self.spawned)
+            self.spawned.append(pid)
+            self.WORKERS[pid] = SimpleNamespace(age=pid)
+            return pid
+
+        def manage_workers(self):
+            self.managed += 1
+
+    class MockRollingArbiter(RollingArbiter, FakeArbiter):
+        pass
+
+
+@skipIf(RollingArbiter is None, "gunicorn is not installed")
+class TestRollingArbiter(TestCase):
+
+    def get_arbiter(self, workers):
+        arbiter = MockRollingArbiter(workers)
+        self.addCleanup(rmtree, arbiter.ready_dir)
+        return arbiter
+
+    def test_hup_reloads_the_configuration(self):
+        arbiter = self.get_arbiter([1, 2])
+        arbiter.handle_hup()
+        self.assertTrue(arbiter.reloaded)
+        # only one new worker, started by the rolling reload
+        self.assertEqual(arbiter.spawned, [100])
+        self.assertEqual(arbiter.rolling.pending, 100)
+        self.assertEqual(arbiter.managed, 0)
+
+    def test_hup_without_rolling_reload(self):
+        arbiter = self.get_arbiter([1, 2])
+        arbiter.cfg.rolling_reload = False
+        arbiter.handle_hup()
+        self.assertIsNone(arbiter.rolling)
+        self.assertEqual(arbiter.spawned, [100, 101])
+        self.assertEqual(arbiter.managed, 1)
@@ -0,0 +1,177 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok.tests.testcase import TestCase
+from anyblok_pyramid.server import (make_anyblok_server, ThreadPoolWSGIServer,
+                                    InputWrapper, PreForkServer)
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection
+from io import BytesIO
+from threading import Thread, current_thread
+from types import SimpleNamespace
+from wsgiref.simple_server import WSGIServer
+import socket
+import time
+
+
+def app(environ, start_response):
+    if environ['PATH_INFO'] == '/slow':
+        time.sleep(0.5)
+
+    if environ['PATH_INFO'] == '/body':
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        body = environ['wsgi.input'].read(length)
+    else:
+        body = current_thread().name.encode('utf-8')
+
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+                              ('Content-Length', str(len(body)))])
+    return [body]
+
+
+def stream_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    yield b'a'
+    yield b'b'
+
+
+class TestServer(TestCase):
+
+    def start_server(self, app, threads=4, keepalive=5, **kwargs):
+        server = make_anyblok_server('127.0.0.1', 0, app, threads=threads,
+                                     keepalive=keepalive, **kwargs)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+
+        def stop():
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+        self.addCleanup(stop)
+        return server
+
+    def get(self, server, path, connection=None):
+        if connection is None:
+            connection = HTTPConnection(*server.server_address)
+        connection.request('GET', path)
+        response = connection.getresponse()
+        return response, response.read()
+
+    def test_without_threads(self):
+        server = make_anyblok_server('127.0.0.1', 0, app)
+        server.server_close()
+        self.assertIs(type(server), WSGIServer)
+
+    def test_with_threads(self):
+        server = make_anyblok_server('127.0.0.1', 0, app, threads=2)
+        server.server_close()
+        self.assertIsInstance(server, ThreadPoolWSGIServer)
+
+    def test_concurrent_slow_requests(self):
+        server = self.start_server(app, threads=4)
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(lambda x: self.get(server, '/slow'),
+                                        range(4)))
+
+        self.assertLess(time.time() - start, 1.5)
+        self.assertEqual([r[0].status for r in results], [200] * 4)
+
+    def test_keep_alive(self):
+        server = self.start_server(app)
+        connection = HTTPConnection(*server.server_address)
+        response, body1 = self.get(server, '/', connection=connection)
+        self.assertEqual(response.version, 11)
+        sock = connection.sock
+        response, body2 = self.get(server, '/', connection=connection)
+        self.assertIs(connection.sock, sock)
+        # the same connection is handled by the same thread
+        self.assertEqual(body1, body2)
+
+    def test_keep_alive_disabled(self):
+        server = self.start_server(app, keepalive=0)
+        connection = HTTPConnection(*server.server_address)
+        self.get(server, '/', connection=connection)
+        self.assertIsNone(connection.sock)
+
+    def test_connection_without_request(self):
+        server = self.start_server(app, timeout=0.2)
+        sock = socket.create_connection(server.server_address)
+        self.addCleanup(sock.close)
+        sock.settimeout(2)
+        # the server closes the connection
+        self.assertEqual(sock.recv(10), b'')
+
+    def test_idle_keep_alive_closed_when_saturated(self):
+        server = self.start_server(app, threads=1)
+        idle = HTTPConnection(*server.server_address)
+        self.get(server, '/', connection=idle)
+        start = time.time()
+        # the thread is given to the new connection without waiting the
+        # keep alive timeout
+        response, body = self.get(server, '/')
+        self.assertEqual(response.status, 200)
+        self.assertLess(time.time() - start, 2)
+
+    def test_close_without_content_length(self):
+        server = self.start_server(stream_app)
+        connection = HTTPConnection(*server.server_address)
+        response, body = self.get(server, '/', connection=connection)
+        self.assertEqual(body, b'ab')
+
+    def test_unread_body_is_drained(self):
+        server = self.start_server(app)
+        connection = HTTPConnection(*server.server_address)
+        connection.request('POST', '/', body=b'x' * 1000)
+        connection.getresponse().read()
+        connection.request('POST', '/body', body=b'hello')
+        response = connection.getresponse()
+        self.assertEqual(response.read(), b'hello')
+
+    def test_close_waits_requests_in_progress(self):
+        server = self.start_server(app)
+        results = []
+
+        def request():
+            results.append(self.get(server, '/slow')[0].status)
+
+        thread = Thread(target=request)
+        thread.start()
+        time.sleep(0.1)
+        server.shutdown()
+        server.server_close()
+        thread.join()
+        self.assertEqual(results, [200])
+
+    def test_input_wrapper(self):
+        wrapper = InputWrapper(BytesIO(b'line1\nline2\nnext request'), 12)
+        self.assertEqual(wrapper.readline(), b'line1\n')
+        self.assertEqual(wrapper.read(), b'line2\n')
+        self.assertEqual(wrapper.read(), b'')
+        wrapper = InputWrapper(BytesIO(b'0123456789'), 8)
+        self.assertEqual(wrapper.read(2), b'01')
+        self.assertTrue(wrapper.drain(100))
+        self.assertEqual(wrapper.remaining, 0)
+        self.assertFalse(InputWrapper(BytesIO(b''), 200).drain(100))
+
+
+class TestPreForkServer(TestCase):
+
+    def test_backoff(self):
+        server = PreForkServer(SimpleNamespace(), 1)
+        server.max_backoff = 0.4
+        server.wait_backoff(time.monotonic())
+        self.assertEqual(server.backoff, 0.1)
+        server.wait_backoff(time.monotonic())
+        self.assertEqual(server.backoff, 0.2)
+        server.wait_backoff(time.monotonic())
+        server.wait_backoff(time.monotonic())
+        self.assertEqual(server.backoff, 0.4)
+        # a process which lived resets the backoff
+        server.wait_backoff(time.monotonic() - 10)
+        self.assertEqual(server.backoff, 0)
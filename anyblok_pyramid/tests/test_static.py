@@ -0,0 +1,238 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok.tests.testcase import TestCase
+from anyblok_pyramid.static import (build_static, fingerprint,
+                                    add_static_assets, static_asset_url,
+                                    load_manifest, add_static_file_view,
+                                    StatCache, FileRange, is_safe_subpath)
+from io import BytesIO
+from pyramid.authentication import AuthTktAuthenticationPolicy
+from pyramid.authorization import ACLAuthorizationPolicy
+from pyramid.config import Configurator
+from os.path import join, exists
+from tempfile import mkdtemp
+from shutil import rmtree
+from webob import Request
+from webtest import TestApp
+import gzip
+import os
+
+
+JS = b'function hello() { return "hello world"; }\n' * 20
+
+
+class TestStatic(TestCase):
+
+    def setUp(self):
+        super(TestStatic, self).setUp()
+        self.directory = mkdtemp()
+        self.addCleanup(rmtree, self.directory)
+        static = join(self.directory, 'blok', 'static')
+        os.makedirs(join(static, 'js'))
+        with open(join(static, 'js', 'app.js'), 'wb') as fp:
+            fp.write(JS)
+
+        with open(join(static, 'logo.png'), 'wb') as fp:
+            fp.write(b'\x89PNG' * 100)
+
+        with open(join(static, 'small.css'), 'wb') as fp:
+            fp.write(b'a {}')
+
+        self.static_paths = [('blok', 'blok/static', static),
+                             ('other', 'other/static',
+                              join(self.directory, 'missing'))]
+        self.build_dir = join(self.directory, 'build')
+
+    def build(self):
+        return build_static(self.build_dir, static_paths=self.static_paths)
+
+    def get_app(self):
+        self.build()
+        config = Configurator()
+        config.add_request_method(static_asset_url, 'static_asset_url')
+        add_static_assets(config, self.build_dir,
+                          static_paths=self.static_paths)
+
+        def view(request):
+            request.response.text = request.static_asset_url(
+                'blok/static/js/app.js')
+            return request.response
+
+        config.add_route('url', '/url')
+        config.add_view(view, route_name='url')
+        return TestApp(config.make_wsgi_app())
+
+    def test_fingerprint(self):
+        self.assertEqual(fingerprint('a/app.min.js', 'abc'),
+                         'a/app.min.abc.js')
+
+    def test_build(self):
+        manifest = self.build()
+        self.assertEqual(manifest, load_manifest(self.build_dir))
+        files = manifest['files']
+        self.assertEqual(sorted(files.keys()),
+                         ['blok/static/js/app.js', 'blok/static/logo.png',
+                          'blok/static/small.css'])
+        path = files['blok/static/js/app.js']['path']
+        self.assertRegex(path, r'^blok/static/js/app\.[0-9a-f]{12}\.js$')
+        self.assertIn('gzip', files['blok/static/js/app.js']['encodings'])
+        with gzip.open(join(self.build_dir, path + '.gz'), 'rb') as fp:
+            self.assertEqual(fp.read(), JS)
+
+        # not compressible or too small
+        self.assertEqual(files['blok/static/logo.png']['encodings'], [])
+        self.assertEqual(files['blok/static/small.css']['encodings'], [])
+
+    def test_build_remove_old_files(self):
+        self.build()
+        old = join(self.build_dir, 'old.js')
+        with open(old, 'w') as fp:
+            fp.write('old')
+
+        self.build()
+        self.assertFalse(exists(old))
+
+    def test_serve_fingerprinted_gzip(self):
+        app = self.get_app()
+        path = app.get('/url').text[len('http://localhost'):]
+        # webtest decodes the body, call the application directly
+        response = Request.blank(
+            path, headers={'Accept-Encoding': 'gzip'}).get_response(app.app)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertEqual(gzip.decompress(response.body), JS)
+
+    def test_serve_without_accept_encoding(self):
+        app = self.get_app()
+        path = app.get('/url').text[len('http://localhost'):]
+        response = app.get(path)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.body, JS)
+
+    def test_serve_original_name(self):
+        app = self.get_app()
+        response = app.get('/blok/static/js/app.js')
+        self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+        self.assertEqual(response.body, JS)
+
+    def test_serve_with_default_permission(self):
+        self.build()
+        config = Configurator(
+            authentication_policy=AuthTktAuthenticationPolicy('secret'),
+            authorization_policy=ACLAuthorizationPolicy())
+        config.set_default_permission('read')
+        add_static_assets(config, self.build_dir,
+                          static_paths=self.static_paths)
+        app = TestApp(config.make_wsgi_app())
+        app.get('/blok/static/js/app.js', status=200)
+
+    def test_serve_unknown_file(self):
+        app = self.get_app()
+        app.get('/blok/static/manifest.json', status=404)
+        app.get('/blok/static/../manifest.json', status=404)
+
+
+class TestStaticFile(TestCase):
+
+    def setUp(self):
+        super(TestStaticFile, self).setUp()
+        self.directory = mkdtemp()
+        self.addCleanup(rmtree, self.directory)
+        with open(join(self.directory, 'data.js'), 'wb') as fp:
+            fp.write(JS)
+
+        config = Configurator()
+        add_static_file_view(config, 'blok/static', self.directory)
+
+        def view(request):
+            request.response.text = request.static_path(
+                join(self.directory, 'data.js'))
+            return request.response
+
+        config.add_route('url', '/url')
+        config.add_view(view, route_name='url')
+        self.app = TestApp(config.make_wsgi_app())
+
+    def test_static_url(self):
+        self.assertEqual(self.app.get('/url').text, '/blok/static/data.js')
+
+    def test_get(self):
+        response = self.app.get('/blok/static/data.js')
+        self.assertEqual(response.body, JS)
+        self.assertTrue(response.content_type.endswith('javascript'))
+        self.assertEqual(response.headers['Accept-Ranges'], 'bytes')
+        self.assertEqual(response.headers['Cache-Control'], 'max-age=3600')
+        self.assertTrue(response.etag)
+        self.assertTrue(response.last_modified)
+
+    def test_if_none_match(self):
+        etag = self.app.get('/blok/static/data.js').etag
+        self.app.get('/blok/static/data.js',
+                     headers={'If-None-Match': '"%s"' % etag}, status=304)
+
+    def test_if_modified_since(self):
+        last_modified = self.app.get('/blok/static/data.js').headers[
+            'Last-Modified']
+        self.app.get('/blok/static/data.js',
+                     headers={'If-Modified-Since': last_modified},
+                     status=304)
+
+    def test_range(self):
+        response = self.app.get('/blok/static/data.js',
+                                headers={'Range': 'bytes=10-19'}, status=206)
+        self.assertEqual(response.body, JS[10:20])
+        self.assertEqual(response.headers['Content-Range'],
+                         'bytes 10-19/%d' % len(JS))
+
+    def test_range_with_file_wrapper(self):
+        class FileWrapper:
+
+            def __init__(self, filelike, block_size):
+                self.filelike = filelike
+
+            def __iter__(self):
+                return iter(lambda: self.filelike.read(7), b'')
+
+            def close(self):
+                self.filelike.close()
+
+        response = self.app.get('/blok/static/data.js',
+                                headers={'Range': 'bytes=5-'},
+                                extra_environ={
+                                    'wsgi.file_wrapper': FileWrapper},
+                                status=206)
+        self.assertEqual(response.body, JS[5:])
+
+    def test_not_found(self):
+        self.app.get('/blok/static/unknown.js', status=404)
+        self.app.get('/blok/static/', status=404)
+
+    def test_is_safe_subpath(self):
+        self.assertTrue(is_safe_subpath(('js', 'data.js')))
+        self.assertFalse(is_safe_subpath(('..', 'data.js')))
+        self.assertFalse(is_safe_subpath(('js/../..', 'data.js')))
+        self.assertFalse(is_safe_subpath(()))
+
+    def test_stat_cache(self):
+        path = join(self.directory, 'data.js')
+        cache = StatCache(ttl=60)
+        self.assertEqual(cache.stat(path).st_size, len(JS))
+        os.remove(path)
+        self.assertEqual(cache.stat(path).st_size, len(JS))
+        cache.clear()
+        self.assertIsNone(cache.stat(path))
+        self.assertIsNone(cache.stat(self.directory))
+
+    def test_file_range(self):
+        fp = BytesIO(b'0123456789')
+        fp.seek(2)
+        file_range = FileRange(fp, 5)
+        self.assertEqual(file_range.read(3), b'234')
+        self.assertEqual(file_range.read(), b'56')
+        self.assertEqual(file_range.read(), b'')
@@ -0,0 +1,212 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok.tests.testcase import TestCase, DBTestCase
+from datetime import datetime, timezone
+from anyblok_pyramid import tasks
+from anyblok_pyramid.anyblok import add_after_commit_callback
+from anyblok_pyramid.tasks import (Task, TaskExecutor, add_task,
+                                   get_function_path, process_durable_tasks)
+from .testcase import PyramidDBTestCase
+from threading import Event
+import transaction
+
+CALLS = []
+
+
+def record(value):
+    CALLS.append(value)
+
+
+def fail(value):
+    CALLS.append(value)
+    raise Exception('error in the task')
+
+
+class FailOnce:
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls == 1:
+            raise Exception('first call')
+
+
+def metrics(executor):
+    return {metric.name: metric.samples[0][1]
+            for metric in executor.collect()}
+
+
+class TestTaskExecutor(TestCase):
+
+    def test_task(self):
+        executor = TaskExecutor(threads=1, retry_delay=0)
+        calls = []
+        executor.submit(Task(calls.append, (1,)))
+        executor.join()
+        executor.stop()
+        self.assertEqual(calls, [1])
+        self.assertEqual(
+            metrics(executor)['anyblok_pyramid_tasks_succeeded_total'], 1)
+
+    def test_retry(self):
+        executor = TaskExecutor(threads=1, retries=2, retry_delay=0)
+        func = FailOnce()
+        executor.submit(Task(func))
+        executor.join()
+        executor.stop()
+        self.assertEqual(func.calls, 2)
+        self.assertEqual(
+            metrics(executor)['anyblok_pyramid_tasks_retried_total'], 1)
+
+    def test_failed_after_the_retries(self):
+        executor = TaskExecutor(threads=1, retries=2, retry_delay=0)
+        calls = []
+
+        def func():
+            calls.append(1)
+            raise Exception('always')
+
+        executor.submit(Task(func))
+        executor.join()
+        executor.stop()
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(
+            metrics(executor)['anyblok_pyramid_tasks_failed_total'], 1)
+
+    def test_full_queue(self):
+        executor = TaskExecutor(threads=0, queue_size=1)
+        calls = []
+        executor.submit(Task(calls.append, (1,)))
+        executor.submit(Task(calls.append, (2,)))
+        self.assertEqual(calls, [2])
+        values = metrics(executor)
+        self.assertEqual(values['anyblok_pyramid_tasks_inline_total'], 1)
+        self.assertEqual(values['anyblok_pyramid_tasks_queue'], 1)
+
+    def test_stop_calls_the_queue(self):
+        executor = TaskExecutor(threads=1)
+        calls = []
+        for value in range(3):
+            executor.submit(Task(calls.append, (value,)))
+
+        self.assertEqual(executor.stop(timeout=5), [])
+        self.assertEqual(calls, [0, 1, 2])
+
+    def test_stop_drops_after_the_timeout(self):
+        executor = TaskExecutor(threads=1)
+        started, event = Event(), Event()
+        self.addCleanup(event.set)
+
+        def block():
+            started.set()
+            event.wait(5)
+
+        waiting = Task(record, ('never',))
+        executor.submit(Task(block))
+        started.wait(5)
+        executor.submit(waiting)
+        self.assertEqual(executor.stop(timeout=0.05), [waiting])
+        self.assertEqual(
+            metrics(executor)['anyblok_pyramid_tasks_dropped_total'], 1)
+
+    def test_stop_task_executor(self):
+        executor = TaskExecutor(threads=1)
+        tasks._EXECUTOR['executor'] = executor
+        self.addCleanup(tasks._EXECUTOR.clear)
+        calls = []
+        executor.submit(Task(calls.append, (1,)))
+        tasks.stop_task_executor()
+        self.assertEqual(calls, [1])
+        self.assertNotIn('executor', tasks._EXECUTOR)
+
+    def test_function_path(self):
+        self.assertEqual(get_function_path(record),
+                         'anyblok_pyramid.tests.test_tasks:record')
+        with self.assertRaises(ValueError):
+            get_function_path(lambda: None)
+
+
+def task_view(request):
+    add_task(request.anyblok.registry, record, request.matchdict['value'])
+    if request.params.get('fail'):
+        raise Exception('error in the view')
+
+    return {}
+
+
+def add_route_and_views(config):
+    config.add_route('task', '/task/{value}')
+    config.add_view(task_view, route_name='task', renderer='json')
+
+
+class TestAfterCommit(PyramidDBTestCase):
+
+    def setUp(self):
+        super(TestAfterCommit, self).setUp()
+        self.executor = TaskExecutor(threads=1, retry_delay=0)
+        tasks._EXECUTOR['executor'] = self.executor
+        self.addCleanup(tasks._EXECUTOR.clear)
+        self.addCleanup(self.executor.stop)
+        del CALLS[:]
+        self.includemes.append(add_route_and_views)
+        self.registry = self.init_registry(None)
+
+    def test_called_after_commit(self):
+        self.webserver.get('/task/a')
+        self.executor.join()
+        self.assertEqual(CALLS, ['a'])
+
+    def test_dropped_on_abort(self):
+        with self.assertRaises(Exception):
+            self.webserver.get('/task/b', params={'fail': 1})
+
+        self.executor.join()
+        self.assertEqual(CALLS, [])
+        self.assertEqual(self.executor.submitted, 0)
+
+    def test_dropped_on_rollback(self):
+        session = self.registry.session
+        add_after_commit_callback(session, lambda: record('c'))
+        # rolled back without the transaction manager
+        session.rollback()
+        add_after_commit_callback(session, lambda: record('d'))
+        transaction.commit()
+        self.assertEqual(CALLS, ['d'])
+
+
+class TestDurableTask(DBTestCase):
+
+    def setUp(self):
+        super(TestDurableTask, self).setUp()
+        self.registry = self.init_registry_with_bloks(('pyramid-task',), None)
+        self.addCleanup(transaction.abort)
+        del CALLS[:]
+
+    def test_process(self):
+        add_task(self.registry, record, 'a', durable=True)
+        self.assertEqual(CALLS, [])
+        self.assertEqual(process_durable_tasks(self.registry), 1)
+        self.assertEqual(CALLS, ['a'])
+        self.assertEqual(self.registry.Pyramid.Task.query().count(), 0)
+
+    def test_retry_then_failed(self):
+        entry = add_task(self.registry, fail, 'b', durable=True)
+        process_durable_tasks(self.registry, retries=1)
+        self.assertEqual(entry.attempts, 1)
+        self.assertEqual(entry.state, 'pending')
+        self.assertGreater(entry.next_try, datetime.now(timezone.utc))
+        # not ready before next_try
+        self.assertEqual(process_durable_tasks(self.registry), 0)
+        entry.next_try = datetime.now(timezone.utc)
+        process_durable_tasks(self.registry, retries=1)
+        self.assertEqual(entry.attempts, 2)
+        self.assertEqual(entry.state, 'failed')
+        self.assertIn('error in the task', entry.error)
+        self.assertEqual(CALLS, ['b', 'b'])
@@ -0,0 +1,193 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok.tests.testcase import TestCase
+from anyblok.config import Configuration
+from anyblok_pyramid.tenant import (KINDS, TenantMapping, TenantResolver,
+                                    get_db_name, get_subdomain,
+                                    load_file_entries, load_table_entries,
+                                    reset_tenant_resolver,
+                                    tenant_tween_factory)
+from pyramid.request import Request
+from pyramid.response import Response
+from sqlalchemy import create_engine
+from tempfile import TemporaryDirectory
+import json
+import os
+
+
+ENTRIES = [
+    ('header', 'acme', 'header_db'),
+    ('host', 'shop.acme.com', 'host_db'),
+    ('subdomain', 'Acme', 'subdomain_db'),
+    ('prefix', 'acme', 'prefix_db'),
+]
+
+
+def make_request(path='/', **headers):
+    return Request.blank(path, headers=headers)
+
+
+class TestTenantResolver(TestCase):
+
+    def get_resolver(self, entries=ENTRIES, **kwargs):
+        kwargs.setdefault('ttl', 0)
+        kwargs.setdefault('header', 'X-Tenant')
+        kwargs.setdefault('domain', 'example.com')
+        return TenantResolver(lambda: TenantMapping(entries), **kwargs)
+
+    def test_kinds(self):
+        resolver = self.get_resolver(kinds=KINDS)
+        self.assertEqual(
+            resolver.resolve(make_request(**{'X-Tenant': 'acme'})),
+            'header_db')
+        self.assertEqual(
+            resolver.resolve(make_request(Host='SHOP.acme.com:8080')),
+            'host_db')
+        self.assertEqual(
+            resolver.resolve(make_request(Host='www.acme.example.com')),
+            'subdomain_db')
+        self.assertEqual(resolver.resolve(make_request('/acme/items')),
+                         'prefix_db')
+        self.assertIsNone(resolver.resolve(make_request('/other')))
+
+    def test_header_opt_in(self):
+        resolver = self.get_resolver()
+        self.assertIsNone(resolver.resolve(make_request(
+            **{'X-Tenant': 'acme'})))
+        # the host is tried first
+        request = make_request(Host='shop.acme.com', **{'X-Tenant': 'acme'})
+        resolver = self.get_resolver(kinds=('host', 'header'))
+        self.assertEqual(resolver.resolve(request), 'host_db')
+
+    def test_order_of_the_kinds(self):
+        resolver = self.get_resolver(kinds=('prefix', 'header'))
+        request = make_request('/acme', **{'X-Tenant': 'acme'})
+        self.assertEqual(resolver.resolve(request), 'prefix_db')
+
+    def test_without_header_or_domain(self):
+        resolver = self.get_resolver(header=None, domain=None, kinds=KINDS)
+        self.assertIsNone(resolver.resolve(make_request(
+            Host='acme.example.com', **{'X-Tenant': 'acme'})))
+
+    def test_subdomain(self):
+        self.assertEqual(get_subdomain('acme.example.com', 'example.com'),
+                         'acme')
+        self.assertIsNone(get_subdomain('example.com', 'example.com'))
+        self.assertIsNone(get_subdomain('acmeexample.com', 'example.com'))
+
+    def test_failed_load_keeps_the_mapping(self):
+        loads = [TenantMapping(ENTRIES)]
+
+        def loader():
+            if not loads:
+                raise Exception('database down')
+
+            return loads.pop()
+
+        resolver = TenantResolver(loader, ttl=0)
+        self.assertEqual(resolver.resolve(make_request('/acme')), 'prefix_db')
+        self.assertFalse(resolver.refresh())
+        self.assertEqual(resolver.errors, 1)
+        self.assertEqual(resolver.resolve(make_request('/acme')), 'prefix_db')
+
+    def test_refreshed_by_the_thread(self):
+        mappings = [TenantMapping(), TenantMapping(ENTRIES)]
+        resolver = TenantResolver(mappings.pop, ttl=0.01)
+        self.addCleanup(resolver.stop)
+        self.assertEqual(resolver.resolve(make_request('/acme')), 'prefix_db')
+        # the thread loads the next mapping, then fails
+        resolver.stopped.wait(0.1)
+        self.assertIsNone(resolver.resolve(make_request('/acme')))
+        self.assertGreater(resolver.errors, 0)
+
+    def test_collect(self):
+        resolver = self.get_resolver()
+        resolver.start()
+        metrics = {x.name: x for x in resolver.collect()}
+        self.assertEqual(
+            metrics['anyblok_pyramid_tenant_entries'].samples,
+            [({'kind': 'header'}, 1), ({'kind': 'host'}, 1),
+             ({'kind': 'subdomain'}, 1), ({'kind': 'prefix'}, 1)])
+
+
+class TestSources(TestCase):
+
+    def test_file(self):
+        with TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'tenants.json')
+            with open(path, 'w') as fp:
+                json.dump({'host': {'a.com': 'a'}, 'prefix': {'b': 'b'}}, fp)
+
+            self.assertEqual(sorted(load_file_entries(path)),
+                             [('host', 'a.com', 'a'), ('prefix', 'b', 'b')])
+
+    def test_table(self):
+        with TemporaryDirectory() as directory:
+            url = 'sqlite:///' + os.path.join(directory, 'tenants.db')
+            engine = create_engine(url)
+            engine.execute('CREATE TABLE tenant '
+                           '(kind VARCHAR, value VARCHAR, db_name VARCHAR)')
+            engine.execute("INSERT INTO tenant VALUES ('host', 'a.com', 'a')")
+            engine.dispose()
+            self.assertEqual(load_table_entries(url), [('host', 'a.com', 'a')])
+
+
+class TestGetDbName(TestCase):
+
+    def setUp(self):
+        super(TestGetDbName, self).setUp()
+        self.directory = TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        path = os.path.join(self.directory.name, 'tenants.json')
+        with open(path, 'w') as fp:
+            json.dump({'prefix': {'acme': 'acme_db'}}, fp)
+
+        for key, type_ in (('pyramid_tenant_mapping', str),
+                           ('pyramid_tenant_ttl', float),
+                           ('pyramid_tenant_exclude', list)):
+            if not Configuration.has(key):
+                Configuration.add_argument(key, None, type=type_)
+
+        self.addCleanup(
+            Configuration.update,
+            pyramid_tenant_mapping=Configuration.get('pyramid_tenant_mapping'),
+            pyramid_tenant_ttl=Configuration.get('pyramid_tenant_ttl'),
+            pyramid_tenant_exclude=Configuration.get('pyramid_tenant_exclude'))
+        Configuration.update(pyramid_tenant_mapping=path,
+                             pyramid_tenant_ttl=0)
+        reset_tenant_resolver()
+        self.addCleanup(reset_tenant_resolver)
+
+    def test_get_db_name(self):
+        self.assertEqual(get_db_name(make_request('/acme/items')), 'acme_db')
+        self.assertIsNone(get_db_name(make_request('/other')))
+
+    def test_prefix_stripped(self):
+        request = make_request('/acme/items?a=1')
+        self.assertEqual(get_db_name(request), 'acme_db')
+        self.assertEqual((request.script_name, request.path_info),
+                         ('/acme', '/items'))
+        self.assertEqual(request.path_qs, '/acme/items?a=1')
+
+    def test_resolved_once_by_request(self):
+        request = make_request('/acme/items')
+        self.assertEqual(get_db_name(request), 'acme_db')
+        self.assertEqual(get_db_name(request), 'acme_db')
+        self.assertEqual(request.path_info, '/items')
+        request = make_request('/other')
+        self.assertIsNone(get_db_name(request))
+        request.path_info = '/acme/items'
+        self.assertIsNone(get_db_name(request))
+
+    def test_tween(self):
+        Configuration.update(pyramid_tenant_exclude=['/metrics'])
+        tween = tenant_tween_factory(
+            lambda request: Response(request.path_info), None)
+        self.assertEqual(tween(make_request('/acme/items')).text, '/items')
+        self.assertEqual(tween(make_request('/other')).status_int, 404)
+        self.assertEqual(tween(make_request('/metrics')).text, '/metrics')
@@ -0,0 +1,191 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok.tests.testcase import TestCase, DBTestCase
+from anyblok.environment import EnvironmentManager
+from anyblok_pyramid.timeout import (timeout, collect_timeouts,
+                                     get_statement_timeout,
+                                     apply_statement_timeout,
+                                     refresh_statement_timeout,
+                                     is_query_canceled, DeadlineExceeded,
+                                     QUERY_CANCELED, TIMEOUT_INFO)
+from anyblok_pyramid.metrics import remove_metrics_collector
+from pyramid.config import Configurator
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError, OperationalError
+from webtest import TestApp
+import time
+
+
+class CanceledError(Exception):
+    pgcode = QUERY_CANCELED
+
+
+def reset_environment():
+    EnvironmentManager.set('statement_timeout', None)
+    EnvironmentManager.set('request_deadline', None)
+
+
+class TestTimeoutView(TestCase):
+
+    def get_app(self, settings=None):
+        config = Configurator(settings=settings)
+        config.include(timeout)
+        self.addCleanup(remove_metrics_collector, collect_timeouts)
+        self.addCleanup(event.remove, Engine, 'before_cursor_execute',
+                        refresh_statement_timeout)
+        self.seen = []
+
+        def slow(request):
+            time.sleep(0.05)
+            return {}
+
+        def canceled(request):
+            raise DBAPIError('select', {}, CanceledError())
+
+        def error(request):
+            raise DBAPIError('select', {}, Exception())
+
+        def check(request):
+            self.seen.append(get_statement_timeout())
+            return {}
+
+        def late(request):
+            raise DeadlineExceeded()
+
+        config.add_route('slow', '/slow')
+        config.add_view(slow, route_name='slow', renderer='json',
+                        anyblok_deadline=0.01)
+        config.add_route('canceled', '/canceled')
+        config.add_view(canceled, route_name='canceled', renderer='json',
+                        anyblok_statement_timeout=10)
+        config.add_route('error', '/error')
+        config.add_view(error, route_name='error', renderer='json',
+                        anyblok_statement_timeout=10)
+        config.add_route('check', '/check')
+        config.add_view(check, route_name='check', renderer='json')
+        config.add_route('late', '/late')
+        config.add_view(late, route_name='late', renderer='json',
+                        anyblok_deadline=10)
+        return TestApp(config.make_wsgi_app())
+
+    def get_count(self, kind, route):
+        samples = dict(
+            ((labels['kind'], labels['route']), value)
+            for labels, value in next(collect_timeouts()).samples)
+        return samples.get((kind, route), 0)
+
+    def test_deadline(self):
+        app = self.get_app()
+        before = self.get_count('deadline', 'slow')
+        app.get('/slow', status=504)
+        self.assertEqual(self.get_count('deadline', 'slow'), before + 1)
+
+    def test_deadline_before_a_statement(self):
+        app = self.get_app()
+        before = self.get_count('deadline', 'late')
+        app.get('/late', status=504)
+        self.assertEqual(self.get_count('deadline', 'late'), before + 1)
+
+    def test_statement_canceled(self):
+        app = self.get_app()
+        before = self.get_count('statement', 'canceled')
+        app.get('/canceled', status=504)
+        self.assertEqual(self.get_count('statement', 'canceled'),
+                         before + 1)
+
+    def test_other_database_error(self):
+        app = self.get_app()
+        with self.assertRaises(DBAPIError):
+            app.get('/error')
+
+    def test_default_from_settings(self):
+        app = self.get_app({'anyblok.statement_timeout': 2000})
+        app.get('/check')
+        self.assertEqual(self.seen, [2000])
+        self.assertIsNone(EnvironmentManager.get('statement_timeout'))
+
+    def test_without_timeout(self):
+        app = self.get_app()
+        app.get('/check')
+        self.assertEqual(self.seen, [None])
+
+    def test_timeouts_of_the_caller_restored(self):
+        app = self.get_app({'anyblok.statement_timeout': 2000,
+                            'anyblok.request_deadline': 60})
+        self.addCleanup(reset_environment)
+        deadline = time.time() + 1
+        EnvironmentManager.set('statement_timeout', 5000)
+        EnvironmentManager.set('request_deadline', deadline)
+        app.get('/check')
+        # the deadline of the caller is earlier
+        self.assertLessEqual(self.seen[0], 1000)
+        self.assertEqual(EnvironmentManager.get('statement_timeout'), 5000)
+        self.assertEqual(EnvironmentManager.get('request_deadline'),
+                         deadline)
+
+
+class TestStatementTimeout(DBTestCase):
+
+    def test_bounded_by_deadline(self):
+        self.addCleanup(reset_environment)
+        EnvironmentManager.set('statement_timeout', 5000)
+        EnvironmentManager.set('request_deadline', time.time() + 1)
+        self.assertLessEqual(get_statement_timeout(), 1000)
+
+    def test_query_canceled(self):
+        registry = self.init_registry(None)
+        self.addCleanup(reset_environment)
+        EnvironmentManager.set('statement_timeout', 50)
+        connection = registry.session.connection()
+        apply_statement_timeout(connection)
+        with self.assertRaises(OperationalError) as error:
+            connection.execute('select pg_sleep(1)')
+
+        self.assertTrue(is_query_canceled(error.exception))
+
+    def listen(self, registry):
+        event.listen(registry.engine, 'before_cursor_execute',
+                     refresh_statement_timeout)
+        self.addCleanup(event.remove, registry.engine,
+                        'before_cursor_execute', refresh_statement_timeout)
+
+    def test_refreshed_before_each_statement(self):
+        registry = self.init_registry(None)
+        self.listen(registry)
+        self.addCleanup(reset_environment)
+        EnvironmentManager.set('statement_timeout', 5000)
+        EnvironmentManager.set('request_deadline', time.time() + 1)
+        connection = registry.session.connection()
+        time.sleep(0.3)
+        timeout = connection.execute('SHOW statement_timeout').scalar()
+        self.assertTrue(timeout.endswith('ms'))
+        self.assertLessEqual(int(timeout[:-2]), 700)
+
+    def test_not_refreshed_before_each_statement(self):
+        registry = self.init_registry(None)
+        self.listen(registry)
+        self.addCleanup(reset_environment)
+        EnvironmentManager.set('statement_timeout', 500)
+        EnvironmentManager.set('request_deadline', time.time() + 60)
+        connection = registry.session.connection()
+        connection.execute('select 1')
+        applied = connection.info[TIMEOUT_INFO]
+        self.assertEqual(applied[2], 500)
+        connection.execute('select 2')
+        self.assertIs(connection.info[TIMEOUT_INFO], applied)
+        self.assertEqual(
+            connection.execute('SHOW statement_timeout').scalar(), '500ms')
+
+    def test_deadline_passed(self):
+        registry = self.init_registry(None)
+        self.listen(registry)
+        self.addCleanup(reset_environment)
+        EnvironmentManager.set('request_deadline', time.time() - 1)
+        with self.assertRaises(DeadlineExceeded):
+            registry.session.connection().execute('select 1')
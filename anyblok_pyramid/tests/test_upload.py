@@ -0,0 +1,96 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+from anyblok.tests.testcase import TestCase, DBTestCase
+from anyblok import Declarations
+from anyblok.column import String, Integer, LargeBinary
+from anyblok_pyramid.upload import (spool_request_body, LargeObjectStorage,
+                                    ChunkedStorage, StoredFileResponse)
+from io import BytesIO
+from os import urandom
+from webob import Request
+
+
+register = Declarations.register
+Model = Declarations.Model
+DATA = urandom(1000)
+
+
+def add_chunk_model():
+
+    @register(Model)
+    class Attachment:
+        key = String(primary_key=True)
+        position = Integer(primary_key=True)
+        data = LargeBinary()
+
+
+class TestSpool(TestCase):
+
+    def test_spool_in_memory(self):
+        request = Request.blank('/', method='POST', body=DATA)
+        spool = spool_request_body(request, threshold=2000, chunk_size=100)
+        self.assertFalse(spool._rolled)
+        self.assertEqual(spool.read(), DATA)
+
+    def test_spool_on_disk(self):
+        request = Request.blank('/', method='POST', body=DATA)
+        spool = spool_request_body(request, threshold=100, chunk_size=100)
+        self.assertTrue(spool._rolled)
+        self.assertEqual(spool.read(), DATA)
+
+
+class StorageMixin:
+
+    def check_storage(self, storage):
+        key = storage.write(BytesIO(DATA))
+        self.assertEqual(storage.size(key), len(DATA))
+        response = StoredFileResponse(storage, key, filename='file.bin')
+        result = Request.blank('/').get_response(response)
+        self.assertEqual(result.body, DATA)
+        self.assertEqual(result.content_length, len(DATA))
+        self.assertEqual(result.headers['Content-Disposition'],
+                         'attachment; filename="file.bin"')
+
+        response = StoredFileResponse(storage, key)
+        result = Request.blank(
+            '/', headers={'Range': 'bytes=250-599'}).get_response(response)
+        self.assertEqual(result.status_int, 206)
+        self.assertEqual(result.body, DATA[250:600])
+
+        response = StoredFileResponse(storage, key)
+        result = Request.blank(
+            '/', headers={'If-None-Match': response.etag}).get_response(
+                response)
+        self.assertEqual(result.status_int, 304)
+
+        storage.delete(key)
+        return key
+
+
+class TestLargeObjectStorage(StorageMixin, DBTestCase):
+
+    def test_storage(self):
+        registry = self.init_registry(None)
+        self.check_storage(LargeObjectStorage(registry, chunk_size=100))
+
+
+class TestChunkedStorage(StorageMixin, DBTestCase):
+
+    def test_storage(self):
+        registry = self.init_registry(add_chunk_model)
+        storage = ChunkedStorage(registry, 'Model.Attachment', chunk_size=100)
+        key = self.check_storage(storage)
+        self.assertEqual(registry.Attachment.query().filter_by(
+            key=key).count(), 0)
+
+    def test_chunks(self):
+        registry = self.init_registry(add_chunk_model)
+        storage = ChunkedStorage(registry, 'Model.Attachment', chunk_size=300)
+        key = storage.write(BytesIO(DATA))
+        self.assertEqual(registry.Attachment.query().filter_by(
+            key=key).count(), 4)
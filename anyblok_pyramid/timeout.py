@@ -0,0 +1,232 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+"""Statement timeout and deadline of the requests
+
+A view gives the maximum duration of its queries and of the whole request::
+
+    @view_config(route_name='report', renderer='json',
+                 anyblok_statement_timeout=5000,  # ms
+                 anyblok_deadline=10)  # s
+    def report(request):
+        ...
+
+The defaults come from the settings ``anyblok.statement_timeout`` and
+``anyblok.request_deadline`` (``--pyramid-statement-timeout`` and
+``--pyramid-request-deadline``).
+
+The statement timeout is set with ``SET LOCAL`` on the transaction of the
+request, when it begins. With a deadline it is set again before a statement
+when the time left is below ``1 - TIMEOUT_REFRESH`` of the timeout set on
+the transaction, and a statement after the deadline is not executed. A
+cancelled query or a request which ends after its deadline is answered by
+``504``, the transaction is aborted by ``pyramid_tm``.
+
+A request called in a request (batch) keeps the deadline of its caller if
+it is earlier, the timeouts of the caller are given back after it.
+"""
+import time
+from collections import Counter
+from threading import Lock
+from anyblok.environment import EnvironmentManager
+from pyramid.httpexceptions import HTTPGatewayTimeout
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError
+from . import AnyBlokPyramidException
+from .metrics import Metric, add_metrics_collector
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+QUERY_CANCELED = '57014'
+TIMEOUT_REFRESH = 0.1
+TIMEOUT_INFO = 'anyblok_pyramid.statement_timeout'
+_TIMEOUTS = Counter()
+_TIMEOUTS_LOCK = Lock()
+
+
+def get_statement_timeout():
+    """Return the statement timeout of the current request in ms, bounded
+    by its deadline, None if there is no timeout
+    """
+    timeout = EnvironmentManager.get('statement_timeout')
+    deadline = EnvironmentManager.get('request_deadline')
+    if deadline:
+        remaining = max(int((deadline - time.time()) * 1000), 1)
+        timeout = min(timeout, remaining) if timeout else remaining
+
+    return timeout
+
+
+def get_timeout_owner():
+    """Return the timeouts of the request which set the statement timeout
+    on the transaction of a connection
+    """
+    return (EnvironmentManager.get('statement_timeout'),
+            EnvironmentManager.get('request_deadline'))
+
+
+def apply_statement_timeout(connection):
+    """Set the statement timeout of the current request on the transaction
+    of the connection, PostgreSQL only
+    """
+    timeout = get_statement_timeout()
+    if timeout and connection.dialect.name == 'postgresql':
+        connection.execute('SET LOCAL statement_timeout = %d' % timeout)
+        connection.info[TIMEOUT_INFO] = get_timeout_owner() + (timeout,)
+    else:
+        connection.info.pop(TIMEOUT_INFO, None)
+
+
+class DeadlineExceeded(AnyBlokPyramidException):
+    """The deadline of the request is passed before a statement"""
+
+
+def is_timeout_applied(conn, timeout):
+    """Return True if the statement timeout set on the transaction of the
+    connection is the one of the current request, and the time left is not
+    too far below it
+    """
+    applied = conn.info.get(TIMEOUT_INFO)
+    if applied is None or applied[:2] != get_timeout_owner():
+        return False
+
+    return timeout >= applied[2] * (1 - TIMEOUT_REFRESH)
+
+
+def refresh_statement_timeout(conn, cursor, statement, parameters, context,
+                              executemany):
+    """Engine event ``before_cursor_execute``, with a deadline the statement
+    timeout is the time left, the statement is not executed after the
+    deadline
+    """
+    deadline = EnvironmentManager.get('request_deadline')
+    if not deadline:
+        return
+
+    if time.time() >= deadline:
+        raise DeadlineExceeded("The deadline of the request is passed")
+
+    if conn.dialect.name != 'postgresql':
+        return
+
+    timeout = get_statement_timeout()
+    if not is_timeout_applied(conn, timeout):
+        cursor.execute('SET LOCAL statement_timeout = %d' % timeout)
+        conn.info[TIMEOUT_INFO] = get_timeout_owner() + (timeout,)
+
+
+def is_query_canceled(error):
+    return getattr(error.orig, 'pgcode', None) == QUERY_CANCELED
+
+
+def count_timeout(kind, request):
+    route = request.matched_route
+    with _TIMEOUTS_LOCK:
+        _TIMEOUTS[(kind, route.name if route is not None else '')] += 1
+
+
+def collect_timeouts():
+    """Metrics collector"""
+    yield Metric('anyblok_pyramid_timeouts_total',
+                 'Requests stopped by a statement timeout or a deadline',
+                 'counter',
+                 [({'kind': kind, 'route': route}, value)
+                  for (kind, route), value in sorted(_TIMEOUTS.items())])
+
+
+def apply_on_current_transaction(request):
+    """The transaction can be begun before the view, by a predicate"""
+    anyblok = request.__dict__.get('anyblok')
+    registry = anyblok._registry if anyblok is not None else None
+    if registry is None:
+        return
+
+    transaction = registry.session.transaction
+    if transaction is not None and transaction._connections:
+        apply_statement_timeout(registry.session.connection())
+
+
+def set_timeouts(statement_timeout, deadline):
+    EnvironmentManager.set('statement_timeout', statement_timeout)
+    EnvironmentManager.set('request_deadline', deadline)
+
+
+def call_view(view, context, request):
+    try:
+        apply_on_current_transaction(request)
+        return view(context, request)
+    except DeadlineExceeded:
+        logger.warning('Deadline exceeded on %s %s', request.method,
+                       request.path)
+        count_timeout('deadline', request)
+        raise HTTPGatewayTimeout()
+    except DBAPIError as error:
+        if not is_query_canceled(error):
+            raise
+
+        logger.warning('Statement timeout on %s %s', request.method,
+                       request.path)
+        count_timeout('statement', request)
+        raise HTTPGatewayTimeout()
+
+
+def timeout_view(view, info):
+    """View deriver, add the options ``anyblok_statement_timeout`` (ms) and
+    ``anyblok_deadline`` (s)
+    """
+    settings = info.settings or {}
+    statement_timeout = info.options.get(
+        'anyblok_statement_timeout',
+        settings.get('anyblok.statement_timeout'))
+    deadline = info.options.get(
+        'anyblok_deadline', settings.get('anyblok.request_deadline'))
+    if not statement_timeout and not deadline:
+        return view
+
+    def wrapper(context, request):
+        # the request can be called by a request which has its timeouts
+        previous = get_timeout_owner()
+        stop = time.time() + deadline if deadline else None
+        if previous[1] and (stop is None or previous[1] < stop):
+            stop = previous[1]
+
+        set_timeouts(statement_timeout or previous[0], stop)
+        try:
+            response = call_view(view, context, request)
+        finally:
+            set_timeouts(*previous)
+
+        if stop and time.time() > stop:
+            logger.warning('Deadline exceeded on %s %s', request.method,
+                           request.path)
+            count_timeout('deadline', request)
+            raise HTTPGatewayTimeout()
+
+        if any(previous):
+            apply_on_current_transaction(request)
+
+        return response
+
+    return wrapper
+
+
+timeout_view.options = ('anyblok_statement_timeout', 'anyblok_deadline')
+
+
+def timeout(config):
+    """Pyramid includeme, add the view deriver of the timeouts
+
+    :param config: Pyramid configurator instance
+    """
+    config.add_view_deriver(timeout_view)
+    add_metrics_collector(collect_timeouts)
+    if not event.contains(Engine, 'before_cursor_execute',
+                          refresh_statement_timeout):
+        event.listen(Engine, 'before_cursor_execute',
+                     refresh_statement_timeout)
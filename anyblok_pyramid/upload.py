@@ -0,0 +1,267 @@
+# This file is a part of the AnyBlok / Pyramid project
+#
+#    Copyright (C) 2017 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+"""Upload and download of big files without loading them in memory
+
+The body of the request is spooled in a temporary file, then written in the
+database by chunks, in the large objects of PostgreSQL
+(``LargeObjectStorage``) or in a table of chunks (``ChunkedStorage``)::
+
+    storage = LargeObjectStorage(request.anyblok.registry)
+    oid = storage.write(spool_request_body(request))
+
+The download is streamed by ``StoredFileResponse``, with range requests::
+
+    return StoredFileResponse(storage, oid, request=request)
+"""
+from contextlib import contextmanager
+from tempfile import SpooledTemporaryFile
+from uuid import uuid4
+from pyramid.response import Response
+from sqlalchemy import func, select
+from sqlalchemy.engine import Connection
+from . import AnyBlokPyramidException
+from .anyblok import mark_changed
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+CHUNK_SIZE = 1024 * 1024
+SPOOL_THRESHOLD = 1024 * 1024
+
+
+def iter_file(fp, chunk_size=CHUNK_SIZE):
+    """Return the chunks of the file"""
+    while True:
+        data = fp.read(chunk_size)
+        if not data:
+            break
+
+        yield data
+
+
+def spool_request_body(request, threshold=SPOOL_THRESHOLD,
+                       chunk_size=CHUNK_SIZE):
+    """Copy the body of the request in a temporary file, kept in memory
+    while it is smaller than ``threshold`` bytes
+
+    .. note::
+
+        For a multipart form, ``request.POST[name].file`` is already a
+        temporary file
+
+    :param request: Pyramid request
+    :param threshold: maximum size in memory
+    :param chunk_size: size of the reads
+    :rtype: file seeked at the beginning
+    """
+    spool = SpooledTemporaryFile(max_size=threshold)
+    for data in iter_file(request.body_file, chunk_size):
+        spool.write(data)
+
+    spool.seek(0)
+    return spool
+
+
+@contextmanager
+def stream_connection(registry):
+    """Connection used to read the file after the end of the transaction of
+    the request, when the response is sent
+    """
+    if isinstance(registry.bind, Connection):
+        # unittest, all in the transaction of the test
+        yield registry.bind
+        return
+
+    connection = registry.engine.connect()
+    transaction = connection.begin()
+    try:
+        yield connection
+    finally:
+        transaction.rollback()
+        connection.close()
+
+
+class LargeObjectStorage:
+    """Store the files in the large objects of PostgreSQL, the key is the
+    oid of the large object
+
+    :param registry: AnyBlok registry
+    :param chunk_size: size of the writes and of the reads
+    """
+
+    def __init__(self, registry, chunk_size=CHUNK_SIZE):
+        if registry.engine.url.get_backend_name() != 'postgresql':
+            raise AnyBlokPyramidException(
+                "The large objects need PostgreSQL")
+
+        self.registry = registry
+        self.chunk_size = chunk_size
+
+    def dbapi_connection(self):
+        return self.registry.session.connection().connection
+
+    def write(self, fp):
+        """Write the file in a new large object
+
+        :param fp: file to store
+        :rtype: int, oid of the large object
+        """
+        lobject = self.dbapi_connection().lobject(0, 'wb')
+        try:
+            for data in iter_file(fp, self.chunk_size):
+                lobject.write(data)
+        finally:
+            lobject.close()
+
+        mark_changed(self.registry.session)
+        return lobject.oid
+
+    def size(self, key):
+        lobject = self.dbapi_connection().lobject(key, 'rb')
+        try:
+            lobject.seek(0, 2)
+            return lobject.tell()
+        finally:
+            lobject.close()
+
+    def delete(self, key):
+        self.dbapi_connection().lobject(key, 'rb').unlink()
+        mark_changed(self.registry.session)
+
+    def read_range(self, connection, key, start, stop):
+        """Return the chunks between ``start`` and ``stop``
+
+        :param connection: SQLAlchemy connection, see ``stream_connection``
+        """
+        lobject = connection.connection.lobject(key, 'rb')
+        try:
+            lobject.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                data = lobject.read(min(self.chunk_size, remaining))
+                if not data:
+                    break
+
+                remaining -= len(data)
+                yield data
+        finally:
+            lobject.close()
+
+
+class ChunkedStorage:
+    """Store the files by chunks in the table of a model, the key is an
+    uuid. The model must have the columns ``key`` (String), ``position``
+    (Integer) and ``data`` (LargeBinary)::
+
+        @register(Model)
+        class Attachment:
+            key = String(primary_key=True)
+            position = Integer(primary_key=True)
+            data = LargeBinary()
+
+    :param registry: AnyBlok registry
+    :param model: name of the model, ``Model.Attachment``
+    :param chunk_size: size of the chunks, must not change once a file is
+        stored
+    """
+
+    def __init__(self, registry, model, chunk_size=CHUNK_SIZE):
+        self.registry = registry
+        self.table = registry.get(model).__table__
+        self.chunk_size = chunk_size
+
+    def write(self, fp):
+        """Write the file by chunks, without keeping them in the session
+
+        :param fp: file to store
+        :rtype: str, key of the file
+        """
+        key = uuid4().hex
+        insert = self.table.insert()
+        session = self.registry.session
+        for position, data in enumerate(iter_file(fp, self.chunk_size)):
+            session.execute(insert.values(key=key, position=position,
+                                          data=data))
+
+        mark_changed(session)
+        return key
+
+    def size(self, key):
+        query = select([func.sum(func.length(self.table.c.data))]).where(
+            self.table.c.key == key)
+        return self.registry.session.execute(query).scalar() or 0
+
+    def delete(self, key):
+        self.registry.session.execute(
+            self.table.delete().where(self.table.c.key == key))
+        mark_changed(self.registry.session)
+
+    def read_range(self, connection, key, start, stop):
+        """Return the chunks between ``start`` and ``stop``, one query by
+        chunk
+
+        :param connection: SQLAlchemy connection, see ``stream_connection``
+        """
+        position = start // self.chunk_size
+        offset = start - position * self.chunk_size
+        remaining = stop - start
+        columns = self.table.c
+        while remaining > 0:
+            query = select([columns.data]).where(columns.key == key).where(
+                columns.position == position)
+            data = connection.execute(query).scalar()
+            if not data:
+                break
+
+            data = bytes(data[offset:offset + remaining])
+            remaining -= len(data)
+            position += 1
+            offset = 0
+            yield data
+
+
+def iter_stored_file(storage, key, start, stop):
+    with stream_connection(storage.registry) as connection:
+        for data in storage.read_range(connection, key, start, stop):
+            yield data
+
+
+class StoredFileResponse(Response):
+    """Stream a file of a storage, the file is read by chunks when the
+    response is sent, with the range and the conditional requests
+
+    :param storage: ``LargeObjectStorage`` or ``ChunkedStorage``
+    :param key: key of the file in the storage
+    :param request: Pyramid request
+    :param size: size of the file, by default asked to the storage
+    :param content_type: content type of the file
+    :param filename: name of the file for the Content-Disposition
+    """
+
+    def __init__(self, storage, key, request=None, size=None,
+                 content_type=None, filename=None):
+        super(StoredFileResponse, self).__init__(
+            conditional_response=True,
+            content_type=content_type or 'application/octet-stream')
+        if size is None:
+            size = storage.size(key)
+
+        self.storage = storage
+        self.key = key
+        self.app_iter = iter_stored_file(storage, key, 0, size)
+        self.content_length = size
+        self.accept_ranges = 'bytes'
+        # the stored files are never modified
+        self.etag = '%s-%x' % (key, size)
+        if filename:
+            self.content_disposition = 'attachment; filename="%s"' % (
+                filename.replace('"', ''))
+
+    def app_iter_range(self, start, stop):
+        self.app_iter.close()
+        return iter_stored_file(self.storage, self.key, start, stop)
@@ -33,11 +33,33 @@ with open(
 console_scripts = [
     'anyblok_pyramid=anyblok_pyramid.scripts:wsgi',
     'gunicorn_anyblok_pyramid=anyblok_pyramid.scripts:gunicorn_wsgi',
+    'anyblok_pyramid_benchmark=anyblok_pyramid.scripts:benchmark',
+    'anyblok_pyramid_replay=anyblok_pyramid.scripts:replay',
+    'anyblok_pyramid_static=anyblok_pyramid.scripts:static',
+    'anyblok_pyramid_reload=anyblok_pyramid.scripts:rolling_reload',
+    'anyblok_pyramid_tasks=anyblok_pyramid.scripts:tasks',
+    'anyblok_pyramid_outbox=anyblok_pyramid.scripts:outbox',
 ]
 
 anyblok_pyramid_includeme = [
     'pyramid_tm=anyblok_pyramid.pyramid_config:pyramid_tm',
     'static_paths=anyblok_pyramid.pyramid_config:static_paths',
+    'memory_debug=anyblok_pyramid.memory:memory_debug',
+    'static_assets=anyblok_pyramid.static:static_assets',
+    'response_cache=anyblok_pyramid.cache:response_cache',
+    'etag=anyblok_pyramid.etag:etag',
+    'reference_cache=anyblok_pyramid.reference:reference_cache',
+    'admission=anyblok_pyramid.admission:admission',
+    'metrics=anyblok_pyramid.metrics:metrics',
+    'timeout=anyblok_pyramid.timeout:timeout',
+    'replica=anyblok_pyramid.replica:replica',
+    'pool=anyblok_pyramid.pool:pool',
+    'batch=anyblok_pyramid.batch:batch',
+    'tasks=anyblok_pyramid.tasks:tasks',
+    'outbox=anyblok_pyramid.outbox:outbox',
+    'idempotency=anyblok_pyramid.idempotency:idempotency',
+    'coalesce=anyblok_pyramid.coalesce:coalesce',
+    'tenant=anyblok_pyramid.tenant:tenant',
 ]
 anyblok_init = [
     'anyblok_pyramid_config=anyblok_pyramid:anyblok_init_config',
@@ -78,6 +100,13 @@ setup(
         ],
         'anyblok_pyramid.includeme': anyblok_pyramid_includeme,
         'anyblok.init': anyblok_init,
+        'bloks': [
+            'pyramid-task=anyblok_pyramid.bloks.pyramid_task:PyramidTaskBlok',
+            'pyramid-outbox=anyblok_pyramid.bloks.pyramid_outbox:'
+            'PyramidOutboxBlok',
+            'pyramid-idempotency=anyblok_pyramid.bloks.pyramid_idempotency:'
+            'PyramidIdempotencyBlok',
+        ],
         'test_bloks': [
             'test-pyramid-blok1=anyblok_pyramid.test_bloks.test_pyramid_blok1:'
             'TestPyramidBlok',